@@ -0,0 +1,140 @@
+import os
+import html
+import logging
+import sqlite3
+import time
+from datetime import datetime
+
+import metrics
+import outbox
+from database import acquire_connection, release_connection
+from storage import storage
+
+# Сводка уведомлений администратору. События (новая подписка, продление, отмена, неудачный
+# платеж, удаление из канала) не отправляются по одному, а накапливаются в таблице
+# admin_events в той же транзакции, что и изменение состояния. Раз в ADMIN_DIGEST_WINDOW
+# секунд или при накоплении ADMIN_DIGEST_MAX_EVENTS событий они заменяются одним сообщением
+# в outbox: количество по видам событий и последние события каждого вида.
+# Срочные события (critical, а также виды из ADMIN_IMMEDIATE_CATEGORIES) отправляются сразу.
+
+# Окно накопления событий в секундах (0 - отправлять каждое событие сразу, как раньше)
+ADMIN_DIGEST_WINDOW = float(os.getenv("ADMIN_DIGEST_WINDOW", "300"))
+# При таком числе накопленных событий сводка отправляется, не дожидаясь конца окна
+ADMIN_DIGEST_MAX_EVENTS = int(os.getenv("ADMIN_DIGEST_MAX_EVENTS", "100"))
+# Сколько последних событий каждого вида показывать в сводке
+ADMIN_DIGEST_TOP = int(os.getenv("ADMIN_DIGEST_TOP", "5"))
+# Виды событий, которые отправляются сразу (через запятую, например: payment_failed,removed)
+ADMIN_IMMEDIATE_CATEGORIES = {
+    category.strip() for category in os.getenv("ADMIN_IMMEDIATE_CATEGORIES", "").split(",") if category.strip()
+}
+# Как часто проверять, не пора ли отправить сводку
+ADMIN_DIGEST_CHECK_INTERVAL = 5
+
+# Заголовки видов событий в порядке вывода
+CATEGORY_TITLES = {
+    "new_subscription": "🎉 Новые подписки",
+    "renewal": "🔄 Автопродления",
+    "cancellation": "🔔 Отмены подписки",
+    "payment_failed": "❌ Неудачные платежи",
+    "removed": "🚪 Удалены из канала",
+    "import": "📥 Импорт событий",
+}
+
+logger = logging.getLogger("admin_digest")
+
+admin_notifications = metrics.counter(
+    "admin_notifications_total", "События для администратора (по виду и способу доставки: digest, immediate)"
+)
+admin_digests = metrics.counter("admin_digests_total", "Отправленные сводки для администратора")
+
+def is_buffered(category: str = None, critical: bool = False) -> bool:
+    """Попадает ли событие в сводку (иначе отправляется отдельным сообщением)"""
+    return (
+        ADMIN_DIGEST_WINDOW > 0 and not critical and category is not None
+        and category not in ADMIN_IMMEDIATE_CATEGORIES
+    )
+
+def add_event(category: str, summary: str, conn: sqlite3.Connection = None, dedup_key: str = None) -> bool:
+    """
+    Добавляет событие в сводку. summary - одна строка без разметки. Если передано
+    соединение conn, запись становится частью его текущей транзакции (conn PostgreSQL - см. outbox.enqueue).
+    """
+    if conn is not None and not isinstance(conn, sqlite3.Connection):
+        admin_notifications.inc(category=category, delivery="digest")
+        return storage.stage(conn, "admin_events", (dedup_key, category, summary, time.time()))
+    own_connection = conn is None
+    if own_connection:
+        conn = acquire_connection()
+    try:
+        cursor = conn.execute(
+            'INSERT OR IGNORE INTO admin_events (dedup_key, category, summary, created_at) VALUES (?, ?, ?, ?)',
+            (dedup_key, category, summary, time.time())
+        )
+        if own_connection:
+            conn.commit()
+    finally:
+        if own_connection:
+            release_connection(conn)
+    admin_notifications.inc(category=category, delivery="digest")
+    return cursor.rowcount > 0
+
+def _format_time(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).strftime("%d.%m %H:%M")
+
+def build_digest(events: list) -> str:
+    """Текст сводки по событиям (category, summary, created_at) в порядке их появления"""
+    by_category = {}
+    for category, summary, created_at in events:
+        by_category.setdefault(category, []).append(summary)
+    # Сначала известные виды в заданном порядке, затем прочие
+    categories = [c for c in CATEGORY_TITLES if c in by_category]
+    categories += sorted(c for c in by_category if c not in CATEGORY_TITLES)
+
+    lines = [
+        f"📋 <b>Сводка событий</b> ({_format_time(events[0][2])} - {_format_time(events[-1][2])})",
+        "",
+    ]
+    for category in categories:
+        lines.append(f"{CATEGORY_TITLES.get(category, html.escape(category))}: <b>{len(by_category[category])}</b>")
+    for category in categories:
+        summaries = by_category[category]
+        lines.append("")
+        lines.append(f"<b>{CATEGORY_TITLES.get(category, html.escape(category))}</b>")
+        # Показываем последние события, остальные только считаем
+        for summary in summaries[-ADMIN_DIGEST_TOP:]:
+            lines.append(f"• {html.escape(summary)}")
+        if len(summaries) > ADMIN_DIGEST_TOP:
+            lines.append(f"… и еще {len(summaries) - ADMIN_DIGEST_TOP}")
+    return "\n".join(lines)
+
+def flush_digest(admin_id, force: bool = False) -> int:
+    """
+    Заменяет накопленные события одной сводкой в outbox, если окно истекло или событий
+    набралось ADMIN_DIGEST_MAX_EVENTS (force - отправить сразу). Возвращает число событий
+    в сводке. Удаление событий и запись сводки - одна транзакция, поэтому при нескольких
+    процессах событие не попадет в две сводки и не потеряется.
+    """
+    conn = acquire_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        count, oldest = conn.execute('SELECT COUNT(*), MIN(created_at) FROM admin_events').fetchone()
+        if not count:
+            return 0
+        if not force and count < ADMIN_DIGEST_MAX_EVENTS and oldest > time.time() - ADMIN_DIGEST_WINDOW:
+            return 0
+        rows = conn.execute(
+            'SELECT id, category, summary, created_at FROM admin_events ORDER BY id'
+        ).fetchall()
+        first_id, last_id = rows[0][0], rows[-1][0]
+        outbox.enqueue_message(
+            admin_id, build_digest([row[1:] for row in rows]), conn,
+            f"admin_digest:{first_id}-{last_id}", parse_mode="HTML"
+        )
+        conn.execute('DELETE FROM admin_events WHERE id <= ?', (last_id,))
+        conn.commit()
+    finally:
+        release_connection(conn)
+    admin_digests.inc()
+    outbox.sender.wake()
+    logger.info(f"Сводка для администратора поставлена в очередь: событий {len(rows)}")
+    return len(rows)
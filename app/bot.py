@@ -1,80 +1,61 @@
 import os
 import logging
-import sqlite3
 import requests
-import telebot
 from telebot import types, apihelper
 import threading
 import time
-from pathlib import Path
+import functools
+import html
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-import json
-
-# Настройка логирования
-DATA_DIR = Path("/mount/database")
-DATA_DIR.mkdir(exist_ok=True)
-
-log_file = DATA_DIR / f"log_{time.strftime('%Y%m%d')}.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()
-    ]
+
+from database import ensure_schema
+from scheduler import scheduler, IntervalTrigger, parse_trigger, get_job_states
+from leader import get_leases
+from reconciliation import reconcile_expiring_members
+from invite_pool import refill_invite_pool, revoke_stale_invite_links
+import outbox
+from outbox import enqueue_message
+from admin_digest import ADMIN_DIGEST_CHECK_INTERVAL
+from group_commit import SHARD_RELAY_INTERVAL
+from storage import storage
+import metrics
+from logging_setup import configure_logging
+from telegram_client import bot
+from subscriptions import (
+    CHANNEL_ID, ADMIN_ID, SUPPORT_USERNAME, CHANNEL_LINK, JOIN_REQUEST_MODE, PERIOD_DAYS, GRACE_PERIOD_DAYS,
+    get_periodicity_by_amount, get_available_subscriptions, create_payment_link,
+    cancel_subscription, check_subscription_status, remove_user_from_channel,
+    notify_admin, flush_admin_digest, show_main_menu
 )
+
 logger = logging.getLogger("payment_bot")
 logging.getLogger("payment_bot").setLevel(logging.DEBUG)
 # Получение настроек из переменных окружения
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-LAVA_API_KEY = os.getenv("LAVA_API_KEY")
-CHANNEL_ID = os.getenv("CHANNEL_ID")
-ADMIN_ID = os.getenv("ADMIN_ID")
-DB_PATH = DATA_DIR / "lava_payments.db"
-SUPPORT_USERNAME = os.getenv("SUPPORT_USERNAME", "support")  # Имя пользователя техподдержки в Telegram
-CHANNEL_LINK = os.getenv("CHANNEL_LINK", "")  # Постоянная ссылка на канал
 USERNAME = os.getenv("WEBHOOK_USERNAME", "admin")
 PASSWORD = os.getenv("WEBHOOK_PASSWORD", "password")
 
-# Цены из переменных окружения
-PRICE_MONTHLY = float(os.getenv("PRICE_MONTHLY", "500"))
-PRICE_3_MONTHS = float(os.getenv("PRICE_3_MONTHS", "1200"))
-PRICE_6_MONTHS = float(os.getenv("PRICE_6_MONTHS", "2000"))
-PRICE_YEARLY = float(os.getenv("PRICE_YEARLY", "3850"))
-
-# Словарь соответствия цен и периодичности
-PRICE_PERIODICITY = {
-    PRICE_MONTHLY: "MONTHLY",
-    PRICE_3_MONTHS: "PERIOD_90_DAYS", 
-    PRICE_6_MONTHS: "PERIOD_180_DAYS",
-    PRICE_YEARLY: "PERIOD_YEAR"
-}
+# Сколько секунд повторный выбор того же тарифа возвращает уже выставленный счет (0 - не кэшировать)
+INVOICE_CACHE_TTL = int(os.getenv("INVOICE_CACHE_TTL", "900"))
+# Предварительное создание счета: при выборе периода счет в валюте по умолчанию
+# создается в фоне, пока пользователь выбирает способ оплаты (работает через кэш счетов)
+INVOICE_PREFETCH = os.getenv("INVOICE_PREFETCH", "false").lower() in ("1", "true", "yes")
+INVOICE_PREFETCH_CURRENCY = os.getenv("INVOICE_PREFETCH_CURRENCY", "RUB")
+INVOICE_PREFETCH_WORKERS = int(os.getenv("INVOICE_PREFETCH_WORKERS", "2"))
+# Сколько предварительно созданных, но еще не востребованных счетов может быть одновременно
+INVOICE_PREFETCH_MAX_PENDING = int(os.getenv("INVOICE_PREFETCH_MAX_PENDING", "50"))
+INVOICE_PREFETCH_MAX_PER_USER = int(os.getenv("INVOICE_PREFETCH_MAX_PER_USER", "2"))
+# Сколько нажатий inline-кнопок обрабатывается одновременно (медленная часть - запросы к Lava)
+CALLBACK_WORKERS = int(os.getenv("CALLBACK_WORKERS", "8"))
 
-# Словарь дней для каждого периода
-PERIOD_DAYS = {
-    "MONTHLY": 30,
-    "PERIOD_90_DAYS": 90,
-    "PERIOD_180_DAYS": 180,
-    "PERIOD_YEAR": 365
-}
+# Расписание проверки подписок: интервал в секундах или выражение cron (UTC)
+SUBSCRIPTION_CHECK_SCHEDULE = os.getenv("SUBSCRIPTION_CHECK_SCHEDULE", "3600")
+# Аренда, под которой выполняются фоновые задачи бота (см. leader.py)
+BOT_JOBS_LEASE = "bot_jobs"
 
-# Функция для определения периодичности по стоимости
-
-def get_periodicity_by_amount(amount: float) -> str:
-    """
-    Определяет периодичность подписки по стоимости
-    """
-    # Ищем точное совпадение цены
-    if amount in PRICE_PERIODICITY:
-        return PRICE_PERIODICITY[amount]
-    # Если точного совпадения нет, ищем ближайшую цену
-    closest_price = min(PRICE_PERIODICITY.keys(), key=lambda x: abs(x - amount))
-    price_difference = abs(closest_price - amount)
-    if price_difference <= closest_price * 0.1:
-        logger.info(f"Цена {amount} близка к {closest_price}, используем периодичность {PRICE_PERIODICITY[closest_price]}")
-        return PRICE_PERIODICITY[closest_price]
-    logger.warning(f"Не удалось определить периодичность для цены {amount}, используем MONTHLY")
-    return "MONTHLY"
+# Устанавливается при остановке сервиса: бот не перезапускается после ошибки
+shutdown_event = threading.Event()
 
 # В начале файла, где определяются другие константы
 default_message = """Добро пожаловать в канал с бурятскими мультфильмами и сериалами.
@@ -98,426 +79,118 @@ CURRENCY_TRANSLATIONS = {
 }
 
 # Добавляем константы для настройки уведомлений
-GRACE_PERIOD_DAYS = 3  # Дней отсрочки после окончания подписки
 NOTIFY_BEFORE_DAYS = [7, 3, 1]  # За сколько дней уведомлять об окончании подписки
 
-# Инициализация бота
-bot = telebot.TeleBot(BOT_TOKEN)
+# Кэш доступа к каналу для мгновенного решения по заявкам: user_id -> дата окончания подписки
+member_access_cache = {}
+member_access_cache_lock = threading.Lock()
 
-
-# Функция для получения списка доступных подписок
-def get_available_subscriptions():
-    url = "https://gate.lava.top/api/v2/products"
-    params = {
-        "contentCategories": "PRODUCT",
-        "feedVisibility": "ONLY_VISIBLE",
-        "showAllSubscriptionPeriods": "true"
-    }
-    headers = {
-        "X-Api-Key": LAVA_API_KEY
-    }
-    
+def parse_end_date(end_date_str):
     try:
-        response = requests.get(url, params=params, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        
-        subscriptions = []
-        for item in data.get("items", []):
-            if item.get("type") == "SUBSCRIPTION":
-                for offer in item.get("offers", []):
-                    # Группируем цены по периодичности
-                    prices_by_period = {}
-                    for price in offer["prices"]:
-                        if price["periodicity"] not in prices_by_period:
-                            prices_by_period[price["periodicity"]] = {}
-                        prices_by_period[price["periodicity"]][price["currency"]] = price["amount"]
-                    
-                    # Преобразуем в список для удобства
-                    prices = []
-                    for periodicity, currencies in prices_by_period.items():
-                        prices.append({
-                            "periodicity": periodicity,
-                            "currencies": currencies
-                        })
-                    
-                    if prices:
-                        subscriptions.append({
-                            "offer_id": offer["id"],
-                            "name": offer["name"],
-                            "description": offer["description"],
-                            "prices": prices
-                        })
-        
-        return subscriptions
-    except Exception as e:
-        logger.error(f"Ошибка при получении списка подписок: {str(e)}")
+        end_date = datetime.fromisoformat(str(end_date_str).replace('Z', '+00:00'))
+    except (ValueError, TypeError):
         return None
+    return end_date if end_date.tzinfo else end_date.replace(tzinfo=timezone.utc)
 
-# Функция для создания ссылки на оплату
-def create_payment_link(user_id, offer_id, periodicity, currency="RUB"):
-    url = "https://gate.lava.top/api/v2/invoice"
-    headers = {
-        "Content-Type": "application/json",
-        "X-Api-Key": LAVA_API_KEY
-    }
-    
-    payload = {
-        "email": f"{user_id}@t.me",
-        "offerId": offer_id,
-        "periodicity": periodicity,
-        "currency": currency,
-        "buyerLanguage": "RU",
-        "clientUtm": {}
+def refresh_member_access_cache():
+    new_cache = {
+        str(user_id): parse_end_date(end_date) for user_id, end_date in storage.access_end_dates()
     }
     
-    try:
-        logger.info(f"Создание ссылки на оплату для пользователя {user_id}")
-        logger.debug(f"URL запроса: {url}")
-        logger.debug(f"Заголовки: {headers}")
-        logger.debug(f"Тело запроса: {payload}")
-        
-        response = requests.post(url, headers=headers, json=payload)
-        logger.debug(f"Код ответа: {response.status_code}")
-        logger.debug(f"Тело ответа: {response.text}")
-        
-        response.raise_for_status()
-        response_data = response.json()
-        
-        logger.info(f"Успешно получен ответ от API: {response_data}")
-        return response_data
-        
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при отправке запроса: {str(e)}")
-        if hasattr(e, 'response') and e.response is not None:
-            logger.error(f"Код ответа: {e.response.status_code}")
-            logger.error(f"Тело ответа: {e.response.text}")
-        return None
-    except Exception as e:
-        logger.error(f"Неожиданная ошибка при создании ссылки: {str(e)}", exc_info=True)
-        return None
+    global member_access_cache
+    with member_access_cache_lock:
+        member_access_cache = new_cache
+    return len(new_cache)
+
+def has_channel_access(user_id):
+    user_id = str(user_id)
+    now = datetime.now(timezone.utc)
+    end_date = member_access_cache.get(user_id)
+    if end_date is None or end_date <= now:
+        # Оплата или продление могли прийти после последнего обновления кэша (вебхук обрабатывает
+        # другой процесс), поэтому перед отказом проверяем одну запись по первичному ключу
+        row = storage.access_end_date(user_id)
+        end_date = parse_end_date(row) if row else None
+        if end_date:
+            with member_access_cache_lock:
+                member_access_cache[user_id] = end_date
+    return bool(end_date and end_date > now)
 
-# Функция для отмены подписки
-def cancel_subscription(user_id, contract_id):
+# Обработчик заявок на вступление в канал (режим JOIN_REQUEST_MODE)
+@bot.chat_join_request_handler(func=lambda request: str(request.chat.id) == str(CHANNEL_ID))
+def channel_join_request_handler(request):
+    user_id = request.from_user.id
     try:
-        url = "https://gate.lava.top/api/v1/subscriptions"
-        headers = {
-            "Content-Type": "application/json",
-            "X-Api-Key": LAVA_API_KEY
-        }
-        
-        # Добавляем параметры в URL для DELETE запроса
-        params = {
-            "contractId": contract_id,
-            "email": f"{user_id}@t.me"
-        }
-        
-        logger.info(f"Отправка запроса на отмену подписки:")
-        logger.info(f"URL: {url}")
-        logger.info(f"Headers: {headers}")
-        logger.info(f"Params: {params}")
-        
-        response = requests.delete(url, headers=headers, params=params)
-        
-        logger.info(f"Ответ от LAVA.TOP:")
-        logger.info(f"Статус: {response.status_code}")
-        logger.info(f"Тело ответа: {response.text}")
-        logger.info(f"Заголовки: {response.headers}")
-        
-        # Проверяем оба кода успешного ответа: 200 и 204
-        if response.status_code in [200, 204]:
-            logger.info(f"Подписка успешно отменена для пользователя {user_id}")
-            
-            # Обновляем статус в БД, но сохраняем дату окончания
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute('''
-            UPDATE channel_members 
-            SET status = 'cancelled' 
-            WHERE user_id = ? AND status = 'active'
-            ''', (user_id,))
-            conn.commit()
-            conn.close()
-            
-            return True, "✅ Автопродление подписки отключено."
+        if has_channel_access(user_id):
+            bot.approve_chat_join_request(request.chat.id, user_id)
+            logger.info(f"Заявка пользователя {user_id} на вступление в канал одобрена")
         else:
-            # Парсим тело ответа, чтобы проверить конкретную ошибку
+            bot.decline_chat_join_request(request.chat.id, user_id)
+            logger.info(f"Заявка пользователя {user_id} на вступление в канал отклонена: нет активной подписки")
             try:
-                error_response = response.json()
-                error_message = error_response.get("error", "")
-                if "Subscription cancelling error (have been already cancelled or not a subscription)" in error_message:
-                    logger.info(f"Подписка для пользователя {user_id} уже была отменена или не является подпиской. Обновляем статус в БД на 'cancelled'.")
-                    
-                    conn = sqlite3.connect(DB_PATH)
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                    UPDATE channel_members 
-                    SET status = 'cancelled' 
-                    WHERE user_id = ? AND status = 'active'
-                    ''', (user_id,))
-                    conn.commit()
-                    conn.close()
-                    return True, "⚠️ Ваша подписка уже была отменена ранее." 
-            except json.JSONDecodeError:
-                pass # Не удалось распарсить JSON, обрабатываем как обычную ошибку
-
-            logger.error(f"Ошибка при отмене подписки: код {response.status_code}, ответ: {response.text}")
-            return False, f"❌ Произошла ошибка при отмене подписки: {response.text}. Попробуйте позже или обратитесь в поддержку."
-            
+                bot.send_message(
+                    user_id,
+                    "❌ У вас нет активной подписки.\n\n"
+                    "Оформите подписку через /subscribe, чтобы получить доступ к закрытому каналу."
+                )
+            except Exception as e:
+                logger.warning(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
     except Exception as e:
-        logger.error(f"Ошибка при отмене подписки: {str(e)}")
-        return False, f"❌ Произошла ошибка при отмене подписки: {str(e)}. Попробуйте позже или обратитесь в поддержку."
+        logger.error(f"Ошибка при обработке заявки пользователя {user_id} на вступление в канал: {str(e)}")
 
-# Функция для проверки статуса подписки пользователя
-def check_subscription_status(user_id):
-    conn = None  # Инициализируем conn вне try-блока
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Сначала проверяем статус в channel_members
-        cursor.execute('''
-        SELECT cm.status, cm.subscription_end_date, cm.last_payment_id,
-               p.contract_id, p.parent_contract_id
-        FROM channel_members cm
-        LEFT JOIN payments p ON p.id = cm.last_payment_id
-        WHERE cm.user_id = ?
-        ''', (user_id,))
-        
-        member = cursor.fetchone()
-        
-        if member:
-            status, end_date_str, last_payment_id, contract_id, parent_contract_id = member
-            
-            if status == 'removed':
-                return {"status": "removed", "end_date": end_date_str, "contract_id": parent_contract_id or contract_id}
-            
-            if status == 'cancelled':
-                return {"status": "cancelled", "end_date": end_date_str, "contract_id": parent_contract_id or contract_id}
+# Конвейер обработки нажатий inline-кнопок: Telegram получает ответ на callback сразу,
+# сообщение переводится в состояние "готовим...", а запросы к Lava выполняются в отдельном пуле
+callback_executor = ThreadPoolExecutor(max_workers=CALLBACK_WORKERS, thread_name_prefix="callback")
+callback_first_response = metrics.histogram(
+    "callback_first_response_seconds", "Время от получения callback до первого ответа пользователю"
+)
+callback_final_response = metrics.histogram(
+    "callback_final_response_seconds", "Время от получения callback до окончательного ответа"
+)
 
-            # Проверяем, не истекла ли подписка, обрабатывая возможные ошибки даты
-            if end_date_str:
-                try:
-                    end_date = datetime.fromisoformat(end_date_str.replace('Z', '+00:00'))
-                    if end_date > datetime.now(timezone.utc):
-                        return {
-                            "status": status,  # Возвращаем фактический статус (active или cancelled)
-                            "end_date": end_date_str,
-                            "contract_id": parent_contract_id or contract_id
-                        }
-                except ValueError as ve:
-                    logger.error(f"Ошибка формата даты в check_subscription_status (member): {end_date_str} - {ve}")
-                except Exception as e:
-                    logger.error(f"Неожиданная ошибка при парсинге даты в check_subscription_status (member): {end_date_str} - {e}")
-        
-        # Если нет активной записи в channel_members или она истекла, проверяем последний платеж
-        cursor.execute('''
-        SELECT p.status, p.timestamp, p.event_type, cm.subscription_end_date,
-               p.contract_id, p.parent_contract_id, p.amount
-        FROM payments p
-        LEFT JOIN channel_members cm ON cm.last_payment_id = p.id
-        WHERE p.buyer_email = ?
-        AND p.event_type IN ('payment.success', 'subscription.recurring.payment.success')
-        ORDER BY p.timestamp DESC
-        LIMIT 1
-        ''', (f"{user_id}@t.me",))
-        
-        payment = cursor.fetchone()
-        
-        if payment:
-            status, timestamp_str, event_type, end_date_str_from_payment, contract_id, parent_contract_id, amount = payment
+def callback_pipeline(name, preparing_text=None):
+    """
+    Декоратор обработчика callback. preparing_text - текст промежуточного состояния
+    (строка или функция от call, возвращающая строку или None).
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(call):
+            received_at = time.monotonic()
+            try:
+                bot.answer_callback_query(call.id)
+            except Exception as e:
+                logger.warning(f"Не удалось ответить на callback {call.data}: {e}")
             
-            # Если end_date_str_from_payment пуст, рассчитываем его на основе amount
-            if not end_date_str_from_payment and timestamp_str and amount is not None:
-                try:
-                    periodicity = get_periodicity_by_amount(amount)
-                    days = PERIOD_DAYS.get(periodicity, 30)
-                    start_date = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-                    end_date_calculated = (start_date + timedelta(days=days)).isoformat()
-                    end_date_str_from_payment = end_date_calculated
-                    logger.info(f"Рассчитана дата окончания подписки для {user_id} по последнему платежу: {end_date_calculated}")
-                except Exception as e:
-                    logger.error(f"Ошибка при расчете даты окончания по amount для {user_id}: {e}")
-                    end_date_str_from_payment = None # Очищаем, чтобы не использовать некорректную дату
-
-            is_active = False
-            if end_date_str_from_payment:
+            text = preparing_text(call) if callable(preparing_text) else preparing_text
+            if text:
                 try:
-                    end_date = datetime.fromisoformat(end_date_str_from_payment.replace('Z', '+00:00'))
-                    if end_date > datetime.now(timezone.utc):
-                        is_active = True
-                except ValueError as ve:
-                    logger.error(f"Ошибка формата даты в check_subscription_status (payment): {end_date_str_from_payment} - {ve}")
+                    # Убираем кнопки, чтобы пользователь не нажимал повторно, пока идет обработка
+                    bot.edit_message_text(text, call.message.chat.id, call.message.message_id)
                 except Exception as e:
-                    logger.error(f"Неожиданная ошибка при парсинге даты в check_subscription_status (payment): {end_date_str_from_payment} - {e}")
+                    logger.debug(f"Не удалось показать промежуточное состояние для {call.data}: {e}")
+            callback_first_response.observe(time.monotonic() - received_at, handler=name)
             
-            return {
-                "status": "active" if is_active else "inactive",
-                "end_date": end_date_str_from_payment,
-                "contract_id": parent_contract_id or contract_id
-            }
-        
-        return {"status": "no_subscription"}
-        
-    except sqlite3.Error as sqle:
-        logger.error(f"Ошибка SQLite при проверке статуса подписки для {user_id}: {sqle}")
-        return {"status": "error", "error": f"Ошибка базы данных: {sqle}"}
-    except Exception as e:
-        logger.error(f"Неожиданная ошибка при проверке статуса подписки для {user_id}: {str(e)}", exc_info=True)
-        return {"status": "error", "error": f"Неизвестная ошибка: {e}"}
-    finally:
-        if conn:
-            conn.close()
-
-# Функция для добавления пользователя в закрытый канал
-def add_user_to_channel(user_id):
-    try:
-        # Создаем ссылку-приглашение в канал
-        invite_link = bot.create_chat_invite_link(
-            chat_id=CHANNEL_ID,
-            member_limit=1,
-            expire_date=int(time.time()) + 2592000
-        )
-        # Проверяем, есть ли уже запись в channel_members
-        # Дата окончания подписки должна быть установлена в main.py перед вызовом этой функции
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT subscription_end_date, last_payment_id
-        FROM channel_members 
-        WHERE user_id = ?
-        ''', (user_id,))
-        existing_member = cursor.fetchone()
-        
-        if existing_member:
-            logger.info(f"Пользователь {user_id} уже имеет запись в channel_members с датой окончания: {existing_member[0]}")
-        else:
-            # Fallback: если записи нет (не должно происходить при нормальной работе),
-            # получаем информацию о последнем платеже и рассчитываем дату
-            logger.warning(f"Запись channel_members для пользователя {user_id} не найдена, создаем fallback запись")
-            cursor.execute('''
-            SELECT id, timestamp, raw_data, amount
-            FROM payments 
-            WHERE buyer_email = ? 
-              AND event_type IN ('payment.success', 'subscription.recurring.payment.success')
-            ORDER BY timestamp DESC
-            LIMIT 1
-            ''', (f"{user_id}@t.me",))
-            payment = cursor.fetchone()
-            if payment:
-                payment_id, timestamp, raw_data, amount = payment
-                # Определяем периодичность по стоимости
-                periodicity = get_periodicity_by_amount(amount)
-                days = PERIOD_DAYS.get(periodicity, 30)
+            def run():
                 try:
-                    # Используем timestamp из платежа (не идеально, но лучше чем ничего)
-                    end_date = (datetime.fromisoformat(timestamp.replace('Z', '+00:00')) + 
-                               timedelta(days=days)).isoformat()
-                    logger.warning(f"Fallback расчет даты для {user_id}: стоимость {amount}, периодичность {periodicity}, дней {days}, окончание {end_date}")
+                    handler(call)
                 except Exception as e:
-                    logger.error(f"Ошибка при расчете даты окончания подписки: {str(e)}")
-                    end_date = (datetime.fromisoformat(timestamp.replace('Z', '+00:00')) + timedelta(days=30)).isoformat()
-                # Добавляем запись в channel_members
-                current_time = datetime.now(timezone.utc).isoformat()
-                cursor.execute('''
-                INSERT INTO channel_members 
-                (user_id, status, joined_at, subscription_end_date, last_payment_id)
-                VALUES (?, 'active', ?, ?, ?)
-                ''', (user_id, current_time, end_date, payment_id))
-                conn.commit()
-        conn.close()
-        # Отправляем сообщение с кнопкой для входа в канал
-        channel_markup = types.InlineKeyboardMarkup(row_width=1)
-        channel_button = types.InlineKeyboardButton('📺 Войти в канал', url=invite_link.invite_link)
-        channel_markup.add(channel_button)
-        bot.send_message(
-            user_id,
-            f"Поздравляем! Вы успешно оформили подписку. Вот ваша ссылка для доступа к закрытому каналу: {invite_link.invite_link}",
-            reply_markup=channel_markup
-        )        
-        # Отправляем пользователю ссылку на канал
-        welcome_message = bot.send_message(
-            user_id,
-            f"⠀⠀⠀⠀⠀Меню подписчика⠀⠀⠀⠀⠀",
-            disable_web_page_preview=False
-        )
-        # Показываем главное меню
-        show_main_menu(welcome_message)
-        logger.info(f"Пользователь {user_id} добавлен в закрытый канал")
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка при добавлении пользователя {user_id} в канал: {str(e)}")
-        return False
-
-# Обновляем функцию remove_user_from_channel
-def remove_user_from_channel(user_id):
-    try:
-        logger.info(f"Попытка удаления пользователя {user_id} из канала {CHANNEL_ID}")
-        
-        # Проверяем права бота в канале
-        try:
-            bot_member = bot.get_chat_member(CHANNEL_ID, bot.get_me().id)
-            logger.debug(f"Права бота в канале: {bot_member.status}")
-            if bot_member.status != 'administrator':
-                logger.error(f"Бот не является администратором канала {CHANNEL_ID}")
-                return False
-        except Exception as e:
-            logger.error(f"Ошибка при проверке прав бота в канале {CHANNEL_ID}: {e}")
-            return False
-        
-        # Проверяем текущий статус пользователя
-        try:
-            current_status = bot.get_chat_member(CHANNEL_ID, user_id)
-            logger.debug(f"Текущий статус пользователя {user_id} в канале: {current_status.status}")
+                    logger.error(f"Необработанная ошибка в обработчике {name}: {str(e)}", exc_info=True)
+                finally:
+                    callback_final_response.observe(time.monotonic() - received_at, handler=name)
             
-            # Если пользователь уже не в канале, считаем операцию успешной
-            if current_status.status in ['left', 'kicked']:
-                logger.info(f"Пользователь {user_id} уже не в канале (статус: {current_status.status})")
-                return True
-        except Exception as e:
-            # Если не удалось получить статус, возможно пользователь уже удален
-            logger.warning(f"Не удалось получить статус пользователя {user_id} в канале: {e}")
-            # Продолжаем попытку удаления
-        
-        # Пытаемся удалить пользователя
-        try:
-            result = bot.ban_chat_member(CHANNEL_ID, user_id)
-            logger.info(f"Результат бана пользователя {user_id}: {result}")
-        except Exception as e:
-            logger.error(f"Ошибка при бане пользователя {user_id}: {e}")
-            return False
-        
-        # Сразу разбаниваем, чтобы пользователь мог вернуться после оплаты
-        try:
-            bot.unban_chat_member(CHANNEL_ID, user_id)
-            logger.info(f"Пользователь {user_id} разбанен для возможности повторного входа")
-        except Exception as e:
-            logger.warning(f"Не удалось разбанить пользователя {user_id}: {e}")
-            # Это не критично, продолжаем
-        
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка при удалении пользователя {user_id} из канала: {str(e)}", exc_info=True)
-        return False
-
-# Функция для отправки уведомления администратору
-def notify_admin(message):
-    if not ADMIN_ID:
-        logger.warning("ID администратора не указан. Уведомление не отправлено.")
-        return False
-    
-    try:
-        bot.send_message(
-            ADMIN_ID,
-            message,
-            parse_mode="HTML"
-        )
-        logger.info(f"Уведомление отправлено администратору: {message[:50]}...")
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка при отправке уведомления администратору: {str(e)}")
-        return False
+            callback_executor.submit(run)
+        return wrapper
+    return decorator
 
+def show_callback_error(call, text):
+    """Заменяет сообщение с кнопками (или промежуточное состояние) текстом ошибки"""
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton('🔙 Главное меню', callback_data='show_menu'))
+    try:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    except Exception:
+        bot.send_message(call.message.chat.id, text, reply_markup=markup)
 
 # Функция для показа меню выбора периода подписки
 def show_subscription_menu(message):
@@ -588,57 +261,9 @@ def show_subscription_menu(message):
                 parse_mode="HTML"
             )
 
-# Функция для показа главного меню
-def show_main_menu(message):
-    markup = types.InlineKeyboardMarkup(row_width=1)
-    
-    # Проверяем статус подписки для определения доступных кнопок
-    subscription = check_subscription_status(message.chat.id)
-    
-    # Общие кнопки
-    btn_about = types.InlineKeyboardButton('🔍 Подробнее о канале', callback_data='show_about')
-    
-    # Создаем кнопку поддержки только если SUPPORT_USERNAME задан
-    btn_support = None
-    if SUPPORT_USERNAME:
-        btn_support = types.InlineKeyboardButton('📞 Поддержка', url=f"https://t.me/{SUPPORT_USERNAME}")
-
-    if subscription["status"] in ["active", "cancelled"]:
-        # Кнопки для активной или отмененной подписки
-        btn_status = types.InlineKeyboardButton('ℹ️ Статус подписки', callback_data='show_status')
-        markup.add(btn_status)
-        
-        # Создаем кнопку перехода в канал только если CHANNEL_LINK задан
-        if CHANNEL_LINK:
-            btn_channel = types.InlineKeyboardButton('📺 Перейти в канал', url=CHANNEL_LINK)
-            markup.add(btn_channel)
-            
-        markup.add(btn_about)
-        if btn_support: # Добавляем кнопку поддержки, если она была создана
-            markup.add(btn_support)
-        
-    else:
-        # Кнопки для неактивной подписки
-        btn_subscribe = types.InlineKeyboardButton('💳 Оформить подписку', callback_data='show_subscribe')
-        btn_status = types.InlineKeyboardButton('ℹ️ Статус подписки', callback_data='show_status')
-        markup.add(btn_subscribe)
-        markup.add(btn_status)
-        markup.add(btn_about)
-        if btn_support: # Добавляем кнопку поддержки, если она была создана
-            markup.add(btn_support)
-        
-    # Отправляем меню отдельным сообщением
-    try:
-        bot.send_message( # Используем send_message для надежности
-            message.chat.id,
-            "⠀⠀⠀⠀⠀Меню подписчика⠀⠀⠀⠀⠀",
-            reply_markup=markup,
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logger.error(f"Ошибка при отправке главного меню пользователю {message.chat.id}: {str(e)}")
 # Обработчик для кнопки отмены подписки
 @bot.callback_query_handler(func=lambda call: call.data.startswith('cancel_'))
+@callback_pipeline("cancel_subscription", preparing_text="⏳ Проверяем подписку...")
 def cancel_subscription_callback(call):
     try:
         user_id = call.from_user.id
@@ -646,12 +271,8 @@ def cancel_subscription_callback(call):
 
         # Обрабатываем ошибку от check_subscription_status явно
         if subscription.get("status") == "error":
-            bot.answer_callback_query(
-                call.id,
-                f"❌ Произошла ошибка при проверке статуса подписки: {subscription.get('error', 'Неизвестная ошибка')}. Попробуйте позже."
-            )
-            bot.send_message(
-                call.message.chat.id,
+            show_callback_error(
+                call,
                 f"❌ Произошла ошибка при проверке статуса подписки: {subscription.get('error', 'Неизвестная ошибка')}. "
                 f"Пожалуйста, попробуйте позже или обратитесь в поддержку."
             )
@@ -663,12 +284,8 @@ def cancel_subscription_callback(call):
             contract_id = call.data.split('_')[1]
         except IndexError:
             logger.error(f"Некорректный формат callback_data для отмены подписки: {call.data} для user {user_id}")
-            bot.answer_callback_query(
-                call.id,
-                "❌ Некорректные данные для отмены подписки. Пожалуйста, обратитесь в поддержку."
-            )
-            bot.send_message(
-                call.message.chat.id,
+            show_callback_error(
+                call,
                 "❌ Произошла ошибка при отмене подписки. Не удалось распознать данные. Пожалуйста, обратитесь в поддержку."
             )
             return
@@ -687,12 +304,8 @@ def cancel_subscription_callback(call):
             # Проверяем наличие contract_id перед формированием кнопки подтверждения
             if not subscription.get("contract_id"):
                 logger.error(f"Не найден contract_id для отмены подписки пользователя {user_id} при запросе подтверждения.")
-                bot.answer_callback_query(
-                    call.id,
-                    "❌ Не удалось найти данные для отмены подписки. Пожалуйста, обратитесь в поддержку."
-                )
-                bot.send_message(
-                    call.message.chat.id,
+                show_callback_error(
+                    call,
                     "❌ Не удалось найти данные для отмены подписки. "
                     "Пожалуйста, попробуйте позже или обратитесь в поддержку."
                 )
@@ -724,12 +337,8 @@ def cancel_subscription_callback(call):
             # Дополнительная проверка contract_id перед вызовом cancel_subscription
             if not contract_id:
                 logger.error(f"Пустой contract_id при подтвержденной отмене для user {user_id}.")
-                bot.answer_callback_query(
-                    call.id,
-                    "❌ Не удалось отменить подписку: отсутствуют данные контракта."
-                )
-                bot.send_message(
-                    call.message.chat.id,
+                show_callback_error(
+                    call,
                     "❌ Произошла ошибка при отмене подписки: отсутствуют данные контракта. Пожалуйста, обратитесь в поддержку."
                 )
                 return
@@ -766,20 +375,15 @@ def cancel_subscription_callback(call):
                 # с актуальной датой окончания подписки (willExpireAt)
                 logger.info(f"Подписка пользователя {user_id} отменена. Ожидаем webhook от Lava.top с актуальной датой окончания.")
             else:
-                bot.answer_callback_query(
-                    call.id,
-                    message
-                )
+                show_callback_error(call, message)
     except Exception as e:
-        logger.error(f"Неожиданная ошибка при обработке отмены подписки для пользователя {user_id}: {str(e)}", exc_info=True)
-        bot.answer_callback_query(
-            call.id,
-            "❌ Произошла ошибка при отмене подписки"
-        )
+        logger.error(f"Неожиданная ошибка при обработке отмены подписки для пользователя {call.from_user.id}: {str(e)}", exc_info=True)
+        show_callback_error(call, "❌ Произошла ошибка при отмене подписки")
 
 
 # Обработчик для кнопки "Подробнее о канале"
 @bot.callback_query_handler(func=lambda call: call.data == 'show_about')
+@callback_pipeline("show_about")
 def show_about_callback(call):
     try:
         # Удаляем предыдущее сообщение с меню
@@ -825,6 +429,7 @@ def show_about_callback(call):
 
 # Обработчик для кнопки "Статус подписки"
 @bot.callback_query_handler(func=lambda call: call.data == 'show_status')
+@callback_pipeline("show_status", preparing_text="⏳ Проверяем подписку...")
 def show_status_callback(call):
     try:
         try:
@@ -916,36 +521,42 @@ def show_status_callback(call):
             reply_markup=markup
         )
 
+# Обработчик для кнопки поддержки: ответ на callback и есть результат, конвейер не нужен
+@bot.callback_query_handler(func=lambda call: call.data == 'show_support')
+def show_support_callback(call):
+    if SUPPORT_USERNAME:
+        bot.answer_callback_query(
+            call.id,
+            "Перенаправляем в чат поддержки...",
+            show_alert=False
+        )
+    else:
+        bot.answer_callback_query(
+            call.id,
+            "❌ Извините, служба поддержки временно недоступна",
+            show_alert=True
+        )
+
 # Обработчик для inline-кнопок основного меню
-@bot.callback_query_handler(func=lambda call: call.data in ['show_subscribe', 'show_status', 'show_support', 'show_menu'])
+@bot.callback_query_handler(func=lambda call: call.data in ['show_subscribe', 'show_menu'])
+@callback_pipeline(
+    "main_menu",
+    preparing_text=lambda call: "⏳ Загружаем варианты подписки..." if call.data == 'show_subscribe' else None
+)
 def process_main_menu(call):
     try:
         if call.data == 'show_subscribe':
             subscribe_command(call.message)
-        elif call.data == 'show_status':
-            show_status_callback(call)
-        elif call.data == 'show_support':
-            if SUPPORT_USERNAME:
-                bot.answer_callback_query(
-                    call.id,
-                    "Перенаправляем в чат поддержки...",
-                    show_alert=False
-                )
-            else:
-                bot.answer_callback_query(
-                    call.id,
-                    "❌ Извините, служба поддержки временно недоступна",
-                    show_alert=True
-                )
         elif call.data == 'show_menu':
             show_main_menu(call.message)
         
     except Exception as e:
         logger.error(f"Ошибка при обработке кнопки меню: {str(e)}")
-        bot.answer_callback_query(call.id, "Произошла ошибка. Попробуйте позже.")
+        show_callback_error(call, "Произошла ошибка. Попробуйте позже.")
 
 # Обработчик для выбора периода оплаты
 @bot.callback_query_handler(func=lambda call: call.data.startswith('p|'))
+@callback_pipeline("select_period", preparing_text="⏳ Загружаем способы оплаты...")
 def process_payment_callback(call):
     try:
         # Получаем ID пользователя из callback
@@ -981,6 +592,10 @@ def process_payment_callback(call):
         if not price_info:
             raise ValueError("Информация о ценах не найдена")
         
+        # Пока пользователь выбирает способ оплаты, создаем счет в валюте по умолчанию
+        if INVOICE_PREFETCH_CURRENCY in price_info["currencies"]:
+            prefetch_payment_link(user_id, offer_id, periodicity, INVOICE_PREFETCH_CURRENCY)
+        
         # Создаем кнопки выбора валюты
         markup = types.InlineKeyboardMarkup(row_width=1)
     
@@ -1007,10 +622,7 @@ def process_payment_callback(call):
     except Exception as e:
 
         logger.error(f"Ошибка при обработке callback выбора периода: {str(e)}")
-        bot.answer_callback_query(
-            call.id,
-            "Произошла ошибка. Пожалуйста, попробуйте позже."
-        )
+        show_callback_error(call, "Произошла ошибка. Пожалуйста, попробуйте позже.")
 
 # Добавляем новую функцию для сокращения ссылки
 def shorten_payment_url(payment_url: str) -> str:
@@ -1038,9 +650,108 @@ def shorten_payment_url(payment_url: str) -> str:
     except Exception as e:
         logger.error(f"Ошибка при сокращении ссылки: {str(e)}")
 
+# Функции кэша выставленных счетов
+def get_cached_payment_link(user_id, offer_id, periodicity, currency):
+    if INVOICE_CACHE_TTL <= 0:
+        return None
+    cutoff_date = (datetime.now(timezone.utc) - timedelta(seconds=INVOICE_CACHE_TTL)).isoformat()
+    return storage.cached_invoice(user_id, offer_id, periodicity, currency, cutoff_date)
+
+def cache_payment_link(user_id, offer_id, periodicity, currency, payment_url, short_url):
+    if INVOICE_CACHE_TTL <= 0:
+        return
+    storage.cache_invoice(
+        user_id, offer_id, periodicity, currency, payment_url, short_url, datetime.now(timezone.utc).isoformat()
+    )
+
+def get_or_create_payment_link(user_id, offer_id, periodicity, currency):
+    """
+    Возвращает короткую ссылку на оплату. Если пользователь недавно уже получал счет
+    на тот же тариф и валюту, возвращается он, без нового счета в Lava и новой короткой ссылки.
+    """
+    # Если для этого выбора уже создается счет в фоне - дожидаемся его, а не создаем второй
+    key = (str(user_id), offer_id, periodicity, currency)
+    with prefetch_lock:
+        future = prefetch_futures.get(key)
+        prefetch_unclaimed.pop(key, None)
+    if future:
+        try:
+            future.result(timeout=60)
+        except Exception as e:
+            logger.warning(f"Предварительное создание счета для пользователя {user_id} не завершилось: {e}")
+        with prefetch_lock:
+            prefetch_unclaimed.pop(key, None)
+    return _get_or_create_payment_link(user_id, offer_id, periodicity, currency)
+
+def _get_or_create_payment_link(user_id, offer_id, periodicity, currency):
+    short_payment_url = get_cached_payment_link(user_id, offer_id, periodicity, currency)
+    if short_payment_url:
+        logger.info(f"Используем ранее выставленный счет для пользователя {user_id}: {short_payment_url}")
+        return short_payment_url
+    
+    # Создаем ссылку на оплату с полным offer_id
+    payment_data = create_payment_link(user_id, offer_id, periodicity, currency)
+    logger.info(f"Получены данные для оплаты: {payment_data}")
+    
+    if not payment_data:
+        raise ValueError("Не удалось создать ссылку на оплату")
+    
+    # Получаем ссылку из ответа
+    payment_url = payment_data.get('paymentUrl')
+    if not payment_url:
+        raise ValueError("В ответе отсутствует ссылка на оплату")
+    
+    # Сокращаем ссылку (при ошибке сокращения используем исходную)
+    short_payment_url = shorten_payment_url(payment_url) or payment_url
+    logger.info(f"Создана короткая ссылка на оплату: {short_payment_url}")
+    
+    cache_payment_link(user_id, offer_id, periodicity, currency, payment_url, short_payment_url)
+    return short_payment_url
+
+# Предварительное создание счетов. prefetch_futures - счета, которые создаются сейчас,
+# prefetch_unclaimed - созданные, но еще не востребованные (время создания по time.monotonic)
+prefetch_executor = ThreadPoolExecutor(max_workers=INVOICE_PREFETCH_WORKERS, thread_name_prefix="invoice_prefetch")
+prefetch_lock = threading.Lock()
+prefetch_futures = {}
+prefetch_unclaimed = {}
+
+def _run_prefetch(key):
+    try:
+        return _get_or_create_payment_link(*key)
+    finally:
+        with prefetch_lock:
+            prefetch_futures.pop(key, None)
+            prefetch_unclaimed[key] = time.monotonic()
+
+def prefetch_payment_link(user_id, offer_id, periodicity, currency):
+    """
+    Запускает создание счета в фоне. Число одновременно создаваемых и невостребованных
+    счетов ограничено, чтобы брошенные на выборе валюты покупки не плодили счета в Lava.
+    """
+    if not INVOICE_PREFETCH or INVOICE_CACHE_TTL <= 0:
+        return
+    key = (str(user_id), offer_id, periodicity, currency)
+    with prefetch_lock:
+        # Невостребованные дольше срока кэша счета уже не будут выданы - не учитываем их
+        expired_before = time.monotonic() - INVOICE_CACHE_TTL
+        for stale_key in [k for k, created in prefetch_unclaimed.items() if created < expired_before]:
+            del prefetch_unclaimed[stale_key]
+        
+        if key in prefetch_futures or key in prefetch_unclaimed:
+            return
+        if len(prefetch_futures) + len(prefetch_unclaimed) >= INVOICE_PREFETCH_MAX_PENDING:
+            logger.debug(f"Достигнут лимит предварительно созданных счетов, пропускаем пользователя {user_id}")
+            return
+        user_pending = sum(1 for k in list(prefetch_futures) + list(prefetch_unclaimed) if k[0] == key[0])
+        if user_pending >= INVOICE_PREFETCH_MAX_PER_USER:
+            return
+        prefetch_futures[key] = prefetch_executor.submit(_run_prefetch, key)
+
 # Модифицируем функцию process_currency_callback
 @bot.callback_query_handler(func=lambda call: call.data.startswith('c|'))
+@callback_pipeline("select_currency", preparing_text="⏳ Готовим ссылку на оплату...")
 def process_currency_callback(call):
+    started_at = time.monotonic()
     try:
         # Получаем ID пользователя из callback
         user_id = call.from_user.id
@@ -1070,21 +781,8 @@ def process_currency_callback(call):
         }
         periodicity = period_map.get(short_period)
         
-        # Создаем ссылку на оплату с полным offer_id
-        payment_data = create_payment_link(user_id, full_offer_id, periodicity, currency)
-        logger.info(f"Получены данные для оплаты: {payment_data}")
-        
-        if not payment_data:
-            raise ValueError("Не удалось создать ссылку на оплату")
-        
-        # Получаем ссылку из ответа
-        payment_url = payment_data.get('paymentUrl')
-        if not payment_url:
-            raise ValueError("В ответе отсутствует ссылка на оплату")
-        
-        # Сокращаем ссылку
-        short_payment_url = shorten_payment_url(payment_url)
-        logger.info(f"Создана короткая ссылка на оплату: {short_payment_url}")
+        # Получаем ссылку на оплату (из кэша выставленных счетов или новую)
+        short_payment_url = get_or_create_payment_link(user_id, full_offer_id, periodicity, currency)
         
         # Создаем клавиатуру с кнопками
         markup = types.InlineKeyboardMarkup(row_width=1)
@@ -1101,18 +799,15 @@ def process_currency_callback(call):
             reply_markup=markup
         )
         
-        # Отмечаем callback как обработанный
-        bot.answer_callback_query(call.id)
-        
         # Логируем успешное создание ссылки
-        logger.info(f"Успешно создана ссылка на оплату для пользователя {user_id}")
+        logger.info(
+            f"Успешно создана ссылка на оплату для пользователя {user_id} "
+            f"за {(time.monotonic() - started_at) * 1000:.0f} мс"
+        )
         
     except Exception as e:
         logger.error(f"Ошибка при создании ссылки на оплату: {str(e)}", exc_info=True)
-        bot.answer_callback_query(
-            call.id,
-            "Произошла ошибка при создании ссылки на оплату. Попробуйте позже."
-        )
+        show_callback_error(call, "Произошла ошибка при создании ссылки на оплату. Попробуйте позже.")
 
 # Добавляем функцию для расчета оставшихся дней подписки
 def calculate_days_left(timestamp, periodicity):
@@ -1135,39 +830,37 @@ def calculate_days_left(timestamp, periodicity):
     
     return max(0, days_left)  # Возвращаем 0, если подписка уже закончилась
 
-# Функция для проверки сроков подписок
+# Функция для постановки в очередь уведомлений об удалении пользователя из канала
+def notify_subscription_removed(conn, user_id, end_date_str, member_status):
+    dedup_key = f"removed:{user_id}:{end_date_str}"
+    # Уведомляем пользователя
+    enqueue_message(
+        user_id,
+        "❌ Срок действия вашей подписки истек.\n"
+        "Доступ к каналу прекращен.\n"
+        "Чтобы вернуться, оформите новую подписку через /subscribe",
+        conn, dedup_key
+    )
+    # Уведомляем администратора
+    notify_admin(
+        f"<b>Пользователь удален из канала</b>\n\n"
+        f"<b>ID пользователя:</b> {user_id}\n"
+        f"<b>Причина:</b> Истек срок подписки\n"
+        f"<b>Дата окончания:</b> {end_date_str}\n"
+        f"<b>Предыдущий статус:</b> {member_status}\n"
+        f"<b>Новый статус:</b> removed",
+        conn, f"{dedup_key}:admin", category="removed",
+        summary=f"{user_id} - подписка до {end_date_str}, статус был {member_status}"
+    )
+
+# Функция для проверки сроков подписок. Изменения по каждому пользователю записываются
+# отдельной транзакцией хранилища (storage.write) вместе с уведомлениями в outbox
 def check_subscription_expiration():
-    conn = None
     try:
         logger.debug("Начало проверки сроков подписок")
         
-        # Получаем всех пользователей канала (активных и отмененных)
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Убеждаемся, что таблица напоминаний существует
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS subscription_reminders (
-            user_id TEXT PRIMARY KEY,
-            last_reminder_at TEXT NOT NULL
-        )
-        ''')
-        
         # Получаем пользователей с активным или отмененным статусом, у которых есть дата окончания
-        cursor.execute('''
-        SELECT 
-            cm.user_id,
-            cm.subscription_end_date,
-            cm.status,
-            p.status as payment_status,
-            p.event_type
-        FROM channel_members cm
-        LEFT JOIN payments p ON p.id = cm.last_payment_id
-        WHERE cm.status IN ('active', 'cancelled')
-        AND cm.subscription_end_date IS NOT NULL
-        ''')
-        
-        members = cursor.fetchall()
+        members = storage.members_to_check()
         logger.debug(f"Найдено {len(members)} пользователей для проверки (active/cancelled)")
         
         current_time = datetime.now(timezone.utc)
@@ -1175,11 +868,14 @@ def check_subscription_expiration():
         errors_count = 0
         
         for member in members:
+            # При остановке сервиса или потере аренды прерываемся между пользователями:
+            # изменения по каждому уже зафиксированы, остальных проверит следующий запуск
+            if not scheduler.should_continue(BOT_JOBS_LEASE):
+                logger.info("Проверка участников канала прервана: сервис останавливается или аренда потеряна")
+                break
             user_id = member[0]
             end_date_str = member[1]
             member_status = member[2]
-            payment_status = member[3]
-            event_type = member[4]
             
             # Пропускаем, если дата окончания отсутствует или некорректна
             if not end_date_str:
@@ -1193,12 +889,19 @@ def check_subscription_expiration():
                 logger.error(f"Ошибка парсинга даты для пользователя {user_id}: {end_date_str} - {e}")
                 continue
             
-            # Вычисляем оставшиеся дни и факт истечения подписки
-            days_left = (end_date - current_time).days
+            # Вычисляем факт истечения подписки
             has_expired = end_date < current_time
             days_after_expiry = (current_time - end_date).days if has_expired else 0
             current_date_iso = current_time.date().isoformat()
             
+            # Статус removed (если еще не установлен) и уведомления - одна операция записи.
+            # Уведомления отправляются только если статус действительно изменился
+            def write_removed(conn, user_id=user_id, end_date_str=end_date_str, member_status=member_status):
+                rows_updated = storage.remove_member(conn, user_id)
+                if rows_updated > 0:
+                    notify_subscription_removed(conn, user_id, end_date_str, member_status)
+                return rows_updated
+            
             try:
                 # Проверяем, является ли пользователь участником канала
                 try:
@@ -1213,39 +916,8 @@ def check_subscription_expiration():
                 # - если срок еще не истек, даем пользователю возможность вернуться в канал и не меняем статус
                 if not is_member and member_status in ['active', 'cancelled']:
                     if has_expired and days_after_expiry >= GRACE_PERIOD_DAYS:
-                        # Обновляем статус только если он еще не 'removed'
-                        cursor.execute('''
-                        UPDATE channel_members 
-                        SET status = 'removed' 
-                        WHERE user_id = ? AND status != 'removed'
-                        ''', (user_id,))
-                        rows_updated = cursor.rowcount
-                        cursor.execute('DELETE FROM subscription_reminders WHERE user_id = ?', (user_id,))
-                        conn.commit()
-                        
-                        # Отправляем уведомления только если статус действительно изменился
-                        if rows_updated > 0:
-                            logger.info(f"Пользователь {user_id} не в канале, обновляем статус на 'removed'")
-                            # Уведомляем пользователя
-                            try:
-                                bot.send_message(
-                                    user_id,
-                                    "❌ Срок действия вашей подписки истек.\n"
-                                    "Доступ к каналу прекращен.\n"
-                                    "Чтобы вернуться, оформите новую подписку через /subscribe"
-                                )
-                            except Exception as e:
-                                logger.warning(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
-                            
-                            # Уведомляем администратора
-                            notify_admin(
-                                f"<b>Пользователь удален из канала</b>\n\n"
-                                f"<b>ID пользователя:</b> {user_id}\n"
-                                f"<b>Причина:</b> Истек срок подписки\n"
-                                f"<b>Дата окончания:</b> {end_date_str}\n"
-                                f"<b>Предыдущий статус:</b> {member_status}\n"
-                                f"<b>Новый статус:</b> removed"
-                            )
+                        if storage.write(user_id, write_removed) > 0:
+                            logger.info(f"Пользователь {user_id} не в канале, статус обновлен на 'removed'")
                         else:
                             logger.debug(f"Пользователь {user_id} уже имеет статус 'removed', пропускаем уведомления")
                     else:
@@ -1257,92 +929,40 @@ def check_subscription_expiration():
                     continue
                 
                 # Если пользователь в канале, проверяем срок подписки
-                if is_member:
-                    if has_expired:
-                        if days_after_expiry >= GRACE_PERIOD_DAYS:
-                            logger.info(
-                                f"Удаление пользователя {user_id} из канала: "
-                                f"подписка истекла {end_date_str}, "
-                                f"дней после окончания: {days_after_expiry}, "
-                                f"статус в БД: {member_status}"
-                            )
-                            
-                            # Удаляем пользователя из канала
-                            result = remove_user_from_channel(user_id)
-                            
-                            if result:
-                                # Обновляем статус в БД только если он еще не 'removed'
-                                cursor.execute('''
-                                UPDATE channel_members 
-                                SET status = 'removed' 
-                                WHERE user_id = ? AND status != 'removed'
-                                ''', (user_id,))
-                                rows_updated = cursor.rowcount
-                                cursor.execute('DELETE FROM subscription_reminders WHERE user_id = ?', (user_id,))
-                                conn.commit()
-                                
-                                # Отправляем уведомления только если статус действительно изменился
-                                if rows_updated > 0:
-                                    removed_count += 1
-                                    
-                                    # Уведомляем пользователя
-                                    try:
-                                        bot.send_message(
-                                            user_id,
-                                            "❌ Срок действия вашей подписки истек.\n"
-                                            "Доступ к каналу прекращен.\n"
-                                            "Чтобы вернуться, оформите новую подписку через /subscribe"
-                                        )
-                                    except Exception as e:
-                                        logger.warning(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
-                                    
-                                    # Уведомляем администратора
-                                    notify_admin(
-                                        f"<b>Пользователь удален из канала</b>\n\n"
-                                        f"<b>ID пользователя:</b> {user_id}\n"
-                                        f"<b>Причина:</b> Истек срок подписки\n"
-                                        f"<b>Дата окончания:</b> {end_date_str}\n"
-                                        f"<b>Предыдущий статус:</b> {member_status}\n"
-                                        f"<b>Новый статус:</b> removed"
-                                    )
-                                else:
-                                    logger.debug(f"Пользователь {user_id} уже имеет статус 'removed', пропускаем уведомления")
+                if is_member and has_expired:
+                    if days_after_expiry >= GRACE_PERIOD_DAYS:
+                        logger.info(
+                            f"Удаление пользователя {user_id} из канала: "
+                            f"подписка истекла {end_date_str}, "
+                            f"дней после окончания: {days_after_expiry}, "
+                            f"статус в БД: {member_status}"
+                        )
+                        
+                        # Удаляем пользователя из канала
+                        if remove_user_from_channel(user_id):
+                            if storage.write(user_id, write_removed) > 0:
+                                removed_count += 1
                             else:
-                                logger.error(f"Не удалось удалить пользователя {user_id} из канала")
-                                errors_count += 1
+                                logger.debug(f"Пользователь {user_id} уже имеет статус 'removed', пропускаем уведомления")
                         else:
-                            # Отправляем напоминание один раз в день
-                            should_notify = False
-                            cursor.execute('SELECT last_reminder_at FROM subscription_reminders WHERE user_id = ?', (user_id,))
-                            reminder_row = cursor.fetchone()
-                            if not reminder_row or reminder_row[0] != current_date_iso:
-                                should_notify = True
-                                cursor.execute('''
-                                INSERT INTO subscription_reminders (user_id, last_reminder_at)
-                                VALUES (?, ?)
-                                ON CONFLICT(user_id) DO UPDATE SET last_reminder_at=excluded.last_reminder_at
-                                ''', (user_id, current_date_iso))
-                                conn.commit()
-                            
-                            if should_notify:
-                                days_grace_left = max(0, GRACE_PERIOD_DAYS - days_after_expiry)
-                                try:
-                                    bot.send_message(
-                                        user_id,
-                                        "⚠️ Ваша подписка истекла.\n"
-                                        f"У вас есть еще {days_grace_left} дн. льготного периода для продления.\n"
-                                        "Чтобы сохранить доступ, оформите новую подписку через /subscribe."
-                                    )
-                                except Exception as e:
-                                    logger.warning(f"Не удалось отправить напоминание пользователю {user_id}: {e}")
-                    # Уведомления о скором окончании подписки
-                    #elif days_left in NOTIFY_BEFORE_DAYS:
-                        #bot.send_message(
-                        #    user_id,
-                        #    f"ℹ️ Ваша подписка закончится через {days_left} дней.\n"
-                        #    f"Не забудьте продлить её, чтобы сохранить доступ к каналу.\n\n"
-                        #    f"Для продления используйте команду /subscribe"
-                        #)
+                            logger.error(f"Не удалось удалить пользователя {user_id} из канала")
+                            errors_count += 1
+                    else:
+                        # Отправляем напоминание один раз в день
+                        def write_reminder(conn, user_id=user_id, days_after_expiry=days_after_expiry):
+                            if storage.last_reminder(conn, user_id) == current_date_iso:
+                                return
+                            storage.set_reminder(conn, user_id, current_date_iso)
+                            days_grace_left = max(0, GRACE_PERIOD_DAYS - days_after_expiry)
+                            enqueue_message(
+                                user_id,
+                                "⚠️ Ваша подписка истекла.\n"
+                                f"У вас есть еще {days_grace_left} дн. льготного периода для продления.\n"
+                                "Чтобы сохранить доступ, оформите новую подписку через /subscribe.",
+                                conn, f"reminder:{user_id}:{current_date_iso}"
+                            )
+                        
+                        storage.write(user_id, write_reminder)
             
             except Exception as e:
                 logger.error(f"Ошибка при проверке пользователя {user_id}: {str(e)}", exc_info=True)
@@ -1356,9 +976,6 @@ def check_subscription_expiration():
             
     except Exception as e:
         logger.error(f"Ошибка при проверке сроков подписок: {str(e)}", exc_info=True)
-    finally:
-        if conn:
-            conn.close()
 
 # Обработчик для команды /status
 @bot.message_handler(commands=['status'])
@@ -1445,29 +1062,8 @@ def broadcast_command(message):
         
         broadcast_text = command_parts[1]
         
-        # Получаем список всех пользователей из базы данных
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Получаем уникальных пользователей из таблицы channel_members
-        cursor.execute('SELECT DISTINCT user_id FROM channel_members')
-        users = cursor.fetchall()
-        
-        # Добавляем пользователей из таблицы payments, которых нет в channel_members
-        cursor.execute('''
-        SELECT DISTINCT SUBSTR(buyer_email, 1, INSTR(buyer_email, '@') - 1) 
-        FROM payments 
-        WHERE buyer_email NOT IN (
-            SELECT user_id || '@t.me' 
-            FROM channel_members
-        )
-        ''')
-        additional_users = cursor.fetchall()
-        
-        conn.close()
-        
-        # Объединяем списки пользователей
-        all_users = list(set([user[0] for user in users + additional_users]))
+        # Получаем список всех пользователей: участники канала и покупатели (включая архив платежей)
+        all_users = list(storage.known_user_ids())
         
         # Отправляем статус о начале рассылки
         status_message = bot.reply_to(
@@ -1525,6 +1121,99 @@ def broadcast_command(message):
         bot.reply_to(message, "❌ Произошла ошибка при выполнении рассылки.")
 
 
+# Обработчик для команды /metrics
+@bot.message_handler(commands=['metrics'])
+def metrics_command(message):
+    if str(message.from_user.id) != str(ADMIN_ID):
+        bot.reply_to(message, "❌ У вас нет прав для использования этой команды.")
+        return
+    bot.reply_to(message, metrics.render_summary(), parse_mode="HTML")
+
+# Обработчик для команды /jobs
+@bot.message_handler(commands=['jobs'])
+def jobs_command(message):
+    if str(message.from_user.id) != str(ADMIN_ID):
+        bot.reply_to(message, "❌ У вас нет прав для использования этой команды.")
+        return
+    jobs = get_job_states()
+    if not jobs:
+        bot.reply_to(message, "Фоновые задачи еще не запускались.")
+        return
+    lines = ["⏱ <b>Фоновые задачи</b>\n"]
+    for job in jobs:
+        status = {"ok": "✅", "error": "❌"}.get(job["last_status"], "⏳")
+        duration = f"{job['last_duration']:.1f} с" if job["last_duration"] is not None else "-"
+        lines.append(
+            f"{status} <b>{job['name']}</b> ({job['trigger']}), процесс {html.escape(job['holder'])}\n"
+            f"Следующий запуск: {(job['next_run_at'] or '-')[:19]}\n"
+            f"Последний: {(job['last_started_at'] or '-')[:19]}, {duration}; "
+            f"запусков {job['runs']}, ошибок {job['failures']}, пропущено {job['skipped']}"
+        )
+        if job["last_status"] == "error" and job["last_error"]:
+            lines.append(f"Ошибка: {html.escape(job['last_error'][:200])}")
+    leases = get_leases()
+    if leases:
+        lines.append("\n👑 <b>Ведущие экземпляры</b>")
+        for lease in leases:
+            holder = html.escape(lease["holder"]) if lease["active"] else "нет (аренда истекла)"
+            lines.append(f"{lease['name']}: {holder}, аренда №{lease['token']}")
+    bot.reply_to(message, "\n".join(lines), parse_mode="HTML")
+
+# Обработчик для команды /stats
+@bot.message_handler(commands=['stats'])
+def stats_command(message):
+    try:
+        if str(message.from_user.id) != str(ADMIN_ID):
+            bot.reply_to(message, "❌ У вас нет прав для использования этой команды.")
+            return
+
+        # Статистика читается из агрегатов и не сканирует таблицу payments
+        stats = storage.stats_summary(days=30)
+        members = stats["members"]
+        events = stats["events"]
+        transitions = stats["transitions"]
+
+        revenue_lines = []
+        for currency, amounts in sorted(stats["revenue"].items()):
+            currency_symbol = CURRENCY_TRANSLATIONS.get(currency, currency)
+            revenue_lines.append(
+                f"{currency_symbol}: сегодня {amounts['today']:.2f}, "
+                f"за 30 дн. {amounts['period']:.2f}, всего {amounts['total']:.2f}"
+            )
+
+        bot.reply_to(
+            message,
+            f"📊 <b>Статистика подписок</b>\n\n"
+            f"<b>Активных:</b> {members.get('active', 0)}\n"
+            f"<b>С отключенным автопродлением:</b> {members.get('cancelled', 0)}\n"
+            f"<b>Удаленных:</b> {members.get('removed', 0)}\n\n"
+            f"<b>За 30 дней:</b>\n"
+            f"Новых подписок: {events.get('payment.success', 0)}\n"
+            f"Продлений: {events.get('subscription.recurring.payment.success', 0)}\n"
+            f"Отмен автопродления: {events.get('subscription.cancelled', 0)}\n"
+            f"Неудачных платежей: {events.get('payment.failed', 0)}\n"
+            f"Удалено из канала: {transitions.get('removed', 0)}\n\n"
+            f"<b>Выручка:</b>\n" + ("\n".join(revenue_lines) or "нет данных"),
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при получении статистики: {str(e)}")
+        bot.reply_to(message, "❌ Произошла ошибка при получении статистики.")
+
+# Обработчик для команды /stats_rebuild
+@bot.message_handler(commands=['stats_rebuild'])
+def stats_rebuild_command(message):
+    try:
+        if str(message.from_user.id) != str(ADMIN_ID):
+            bot.reply_to(message, "❌ У вас нет прав для использования этой команды.")
+            return
+
+        result = storage.rebuild_stats()
+        bot.reply_to(message, f"✅ Статистика пересчитана ({result['payment_rows']} строк агрегатов).")
+    except Exception as e:
+        logger.error(f"Ошибка при пересчете статистики: {str(e)}")
+        bot.reply_to(message, "❌ Произошла ошибка при пересчете статистики.")
+
 # Обработчик для команды /subscribe
 @bot.message_handler(commands=['subscribe'])
 def subscribe_command(message):
@@ -1578,52 +1267,58 @@ def start_command(message):
     # Затем показываем меню
     show_main_menu(message)
 
-# Функция для периодической проверки новых платежей
-def check_payments_periodically():
-    while True:
-        try:
-            # Проверяем существование таблицы перед запросом
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='payments'")
-            table_exists = cursor.fetchone()
-            conn.close()
-            
-            if table_exists:
-                # check_new_payments()
-                pass
-            
-            else:
-                logger.warning("Таблица payments еще не создана. Пропускаем проверку платежей.")
-                
-        except Exception as e:
-            logger.error(f"Ошибка при проверке новых платежей: {str(e)}")
-        
-        # Проверяем каждые 60 секунд
-        time.sleep(20)
+# Задача проверки подписок
+def check_subscriptions():
+    # Сначала сверяемся с Lava, чтобы не удалить пользователя, чей вебхук о продлении потерян
+    try:
+        reconcile_expiring_members(
+            lambda amount, currency, product_id: PERIOD_DAYS.get(
+                get_periodicity_by_amount(amount, currency, product_id), 30
+            )
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при сверке подписок с Lava: {str(e)}")
+    check_subscription_expiration()
+    logger.info("Выполнена проверка активных подписок")
 
-# Функция проверки подписок
-def check_subscriptions_periodically():
-    while True:
-        try:
-            # Проверяем существование таблицы перед запросом
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='payments'")
-            table_exists = cursor.fetchone()
-            conn.close()
-            
-            if table_exists:
-                check_subscription_expiration()
-                logger.info("Выполнена проверка активных подписок")
-            else:
-                logger.warning("Таблица payments еще не создана. Пропускаем проверку подписок.")
-                
-        except Exception as e:
-            logger.error(f"Ошибка при периодической проверке подписок: {str(e)}")
-        
-        # Проверяем каждый час
-        time.sleep(3600)
+# Задача поддержания пула ссылок-приглашений
+def maintain_invite_pool():
+    if CHANNEL_ID:
+        revoke_stale_invite_links(bot, CHANNEL_ID)
+        # В режиме заявок одноразовые ссылки не нужны - остатки пула просто истекают
+        if not JOIN_REQUEST_MODE:
+            refill_invite_pool(bot, CHANNEL_ID)
+
+# Регистрация фоновых задач бота в планировщике процесса
+def start_background_jobs():
+    if "check_subscriptions" in scheduler.jobs:
+        return
+    subscription_trigger = parse_trigger(SUBSCRIPTION_CHECK_SCHEDULE)
+    # Удаления и напоминания при нескольких экземплярах выполняет только ведущий
+    scheduler.add_job(
+        "check_subscriptions", check_subscriptions, subscription_trigger, jitter=60,
+        run_at_start=isinstance(subscription_trigger, IntervalTrigger), lease=BOT_JOBS_LEASE
+    )
+    # Проверяем пул каждую минуту, чтобы успевать за всплесками продаж
+    scheduler.add_job(
+        "invite_pool", maintain_invite_pool, IntervalTrigger(60),
+        jitter=5, run_at_start=True, lease=BOT_JOBS_LEASE
+    )
+    # Сводка событий для администратора (если ее еще не зарегистрировал API в этом процессе)
+    if "admin_digest" not in scheduler.jobs:
+        scheduler.add_job(
+            "admin_digest", flush_admin_digest, IntervalTrigger(ADMIN_DIGEST_CHECK_INTERVAL),
+            run_at_start=True, lease=BOT_JOBS_LEASE
+        )
+    # Перенос сообщений и событий сводки из шардов или PostgreSQL в основную БД (если его еще не зарегистрировал API)
+    if storage.stages_rows and "relay_staged" not in scheduler.jobs:
+        scheduler.add_job("relay_staged", storage.relay_staged, IntervalTrigger(SHARD_RELAY_INTERVAL))
+    if JOIN_REQUEST_MODE:
+        # Кэш доступа нужен каждому экземпляру, обрабатывающему заявки на вступление
+        scheduler.add_job("member_access_cache", refresh_member_access_cache, IntervalTrigger(30), run_at_start=True)
+    scheduler.start()
+    # Уведомления о платежах и окончании подписок отправляются из outbox
+    outbox.sender.start()
 
 # Функция для запуска бота
 def run_bot():
@@ -1638,15 +1333,11 @@ def run_bot():
         if not CHANNEL_ID:
             logger.warning("Не указан ID канала (CHANNEL_ID). Функции работы с каналом будут недоступны.")
         
-        # Запускаем периодическую проверку платежей в отдельном потоке
-        payment_thread = threading.Thread(target=check_payments_periodically)
-        payment_thread.daemon = True
-        payment_thread.start()
+        # Схему создает run.py до запуска API и бота; при отдельном запуске бота создаем ее здесь
+        ensure_schema()
         
-        # Запускаем периодическую проверку подписок в отдельном потоке
-        subscription_thread = threading.Thread(target=check_subscriptions_periodically)
-        subscription_thread.daemon = True
-        subscription_thread.start()
+        # Проверка подписок, пул ссылок-приглашений и кэш доступа выполняются планировщиком
+        start_background_jobs()
         
         # Запускаем бота с увеличенными таймаутами
         # interval=3: увеличиваем интервал между запросами
@@ -1654,15 +1345,47 @@ def run_bot():
         bot.polling(none_stop=True, interval=3, timeout=30)
     except requests.exceptions.ReadTimeout as e:
         logger.warning(f"Таймаут при обращении к Telegram API: {str(e)}. Перезапуск бота...")
-        time.sleep(5)  # Ожидаем 5 секунд перед повторным запуском
-        run_bot()  # Рекурсивно запускаем бота снова
+        # Ожидаем 5 секунд перед повторным запуском (при остановке сервиса - не перезапускаем)
+        if not shutdown_event.wait(5):
+            run_bot()  # Рекурсивно запускаем бота снова
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {str(e)}", exc_info=True)
-        time.sleep(10)  # Ожидаем 10 секунд перед повторным запуском
-        run_bot()  # Рекурсивно запускаем бота снова
+        # Ожидаем 10 секунд перед повторным запуском (при остановке сервиса - не перезапускаем)
+        if not shutdown_event.wait(10):
+            run_bot()  # Рекурсивно запускаем бота снова
+
+def _join_within(target, deadline: float) -> bool:
+    """Выполняет target в отдельном потоке и ждет его не дольше, чем до deadline (time.monotonic)"""
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(max(0.0, deadline - time.monotonic()))
+    return not thread.is_alive()
+
+# Функция для остановки бота
+def stop_bot(timeout: float) -> bool:
+    """
+    Останавливает прием обновлений, планировщик задач и отправку из outbox, затем дожидается
+    уже начатых обработчиков, задач и отправок в Telegram не дольше timeout секунд. Обновления, полученные,
+    но не подтвержденные перед остановкой, Telegram доставит повторно при следующем запуске.
+    Возвращает True, если все успело завершиться.
+    """
+    deadline = time.monotonic() + timeout
+    shutdown_event.set()
+    bot.stop_polling()
+    drained = _join_within(bot.stop_bot, deadline)
+    drained = scheduler.stop(max(0.0, deadline - time.monotonic())) and drained
+    drained = outbox.sender.stop(max(0.0, deadline - time.monotonic())) and drained
+    drained = _join_within(callback_executor.shutdown, deadline) and drained
+    drained = _join_within(prefetch_executor.shutdown, deadline) and drained
+    if drained:
+        logger.info("Бот остановлен, все начатые обработчики завершены")
+    else:
+        logger.warning(f"Бот остановлен, часть обработчиков не завершилась за {timeout} с")
+    return drained
 
 # Запуск бота в отдельном потоке
 if __name__ == "__main__":
+    configure_logging()
     bot_thread = threading.Thread(target=run_bot)
     bot_thread.daemon = True
     bot_thread.start()
@@ -1672,5 +1395,5 @@ if __name__ == "__main__":
         while True:
             time.sleep(60)
     except KeyboardInterrupt:
-        logger.info("Бот остановлен")
+        stop_bot(float(os.getenv("SHUTDOWN_TIMEOUT", "8")))
 
@@ -0,0 +1,773 @@
+import os
+import logging
+import sqlite3
+import threading
+import zlib
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Optional
+
+# Общие настройки хранилища для вебхук-сервера и бота (DATA_DIR - каталог с файлами SQLite,
+# другой каталог задают, например, тесты)
+DATA_DIR = Path(os.getenv("DATA_DIR", "/mount/database"))
+DB_PATH = DATA_DIR / "lava_payments.db"
+ARCHIVE_DB_PATH = DATA_DIR / "lava_payments_archive.db"
+
+# Через сколько дней завершенные события переносятся в архивную БД
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+# Сколько платежей переносится за одну транзакцию
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+
+# Версия схемы (PRAGMA user_version). Увеличивается при каждом изменении init_db,
+# чтобы воркеры при запуске не выполняли DDL заново, если схема уже актуальна
+SCHEMA_VERSION = 9
+
+# Сколько свободных соединений хранит пул одного потока
+POOL_SIZE_PER_THREAD = 2
+
+# Разделение данных пользователей по файлам (шардам). При SHARD_COUNT > 1 таблицы пользователей
+# (SHARDED_TABLES и агрегаты статистики по ним) хранятся в SHARD_COUNT файлах по хэшу user_id,
+# а остальные таблицы (ссылки, outbox, входящие вебхуки, настройки) - в основной БД. Запись
+# платежей разных пользователей тогда не упирается в блокировку одного файла.
+# Режим экспериментальный и включается явно: на одном ядре он медленнее одного файла (см. README).
+# Соединение шарда (connect_shard) открывает файл шарда и подключает к нему основную БД,
+# поэтому запросы обращаются ко всем таблицам по обычным именам. Транзакция, изменяющая
+# и шард, и основную БД, в режиме WAL атомарна для каждого файла, но не для обоих сразу.
+# При SHARD_COUNT = 1 (по умолчанию) шард один - это сама основная БД.
+SHARD_COUNT = max(1, int(os.getenv("SHARD_COUNT", "1")))
+SHARDED_TABLES = ("payments", "channel_members", "subscription_reminders", "payment_summaries", "invoice_cache")
+# Номера платежей в шардах выдаются из непересекающихся диапазонов такого размера,
+# поэтому платеж однозначно находится по номеру (например, в /admin/payments/{id}/raw)
+SHARD_ID_RANGE = 10 ** 12
+# Сообщения outbox и события сводки для администратора, которые пишут транзакции шарда.
+# В файле шарда у этих таблиц есть одноименные промежуточные таблицы: запись попадает в них
+# и не берет блокировку основной БД, а group_commit.relay_staged переносит строки в основную
+# БД одной транзакцией на пачку. Повторный перенос безопасен: строка с тем же dedup_key
+# не добавляется (строкам без ключа он назначается при переносе)
+STAGED_TABLES = {
+    "telegram_outbox": ("dedup_key", "chat_id", "kind", "payload", "next_attempt_at", "created_at"),
+    "admin_events": ("dedup_key", "category", "summary", "created_at"),
+}
+
+logger = logging.getLogger("database")
+
+# Инициализация базы данных
+def init_db():
+    """
+    Инициализация базы данных при запуске. Ошибка записывается в лог и передается дальше:
+    сервис без схемы не запускается (run.py завершится с ненулевым кодом)
+    """
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cursor = conn.cursor()
+
+        # WAL позволяет читать согласованный снимок (экспорт, отчеты),
+        # не блокируя запись вебхуков. Режим сохраняется в файле БД.
+        cursor.execute('PRAGMA journal_mode=WAL')
+
+        # Создаем таблицу для сокращенных ссылок
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shortened_links (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            short_code TEXT UNIQUE NOT NULL,
+            original_url TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        ''')
+
+        # Последнее известное состояние контракта в Lava по каждому пользователю (сверка)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reconciliation_state (
+            user_id TEXT PRIMARY KEY,
+            contract_id TEXT,
+            lava_status TEXT,
+            checked_at TEXT NOT NULL
+        )
+        ''')
+
+        # Пул заранее созданных одноразовых ссылок-приглашений в канал
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS invite_links (
+            invite_link TEXT PRIMARY KEY,
+            created_at TEXT NOT NULL,
+            expire_date INTEGER NOT NULL,
+            issued_to TEXT,
+            issued_at TEXT,
+            revoked_at TEXT
+        )
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_invite_links_available
+        ON invite_links(expire_date) WHERE issued_to IS NULL AND revoked_at IS NULL
+        ''')
+
+        # Общие настройки, которые создаются во время работы (например, ссылка для заявок в канал)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS app_settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        ''')
+
+        # Общее для всех процессов состояние лимита запросов к Telegram
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS telegram_rate_limit (
+            name TEXT PRIMARY KEY,
+            next_at REAL NOT NULL
+        )
+        ''')
+
+        # Входящие вебхуки: тело записывается до обработки, чтобы вебхук, принятый
+        # перед остановкой сервиса, был обработан при следующем запуске.
+        # Успешно обработанные записи удаляются, неудачные остаются со статусом failed
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_inbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            body BLOB NOT NULL,
+            received_at TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'received',
+            run_id TEXT NOT NULL,
+            payment_id INTEGER,
+            error_message TEXT
+        )
+        ''')
+
+        # Состояние задач планировщика (scheduler.py) для просмотра администратором: строка на задачу
+        # и процесс (holder - leader.HOLDER_ID). Таблица прежней схемы (ключ - только имя задачи)
+        # пересоздается: в ней только данные для просмотра
+        columns = [row[1] for row in cursor.execute("PRAGMA table_info(scheduler_jobs)")]
+        if columns and "holder" not in columns:
+            cursor.execute('DROP TABLE scheduler_jobs')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_jobs (
+            name TEXT NOT NULL,
+            holder TEXT NOT NULL,
+            trigger TEXT NOT NULL,
+            next_run_at TEXT,
+            last_started_at TEXT,
+            last_duration REAL,
+            last_status TEXT,
+            last_error TEXT,
+            runs INTEGER NOT NULL DEFAULT 0,
+            failures INTEGER NOT NULL DEFAULT 0,
+            skipped INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (name, holder)
+        )
+        ''')
+
+        # Аренды ведущего экземпляра для фоновых задач (leader.py)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS leader_lease (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            token INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            renewed_at REAL NOT NULL
+        )
+        ''')
+
+        # Исходящие сообщения Telegram (outbox.py): записываются в одной транзакции с изменением
+        # состояния и отправляются фоновым отправителем с повторами
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS telegram_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedup_key TEXT UNIQUE,
+            chat_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            claimed_until REAL,
+            created_at REAL NOT NULL,
+            sent_at REAL,
+            message_id INTEGER,
+            last_error TEXT
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_telegram_outbox_status ON telegram_outbox(status, next_attempt_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_telegram_outbox_chat ON telegram_outbox(chat_id, status, id)')
+
+        # События для сводки администратору (admin_digest.py), еще не вошедшие в отправленную сводку
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admin_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedup_key TEXT UNIQUE,
+            category TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        ''')
+
+        # Без шардов таблицы пользователей хранятся в основной БД
+        needs_rebuild = create_user_tables(cursor) if SHARD_COUNT == 1 else False
+
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.commit()
+
+        if SHARD_COUNT > 1:
+            for shard in range(SHARD_COUNT):
+                needs_rebuild = init_shard(shard) or needs_rebuild
+        logger.info("База данных успешно инициализирована")
+
+        if needs_rebuild:
+            rebuild_stats_rollups()
+
+    except Exception as e:
+        logger.error(f"Ошибка при инициализации БД: {str(e)}")
+        raise
+    finally:
+        conn.close()
+
+def create_user_tables(cursor: sqlite3.Cursor) -> bool:
+    """
+    Создает таблицы пользователей (SHARDED_TABLES) и агрегаты статистики по ним в БД курсора:
+    в основной БД или в шарде. Возвращает True, если агрегаты нужно заполнить по уже
+    существующим платежам.
+    """
+    # Создаем таблицу payments
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_type TEXT NOT NULL,
+        product_id TEXT NOT NULL,
+        product_title TEXT NOT NULL,
+        buyer_email TEXT NOT NULL,
+        contract_id TEXT NOT NULL,
+        parent_contract_id TEXT,
+        amount REAL NOT NULL,
+        currency TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        status TEXT NOT NULL,
+        error_message TEXT,
+        raw_data TEXT NOT NULL,
+        received_at TEXT NOT NULL,
+        processed INTEGER DEFAULT 0
+    )
+    ''')
+
+    # Поиск уже записанных событий по контракту (повторный импорт, importer.py)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_contract ON payments(contract_id, event_type)')
+    # История покупателя по времени получения: последняя оплата пользователя и пересчет
+    # подписок (replay.py), который читает историю в этом порядке без сортировки
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_buyer ON payments(buyer_email, received_at)')
+
+    # Создаем таблицу channel_members
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS channel_members (
+        user_id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        joined_at TEXT NOT NULL,
+        expires_at TEXT,
+        subscription_end_date TEXT,
+        last_payment_id INTEGER,
+        FOREIGN KEY (last_payment_id) REFERENCES payments(id)
+    )
+    ''')
+
+    # Таблица для отслеживания напоминаний о продлении
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS subscription_reminders (
+        user_id TEXT PRIMARY KEY,
+        last_reminder_at TEXT NOT NULL
+    )
+    ''')
+
+    # Кэш выставленных счетов Lava: повторный выбор того же тарифа не создает новый счет
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS invoice_cache (
+        user_id TEXT NOT NULL,
+        offer_id TEXT NOT NULL,
+        periodicity TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        payment_url TEXT NOT NULL,
+        short_url TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (user_id, offer_id, periodicity, currency)
+    )
+    ''')
+
+    # Сводка по событиям, перенесенным в архив (одна строка на покупателя): число событий и сумма
+    # оплат (PAID_EVENT_TYPES; сумма неудачных попыток в нее не входит)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS payment_summaries (
+        buyer_email TEXT PRIMARY KEY,
+        archived_payments INTEGER NOT NULL DEFAULT 0,
+        archived_amount REAL NOT NULL DEFAULT 0,
+        first_received_at TEXT,
+        last_received_at TEXT
+    )
+    ''')
+
+    create_stats_rollups(cursor)
+
+    # Агрегаты появились в уже заполненной БД - заполняем их один раз по существующим данным
+    cursor.execute('SELECT EXISTS (SELECT 1 FROM payment_stats_daily), EXISTS (SELECT 1 FROM payments)')
+    rollups_exist, payments_exist = cursor.fetchone()
+    return bool(payments_exist and not rollups_exist)
+
+def init_shard(shard: int, shard_count: int = SHARD_COUNT, first_payment_id: Optional[int] = None) -> bool:
+    """
+    Создает таблицы пользователей в файле шарда. Номера платежей нового шарда начинаются
+    с first_payment_id (по умолчанию - с начала диапазона шарда). Возвращает True, если
+    агрегаты статистики нужно заполнить по существующим платежам.
+    """
+    conn = sqlite3.connect(shard_path(shard, shard_count))
+    try:
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        needs_rebuild = create_user_tables(cursor)
+        if shard_count > 1:
+            create_staged_tables(cursor)
+        if first_payment_id is None:
+            first_payment_id = (shard + 1) * SHARD_ID_RANGE
+        cursor.execute('''
+        INSERT INTO sqlite_sequence (name, seq)
+        SELECT 'payments', ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'payments')
+        ''', (first_payment_id - 1,))
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.commit()
+        return needs_rebuild
+    finally:
+        conn.close()
+
+def create_staged_tables(cursor: sqlite3.Cursor):
+    """Промежуточные таблицы шарда для строк основной БД (STAGED_TABLES)"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS telegram_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        dedup_key TEXT UNIQUE,
+        chat_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        next_attempt_at REAL NOT NULL,
+        created_at REAL NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS admin_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        dedup_key TEXT UNIQUE,
+        category TEXT NOT NULL,
+        summary TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+    ''')
+
+def take_staged(conn: sqlite3.Connection, shard: int) -> dict:
+    """Строки промежуточных таблиц шарда: {таблица: (последний id, строки для put_staged)}"""
+    staged = {}
+    for table, columns in STAGED_TABLES.items():
+        rows = conn.execute(f"SELECT id, {', '.join(columns)} FROM main.{table} ORDER BY id").fetchall()
+        if rows:
+            # Ключ строки без dedup_key: номер строки в шарде и время записи (номера начинаются
+            # заново в файлах после смены числа шардов, время - нет)
+            staged[table] = (rows[-1][0], [
+                (row[1] or f"shard{shard}:{row[0]}:{row[-1]!r}",) + row[2:] for row in rows
+            ])
+    return staged
+
+def put_staged(conn: sqlite3.Connection, staged: dict):
+    """Записывает строки take_staged в основную БД в текущей транзакции conn"""
+    for table, (_, rows) in staged.items():
+        columns = STAGED_TABLES[table]
+        conn.executemany(
+            f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            rows
+        )
+
+def clear_staged(conn: sqlite3.Connection, staged: dict):
+    """Удаляет из шарда строки, перенесенные put_staged"""
+    for table, (last_id, _) in staged.items():
+        conn.execute(f"DELETE FROM main.{table} WHERE id <= ?", (last_id,))
+
+def get_schema_version(path: Path = DB_PATH) -> int:
+    conn = sqlite3.connect(path, timeout=2)
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        conn.close()
+
+def ensure_schema():
+    """Инициализирует БД, только если схема отсутствует или устарела (одно чтение заголовка файла)"""
+    DATA_DIR.mkdir(exist_ok=True)
+    paths = [DB_PATH] + ([shard_path(shard) for shard in range(SHARD_COUNT)] if SHARD_COUNT > 1 else [])
+    if any(get_schema_version(path) < SCHEMA_VERSION for path in paths):
+        init_db()
+
+def shard_path(shard: int, shard_count: int = SHARD_COUNT) -> Path:
+    """Файл шарда; в имени число шардов, чтобы при смене SHARD_COUNT старые файлы не смешивались с новыми"""
+    if shard_count == 1:
+        return DB_PATH
+    return DATA_DIR / f"lava_payments.shard{shard}-of-{shard_count}.db"
+
+def archive_path(shard: int, shard_count: int = SHARD_COUNT) -> Path:
+    """Архивная БД шарда"""
+    if shard_count == 1:
+        return ARCHIVE_DB_PATH
+    return DATA_DIR / f"lava_payments_archive.shard{shard}-of-{shard_count}.db"
+
+def shard_of(user_id, shard_count: int = SHARD_COUNT) -> int:
+    """Номер шарда пользователя (стабильный хэш, не зависит от процесса)"""
+    if shard_count == 1:
+        return 0
+    return zlib.crc32(str(user_id).encode()) % shard_count
+
+def shard_of_email(email: str, shard_count: int = SHARD_COUNT) -> int:
+    """Номер шарда покупателя по email (user_id - часть до @)"""
+    return shard_of(email.split('@')[0], shard_count)
+
+def connect_shard(shard: int, common: bool = True, **kwargs) -> sqlite3.Connection:
+    """
+    Соединение с шардом, в котором доступны и таблицы основной БД (подключена как common).
+    Таблицы пользователей - схема main, поэтому запросы вида main.payments тоже работают.
+    BEGIN IMMEDIATE берет блокировку записи всех подключенных файлов, поэтому соединения,
+    которые пишут такими транзакциями (писатели шардов, импорт, архивация), открываются
+    с common=False - только файл шарда: записи разных шардов тогда не ждут друг друга
+    и основную БД, а outbox и сводка пишутся в промежуточные таблицы шарда (STAGED_TABLES)
+    """
+    conn = sqlite3.connect(shard_path(shard), **kwargs)
+    if SHARD_COUNT > 1 and common:
+        conn.execute("ATTACH DATABASE ? AS common", (str(DB_PATH),))
+    return conn
+
+def connect_user(user_id, **kwargs) -> sqlite3.Connection:
+    """Соединение с шардом пользователя"""
+    return connect_shard(shard_of(user_id), **kwargs)
+
+# Пул соединений: свободные соединения хранятся отдельно для каждого потока, поэтому
+# долгоживущие потоки (задачи планировщика, обработчики бота) не открывают БД заново
+# при каждом обращении. Вложенные вызовы в одном потоке получают разные соединения.
+_pool = threading.local()
+
+def _pool_key(shard: Optional[int]) -> Optional[int]:
+    # Без шардов соединение шарда и основной БД - одно и то же
+    return None if shard is None or SHARD_COUNT == 1 else shard
+
+def acquire_connection(shard: Optional[int] = None) -> sqlite3.Connection:
+    """Берет соединение из пула текущего потока или открывает новое (shard - соединение шарда, см. connect_shard)"""
+    key = _pool_key(shard)
+    free = _pool.__dict__.setdefault("free", {}).get(key)
+    if free:
+        return free.pop()
+    return sqlite3.connect(DB_PATH) if key is None else connect_shard(key)
+
+def release_connection(conn: sqlite3.Connection, shard: Optional[int] = None):
+    """Возвращает соединение в пул. Незафиксированная транзакция откатывается, как при close()"""
+    if conn.in_transaction:
+        conn.rollback()
+    free = _pool.__dict__.setdefault("free", {}).setdefault(_pool_key(shard), [])
+    if len(free) < POOL_SIZE_PER_THREAD:
+        free.append(conn)
+    else:
+        conn.close()
+
+def attach_archive(conn: sqlite3.Connection, shard: int = 0, shard_count: int = SHARD_COUNT):
+    """
+    Подключает архивную БД шарда к соединению как схему archive и создает
+    временное представление payments_history со всей историей платежей.
+    """
+    conn.execute("ATTACH DATABASE ? AS archive", (str(archive_path(shard, shard_count)),))
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS archive.payments (
+        id INTEGER PRIMARY KEY,
+        event_type TEXT NOT NULL,
+        product_id TEXT NOT NULL,
+        product_title TEXT NOT NULL,
+        buyer_email TEXT NOT NULL,
+        contract_id TEXT NOT NULL,
+        parent_contract_id TEXT,
+        amount REAL NOT NULL,
+        currency TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        status TEXT NOT NULL,
+        error_message TEXT,
+        raw_data TEXT NOT NULL,
+        received_at TEXT NOT NULL,
+        processed INTEGER DEFAULT 0
+    )
+    ''')
+    # Индекс по покупателю и времени получения заменяет прежний индекс только по покупателю
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_payments_buyer ON payments(buyer_email, received_at)')
+    conn.execute('DROP INDEX IF EXISTS archive.idx_archive_payments_buyer_email')
+    # Запись может оказаться в обоих файлах, если перенос прервался между ними,
+    # поэтому из архива берем только строки, которых уже нет в основной БД
+    conn.execute('''
+    CREATE TEMP VIEW IF NOT EXISTS payments_history AS
+    SELECT * FROM main.payments
+    UNION ALL
+    SELECT * FROM archive.payments
+    WHERE id NOT IN (SELECT id FROM main.payments)
+    ''')
+
+def connect_with_archive(shard: int = 0) -> sqlite3.Connection:
+    """Соединение с шардом (без основной БД), в котором история платежей доступна через payments_history"""
+    conn = connect_shard(shard, common=False)
+    attach_archive(conn, shard)
+    return conn
+
+def archive_old_payments(days_to_keep: int = ARCHIVE_AFTER_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Переносит завершенные события старше days_to_keep дней в архивную БД.
+
+    В основной БД остаются платежи, на которые ссылается channel_members,
+    и последний успешный платеж каждого покупателя: их читают живые пути
+    (check_subscription_status, add_user_to_channel). По перенесенным
+    платежам обновляется сводка payment_summaries.
+    """
+    cutoff_date = (datetime.now(timezone.utc) - timedelta(days=days_to_keep)).isoformat()
+    archived = sum(_archive_shard(shard, cutoff_date, batch_size) for shard in range(SHARD_COUNT))
+    if archived > 0:
+        logger.info(f"В архив перенесено {archived} платежей старше {days_to_keep} дн.")
+    return archived
+
+def _archive_shard(shard: int, cutoff_date: str, batch_size: int) -> int:
+    conn = connect_with_archive(shard)
+    archived = 0
+    try:
+        cursor = conn.cursor()
+        while True:
+            cursor.execute('''
+            SELECT id FROM main.payments
+            WHERE received_at < ?
+              AND id NOT IN (
+                  SELECT last_payment_id FROM main.channel_members
+                  WHERE last_payment_id IS NOT NULL
+              )
+              AND id NOT IN (
+                  SELECT MAX(id) FROM main.payments
+                  WHERE event_type IN ('payment.success', 'subscription.recurring.payment.success')
+                  GROUP BY buyer_email
+              )
+            ORDER BY id
+            LIMIT ?
+            ''', (cutoff_date, batch_size))
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                break
+
+            placeholders = ",".join("?" * len(ids))
+            paid_placeholders = ",".join("?" * len(PAID_EVENT_TYPES))
+            # Каждая пачка - отдельная короткая транзакция, чтобы не блокировать вебхуки
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                cursor.execute(f'''
+                INSERT OR IGNORE INTO archive.payments
+                SELECT * FROM main.payments WHERE id IN ({placeholders})
+                ''', ids)
+                cursor.execute(f'''
+                INSERT INTO main.payment_summaries
+                    (buyer_email, archived_payments, archived_amount, first_received_at, last_received_at)
+                SELECT buyer_email, COUNT(*),
+                       SUM(CASE WHEN event_type IN ({paid_placeholders}) THEN amount ELSE 0 END),
+                       MIN(received_at), MAX(received_at)
+                FROM main.payments WHERE id IN ({placeholders})
+                GROUP BY buyer_email
+                ON CONFLICT(buyer_email) DO UPDATE SET
+                    archived_payments = archived_payments + excluded.archived_payments,
+                    archived_amount = archived_amount + excluded.archived_amount,
+                    first_received_at = MIN(COALESCE(first_received_at, excluded.first_received_at), excluded.first_received_at),
+                    last_received_at = MAX(COALESCE(last_received_at, excluded.last_received_at), excluded.last_received_at)
+                ''', (*PAID_EVENT_TYPES, *ids))
+                cursor.execute(f'DELETE FROM main.payments WHERE id IN ({placeholders})', ids)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            archived += len(ids)
+        return archived
+    finally:
+        conn.close()
+
+# Типы событий, которые считаются оплатой
+PAID_EVENT_TYPES = ('payment.success', 'subscription.recurring.payment.success')
+
+def create_stats_rollups(cursor: sqlite3.Cursor):
+    """
+    Создает таблицы агрегатов для статистики и триггеры, которые поддерживают их
+    при каждой записи в payments и channel_members. Триггеры срабатывают в той же
+    транзакции, что и изменение, поэтому агрегаты обновляются из любого процесса
+    и не могут разойтись с данными при сбое.
+    """
+    # Платежи по дням в разрезе продукта, валюты и типа события
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS payment_stats_daily (
+        day TEXT NOT NULL,
+        product_id TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        event_type TEXT NOT NULL,
+        events INTEGER NOT NULL DEFAULT 0,
+        amount REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, product_id, currency, event_type)
+    )
+    ''')
+
+    # Текущее количество участников в каждом статусе
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS member_status_counts (
+        status TEXT PRIMARY KEY,
+        members INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+
+    # Сколько участников перешло в каждый статус за день (отток - cancelled/removed)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS member_stats_daily (
+        day TEXT NOT NULL,
+        status TEXT NOT NULL,
+        transitions INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, status)
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS payments_stats_insert AFTER INSERT ON payments
+    BEGIN
+        INSERT INTO payment_stats_daily (day, product_id, currency, event_type, events, amount)
+        VALUES (substr(NEW.received_at, 1, 10), NEW.product_id, NEW.currency, NEW.event_type, 1, NEW.amount)
+        ON CONFLICT(day, product_id, currency, event_type) DO UPDATE SET
+            events = events + 1,
+            amount = amount + excluded.amount;
+    END
+    ''')
+
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS channel_members_stats_insert AFTER INSERT ON channel_members
+    BEGIN
+        INSERT INTO member_status_counts (status, members) VALUES (NEW.status, 1)
+        ON CONFLICT(status) DO UPDATE SET members = members + 1;
+        INSERT INTO member_stats_daily (day, status, transitions) VALUES (date('now'), NEW.status, 1)
+        ON CONFLICT(day, status) DO UPDATE SET transitions = transitions + 1;
+    END
+    ''')
+
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS channel_members_stats_update AFTER UPDATE OF status ON channel_members
+    WHEN OLD.status IS NOT NEW.status
+    BEGIN
+        UPDATE member_status_counts SET members = members - 1 WHERE status = OLD.status;
+        INSERT INTO member_status_counts (status, members) VALUES (NEW.status, 1)
+        ON CONFLICT(status) DO UPDATE SET members = members + 1;
+        INSERT INTO member_stats_daily (day, status, transitions) VALUES (date('now'), NEW.status, 1)
+        ON CONFLICT(day, status) DO UPDATE SET transitions = transitions + 1;
+    END
+    ''')
+
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS channel_members_stats_delete AFTER DELETE ON channel_members
+    BEGIN
+        UPDATE member_status_counts SET members = members - 1 WHERE status = OLD.status;
+    END
+    ''')
+
+def rebuild_stats_rollups() -> dict:
+    """
+    Пересчитывает агрегаты статистики по payments (включая архив) и channel_members
+    за один проход. Дневные переходы статусов участников не пересчитываются:
+    история переходов нигде, кроме самих агрегатов, не хранится.
+    """
+    payment_rows = sum(_rebuild_shard_rollups(shard) for shard in range(SHARD_COUNT))
+    logger.info(f"Агрегаты статистики пересчитаны: {payment_rows} строк по платежам")
+    return {"payment_rows": payment_rows}
+
+def _rebuild_shard_rollups(shard: int) -> int:
+    conn = connect_with_archive(shard)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            payment_rows = fill_stats_rollups(cursor)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return payment_rows
+    finally:
+        conn.close()
+
+def fill_stats_rollups(cursor: sqlite3.Cursor) -> int:
+    """
+    Заполняет агрегаты платежей и статусов участников заново в текущей транзакции курсора
+    (нужно представление payments_history, см. attach_archive). Возвращает число строк по платежам.
+    """
+    cursor.execute('DELETE FROM payment_stats_daily')
+    cursor.execute('''
+    INSERT INTO payment_stats_daily (day, product_id, currency, event_type, events, amount)
+    SELECT substr(received_at, 1, 10), product_id, currency, event_type, COUNT(*), COALESCE(SUM(amount), 0)
+    FROM payments_history
+    GROUP BY substr(received_at, 1, 10), product_id, currency, event_type
+    ''')
+    payment_rows = cursor.rowcount
+
+    cursor.execute('DELETE FROM member_status_counts')
+    cursor.execute('''
+    INSERT INTO member_status_counts (status, members)
+    SELECT status, COUNT(*) FROM channel_members GROUP BY status
+    ''')
+    return payment_rows
+
+def get_stats_summary(days: int = 30) -> dict:
+    """Сводная статистика из агрегатов: не требует сканирования payments (агрегаты шардов суммируются)"""
+    members, revenue, events, transitions = {}, {}, {}, {}
+    for shard in range(SHARD_COUNT):
+        _add_shard_stats(shard, days, members, revenue, events, transitions)
+    return {
+        "days": days,
+        "members": members,
+        "revenue": revenue,
+        "events": events,
+        "transitions": transitions,
+    }
+
+def _add_counts(total: dict, rows):
+    for key, count in rows:
+        total[key] = total.get(key, 0) + count
+
+def _add_shard_stats(shard: int, days: int, members: dict, revenue: dict, events: dict, transitions: dict):
+    since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).date().isoformat()
+    today = datetime.now(timezone.utc).date().isoformat()
+    placeholders = ",".join("?" * len(PAID_EVENT_TYPES))
+
+    conn = connect_shard(shard)
+    try:
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT status, members FROM member_status_counts')
+        _add_counts(members, cursor.fetchall())
+
+        cursor.execute(f'''
+        SELECT currency,
+               SUM(CASE WHEN day = ? THEN amount ELSE 0 END),
+               SUM(CASE WHEN day >= ? THEN amount ELSE 0 END),
+               SUM(amount)
+        FROM payment_stats_daily
+        WHERE event_type IN ({placeholders})
+        GROUP BY currency
+        ''', (today, since, *PAID_EVENT_TYPES))
+        for currency, today_amount, period_amount, total_amount in cursor.fetchall():
+            total = revenue.setdefault(currency, {"today": 0, "period": 0, "total": 0})
+            total["today"] += today_amount
+            total["period"] += period_amount
+            total["total"] += total_amount
+
+        cursor.execute('''
+        SELECT event_type, SUM(events) FROM payment_stats_daily
+        WHERE day >= ?
+        GROUP BY event_type
+        ''', (since,))
+        _add_counts(events, cursor.fetchall())
+
+        cursor.execute('''
+        SELECT status, SUM(transitions) FROM member_stats_daily
+        WHERE day >= ?
+        GROUP BY status
+        ''', (since,))
+        _add_counts(transitions, cursor.fetchall())
+    finally:
+        conn.close()
+
+# Инициализация схемы из командной строки; сервис создает схему сам при запуске (run.py)
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    ensure_schema()
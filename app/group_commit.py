@@ -0,0 +1,244 @@
+import os
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Optional
+
+import metrics
+from database import (
+    DB_PATH, SHARD_COUNT, acquire_connection, release_connection, connect_shard, shard_of,
+    take_staged, put_staged, clear_staged
+)
+
+# Групповая фиксация записей (group commit). Каждый вебхук записывает данные несколькими
+# короткими транзакциями, и каждая фиксация - это отдельный fsync журнала SQLite. Здесь
+# записи всех обработчиков выполняет один поток-писатель: он забирает все операции, которые
+# накопились в очереди, пока фиксировалась предыдущая пачка (но не больше GROUP_COMMIT_MAX_OPS),
+# и фиксирует их одной транзакцией. Каждая операция выполняется в своей точке сохранения (SAVEPOINT):
+# ошибка одной операции откатывает только ее. Результат операции (например, lastrowid)
+# вызывающий получает через Future только после фиксации пачки.
+#
+# Операция - функция operation(conn), которая только пишет и читает БД через conn (без
+# запросов к Telegram и Lava) и не вызывает conn.commit().
+#
+# При нескольких шардах (database.SHARD_COUNT) у каждого шарда свой писатель (writer_for):
+# записи пользователей разных шардов фиксируются параллельно. Общий writer пишет только
+# в основную БД (например, входящие вебхуки). Сообщения outbox и события сводки, записанные
+# операциями шарда, писатель шарда после фиксации пачки переносит в основную БД через общий
+# writer (relay_staged, см. database.STAGED_TABLES).
+
+# Групповая фиксация включена (false - каждая операция фиксируется отдельно, как раньше)
+GROUP_COMMIT = os.getenv("GROUP_COMMIT", "true").lower() in ("1", "true", "yes")
+# Наибольшее число операций в одной транзакции
+GROUP_COMMIT_MAX_OPS = int(os.getenv("GROUP_COMMIT_MAX_OPS", "64"))
+# Сколько миллисекунд после первой операции дополнительно ждать следующих (0 - не ждать;
+# ожидание в 1-2 мс имеет смысл, только если fsync на томе с БД медленный)
+GROUP_COMMIT_MAX_DELAY_MS = float(os.getenv("GROUP_COMMIT_MAX_DELAY_MS", "0"))
+# Как часто переносить в основную БД строки, записанные в шарды не писателем (проверка сроков, бот)
+SHARD_RELAY_INTERVAL = float(os.getenv("SHARD_RELAY_INTERVAL", "2"))
+# Писатель шарда переносит строки, когда его очередь опустела, а под нагрузкой - не чаще
+# одного раза за столько секунд (перенос - отдельная транзакция общего writer)
+SHARD_RELAY_MIN_DELAY = 0.1
+
+logger = logging.getLogger("group_commit")
+
+batch_size = metrics.histogram(
+    "group_commit_batch_operations", "Операций в одной групповой фиксации",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+commit_duration = metrics.histogram(
+    "group_commit_seconds", "Время выполнения и фиксации пачки операций",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+)
+
+def run_direct(operation: Callable[[sqlite3.Connection], Any], shard: Optional[int] = None) -> Any:
+    """Выполняет операцию в отдельной транзакции на соединении из пула (shard - соединение шарда)"""
+    conn = acquire_connection(shard)
+    try:
+        result = operation(conn)
+        conn.commit()
+        if shard is not None and SHARD_COUNT > 1:
+            relay_staged(shard, conn)
+        return result
+    finally:
+        release_connection(conn, shard)
+
+class GroupCommitWriter:
+    """Поток-писатель, фиксирующий операции пачками (shard - писатель шарда, None - основной БД)"""
+
+    def __init__(self, shard: Optional[int] = None, max_ops: int = GROUP_COMMIT_MAX_OPS,
+                 max_delay_ms: float = GROUP_COMMIT_MAX_DELAY_MS):
+        self.shard = shard
+        self.max_ops = max(1, max_ops)
+        self.max_delay = max(0.0, max_delay_ms) / 1000
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.thread: Optional[threading.Thread] = None
+
+    def submit(self, operation: Callable[[sqlite3.Connection], Any]) -> Future:
+        """Ставит операцию в очередь писателя. Future завершится после фиксации ее пачки"""
+        future = Future()
+        with self.lock:
+            if not GROUP_COMMIT or self.stopping:
+                # Писатель выключен или остановлен: выполняем сразу в вызывающем потоке
+                try:
+                    future.set_result(run_direct(operation, self.shard))
+                except Exception as e:
+                    future.set_exception(e)
+                return future
+            if self.thread is None:
+                name = "group-commit" if self.shard is None else f"group-commit-{self.shard}"
+                self.thread = threading.Thread(target=self._loop, name=name, daemon=True)
+                self.thread.start()
+            self.queue.put((operation, future))
+        return future
+
+    def run(self, operation: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Выполняет операцию и возвращает ее результат после фиксации"""
+        return self.submit(operation).result()
+
+    async def run_async(self, operation: Callable[[sqlite3.Connection], Any]) -> Any:
+        """То же для цикла событий: ожидание фиксации не блокирует другие запросы"""
+        if not GROUP_COMMIT:
+            return run_direct(operation, self.shard)
+        return await asyncio.wrap_future(self.submit(operation))
+
+    def stop(self, timeout: float) -> bool:
+        """Фиксирует операции из очереди и останавливает поток; новые операции выполняются сразу"""
+        with self.lock:
+            self.stopping = True
+            thread = self.thread
+            if thread is not None:
+                self.queue.put(None)
+        if thread is None:
+            return True
+        thread.join(timeout)
+        return not thread.is_alive()
+
+    def _loop(self):
+        # Транзакциями управляем сами (BEGIN / SAVEPOINT / COMMIT)
+        if self.shard is None:
+            conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+        else:
+            # Только файл шарда: BEGIN IMMEDIATE не блокирует основную БД и другие шарды
+            conn = connect_shard(self.shard, common=False, timeout=30, isolation_level=None)
+        try:
+            stop = False
+            last_relay = 0.0
+            while not stop:
+                item = self.queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + self.max_delay
+                while len(batch) < self.max_ops:
+                    try:
+                        item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stop = True
+                        break
+                    batch.append(item)
+                self._commit(conn, batch)
+                if (self.shard is not None and SHARD_COUNT > 1
+                        and (stop or self.queue.empty() or time.monotonic() - last_relay >= SHARD_RELAY_MIN_DELAY)):
+                    last_relay = time.monotonic()
+                    try:
+                        relay_staged(self.shard, conn)
+                    except Exception as e:
+                        # Строки останутся в шарде до следующей пачки или периодического переноса
+                        logger.error(f"Не удалось перенести строки шарда {self.shard} в основную БД: {str(e)}")
+        finally:
+            conn.close()
+
+    def _commit(self, conn: sqlite3.Connection, batch: list):
+        started = time.perf_counter()
+        done = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for operation, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT operation")
+                try:
+                    result = operation(conn)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO operation")
+                    conn.execute("RELEASE operation")
+                    future.set_exception(e)
+                    continue
+                conn.execute("RELEASE operation")
+                done.append((future, result))
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось зафиксировать пачку из {len(batch)} операций: {str(e)}")
+            if conn.in_transaction:
+                conn.rollback()
+            for future, _ in done:
+                future.set_exception(e)
+            # Операции, до которых не дошла очередь (ошибка BEGIN), тоже завершаем ошибкой
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        batch_size.observe(len(batch))
+        commit_duration.observe(time.perf_counter() - started)
+        for future, result in done:
+            future.set_result(result)
+
+writer = GroupCommitWriter()
+shard_writers = {}
+shard_writers_lock = threading.Lock()
+
+def writer_for(user_id) -> GroupCommitWriter:
+    """Писатель для операций с данными пользователя (без шардов - общий writer)"""
+    if SHARD_COUNT == 1:
+        return writer
+    shard = shard_of(user_id)
+    with shard_writers_lock:
+        if shard not in shard_writers:
+            shard_writers[shard] = GroupCommitWriter(shard)
+        return shard_writers[shard]
+
+def stop_writers(timeout: float) -> bool:
+    """Останавливает все писатели, дожидаясь фиксации их очередей не дольше timeout секунд"""
+    deadline = time.monotonic() + timeout
+    with shard_writers_lock:
+        writers = [writer] + list(shard_writers.values())
+    stopped = True
+    for current in writers:
+        stopped = current.stop(max(0.0, deadline - time.monotonic())) and stopped
+    return stopped
+
+def relay_staged(shard: int, conn: Optional[sqlite3.Connection] = None) -> int:
+    """
+    Переносит сообщения outbox и события сводки, записанные в шард, в основную БД
+    (одна транзакция общего writer). Возвращает число перенесенных строк.
+    """
+    own_connection = conn is None
+    if own_connection:
+        conn = acquire_connection(shard)
+    try:
+        staged = take_staged(conn, shard)
+        if not staged:
+            return 0
+        writer.run(lambda main_conn: put_staged(main_conn, staged))
+        clear_staged(conn, staged)
+        if conn.in_transaction:
+            conn.commit()
+    finally:
+        if own_connection:
+            release_connection(conn, shard)
+    from outbox import sender
+    sender.wake()
+    return sum(len(rows) for _, rows in staged.values())
+
+def relay_all_staged() -> int:
+    """Периодический перенос строк всех шардов (записи вне писателей шардов)"""
+    return sum(relay_staged(shard) for shard in range(SHARD_COUNT))
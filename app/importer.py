@@ -0,0 +1,288 @@
+import os
+import sys
+import json
+import logging
+import time
+import argparse
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Iterator, Optional
+
+from database import ensure_schema
+from storage import storage
+
+# Пакетный импорт событий Lava (пропущенные вебхуки, перенос из другой системы).
+# В отличие от /lava/payment, события не обрабатываются по одному: они проверяются,
+# записываются в payments пачками (одна транзакция на пачку, в PostgreSQL - через COPY), а состояние
+# channel_members пересчитывается один раз в конце по всем импортированным событиям.
+# Уведомления пользователям не отправляются, если не указан notify (см. import_events).
+# Повторный импорт тех же событий безопасен: событие с уже записанной парой
+# (eventType, contractId) пропускается. Архив платежей при этой проверке не учитывается.
+
+# Сколько событий записывается в одной транзакции
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "5000"))
+# Наибольшее число событий в одном запросе POST /lava/payments/batch
+IMPORT_MAX_EVENTS_PER_REQUEST = int(os.getenv("IMPORT_MAX_EVENTS_PER_REQUEST", "10000"))
+# Сколько ошибок проверки событий возвращается в отчете
+IMPORT_MAX_REPORTED_ERRORS = 100
+
+PAYMENT_EVENTS = ("payment.success", "subscription.recurring.payment.success")
+
+logger = logging.getLogger("importer")
+
+def iter_raw_events(data: bytes) -> Iterator[bytes]:
+    """Разбивает JSON-массив или JSONL на тела отдельных событий"""
+    stripped = data.lstrip()
+    if stripped[:1] == b"[":
+        for item in json.loads(stripped):
+            yield json.dumps(item, ensure_ascii=False).encode()
+        return
+    for line in data.splitlines():
+        if line.strip():
+            yield line
+
+def iter_file_events(path: str) -> Iterator[bytes]:
+    """События из файла JSON-массива или JSONL ("-" - стандартный ввод); JSONL читается построчно"""
+    stream = sys.stdin.buffer if path == "-" else open(path, "rb")
+    try:
+        first = stream.peek(1)[:1]
+        while first and first.isspace():
+            stream.read(1)
+            first = stream.peek(1)[:1]
+        if first == b"[":
+            yield from iter_raw_events(stream.read())
+            return
+        for line in stream:
+            if line.strip():
+                yield line.rstrip(b"\r\n")
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+
+def _parse_time(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+class _Batch:
+    """Проверенные события одной пачки: строки для payments и данные для пересчета подписок"""
+
+    def __init__(self):
+        self.keys = set()
+        self.rows = []
+        self.events = []
+
+def _prepare(raw: bytes, imported_at: str, periods: dict):
+    """Строка payments и событие для пересчета подписки по телу события"""
+    from main import parse_webhook_payload, compress_raw_data, normalize_datetime_string
+    from subscriptions import get_periodicity_by_amount, PERIOD_DAYS
+
+    payload = parse_webhook_payload(raw)
+    if payload.eventType == "subscription.cancelled":
+        event_time = normalize_datetime_string(payload.cancelledAt)
+        amount, currency = 0, 'RUB'
+    else:
+        event_time = normalize_datetime_string(payload.timestamp)
+        amount, currency = payload.amount, payload.currency
+        if amount is None or currency is None:
+            raise ValueError("Для события оплаты обязательны amount и currency")
+    # Для статистики по дням событие учитывается в день, когда произошло
+    received_at = event_time or imported_at
+    status = 'cancelled' if payload.eventType == "subscription.cancelled" else payload.status
+    row = (
+        payload.eventType, payload.product.id, payload.product.title, payload.buyer.email,
+        payload.contractId, payload.parentContractId, amount, currency, event_time or imported_at,
+        status or '', payload.errorMessage, compress_raw_data(raw), received_at
+    )
+
+    days = None
+    if payload.eventType in PAYMENT_EVENTS:
+        key = (amount, currency, payload.product.id)
+        if key not in periods:
+            periods[key] = PERIOD_DAYS.get(get_periodicity_by_amount(*key), 30)
+        days = periods[key]
+    moment = _parse_time(received_at) or datetime.now(timezone.utc)
+    # Для пересчета подписки: (пользователь, время события, тип, дней подписки, окончание при отмене,
+    # контракт оплаты - для ключей уведомлений). Время хранится числом: событий может быть миллион
+    event = (
+        payload.buyer.email.split('@')[0], moment.timestamp(), payload.eventType, days,
+        normalize_datetime_string(payload.willExpireAt),
+        payload.contractId if payload.eventType == "payment.success" else None
+    )
+    return (payload.eventType, payload.contractId), row, event
+
+def _write_batch(partition: int, batch: _Batch, report: dict, dry_run: bool) -> list:
+    """Записывает новые события пачки одной транзакцией; возвращает события с id платежей"""
+    with storage.import_transaction(partition, dry_run) as conn:
+        written = storage.import_payments(conn, batch.rows, dry_run)
+    report["duplicates"] += len(batch.rows) - len(written)
+    report["imported"] += len(written)
+    return [(batch.events[index], payment_id) for index, payment_id in written]
+
+def _apply(state: dict, event: tuple):
+    """
+    Применяет событие к состоянию подписки так же, как обработка вебхука.
+    Событие: (время, тип, дней подписки, окончание при отмене, контракт оплаты, id платежа)
+    """
+    moment, event_type, days, will_expire_at, contract_id, payment_id = event
+    if event_type in PAYMENT_EVENTS:
+        moment = datetime.fromtimestamp(moment, timezone.utc)
+        if event_type == "payment.success" or state["joined_at"] is None:
+            state["joined_at"] = moment.isoformat()
+        state["status"] = 'active'
+        state["end"] = (moment + timedelta(days=days)).isoformat()
+        state["last_payment_id"] = payment_id
+        state["activated_by"] = (contract_id, payment_id)
+    elif event_type == "subscription.cancelled" and state["status"] == 'active':
+        # Отмена выключает только продление: оплаченный доступ (и ссылка на канал) сохраняется
+        state["status"] = 'cancelled'
+        state["end"] = will_expire_at or state["end"]
+
+def rebuild_members(partition: int, by_user: dict, notify: bool = False, dry_run: bool = False) -> int:
+    """
+    Пересчитывает channel_members для пользователей импортированных событий. Исходное
+    состояние - текущая запись; к ней по порядку применяются события новее последнего
+    учтенного в ней платежа (старые события только сохраняются в истории платежей).
+    Подписка, срок которой уже истек, получает статус removed: проверка сроков не будет
+    удалять таких пользователей из канала и уведомлять их. С notify пользователи, чья
+    подписка активирована импортированной оплатой, получают ссылку на канал через outbox.
+    by_user - события каждого пользователя в формате _apply.
+    """
+    if not by_user:
+        return 0
+
+    with storage.import_transaction(partition, dry_run) as conn:
+        current = storage.import_members(conn, by_user)
+        now = datetime.now(timezone.utc)
+        updates, activated = [], []
+        for user_id, user_events in by_user.items():
+            status, joined_at, end, last_payment_id, as_of = current.get(user_id, (None, None, None, None, None))
+            state = {"status": status, "joined_at": joined_at, "end": end,
+                     "last_payment_id": last_payment_id, "activated_by": None}
+            as_of_time = _parse_time(as_of)
+            as_of_timestamp = as_of_time.timestamp() if as_of_time is not None else None
+            changed = False
+            for event in sorted(user_events, key=lambda event: event[0]):
+                if as_of_timestamp is not None and event[0] <= as_of_timestamp:
+                    continue
+                _apply(state, event)
+                changed = True
+            if not changed or state["status"] is None:
+                continue
+            end_time = _parse_time(state["end"])
+            if state["status"] in ('active', 'cancelled') and end_time is not None and end_time < now:
+                state["status"] = 'removed'
+                state["activated_by"] = None
+            updates.append((user_id, state["status"], state["joined_at"], state["end"], state["last_payment_id"]))
+            if state["activated_by"] is not None:
+                activated.append((user_id, state["activated_by"]))
+
+        # С dry_run транзакция откатывается при выходе из блока
+        if dry_run:
+            return len(updates)
+        storage.upsert_members(conn, updates)
+        storage.clear_reminders(conn, [update[0] for update in updates if update[1] == 'active'])
+        if notify:
+            from subscriptions import add_user_to_channel, notification_key
+            for user_id, (contract_id, payment_id) in activated:
+                # Те же ключи, что у вебхука: если он уже был обработан, сообщения не повторятся
+                add_user_to_channel(user_id, conn, notification_key("payment.success", user_id, contract_id, payment_id))
+    return len(updates)
+
+def import_events(raw_events: Iterable[bytes], source: str = "api", notify: bool = False,
+                  dry_run: bool = False, batch_size: int = IMPORT_BATCH_SIZE) -> dict:
+    """
+    Импортирует события Lava (тела вебхуков). Некорректные события пропускаются и попадают
+    в отчет (не больше IMPORT_MAX_REPORTED_ERRORS). Возвращает отчет: сколько событий
+    прочитано, записано, пропущено как повторы и с ошибками, сколько подписок обновлено.
+    """
+    started = time.monotonic()
+    report = {"received": 0, "imported": 0, "duplicates": 0, "invalid": 0, "members_updated": 0, "errors": []}
+    imported_at = datetime.now(timezone.utc).isoformat()
+    periods = {}
+    by_user = {}
+
+    def collect(written: list):
+        for event, payment_id in written:
+            by_user.setdefault(event[0], []).append(event[1:] + (payment_id,))
+
+    # При нескольких шардах (database.SHARD_COUNT) события делятся по шарду пользователя:
+    # у каждого шарда свои пачки и пересчет подписок
+    batches = {}
+    for index, raw in enumerate(raw_events):
+        report["received"] += 1
+        try:
+            key, row, event = _prepare(raw, imported_at, periods)
+        except Exception as e:
+            report["invalid"] += 1
+            if len(report["errors"]) < IMPORT_MAX_REPORTED_ERRORS:
+                report["errors"].append({"index": index, "error": str(e)[:300]})
+            continue
+        partition = storage.partition_of(event[0])
+        batch = batches.setdefault(partition, _Batch())
+        # Повторы внутри пачки; с уже записанными пачками сверяется _write_batch
+        if key in batch.keys:
+            report["duplicates"] += 1
+            continue
+        batch.keys.add(key)
+        batch.rows.append(row)
+        batch.events.append(event)
+        if len(batch.rows) >= batch_size:
+            collect(_write_batch(partition, batch, report, dry_run))
+            batches[partition] = _Batch()
+    for partition, batch in batches.items():
+        if batch.rows:
+            collect(_write_batch(partition, batch, report, dry_run))
+
+    by_partition = {}
+    for user_id, user_events in by_user.items():
+        by_partition.setdefault(storage.partition_of(user_id), {})[user_id] = user_events
+    for partition, partition_users in by_partition.items():
+        report["members_updated"] += rebuild_members(partition, partition_users, notify, dry_run)
+
+    report["seconds"] = round(time.monotonic() - started, 2)
+    logger.info(
+        f"Импорт событий ({source}{', проверка без записи' if dry_run else ''}): прочитано {report['received']}, "
+        f"записано {report['imported']}, повторов {report['duplicates']}, с ошибками {report['invalid']}, "
+        f"обновлено подписок {report['members_updated']} за {report['seconds']} с"
+    )
+    if report["imported"] and not dry_run:
+        from subscriptions import notify_admin
+        notify_admin(
+            f"📥 <b>Импорт событий</b> ({source}): записано {report['imported']}, "
+            f"обновлено подписок {report['members_updated']}",
+            category="import",
+            summary=f"{source}: событий {report['imported']}, подписок {report['members_updated']}"
+        )
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Импорт событий Lava (тел вебхуков) из файлов JSON-массива или JSONL"
+    )
+    parser.add_argument("files", nargs="+", help='Файлы с событиями ("-" - стандартный ввод)')
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE,
+                        help=f"Событий в одной транзакции (по умолчанию {IMPORT_BATCH_SIZE})")
+    parser.add_argument("--notify", action="store_true",
+                        help="Отправить ссылку на канал пользователям, подписка которых активирована импортом")
+    parser.add_argument("--dry-run", action="store_true", help="Проверить события, ничего не записывая")
+    args = parser.parse_args()
+
+    from logging_setup import configure_logging
+    configure_logging()
+    ensure_schema()
+
+    def all_events():
+        for path in args.files:
+            yield from iter_file_events(path)
+
+    report = import_events(all_events(), ", ".join(args.files), args.notify, args.dry_run, args.batch_size)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.notify and report["members_updated"]:
+        print("Сообщения поставлены в outbox и будут отправлены запущенным сервисом")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import os
+import math
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from database import acquire_connection, release_connection
+from storage import storage
+
+# Пул заранее созданных одноразовых ссылок-приглашений в канал.
+# Ссылки создаются фоновой задачей бота, а обработка payment.success только
+# забирает готовую ссылку из БД и не ждет ответа Telegram.
+
+# Срок действия создаваемой ссылки (как и раньше - 30 дней)
+INVITE_LINK_TTL = 2592000
+# Ссылка выдается, только если ей осталось действовать не меньше этого срока;
+# более старые неиспользованные ссылки отзываются
+INVITE_LINK_MIN_VALID_DAYS = int(os.getenv("INVITE_LINK_MIN_VALID_DAYS", "20"))
+# Границы размера пула: внутри них размер подстраивается под частоту оплат
+INVITE_POOL_MIN = int(os.getenv("INVITE_POOL_MIN", "5"))
+INVITE_POOL_MAX = int(os.getenv("INVITE_POOL_MAX", "200"))
+# На сколько часов продаж в текущем темпе должно хватать пула
+INVITE_POOL_COVER_HOURS = float(os.getenv("INVITE_POOL_COVER_HOURS", "2"))
+# Сколько ссылок создается и отзывается за один проход фоновой задачи
+INVITE_POOL_BATCH_SIZE = int(os.getenv("INVITE_POOL_BATCH_SIZE", "20"))
+# Через сколько часов после выдачи ссылка отзывается, даже если ею не воспользовались
+# (0 - выданная ссылка действует до своего срока, пока у получателя есть доступ)
+INVITE_LINK_ISSUED_TTL_HOURS = float(os.getenv("INVITE_LINK_ISSUED_TTL_HOURS", "168"))
+
+logger = logging.getLogger("invite_pool")
+
+def _min_expire_date() -> int:
+    return int(time.time()) + INVITE_LINK_MIN_VALID_DAYS * 86400
+
+def take_invite_link(user_id) -> Optional[str]:
+    """Атомарно выдает пользователю одну ссылку из пула. Возвращает None, если пул пуст."""
+    conn = acquire_connection()
+    try:
+        cursor = conn.cursor()
+        # Один UPDATE ... RETURNING под блокировкой записи SQLite: одна ссылка
+        # не может достаться двум платежам, даже если их обрабатывают разные процессы
+        cursor.execute('''
+        UPDATE invite_links
+        SET issued_to = ?, issued_at = ?
+        WHERE invite_link = (
+            SELECT invite_link FROM invite_links
+            WHERE issued_to IS NULL AND revoked_at IS NULL AND expire_date > ?
+            ORDER BY expire_date
+            LIMIT 1
+        )
+        RETURNING invite_link
+        ''', (str(user_id), datetime.now(timezone.utc).isoformat(), _min_expire_date()))
+        row = cursor.fetchone()
+        conn.commit()
+        return row[0] if row else None
+    finally:
+        release_connection(conn)
+
+def record_issued_link(user_id, invite_link: str, expire_date: int):
+    """Записывает ссылку, созданную напрямую (пул был пуст), чтобы ее тоже отозвала очистка"""
+    conn = acquire_connection()
+    try:
+        now = datetime.now(timezone.utc).isoformat()
+        conn.execute('''
+        INSERT OR IGNORE INTO invite_links (invite_link, created_at, expire_date, issued_to, issued_at)
+        VALUES (?, ?, ?, ?, ?)
+        ''', (invite_link, now, expire_date, str(user_id), now))
+        conn.commit()
+    finally:
+        release_connection(conn)
+
+def target_pool_size() -> int:
+    """Размер пула по частоте оплат за последний час и за последние сутки (по всему хранилищу)"""
+    now = datetime.now(timezone.utc)
+    last_hour, last_day = storage.count_new_payments(
+        (now - timedelta(hours=1)).isoformat(), (now - timedelta(days=1)).isoformat()
+    )
+    payments_per_hour = max(last_hour, last_day / 24)
+    target = math.ceil(payments_per_hour * INVITE_POOL_COVER_HOURS)
+    return max(INVITE_POOL_MIN, min(INVITE_POOL_MAX, target))
+
+def refill_invite_pool(bot, channel_id) -> int:
+    """Досоздает ссылки до целевого размера пула, не больше INVITE_POOL_BATCH_SIZE за вызов"""
+    conn = acquire_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT COUNT(*) FROM invite_links
+        WHERE issued_to IS NULL AND revoked_at IS NULL AND expire_date > ?
+        ''', (_min_expire_date(),))
+        available = cursor.fetchone()[0]
+        missing = min(target_pool_size() - available, INVITE_POOL_BATCH_SIZE)
+
+        created = 0
+        for _ in range(max(0, missing)):
+            expire_date = int(time.time()) + INVITE_LINK_TTL
+            try:
+                invite_link = bot.create_chat_invite_link(
+                    chat_id=channel_id,
+                    member_limit=1,
+                    expire_date=expire_date
+                )
+            except Exception as e:
+                # Скорее всего, лимит Telegram: продолжим на следующем проходе
+                logger.warning(f"Не удалось создать ссылку для пула приглашений: {e}")
+                break
+            cursor.execute('''
+            INSERT INTO invite_links (invite_link, created_at, expire_date)
+            VALUES (?, ?, ?)
+            ''', (invite_link.invite_link, datetime.now(timezone.utc).isoformat(), expire_date))
+            conn.commit()
+            created += 1
+
+        if created > 0:
+            logger.info(f"Пул приглашений пополнен на {created} ссылок (было доступно {available})")
+        return created
+    finally:
+        release_connection(conn)
+
+def _has_access(user_id, now: datetime) -> bool:
+    end_date = storage.access_end_date(user_id)
+    if not end_date:
+        return False
+    try:
+        end = datetime.fromisoformat(str(end_date).replace('Z', '+00:00'))
+    except ValueError:
+        return False
+    return (end if end.tzinfo else end.replace(tzinfo=timezone.utc)) > now
+
+def _stale_issued_links(cursor, limit: int) -> list:
+    """
+    Выданные ссылки, которые пора отозвать: выданы раньше INVITE_LINK_ISSUED_TTL_HOURS
+    назад или у получателя уже нет доступа к каналу. Отзыв использованной ссылки
+    (member_limit=1) ничего не меняет, а по неиспользованной после этого не войти.
+    """
+    now = datetime.now(timezone.utc)
+    issued_before = ""
+    if INVITE_LINK_ISSUED_TTL_HOURS > 0:
+        issued_before = (now - timedelta(hours=INVITE_LINK_ISSUED_TTL_HOURS)).isoformat()
+    cursor.execute('''
+    SELECT invite_link, issued_to, issued_at FROM invite_links
+    WHERE issued_to IS NOT NULL AND revoked_at IS NULL
+    ORDER BY issued_at
+    ''')
+    stale = []
+    for invite_link, user_id, issued_at in cursor.fetchall():
+        if len(stale) >= limit:
+            break
+        if issued_at < issued_before or not _has_access(user_id, now):
+            stale.append(invite_link)
+    return stale
+
+def revoke_stale_invite_links(bot, channel_id) -> int:
+    """
+    Отзывает неиспользованные ссылки пула, которым осталось действовать меньше
+    INVITE_LINK_MIN_VALID_DAYS, и устаревшие выданные ссылки (см. _stale_issued_links).
+    Удаляет записи об уже истекших ссылках.
+    """
+    conn = acquire_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT invite_link FROM invite_links
+        WHERE issued_to IS NULL AND revoked_at IS NULL AND expire_date <= ?
+        ORDER BY expire_date
+        LIMIT ?
+        ''', (_min_expire_date(), INVITE_POOL_BATCH_SIZE))
+        stale_links = [row[0] for row in cursor.fetchall()]
+        stale_links += _stale_issued_links(cursor, INVITE_POOL_BATCH_SIZE)
+
+        revoked = []
+        for link in stale_links:
+            try:
+                bot.revoke_chat_invite_link(channel_id, link)
+            except Exception as e:
+                # Ссылка могла уже истечь - все равно исключаем ее из пула
+                logger.warning(f"Не удалось отозвать ссылку-приглашение {link}: {e}")
+            revoked.append((datetime.now(timezone.utc).isoformat(), link))
+        cursor.executemany('UPDATE invite_links SET revoked_at = ? WHERE invite_link = ?', revoked)
+
+        # Истекшие ссылки больше не действуют - хранить их незачем
+        cursor.execute('DELETE FROM invite_links WHERE expire_date < ?', (int(time.time()),))
+        conn.commit()
+
+        if revoked:
+            logger.info(f"Отозвано {len(revoked)} устаревших ссылок-приглашений")
+        return len(revoked)
+    finally:
+        release_connection(conn)
@@ -0,0 +1,191 @@
+import os
+import logging
+import socket
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+import metrics
+from database import acquire_connection, release_connection
+
+# Выбор ведущего экземпляра для фоновых задач. Если несколько контейнеров работают с одним
+# томом /mount/database (например, при обновлении без простоя), задачи с арендой (lease)
+# выполняет только тот процесс, который держит строку аренды в leader_lease. Аренда
+# продлевается каждые LEADER_HEARTBEAT секунд и истекает через LEADER_LEASE_TTL секунд
+# без продления - тогда ее забирает другой процесс. При каждой смене владельца номер
+# аренды (fencing token) увеличивается: процесс, который «проспал» потерю аренды, по нему
+# узнает, что больше не ведущий, и не выполняет действия задачи.
+
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "10"))
+LEADER_HEARTBEAT = float(os.getenv("LEADER_HEARTBEAT", "3"))
+
+# Процесс перестает считать себя ведущим раньше, чем аренду смогут забрать другие:
+# через (1 - STEP_DOWN_MARGIN) * LEADER_LEASE_TTL после последнего продления
+STEP_DOWN_MARGIN = 0.2
+
+logger = logging.getLogger("leader")
+
+leader_changes = metrics.counter("leader_changes_total", "Получение и потеря аренды ведущего (по аренде и событию)")
+
+# Идентификатор процесса-претендента: хост (контейнер), pid и случайная часть на случай повтора pid
+HOLDER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def try_acquire(name: str, holder: str = HOLDER_ID, ttl: float = LEADER_LEASE_TTL) -> Optional[int]:
+    """
+    Получает или продлевает аренду одной атомарной командой. Возвращает номер аренды
+    (fencing token), если аренда у holder, иначе None.
+    """
+    now = time.time()
+    conn = acquire_connection()
+    try:
+        row = conn.execute('''
+        INSERT INTO leader_lease (name, holder, token, expires_at, renewed_at)
+        VALUES (?, ?, 1, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET
+            token = CASE WHEN leader_lease.holder = excluded.holder
+                         THEN leader_lease.token ELSE leader_lease.token + 1 END,
+            holder = excluded.holder,
+            expires_at = excluded.expires_at,
+            renewed_at = excluded.renewed_at
+        WHERE leader_lease.holder = excluded.holder OR leader_lease.expires_at < ?
+        RETURNING token
+        ''', (name, holder, now + ttl, now, now)).fetchone()
+        conn.commit()
+        return row[0] if row else None
+    finally:
+        release_connection(conn)
+
+def release(name: str, holder: str = HOLDER_ID):
+    """Освобождает аренду, чтобы другой процесс забрал ее сразу, не дожидаясь истечения"""
+    conn = acquire_connection()
+    try:
+        conn.execute('UPDATE leader_lease SET expires_at = 0 WHERE name = ? AND holder = ?', (name, holder))
+        conn.commit()
+    finally:
+        release_connection(conn)
+
+def holds_lease(name: str, token: int, holder: str = HOLDER_ID) -> bool:
+    """Проверяет по БД, что аренда с этим номером все еще у holder и не истекла"""
+    conn = acquire_connection()
+    try:
+        row = conn.execute(
+            'SELECT 1 FROM leader_lease WHERE name = ? AND holder = ? AND token = ? AND expires_at > ?',
+            (name, holder, token, time.time())
+        ).fetchone()
+        return row is not None
+    finally:
+        release_connection(conn)
+
+def get_leases() -> List[dict]:
+    """Текущие аренды всех процессов для просмотра администратором"""
+    conn = acquire_connection()
+    try:
+        now = time.time()
+        return [
+            {"name": name, "holder": holder, "token": token, "active": expires_at > now,
+             "expires_in": round(expires_at - now, 1)}
+            for name, holder, token, expires_at in conn.execute(
+                'SELECT name, holder, token, expires_at FROM leader_lease ORDER BY name'
+            ).fetchall()
+        ]
+    finally:
+        release_connection(conn)
+
+class LeaderElector:
+    """Поддерживает аренды процесса: фоновый поток продлевает их и забирает освободившиеся"""
+
+    def __init__(self, on_change: Optional[Callable[[], None]] = None):
+        self.on_change = on_change
+        self.lock = threading.Lock()
+        # аренда -> (номер аренды, до какого момента time.monotonic() процесс считает себя ведущим)
+        self.leases: Dict[str, Optional[tuple]] = {}
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def add(self, name: str):
+        with self.lock:
+            self.leases.setdefault(name, None)
+
+    def is_leader(self, name: str) -> bool:
+        with self.lock:
+            lease = self.leases.get(name)
+        return lease is not None and time.monotonic() < lease[1]
+
+    def token(self, name: str) -> Optional[int]:
+        with self.lock:
+            lease = self.leases.get(name)
+        return lease[0] if lease is not None and time.monotonic() < lease[1] else None
+
+    def verify(self, name: str) -> bool:
+        """Проверка перед действием задачи: аренда не потеряна ни по локальным часам, ни по БД"""
+        token = self.token(name)
+        if token is None:
+            return False
+        try:
+            return holds_lease(name, token)
+        except Exception as e:
+            logger.warning(f"Не удалось проверить аренду {name}: {str(e)}")
+            return False
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._loop, name="leader_election", daemon=True)
+        # Первая попытка сразу: единственный экземпляр становится ведущим без ожидания
+        self._heartbeat()
+        with self.lock:
+            standby = [name for name, lease in self.leases.items() if lease is None]
+        for name in standby:
+            logger.info(f"Аренда {name} у другого процесса, задачи этой аренды выполнит он")
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        # Дожидаемся текущего продления, иначе оно может вернуть аренду уже после освобождения
+        if self.thread is not None:
+            self.thread.join(5)
+        with self.lock:
+            held = [name for name, lease in self.leases.items() if lease is not None]
+            self.leases = dict.fromkeys(self.leases)
+        for name in held:
+            try:
+                release(name)
+                logger.info(f"Аренда {name} освобождена")
+            except Exception as e:
+                logger.warning(f"Не удалось освободить аренду {name}: {str(e)}")
+
+    def _loop(self):
+        while not self.stopping.wait(LEADER_HEARTBEAT):
+            self._heartbeat()
+
+    def _heartbeat(self):
+        changed = False
+        with self.lock:
+            names = list(self.leases)
+        for name in names:
+            started = time.monotonic()
+            try:
+                token = try_acquire(name)
+            except Exception as e:
+                # Продлить не удалось: остаемся ведущим только до истечения прежнего срока
+                logger.warning(f"Не удалось продлить аренду {name}: {str(e)}")
+                continue
+            with self.lock:
+                previous = self.leases.get(name)
+                if token is None:
+                    self.leases[name] = None
+                else:
+                    # Срок отсчитывается от начала запроса, а не от ответа БД
+                    self.leases[name] = (token, started + LEADER_LEASE_TTL * (1 - STEP_DOWN_MARGIN))
+            if (previous is None) != (token is None) or (previous and token and previous[0] != token):
+                changed = True
+                if token is None:
+                    leader_changes.inc(lease=name, event="lost")
+                    logger.warning(f"Аренда {name} у другого процесса, задачи этой аренды здесь не выполняются")
+                else:
+                    leader_changes.inc(lease=name, event="acquired")
+                    logger.info(f"Процесс {HOLDER_ID} стал ведущим для {name} (номер аренды {token})")
+        if changed and self.on_change:
+            self.on_change()
@@ -0,0 +1,20 @@
+import logging
+import time
+
+from database import DATA_DIR
+
+def configure_logging():
+    """
+    Настраивает логирование в файл за текущий день и в консоль.
+    Вызывается при запуске процесса, а не при импорте модулей.
+    """
+    DATA_DIR.mkdir(exist_ok=True)
+    log_file = DATA_DIR / f"log_{time.strftime('%Y%m%d')}.log"
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        handlers=[
+            logging.FileHandler(log_file),
+            logging.StreamHandler()
+        ]
+    )
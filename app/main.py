@@ -11,11 +11,36 @@ import secrets
 import sqlite3
 import json
 from pydantic import BaseModel
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 import hashlib
 import base64
 import time
-import requests
+import zlib
+import fcntl
+import csv
+import io
+import uuid
+
+from logging_setup import configure_logging
+from scheduler import scheduler, IntervalTrigger, parse_trigger, get_job_states
+from leader import get_leases
+import outbox
+import importer
+import replay
+from group_commit import writer, stop_writers, SHARD_RELAY_INTERVAL
+from storage import storage, require_sqlite
+from admin_digest import ADMIN_DIGEST_CHECK_INTERVAL
+from database import (
+    DATA_DIR, DB_PATH, SCHEMA_VERSION, init_db, ensure_schema, get_schema_version,
+    archive_old_payments, attach_archive, acquire_connection, release_connection,
+    rebuild_stats_rollups, SHARD_COUNT, SHARDED_TABLES, connect_shard
+)
+
+try:
+    import orjson  # Быстрый JSON-парсер (requirements.txt); без него - model_validate_json
+except ImportError:
+    orjson = None
 
 # Вспомогательная функция для нормализации строковых представлений дат
 def normalize_datetime_string(dt_str: Optional[str]) -> Optional[str]:
@@ -33,19 +58,6 @@ def normalize_datetime_string(dt_str: Optional[str]) -> Optional[str]:
             return dt_str # В случае полной неудачи возвращаем исходную строку
     return dt_obj.isoformat() # Всегда возвращаем в ISO формате с часовым поясом
 
-# Настройка логирования
-DATA_DIR = Path("/mount/database")
-DATA_DIR.mkdir(exist_ok=True)
-
-log_file = DATA_DIR / f"log_{time.strftime('%Y%m%d')}.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger("lava_webhook")
 
 # Инициализация FastAPI
@@ -55,7 +67,20 @@ security = HTTPBasic()
 # Получение настроек из переменных окружения
 USERNAME = os.getenv("WEBHOOK_USERNAME", "admin")
 PASSWORD = os.getenv("WEBHOOK_PASSWORD", "password")
-DB_PATH = DATA_DIR / "lava_payments.db"
+LAVA_API_URL = os.getenv("LAVA_API_URL", "https://gate.lava.top").rstrip("/")
+# Как долго /readyz использует результат проверки доступности Telegram и Lava (в секундах)
+READINESS_CACHE_SECONDS = int(os.getenv("READINESS_CACHE_SECONDS", "30"))
+# Расписание переноса старых платежей в архив: интервал в секундах или выражение cron (UTC)
+ARCHIVE_SCHEDULE = os.getenv("ARCHIVE_SCHEDULE", os.getenv("ARCHIVE_INTERVAL", "86400"))
+# Сколько секунд при остановке ждать завершения выполняющихся фоновых задач
+SCHEDULER_STOP_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "8"))
+# Идентификатор запуска сервиса, общий для всех его воркеров (задается run.py).
+# По нему вебхуки, прерванные прошлым запуском, отличаются от обрабатываемых сейчас
+RUN_ID = os.getenv("RUN_ID") or uuid.uuid4().hex
+# Через сколько секунд необработанный вебхук другого запуска считается брошенным
+WEBHOOK_RESUME_AFTER = int(os.getenv("WEBHOOK_RESUME_AFTER", "60"))
+# Аренда, под которой выполняются фоновые задачи API (см. leader.py)
+API_JOBS_LEASE = "api_jobs"
 
 # Модели данных
 class Product(BaseModel):
@@ -79,74 +104,122 @@ class WebhookPayload(BaseModel):
     cancelledAt: Optional[str] = None
     willExpireAt: Optional[str] = None
 
+def parse_webhook_payload(body: bytes) -> WebhookPayload:
+    """Валидирует тело вебхука напрямую из байтов"""
+    if orjson is not None:
+        return WebhookPayload.model_validate(orjson.loads(body))
+    return WebhookPayload.model_validate_json(body)
+
 # Добавляем новую модель для запроса сокращения ссылки
 class ShortenLinkRequest(BaseModel):
     original_url: str
 
-# Инициализация базы данных
-def init_db():
-    """Инициализация базы данных при запуске"""
+# Общий словарь zlib для сжатия raw_data: типичные ключи и значения вебхуков Lava.
+# Короткие JSON-документы почти не сжимаются без словаря, с ним - в несколько раз.
+# Менять словарь нельзя: по нему распаковываются уже сохраненные записи.
+RAW_DATA_ZDICT = (
+    b'"errorMessage":"","cancelledAt":"","willExpireAt":"","status":"failed",'
+    b'"subscription-failed","subscription-cancelled","subscription-active",'
+    b'"status":"completed","timestamp":"2025-01-01T00:00:00.000000Z",'
+    b'"currency":"USD","currency":"EUR","currency":"RUB","amount":0.0,'
+    b'"parentContractId":"","contractId":"","buyer":{"email":"@t.me"},'
+    b'"product":{"id":"","title":""},"eventType":"payment.failed",'
+    b'{"eventType":"subscription.cancelled",{"eventType":"payment.success",'
+    b'{"eventType":"subscription.recurring.payment.success"'
+)
+# Префикс формата хранения: отличает сжатые записи от старых (TEXT и несжатых BLOB)
+RAW_DATA_FORMAT_ZLIB = b'\x01'
+
+def compress_raw_data(body: bytes) -> bytes:
+    """Сжимает тело вебхука для хранения в payments.raw_data"""
+    compressor = zlib.compressobj(level=9, zdict=RAW_DATA_ZDICT)
+    return RAW_DATA_FORMAT_ZLIB + compressor.compress(body) + compressor.flush()
+
+def decompress_raw_data(value: Union[str, bytes]) -> str:
+    """Восстанавливает исходный JSON из payments.raw_data в любом из форматов хранения"""
+    if isinstance(value, str):
+        return value
+    if value[:1] == RAW_DATA_FORMAT_ZLIB:
+        decompressor = zlib.decompressobj(zdict=RAW_DATA_ZDICT)
+        value = decompressor.decompress(value[1:]) + decompressor.flush()
+    return value.decode("utf-8")
+
+# Отметка в app_settings: raw_data всех шардов уже сжаты, повторный проход не нужен
+RAW_DATA_MIGRATED_KEY = "raw_data_compressed"
+
+def migrate_raw_data_storage(batch_size: int = 500) -> int:
+    """
+    Сжимает raw_data у записей, сохраненных до перехода на сжатие.
+    Работает пачками по batch_size записей, чтобы не держать долгую блокировку на запись.
+    После прохода по всем шардам без ошибок ставит отметку в app_settings, и следующие
+    запуски ничего не читают. Ошибка шарда записывается в журнал, отметка не ставится.
+    """
+    conn = acquire_connection()
+    try:
+        if conn.execute("SELECT 1 FROM app_settings WHERE key = ?", (RAW_DATA_MIGRATED_KEY,)).fetchone():
+            return 0
+    finally:
+        release_connection(conn)
+
+    migrated = 0
+    failed = False
+    for shard in range(SHARD_COUNT):
+        try:
+            migrated += _migrate_shard_raw_data(shard, batch_size)
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось сжать raw_data шарда {shard}: {str(e)}")
+            failed = True
+    if not failed:
+        conn = acquire_connection()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO app_settings (key, value) VALUES (?, ?)",
+                (RAW_DATA_MIGRATED_KEY, datetime.now(timezone.utc).isoformat())
+            )
+            conn.commit()
+        finally:
+            release_connection(conn)
+    return migrated
+
+def _migrate_shard_raw_data(shard: int, batch_size: int) -> int:
+    conn = connect_shard(shard)
     try:
-        conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
-        
-        # Создаем таблицу payments
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            event_type TEXT NOT NULL,
-            product_id TEXT NOT NULL,
-            product_title TEXT NOT NULL,
-            buyer_email TEXT NOT NULL,
-            contract_id TEXT NOT NULL,
-            parent_contract_id TEXT,
-            amount REAL NOT NULL,
-            currency TEXT NOT NULL,
-            timestamp TEXT NOT NULL,
-            status TEXT NOT NULL,
-            error_message TEXT,
-            raw_data TEXT NOT NULL,
-            received_at TEXT NOT NULL,
-            processed INTEGER DEFAULT 0
-        )
-        ''')
-        
-        # Создаем таблицу channel_members
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS channel_members (
-            user_id TEXT PRIMARY KEY,
-            status TEXT NOT NULL,
-            joined_at TEXT NOT NULL,
-            expires_at TEXT,
-            subscription_end_date TEXT,
-            last_payment_id INTEGER,
-            FOREIGN KEY (last_payment_id) REFERENCES payments(id)
-        )
-        ''')
-        
-        # Таблица для отслеживания напоминаний о продлении
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS subscription_reminders (
-            user_id TEXT PRIMARY KEY,
-            last_reminder_at TEXT NOT NULL
-        )
-        ''')
-        
-        # Создаем таблицу для сокращенных ссылок
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS shortened_links (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            short_code TEXT UNIQUE NOT NULL,
-            original_url TEXT NOT NULL,
-            created_at TEXT NOT NULL
-        )
-        ''')
-        
-        conn.commit()
-        logger.info("База данных успешно инициализирована")
-        
-    except Exception as e:
-        logger.error(f"Ошибка при инициализации БД: {str(e)}")
+        cursor.execute('PRAGMA page_count')
+        pages_before = cursor.fetchone()[0]
+
+        migrated = 0
+        last_id = 0
+        while True:
+            cursor.execute('''
+            SELECT id, raw_data FROM payments
+            WHERE id > ?
+              AND (typeof(raw_data) = 'text' OR substr(raw_data, 1, 1) != ?)
+            ORDER BY id
+            LIMIT ?
+            ''', (last_id, RAW_DATA_FORMAT_ZLIB, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for payment_id, raw_data in rows:
+                if isinstance(raw_data, str):
+                    raw_data = raw_data.encode("utf-8")
+                updates.append((compress_raw_data(raw_data), payment_id))
+            cursor.executemany('UPDATE payments SET raw_data = ? WHERE id = ?', updates)
+            conn.commit()
+
+            migrated += len(rows)
+            last_id = rows[-1][0]
+
+        if migrated > 0:
+            # Возвращаем освободившиеся страницы файлу БД
+            conn.execute('VACUUM')
+            cursor.execute('PRAGMA page_count')
+            pages_after = cursor.fetchone()[0]
+            logger.info(f"Сжато raw_data у {migrated} платежей, страниц БД: {pages_before} -> {pages_after}")
+        return migrated
     finally:
         conn.close()
 
@@ -164,65 +237,67 @@ def verify_credentials(credentials: HTTPBasicCredentials = Depends(security)):
         )
     return credentials.username
 
+def require_sqlite_storage(feature: str):
+    """Функции, работающие с файлами SQLite, недоступны при хранилище PostgreSQL"""
+    try:
+        require_sqlite(feature)
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail=str(e))
+
 # Сохранение данных в БД
-def save_to_db(payload: WebhookPayload, raw_data: str) -> Optional[int]:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+def save_to_db(payload: WebhookPayload, raw_data: bytes, inbox_id: Optional[int] = None) -> Optional[int]:
+    compressed_raw_data = compress_raw_data(raw_data)
     
-    payment_id = None
-
-    if payload.eventType == "subscription.cancelled":
-        # Для события отмены подписки
-        cursor.execute('''
-        INSERT INTO payments (
-            event_type, product_id, product_title, buyer_email, contract_id, 
-            parent_contract_id, timestamp, status, raw_data, received_at,
-            amount, currency
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            payload.eventType,
-            payload.product.id,
-            payload.product.title,
-            payload.buyer.email,
-            payload.contractId,
-            payload.parentContractId,
-            normalize_datetime_string(payload.cancelledAt), # Нормализуем дату
-            'cancelled',
-            raw_data,
-            datetime.now().isoformat(),
-            0,  # amount для отмены не важен
-            'RUB'  # валюта для отмены не важна
-        ))
-        conn.commit()
-        payment_id = cursor.lastrowid # Получаем ID только что вставленной записи
+    # Запись выполняет поток групповой фиксации (group_commit) вместе с записями других вебхуков
+    # (для PostgreSQL - транзакция соединения из пула, см. storage.write)
+    def write(conn) -> int:
+        # Любой вебхук по пользователю делает его кэшированные счета неактуальными;
+        # удаляем их в той же транзакции, что и запись платежа
+        storage.invalidate_invoices(conn, payload.buyer.email.split('@')[0])
+
+        if payload.eventType == "subscription.cancelled":
+            # Для события отмены подписки
+            payment_id = storage.insert_payment(conn, {
+                "event_type": payload.eventType,
+                "product_id": payload.product.id,
+                "product_title": payload.product.title,
+                "buyer_email": payload.buyer.email,
+                "contract_id": payload.contractId,
+                "parent_contract_id": payload.parentContractId,
+                "timestamp": normalize_datetime_string(payload.cancelledAt), # Нормализуем дату
+                "status": 'cancelled',
+                "raw_data": compressed_raw_data,
+                "received_at": datetime.now().isoformat(),
+                "amount": 0,  # amount для отмены не важен
+                "currency": 'RUB'  # валюта для отмены не важна
+            })
         
-    else:
-        # Для остальных событий оставляем старую логику
-        cursor.execute('''
-        INSERT INTO payments (
-            event_type, product_id, product_title, buyer_email, contract_id, 
-            parent_contract_id, amount, currency, timestamp, status, 
-            error_message, raw_data, received_at
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            payload.eventType,
-            payload.product.id,
-            payload.product.title,
-            payload.buyer.email,
-            payload.contractId,
-            payload.parentContractId,
-            payload.amount,
-            payload.currency,
-            normalize_datetime_string(payload.timestamp), # Нормализуем дату
-            payload.status,
-            payload.errorMessage,
-            raw_data,
-            datetime.now(timezone.utc).isoformat() # Используем aware datetime
-        ))
-        conn.commit()
-        payment_id = cursor.lastrowid # Получаем ID только что вставленной записи
+        else:
+            # Для остальных событий оставляем старую логику
+            payment_id = storage.insert_payment(conn, {
+                "event_type": payload.eventType,
+                "product_id": payload.product.id,
+                "product_title": payload.product.title,
+                "buyer_email": payload.buyer.email,
+                "contract_id": payload.contractId,
+                "parent_contract_id": payload.parentContractId,
+                "amount": payload.amount,
+                "currency": payload.currency,
+                "timestamp": normalize_datetime_string(payload.timestamp), # Нормализуем дату
+                "status": payload.status,
+                "error_message": payload.errorMessage,
+                "raw_data": compressed_raw_data,
+                "received_at": datetime.now(timezone.utc).isoformat() # Используем aware datetime
+            })
+        
+        if inbox_id is not None and storage.in_main_db:
+            # Связываем входящий вебхук с платежом в той же транзакции: после перезапуска
+            # по этой отметке видно, что платеж уже сохранен и повторять вебхук нельзя.
+            # При шардах и PostgreSQL входящие вебхуки в другой БД - платеж ищется по контракту (saved_payment_id)
+            conn.execute('UPDATE webhook_inbox SET payment_id = ? WHERE id = ?', (payment_id, inbox_id))
+        return payment_id
     
-    conn.close()
+    payment_id = storage.write(payload.buyer.email.split('@')[0], write)
     logger.info(f"Данные сохранены в БД: {payload.eventType}, contractId: {payload.contractId}, Payment ID: {payment_id}")
     return payment_id
 
@@ -242,40 +317,22 @@ def cleanup_old_shortened_links(days_to_keep=7, force=False):
     Параметр force=True игнорирует проверку количества и всегда выполняет очистку.
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
         # Получаем общее количество ссылок
-        cursor.execute('SELECT COUNT(*) FROM shortened_links')
-        total_links = cursor.fetchone()[0]
+        total_links = storage.count_links()
         
         # Очищаем только если количество ссылок превышает порог или установлен force=True
         if total_links > 1000 or force:
             # Рассчитываем дату, старше которой ссылки будут удалены
             cutoff_date = (datetime.now() - timedelta(days=days_to_keep)).isoformat()
             
-            # Получаем количество ссылок до очистки
-            cursor.execute('SELECT COUNT(*) FROM shortened_links')
-            count_before = cursor.fetchone()[0]
-            
             # Удаляем старые ссылки
-            cursor.execute('DELETE FROM shortened_links WHERE created_at < ?', (cutoff_date,))
-            
-            # Получаем количество ссылок после очистки
-            cursor.execute('SELECT COUNT(*) FROM shortened_links')
-            count_after = cursor.fetchone()[0]
-            
-            deleted_count = count_before - count_after
-            
-            conn.commit()
-            conn.close()
+            deleted_count = storage.delete_links_before(cutoff_date)
             
             if deleted_count > 0:
                 logger.info(f"Очищено {deleted_count} устаревших сокращенных ссылок")
             
             return deleted_count
         else:
-            conn.close()
             return 0
     
     except Exception as e:
@@ -285,7 +342,7 @@ def cleanup_old_shortened_links(days_to_keep=7, force=False):
 # В main.py добавим функцию для прямой отправки уведомлений в бот
 def notify_bot(user_id: str, message: str, markup=None):
     try:
-        from bot import bot  # Импортируем экземпляр бота
+        from telegram_client import bot  # Общий клиент Telegram без обработчиков бота
         
         if markup:
             bot.send_message(user_id, message, reply_markup=markup)
@@ -297,74 +354,333 @@ def notify_bot(user_id: str, message: str, markup=None):
         logger.error(f"Ошибка при отправке уведомления в бот: {str(e)}")
         return False
 
-# Фоновая задача для периодической очистки ссылок
-async def periodic_cleanup_task():
-    while True:
-        try:
-            # Проверяем количество ссылок
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute('SELECT COUNT(*) FROM shortened_links')
-            total_links = cursor.fetchone()[0]
-            conn.close()
-            
-            # Определяем интервал проверки в зависимости от размера базы
-            if total_links > 5000:
-                # Много ссылок - короткий интервал (каждые 3 часа)
-                cleanup_interval = 10800
-                cleanup_count = cleanup_old_shortened_links(days_to_keep=3)
-            elif total_links > 1000:
-                # Средний размер базы - средний интервал (каждые 12 часов)
-                cleanup_interval = 43200
-                cleanup_count = cleanup_old_shortened_links(days_to_keep=5)
-            else:
-                # Малый размер базы - длинный интервал (раз в день)
-                cleanup_interval = 86400
-                cleanup_count = cleanup_old_shortened_links(days_to_keep=7, force=False)
-            
-            if cleanup_count > 0:
-                logger.info(f"Плановая очистка завершена, удалено {cleanup_count} ссылок. Следующая через {cleanup_interval // 3600} ч.")
-            
-            # Ждем до следующей проверки
-            await asyncio.sleep(cleanup_interval)
-            
-        except Exception as e:
-            logger.error(f"Ошибка в фоновой задаче очистки ссылок: {str(e)}")
-            # Ждем 1 час перед повторной попыткой в случае ошибки
-            await asyncio.sleep(3600)
+# Функция для очистки устаревшего кэша счетов
+def cleanup_invoice_cache(hours_to_keep=24):
+    try:
+        cutoff_date = (datetime.now(timezone.utc) - timedelta(hours=hours_to_keep)).isoformat()
+        return storage.delete_invoices_before(cutoff_date)
+    except Exception as e:
+        logger.error(f"Ошибка при очистке кэша счетов: {str(e)}")
+        return 0
 
-# Запуск фоновой задачи
-@app.on_event("startup")
-async def start_cleanup_task():
-    asyncio.create_task(periodic_cleanup_task())
+# Функция для очистки неудачных и прерванных входящих вебхуков
+def cleanup_webhook_inbox(days_to_keep=30):
+    try:
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=days_to_keep)).isoformat()
+        conn = acquire_connection()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM webhook_inbox WHERE status != 'received' AND received_at < ?", (cutoff,))
+        deleted_count = cursor.rowcount
+        conn.commit()
+        release_connection(conn)
+        return deleted_count
+    except Exception as e:
+        logger.error(f"Ошибка при очистке входящих вебхуков: {str(e)}")
+        return 0
+
+# Функция для очистки отправленных сообщений outbox
+def cleanup_outbox_messages():
+    try:
+        return outbox.cleanup_outbox()
+    except Exception as e:
+        logger.error(f"Ошибка при очистке outbox: {str(e)}")
+        return 0
 
+# Функция для очистки состояния лимитов отправки в чаты, куда давно ничего не отправлялось
+def cleanup_telegram_rate_limits():
+    try:
+        from telegram_client import cleanup_rate_limit_state
+        return cleanup_rate_limit_state()
+    except Exception as e:
+        logger.error(f"Ошибка при очистке состояния лимитов Telegram: {str(e)}")
+        return 0
+
+# Плановая очистка ссылок, кэша счетов, входящих вебхуков, outbox и лимитов Telegram (задача планировщика cleanup).
+# Возвращает, через сколько секунд запустить ее снова: интервал зависит от размера таблицы ссылок
+def run_cleanup() -> int:
+    total_links = storage.count_links()
+    
+    # Определяем интервал проверки в зависимости от размера базы
+    if total_links > 5000:
+        # Много ссылок - короткий интервал (каждые 3 часа)
+        cleanup_interval = 10800
+        cleanup_count = cleanup_old_shortened_links(days_to_keep=3)
+    elif total_links > 1000:
+        # Средний размер базы - средний интервал (каждые 12 часов)
+        cleanup_interval = 43200
+        cleanup_count = cleanup_old_shortened_links(days_to_keep=5)
+    else:
+        # Малый размер базы - длинный интервал (раз в день)
+        cleanup_interval = 86400
+        cleanup_count = cleanup_old_shortened_links(days_to_keep=7, force=False)
+    
+    cleanup_invoice_cache()
+    cleanup_webhook_inbox()
+    cleanup_telegram_rate_limits()
+    cleanup_outbox_messages()
+    
+    if cleanup_count > 0:
+        logger.info(f"Плановая очистка завершена, удалено {cleanup_count} ссылок. Следующая через {cleanup_interval // 3600} ч.")
+    return cleanup_interval
+
+# Запуск фоновой задачи
 # Маршруты
 @app.on_event("startup")
 async def startup_event():
-    init_db()
+    configure_logging()
+    # Схема обычно уже создана run.py; здесь только проверяется ее версия
+    ensure_schema()
     # Первоначальная очистка старых ссылок при запуске сервера
     cleanup_old_shortened_links(days_to_keep=30, force=True)  # При первом запуске выполняем принудительную очистку
+    # Сообщения из outbox отправляет каждый воркер: сообщение забирает только один из них
+    outbox.sender.start()
     logger.info("Сервер запущен")
 
+# Блокировка, по которой один из воркеров uvicorn выбирается для фоновых задач
+background_lock_file = None
+
+def acquire_background_lock() -> bool:
+    """Возвращает True в единственном воркере, который должен выполнять фоновые задачи"""
+    global background_lock_file
+    background_lock_file = open(DATA_DIR / "api_background.lock", "w")
+    try:
+        fcntl.flock(background_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        background_lock_file.close()
+        background_lock_file = None
+        return False
+
+@app.on_event("startup")
+async def start_cleanup_task():
+    # При нескольких воркерах фоновые задачи регистрирует только один из них, а при нескольких
+    # экземплярах сервиса выполняет только ведущий (аренда API_JOBS_LEASE)
+    if not acquire_background_lock():
+        logger.info("Фоновые задачи выполняются другим воркером")
+        return
+    # После ошибки очистка повторяется через час, иначе интервал возвращает сама задача
+    scheduler.add_job(
+        "cleanup", run_cleanup, IntervalTrigger(3600),
+        run_at_start=True, adaptive=True, lease=API_JOBS_LEASE
+    )
+    archive_trigger = parse_trigger(ARCHIVE_SCHEDULE)
+    # Перенос идет пачками в потоке планировщика, не блокируя обработку вебхуков.
+    # Архив - отдельные файлы SQLite; в PostgreSQL платежи остаются в одной таблице
+    if storage.name == "sqlite":
+        scheduler.add_job(
+            "archive_payments", archive_old_payments, archive_trigger,
+            run_at_start=isinstance(archive_trigger, IntervalTrigger), lease=API_JOBS_LEASE
+        )
+        # Сжатие raw_data у записей, сохраненных до перехода на сжатое хранение. Выполняется
+        # одним процессом; после успешного прохода запуски только проверяют отметку в app_settings
+        scheduler.add_job(
+            "compress_raw_data", migrate_raw_data_storage, IntervalTrigger(86400),
+            run_at_start=True, lease=API_JOBS_LEASE
+        )
+    # Дообрабатываем вебхуки, прерванные остановкой предыдущего запуска
+    scheduler.add_job(
+        "resume_webhooks", resume_pending_webhooks, IntervalTrigger(60),
+        run_at_start=True, lease=API_JOBS_LEASE
+    )
+    # Сводка событий для администратора. Ту же задачу регистрирует бот - при общем
+    # процессе (run.py) она одна, при раздельных сводку отправит один из процессов
+    if "admin_digest" not in scheduler.jobs:
+        from subscriptions import flush_admin_digest
+        scheduler.add_job(
+            "admin_digest", flush_admin_digest, IntervalTrigger(ADMIN_DIGEST_CHECK_INTERVAL),
+            run_at_start=True, lease=API_JOBS_LEASE
+        )
+    # Перенос сообщений и событий сводки из шардов или PostgreSQL в основную БД (его же регистрирует бот)
+    if storage.stages_rows and "relay_staged" not in scheduler.jobs:
+        scheduler.add_job("relay_staged", storage.relay_staged, IntervalTrigger(SHARD_RELAY_INTERVAL))
+    scheduler.start()
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    deadline = time.monotonic() + SCHEDULER_STOP_TIMEOUT
+    await asyncio.to_thread(scheduler.stop, SCHEDULER_STOP_TIMEOUT)
+    # Неотправленные сообщения остаются в outbox до следующего запуска
+    await asyncio.to_thread(outbox.sender.stop, max(0.0, deadline - time.monotonic()))
+    # Записи из очереди писателя фиксируются; поздние записи выполняются без группировки
+    await asyncio.to_thread(stop_writers, max(0.0, deadline - time.monotonic()))
+
+# Проверки готовности. Доступность Telegram и Lava проверяется в фоне и кэшируется,
+# чтобы частые запросы проб не обращались к внешним API и не задерживали ответ
+external_checks = {
+    "checked_at": 0.0,
+    "refreshing": False,
+    "telegram": {"ok": None},
+    "lava": {"ok": None},
+}
+
+def check_database() -> dict:
+    try:
+        version = get_schema_version()
+        return {"ok": version >= SCHEMA_VERSION, "schema_version": version}
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+
+def check_telegram() -> dict:
+    try:
+        from telegram_client import get_bot
+        started = time.perf_counter()
+        get_bot().get_me()
+        return {"ok": True, "latency_ms": round((time.perf_counter() - started) * 1000)}
+    except Exception as e:
+        # Текст ошибки может содержать URL с токеном бота - наружу отдаем только тип ошибки
+        return {"ok": False, "error": type(e).__name__}
+
+def check_lava() -> dict:
+    try:
+        import requests
+        started = time.perf_counter()
+        # Любой HTTP-ответ означает, что API Lava доступно
+        requests.get(LAVA_API_URL, timeout=3)
+        return {"ok": True, "latency_ms": round((time.perf_counter() - started) * 1000)}
+    except Exception as e:
+        return {"ok": False, "error": type(e).__name__}
+
+async def refresh_external_checks():
+    try:
+        telegram, lava = await asyncio.gather(asyncio.to_thread(check_telegram), asyncio.to_thread(check_lava))
+        external_checks.update(telegram=telegram, lava=lava, checked_at=time.monotonic())
+    finally:
+        external_checks["refreshing"] = False
+
+@app.get("/healthz")
+async def healthz():
+    """Проверка жизнеспособности: процесс отвечает на запросы"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz(response: Response):
+    """
+    Проверка готовности: БД доступна и схема актуальна. Доступность Telegram и Lava
+    показывается для диагностики, но не влияет на готовность - вебхуки принимаются и без них.
+    """
+    database = await asyncio.to_thread(check_database)
+    if not external_checks["refreshing"] and time.monotonic() - external_checks["checked_at"] > READINESS_CACHE_SECONDS:
+        external_checks["refreshing"] = True
+        asyncio.create_task(refresh_external_checks())
+    
+    response.status_code = status.HTTP_200_OK if database["ok"] else status.HTTP_503_SERVICE_UNAVAILABLE
+    return {
+        "status": "ready" if database["ok"] else "not_ready",
+        "database": database,
+        "telegram": external_checks["telegram"],
+        "lava": external_checks["lava"],
+    }
+
 @app.get("/")
 async def root(_: str = Depends(verify_credentials)):
     return {"status": "ok", "message": "Lava.top webhook service is running"}
 
+# Входящие вебхуки. Тело записывается в webhook_inbox до обработки; запись удаляется
+# после успешной обработки. Если процесс остановлен посреди обработки, запись остается
+# и дообрабатывается при следующем запуске (см. resume_pending_webhooks)
+async def record_webhook(body: bytes, received_at: datetime) -> int:
+    def write(conn: sqlite3.Connection) -> int:
+        cursor = conn.execute(
+            'INSERT INTO webhook_inbox (body, received_at, run_id) VALUES (?, ?, ?)',
+            (body, received_at.isoformat(), RUN_ID)
+        )
+        return cursor.lastrowid
+    
+    return await writer.run_async(write)
+
+def finish_webhook(inbox_id: int, error_message: Optional[str] = None, status: str = 'failed'):
+    """Удаляет обработанный вебхук из очереди или помечает его статусом status (failed / interrupted)"""
+    def write(conn: sqlite3.Connection):
+        if error_message is None:
+            conn.execute('DELETE FROM webhook_inbox WHERE id = ?', (inbox_id,))
+        else:
+            conn.execute(
+                'UPDATE webhook_inbox SET status = ?, error_message = ? WHERE id = ?',
+                (status, error_message, inbox_id)
+            )
+    
+    writer.run(write)
+
+def saved_payment_id(body: bytes) -> Optional[int]:
+    """Номер уже сохраненного платежа вебхука (по типу события и контракту) в хранилище покупателя"""
+    try:
+        payload = parse_webhook_payload(body)
+    except Exception:
+        return None
+    return storage.find_payment(payload.buyer.email.split('@')[0], payload.contractId, payload.eventType)
+
+def resume_pending_webhooks() -> int:
+    """
+    Дообрабатывает вебхуки, принятые другим запуском сервиса (обычно предыдущим), но не
+    обработанные до конца. Вебхук моложе WEBHOOK_RESUME_AFTER секунд не трогаем: его может
+    еще обрабатывать другой работающий экземпляр. Вебхук, по которому платеж уже сохранен,
+    не повторяется (это создало бы дубликат платежа и повторно продлило подписку):
+    он помечается interrupted, и администратор получает уведомление.
+    """
+    abandoned_before = (datetime.now(timezone.utc) - timedelta(seconds=WEBHOOK_RESUME_AFTER)).isoformat()
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        rows = conn.execute(
+            "SELECT id, body, received_at, payment_id FROM webhook_inbox "
+            "WHERE status = 'received' AND run_id != ? AND received_at < ? ORDER BY id",
+            (RUN_ID, abandoned_before)
+        ).fetchall()
+    finally:
+        conn.close()
+    
+    resumed = 0
+    for inbox_id, body, received_at, payment_id in rows:
+        if payment_id is None and not storage.in_main_db:
+            payment_id = saved_payment_id(bytes(body))
+        if payment_id is None:
+            logger.info(f"Повторная обработка вебхука {inbox_id}, принятого {received_at} до перезапуска")
+            process_webhook(bytes(body), datetime.fromisoformat(received_at), inbox_id)
+            resumed += 1
+            continue
+        
+        finish_webhook(inbox_id, "Обработка прервана остановкой сервиса после сохранения платежа", 'interrupted')
+        logger.warning(f"Вебхук {inbox_id} (платеж {payment_id}) прерван после сохранения платежа")
+        from subscriptions import notify_admin
+        notify_admin(
+            f"⚠️ <b>Обработка платежа прервана перезапуском</b>\n\n"
+            f"<b>Платеж:</b> {payment_id}\n"
+            f"<b>Получен:</b> {received_at}\n"
+            f"Проверьте, что пользователь получил доступ к каналу.",
+            critical=True
+        )
+    if rows:
+        logger.info(f"Вебхуков из предыдущего запуска: {len(rows)}, обработано повторно: {resumed}")
+    return resumed
+
 @app.post("/lava/payment")
 async def lava_webhook(request: Request, username: str = Depends(verify_credentials)):
     try:
-        # Получаем тело запроса
+        # Получаем тело запроса. Байты не декодируем: pydantic валидирует их напрямую,
+        # а в payments.raw_data исходное тело сохраняется сжатым, без перекодирования
         body = await request.body()
-        raw_data = body.decode("utf-8")
-        
-        # Логируем входящие данные
-        logger.info(f"Получены данные от lava.top: {raw_data}")
         
         # Используем время получения вебхука вместо ненадежного timestamp из payload
         webhook_received_time = datetime.now(timezone.utc)
         
-        # Парсим JSON
-        payload = WebhookPayload.parse_raw(raw_data)
+        # Записываем вебхук до обработки, чтобы остановка сервиса не потеряла платеж
+        inbox_id = await record_webhook(body, webhook_received_time)
+    except Exception as e:
+        logger.error(f"Ошибка при приеме веб-хука: {str(e)}")
+        return {"status": "error", "message": str(e)}
+    
+    # Обработка (запросы к Telegram и Lava) идет вне цикла событий: сервер продолжает
+    # принимать запросы и сигналы остановки, пока обрабатывается вебхук
+    return await asyncio.to_thread(process_webhook, body, webhook_received_time, inbox_id)
+
+def process_webhook(body: bytes, webhook_received_time: datetime, inbox_id: Optional[int] = None) -> dict:
+    """Обрабатывает вебхук Lava: сохраняет платеж, обновляет подписку и уведомляет пользователя"""
+    try:
+        # Полное тело пишем только в debug, чтобы не декодировать его на каждом вебхуке
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Получены данные от lava.top: %s", body.decode("utf-8", errors="replace"))
+        
+        # Парсим и валидируем JSON за один проход (pydantic v2, без промежуточного dict/str)
+        payload = parse_webhook_payload(body)
         logger.info(
             "Webhook parsed | event=%s user=%s amount=%s currency=%s payload_timestamp=%s webhook_received=%s contract=%s parent_contract=%s",
             payload.eventType,
@@ -378,13 +694,16 @@ async def lava_webhook(request: Request, username: str = Depends(verify_credenti
         )
         
         # Сохраняем в БД
-        payment_id = save_to_db(payload, raw_data)
+        payment_id = save_to_db(payload, body, inbox_id)
         
         # Получаем user_id из email
         user_id = payload.buyer.email.split('@')[0]
-        
-        # Импортируем функции из bot.py
-        from bot import add_user_to_channel, notify_admin, bot, get_periodicity_by_amount, PERIOD_DAYS
+        # Общие функции подписок; модуль бота с обработчиками в процесс API не импортируется.
+        # Сообщения не отправляются здесь, а записываются в outbox в транзакции с изменением
+        # подписки; ключ дедупликации не дает повторному вебхуку Lava отправить их дважды
+        from outbox import enqueue, enqueue_message
+        from subscriptions import add_user_to_channel, notify_admin, notification_key, get_periodicity_by_amount, PERIOD_DAYS
+        dedup_key = notification_key(payload.eventType, user_id, payload.contractId, payment_id)
         
         # Обрабатываем успешный платеж
         if payload.eventType == "payment.success":
@@ -398,7 +717,7 @@ async def lava_webhook(request: Request, username: str = Depends(verify_credenti
             )
             
             # Рассчитываем дату окончания подписки от момента получения webhook'а
-            periodicity = get_periodicity_by_amount(payload.amount)
+            periodicity = get_periodicity_by_amount(payload.amount, payload.currency, payload.product.id)
             days_to_add = PERIOD_DAYS.get(periodicity, 30)
             subscription_end_date_dt = webhook_received_time + timedelta(days=days_to_add)
             subscription_end_date = subscription_end_date_dt.replace(tzinfo=subscription_end_date_dt.tzinfo or timezone.utc).isoformat()
@@ -412,21 +731,35 @@ async def lava_webhook(request: Request, username: str = Depends(verify_credenti
             )
             
             # Обновляем БД с правильной датой окончания перед добавлением в канал
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute('''
-            INSERT OR REPLACE INTO channel_members 
-            (user_id, status, joined_at, subscription_end_date, last_payment_id)
-            VALUES (?, 'active', ?, ?, ?)
-            ''', (
-                user_id,
-                webhook_received_time.isoformat(),
-                subscription_end_date,
-                payment_id
-            ))
-            cursor.execute('DELETE FROM subscription_reminders WHERE user_id = ?', (user_id,))
-            conn.commit()
-            conn.close()
+            def write_payment(conn):
+                storage.activate_member(conn, user_id, webhook_received_time.isoformat(), subscription_end_date, payment_id)
+                storage.clear_reminder(conn, user_id)
+            
+                # Уведомление пользователю
+                enqueue_message(
+                    user_id,
+                    f"✅ Поздравляем! Ваша подписка '{payload.product.title}' успешно оплачена.\n"
+                    f"Сумма: {payload.amount} {payload.currency}",
+                    conn, f"{dedup_key}:paid"
+                )
+            
+                # Добавляем пользователя в канал
+                if add_user_to_channel(user_id, conn, dedup_key):
+                    logger.info(f"Пользователь {user_id} успешно добавлен в канал")
+                
+                    # Уведомляем администратора
+                    notify_admin(
+                        f"🎉 <b>Новая подписка</b>\n\n"
+                        f"<b>Пользователь:</b> {user_id}\n"
+                        f"<b>Подписка:</b> {payload.product.title}\n"
+                        f"<b>Сумма:</b> {payload.amount} {payload.currency}",
+                        conn, f"{dedup_key}:admin", category="new_subscription",
+                        summary=f"{user_id} - {payload.product.title}, {payload.amount} {payload.currency}"
+                    )
+                else:
+                    logger.error(f"Не удалось добавить пользователя {user_id} в канал")
+            
+            storage.write(user_id, write_payment)
             
             logger.info(
                 "payment.success.persisted | user=%s status=active subscription_end_date=%s payment_id=%s",
@@ -434,27 +767,6 @@ async def lava_webhook(request: Request, username: str = Depends(verify_credenti
                 subscription_end_date,
                 str(payment_id)
             )
-            
-            # Отправляем уведомление пользователю
-            bot.send_message(
-                user_id,
-                f"✅ Поздравляем! Ваша подписка '{payload.product.title}' успешно оплачена.\n"
-                f"Сумма: {payload.amount} {payload.currency}"
-            )
-            
-            # Добавляем пользователя в канал
-            if add_user_to_channel(user_id):
-                logger.info(f"Пользователь {user_id} успешно добавлен в канал")
-                
-                # Уведомляем администратора
-                notify_admin(
-                    f"🎉 <b>Новая подписка</b>\n\n"
-                    f"<b>Пользователь:</b> {user_id}\n"
-                    f"<b>Подписка:</b> {payload.product.title}\n"
-                    f"<b>Сумма:</b> {payload.amount} {payload.currency}"
-                )
-            else:
-                logger.error(f"Не удалось добавить пользователя {user_id} в канал")
                 
         # Обрабатываем автоматическое продление подписки
         elif payload.eventType == "subscription.recurring.payment.success":
@@ -467,16 +779,12 @@ async def lava_webhook(request: Request, username: str = Depends(verify_credenti
                 webhook_received_time.isoformat()
             )
             # Получаем текущую дату окончания подписки из БД
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("SELECT subscription_end_date FROM channel_members WHERE user_id = ?", (user_id,))
-            current_end_date_row = cursor.fetchone()
-            conn.close()
+            current_end_date_value = storage.member_end_date(user_id)
 
             current_end_date: datetime
             try:
-                if current_end_date_row and current_end_date_row[0]:
-                    current_end_date = datetime.fromisoformat(str(current_end_date_row[0]).replace('Z', '+00:00'))
+                if current_end_date_value:
+                    current_end_date = datetime.fromisoformat(str(current_end_date_value).replace('Z', '+00:00'))
                 else:
                     current_end_date = datetime.now(timezone.utc)
             except Exception:
@@ -487,7 +795,7 @@ async def lava_webhook(request: Request, username: str = Depends(verify_credenti
             event_time = webhook_received_time
 
             # Определяем периодичность по сумме и рассчитываем длительность периода
-            periodicity = get_periodicity_by_amount(payload.amount)
+            periodicity = get_periodicity_by_amount(payload.amount, payload.currency, payload.product.id)
             days_to_add = PERIOD_DAYS.get(periodicity, 30)
 
             # Продлеваем подписку от момента получения webhook'а, добавляя период подписки
@@ -505,18 +813,40 @@ async def lava_webhook(request: Request, username: str = Depends(verify_credenti
             )
 
             # Обновляем статус подписки в channel_members
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute('''
-            UPDATE channel_members 
-            SET status = 'active', 
-                subscription_end_date = ?,
-                last_payment_id = ?
-            WHERE user_id = ?
-            ''', (new_end_date, payment_id, user_id))
-            cursor.execute('DELETE FROM subscription_reminders WHERE user_id = ?', (user_id,))
-            conn.commit()
-            conn.close()
+            def write_renewal(conn):
+                storage.renew_member(conn, user_id, new_end_date, payment_id)
+                storage.clear_reminder(conn, user_id)
+
+                # Уведомление пользователю
+                from telebot import types
+                from subscriptions import CHANNEL_LINK
+
+                markup = types.InlineKeyboardMarkup(row_width=1)
+                btn_channel = types.InlineKeyboardButton('📺 Войти в канал', url=CHANNEL_LINK)
+                btn_menu = types.InlineKeyboardButton('🔙 Главное меню', callback_data='show_menu')
+                markup.add(btn_channel, btn_menu)
+
+                enqueue_message(
+                    user_id,
+                    f"✅ Ваша подписка '{payload.product.title}' автоматически продлена!\n"
+                    f"Новая дата окончания: {new_end_date_dt.strftime('%d.%m.%Y')}",
+                    conn, f"{dedup_key}:renewed",
+                    reply_markup=markup
+                )
+
+                # Уведомляем администратора
+                formatted_end_date = new_end_date_dt.strftime('%d.%m.%Y')
+                notify_admin(
+                    f"🔄 <b>Автопродление подписки</b>\n\n"
+                    f"<b>Пользователь:</b> {user_id}\n"
+                    f"<b>Подписка:</b> {payload.product.title}\n"
+                    f"<b>Сумма:</b> {payload.amount} {payload.currency}\n"
+                    f"<b>Новая дата окончания:</b> {formatted_end_date}",
+                    conn, f"{dedup_key}:admin", category="renewal",
+                    summary=f"{user_id} - {payload.product.title}, {payload.amount} {payload.currency}, до {formatted_end_date}"
+                )
+            
+            storage.write(user_id, write_renewal)
 
             logger.info(
                 "recurring.persisted | user=%s status=active subscription_end_date=%s payment_id=%s",
@@ -524,31 +854,6 @@ async def lava_webhook(request: Request, username: str = Depends(verify_credenti
                 new_end_date,
                 str(payment_id)
             )
-
-            # Отправляем уведомление пользователю
-            from bot import types, CHANNEL_LINK, show_main_menu
-
-            markup = types.InlineKeyboardMarkup(row_width=1)
-            btn_channel = types.InlineKeyboardButton('📺 Войти в канал', url=CHANNEL_LINK)
-            btn_menu = types.InlineKeyboardButton('🔙 Главное меню', callback_data='show_menu')
-            markup.add(btn_channel, btn_menu)
-
-            bot.send_message(
-                user_id,
-                f"✅ Ваша подписка '{payload.product.title}' автоматически продлена!\n"
-                f"Новая дата окончания: {new_end_date_dt.strftime('%d.%m.%Y')}",
-                reply_markup=markup
-            )
-
-            # Уведомляем администратора
-            formatted_end_date = new_end_date_dt.strftime('%d.%m.%Y')
-            notify_admin(
-                f"🔄 <b>Автопродление подписки</b>\n\n"
-                f"<b>Пользователь:</b> {user_id}\n"
-                f"<b>Подписка:</b> {payload.product.title}\n"
-                f"<b>Сумма:</b> {payload.amount} {payload.currency}\n"
-                f"<b>Новая дата окончания:</b> {formatted_end_date}"
-            )
             logger.info(f"Подписка пользователя {user_id} успешно продлена до {new_end_date}")
 
         elif payload.eventType == "subscription.cancelled": # Добавляем обработку отмены подписки
@@ -560,70 +865,67 @@ async def lava_webhook(request: Request, username: str = Depends(verify_credenti
                 payload.willExpireAt or "",
                 webhook_received_time.isoformat()
             )
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
+            # Смена статуса и уведомления - одна операция записи
+            def write_cancellation(conn):
+                # Проверяем текущий статус перед обновлением
+                current_status = storage.member_status(user_id, conn)
             
-            # Проверяем текущий статус перед обновлением
-            cursor.execute('SELECT status FROM channel_members WHERE user_id = ?', (user_id,))
-            current_status_row = cursor.fetchone()
-            current_status = current_status_row[0] if current_status_row else None
+                # Обновляем статус только если он был 'active' (чтобы не обрабатывать повторные webhook'и)
+                rows_updated = storage.cancel_member_until(
+                    conn, user_id, normalize_datetime_string(payload.willExpireAt) # Нормализуем дату
+                )
             
-            # Обновляем статус только если он был 'active' (чтобы не обрабатывать повторные webhook'и)
-            cursor.execute('''
-            UPDATE channel_members 
-            SET status = 'cancelled',
-                subscription_end_date = ?
-            WHERE user_id = ? AND status = 'active'
-            ''', (
-                normalize_datetime_string(payload.willExpireAt), # Нормализуем дату
-                user_id
-            ))
-            rows_updated = cursor.rowcount
-            conn.commit()
-            conn.close()
+                # Отправляем уведомление только если статус действительно изменился
+                # (rows_updated > 0 означает, что была обновлена запись со статусом 'active')
+                if rows_updated == 0:
+                    logger.info(
+                        f"Webhook об отмене подписки для пользователя {user_id} уже был обработан ранее "
+                        f"(текущий статус: {current_status}). Пропускаем отправку уведомлений."
+                    )
+                else:
+                    logger.info(f"Статус подписки пользователя {user_id} обновлен на 'cancelled' (webhook)")
+
+                # Отправляем уведомление пользователю только если статус изменился
+                if rows_updated > 0 and payload.willExpireAt:
+                    from subscriptions import MENU_TEXT
+                    # Используем normalize_datetime_string для получения корректной даты для отображения
+                    normalized_will_expire_at = normalize_datetime_string(payload.willExpireAt)
+                    end_date_str = datetime.fromisoformat(normalized_will_expire_at.replace('Z', '+00:00')).strftime("%d.%m.%Y") if normalized_will_expire_at else "не определена"
+                    enqueue_message(
+                        user_id,
+                        f"ℹ️ Автопродление подписки отключено.\n\n"
+                        f"Доступ к каналу будет действовать до: {end_date_str}.",
+                        conn, f"{dedup_key}:cancelled"
+                    )
+                    enqueue_message(user_id, MENU_TEXT, conn, f"{dedup_key}:welcome")
+                    enqueue(user_id, "main_menu", {}, conn, f"{dedup_key}:menu")
+                    notify_admin(
+                        f"🔔 <b>Отмена подписки</b>\n\n"
+                        f"Пользователь: {user_id}\n"
+                        f"Доступ активен до: {end_date_str}",
+                        conn, f"{dedup_key}:admin", category="cancellation",
+                        summary=f"{user_id} - доступ до {end_date_str}"
+                    )
+                elif rows_updated > 0:
+                    from subscriptions import MENU_TEXT
+                    # Отправляем уведомление только если статус изменился и нет willExpireAt
+                    logger.warning(f"Отмена подписки для {user_id} через webhook, но без willExpireAt.")
+                    enqueue_message(
+                        user_id,
+                        "ℹ️ Автопродление подписки отключено.",
+                        conn, f"{dedup_key}:cancelled"
+                    )
+                    enqueue_message(user_id, MENU_TEXT, conn, f"{dedup_key}:welcome")
+                    enqueue(user_id, "main_menu", {}, conn, f"{dedup_key}:menu")
+                    notify_admin(
+                        f"🔔 <b>Отмена подписки</b>\n\n"
+                        f"Пользователь: {user_id}\n"
+                        f"Доступ был отменен. (Дата окончания не указана)",
+                        conn, f"{dedup_key}:admin", category="cancellation",
+                        summary=f"{user_id} - дата окончания не указана"
+                    )
             
-            # Отправляем уведомление только если статус действительно изменился
-            # (rows_updated > 0 означает, что была обновлена запись со статусом 'active')
-            if rows_updated == 0:
-                logger.info(
-                    f"Webhook об отмене подписки для пользователя {user_id} уже был обработан ранее "
-                    f"(текущий статус: {current_status}). Пропускаем отправку уведомлений."
-                )
-            else:
-                logger.info(f"Статус подписки пользователя {user_id} обновлен на 'cancelled' (webhook)")
-
-            # Отправляем уведомление пользователю только если статус изменился
-            if rows_updated > 0 and payload.willExpireAt:
-                from bot import bot, types, show_main_menu
-                # Используем normalize_datetime_string для получения корректной даты для отображения
-                normalized_will_expire_at = normalize_datetime_string(payload.willExpireAt)
-                end_date_str = datetime.fromisoformat(normalized_will_expire_at.replace('Z', '+00:00')).strftime("%d.%m.%Y") if normalized_will_expire_at else "не определена"
-                bot.send_message(
-                    user_id,
-                    f"ℹ️ Автопродление подписки отключено.\n\n"
-                    f"Доступ к каналу будет действовать до: {end_date_str}."
-                )
-                menu_message = bot.send_message(user_id, "⠀⠀⠀⠀⠀Меню подписчика⠀⠀⠀⠀⠀")
-                show_main_menu(menu_message)
-                notify_admin(
-                    f"🔔 <b>Отмена подписки</b>\n\n"
-                    f"Пользователь: {user_id}\n"
-                    f"Доступ активен до: {end_date_str}"
-                )
-            elif rows_updated > 0:
-                # Отправляем уведомление только если статус изменился и нет willExpireAt
-                logger.warning(f"Отмена подписки для {user_id} через webhook, но без willExpireAt.")
-                bot.send_message(
-                    user_id,
-                    "ℹ️ Автопродление подписки отключено."
-                )
-                menu_message = bot.send_message(user_id, "⠀⠀⠀⠀⠀Меню подписчика⠀⠀⠀⠀⠀")
-                show_main_menu(menu_message)
-                notify_admin(
-                    f"🔔 <b>Отмена подписки</b>\n\n"
-                    f"Пользователь: {user_id}\n"
-                    f"Доступ был отменен. (Дата окончания не указана)"
-                )
+            storage.write(user_id, write_cancellation)
 
         # Обрабатываем неудачный платеж
         elif payload.eventType == "payment.failed":
@@ -634,92 +936,81 @@ async def lava_webhook(request: Request, username: str = Depends(verify_credenti
                 payload.errorMessage or "",
                 webhook_received_time.isoformat()
             )
-            bot.send_message(
-                user_id,
-                f"❌ К сожалению, оплата подписки '{payload.product.title}' не удалась.\n"
-                f"Причина: {payload.errorMessage}\n\n"
-                f"Вы можете попробовать снова, используя команду /subscribe"
-            )
-            
-            # Показываем основное меню
-            from bot import types, SUPPORT_USERNAME, show_main_menu
+            # Уведомления о неудачной оплате записываются в outbox одной операцией
+            def write_failure(conn):
+                enqueue_message(
+                    user_id,
+                    f"❌ К сожалению, оплата подписки '{payload.product.title}' не удалась.\n"
+                    f"Причина: {payload.errorMessage}\n\n"
+                    f"Вы можете попробовать снова, используя команду /subscribe",
+                    conn, f"{dedup_key}:failed"
+                )
             
-            # Сначала создаем сообщение, чтобы затем на него повесить меню
-            menu_message = bot.send_message(
-                user_id,
-                "⠀⠀⠀⠀⠀Выберите пункт меню⠀⠀⠀⠀⠀"
-            )
+                # Сначала сообщение-заголовок, затем главное меню пользователю после неудачной оплаты
+                enqueue_message(user_id, "⠀⠀⠀⠀⠀Выберите пункт меню⠀⠀⠀⠀⠀", conn, f"{dedup_key}:welcome")
+                enqueue(user_id, "main_menu", {}, conn, f"{dedup_key}:menu")
             
-            # Показываем главное меню пользователю после неудачной оплаты
-            show_main_menu(menu_message)
+                # Уведомляем администратора о неудачном платеже
+                notify_admin(
+                    f"❌ <b>Неудачный платеж</b>\n\n"
+                    f"<b>Пользователь:</b> {user_id}\n"
+                    f"<b>Подписка:</b> {payload.product.title}\n"
+                    f"<b>Причина:</b> {payload.errorMessage}",
+                    conn, f"{dedup_key}:admin", category="payment_failed",
+                    summary=f"{user_id} - {payload.product.title}: {payload.errorMessage}"
+                )
             
-            # Уведомляем администратора о неудачном платеже
-            notify_admin(
-                f"❌ <b>Неудачный платеж</b>\n\n"
-                f"<b>Пользователь:</b> {user_id}\n"
-                f"<b>Подписка:</b> {payload.product.title}\n"
-                f"<b>Причина:</b> {payload.errorMessage}"
-            )
+            storage.write(user_id, write_failure)
         
-        return {"status": "success", "message": "Webhook processed successfully"}
+        result = {"status": "success", "message": "Webhook processed successfully"}
     
     except Exception as e:
         logger.error(f"Ошибка при обработке веб-хука: {str(e)}")
-        return {"status": "error", "message": str(e)}
+        result = {"status": "error", "message": str(e)}
+    
+    if inbox_id is not None:
+        try:
+            finish_webhook(inbox_id, result["message"] if result["status"] == "error" else None)
+        except Exception as e:
+            logger.error(f"Не удалось обновить запись входящего вебхука {inbox_id}: {str(e)}")
+    return result
+
+@app.post("/lava/payments/batch")
+async def lava_webhook_batch(request: Request, notify: bool = False, dry_run: bool = False,
+                             username: str = Depends(verify_credentials)):
+    """
+    Пакетный прием событий Lava: JSON-массив или JSONL с телами вебхуков (см. importer.py).
+    События записываются без уведомлений; notify=true отправляет ссылку на канал пользователям,
+    подписка которых активирована этими событиями.
+    """
+    body = await request.body()
+    try:
+        raw_events = list(importer.iter_raw_events(body))
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Некорректный JSON: {str(e)}")
+    if len(raw_events) > importer.IMPORT_MAX_EVENTS_PER_REQUEST:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Не больше {importer.IMPORT_MAX_EVENTS_PER_REQUEST} событий в одном запросе"
+        )
+    return await asyncio.to_thread(importer.import_events, raw_events, f"api:{username}", notify, dry_run)
 
 @app.post("/admin/reset_db")
 async def reset_database(request: Request, username: str = Depends(verify_credentials)):
+    require_sqlite_storage("Сброс базы данных")
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Удаляем все таблицы
-        cursor.execute("DROP TABLE IF EXISTS payments")
-        cursor.execute("DROP TABLE IF EXISTS channel_members")
-        
-        # Создаем таблицу payments
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            event_type TEXT NOT NULL,
-            product_id TEXT NOT NULL,
-            product_title TEXT NOT NULL,
-            buyer_email TEXT NOT NULL,
-            contract_id TEXT NOT NULL,
-            parent_contract_id TEXT,
-            amount REAL NOT NULL,
-            currency TEXT NOT NULL,
-            timestamp TEXT NOT NULL,
-            status TEXT NOT NULL,
-            error_message TEXT,
-            raw_data TEXT NOT NULL,
-            received_at TEXT NOT NULL,
-            processed INTEGER DEFAULT 0
-        )
-        ''')
-        
-        # Создаем таблицу channel_members с обновленной структурой
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS channel_members (
-            user_id TEXT PRIMARY KEY,
-            status TEXT NOT NULL,
-            joined_at TEXT NOT NULL,
-            expires_at TEXT,
-            subscription_end_date TEXT,
-            last_payment_id INTEGER,
-            FOREIGN KEY (last_payment_id) REFERENCES payments(id)
-        )
-        ''')
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS subscription_reminders (
-            user_id TEXT PRIMARY KEY,
-            last_reminder_at TEXT NOT NULL
-        )
-        ''')
+        # Удаляем таблицы платежей и участников во всех шардах
+        for shard in range(SHARD_COUNT):
+            conn = connect_shard(shard)
+            cursor = conn.cursor()
+            cursor.execute("DROP TABLE IF EXISTS payments")
+            cursor.execute("DROP TABLE IF EXISTS channel_members")
+            conn.commit()
+            conn.close()
         
-        conn.commit()
-        conn.close()
+        # Создаем таблицы заново, восстанавливаем триггеры статистики и обнуляем агрегаты
+        init_db()
+        rebuild_stats_rollups()
         
         logger.info("База данных успешно сброшена администратором")
         return {"status": "success", "message": "База данных успешно сброшена"}
@@ -731,26 +1022,215 @@ async def reset_database(request: Request, username: str = Depends(verify_creden
             detail=str(e)
         )
 
+@app.get("/admin/jobs")
+async def get_jobs(username: str = Depends(verify_credentials)):
+    """Фоновые задачи всех процессов: расписание, следующий запуск, результат последнего и ведущие"""
+    return {"jobs": await asyncio.to_thread(get_job_states), "leases": await asyncio.to_thread(get_leases)}
+
+@app.get("/admin/outbox")
+async def get_outbox(username: str = Depends(verify_credentials)):
+    """Очередь исходящих сообщений Telegram: количество по статусам, возраст самого старого неотправленного, последние ошибки"""
+    return await asyncio.to_thread(outbox.get_outbox_stats)
+
+@app.get("/admin/stats")
+async def get_stats(days: int = 30, username: str = Depends(verify_credentials)):
+    # Статистика читается из агрегатов, которые поддерживаются триггерами при записи
+    return await asyncio.to_thread(storage.stats_summary, days)
+
+@app.post("/admin/stats/rebuild")
+async def rebuild_stats(username: str = Depends(verify_credentials)):
+    result = await asyncio.to_thread(storage.rebuild_stats)
+    logger.info(f"Агрегаты статистики пересчитаны по запросу пользователя {username}")
+    return {"status": "success", **result}
+
+@app.post("/admin/members/replay")
+async def replay_members(apply: bool = False, username: str = Depends(verify_credentials)):
+    """
+    Пересчитывает состояние подписок по истории платежей и сравнивает с channel_members;
+    с apply=true переносит расхождения в channel_members (см. replay.py)
+    """
+    require_sqlite_storage("Пересчет подписок")
+    report = {"build": await asyncio.to_thread(replay.build_replay)}
+    if apply:
+        report["apply"] = await asyncio.to_thread(replay.apply_replay)
+        logger.info(f"Пересчет подписок применен по запросу пользователя {username}")
+    else:
+        report["diff"] = await asyncio.to_thread(replay.diff_replay)
+    return {"status": "success", **report}
+
+@app.get("/admin/payments/{payment_id}/raw")
+async def get_payment_raw_data(payment_id: int, username: str = Depends(verify_credentials)):
+    raw_data = await asyncio.to_thread(storage.payment_raw_data, payment_id)
+    if raw_data is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Платеж не найден"
+        )
+
+    # raw_data распаковывается только здесь, по явному запросу администратора
+    return Response(content=decompress_raw_data(raw_data), media_type="application/json")
+
+# Таблицы, доступные для выгрузки: ключ для постраничного чтения и колонка с датой для фильтра
+EXPORT_TABLES = {
+    "payments": {"key": "id", "date_column": "received_at"},
+    "channel_members": {"key": "user_id", "date_column": "joined_at"},
+    "shortened_links": {"key": "id", "date_column": "created_at"},
+}
+EXPORT_PAGE_SIZE = 1000
+
+def iter_export_rows(table: str, date_from: Optional[str], date_to: Optional[str],
+                     event_type: Optional[str], include_archive: bool, include_raw: bool):
+    """
+    Читает таблицу страницами по ключу (keyset), не загружая ее в память целиком.
+    Все страницы читаются в одной транзакции чтения, поэтому выгрузка видит
+    согласованный снимок и в режиме WAL не блокирует запись вебхуков.
+    Таблицы пользователей выгружаются по шардам подряд, снимок у каждого шарда свой.
+    """
+    shards = range(SHARD_COUNT) if table in SHARDED_TABLES else [None]
+    for shard in shards:
+        yield from iter_export_shard_rows(table, shard, date_from, date_to, event_type, include_archive, include_raw)
+
+def iter_export_shard_rows(table: str, shard: Optional[int], date_from: Optional[str], date_to: Optional[str],
+                           event_type: Optional[str], include_archive: bool, include_raw: bool):
+    config = EXPORT_TABLES[table]
+    key = config["key"]
+    source = table
+
+    # Соединение используется из потоков пула Starlette по очереди, но не одновременно
+    if shard is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    else:
+        conn = connect_shard(shard, check_same_thread=False)
+    try:
+        if table == "payments" and include_archive:
+            attach_archive(conn, shard)
+            source = "payments_history"
+
+        conditions = []
+        params = []
+        if date_from:
+            conditions.append(f"{config['date_column']} >= ?")
+            params.append(date_from)
+        if date_to:
+            conditions.append(f"{config['date_column']} < ?")
+            params.append(date_to)
+        if event_type and table == "payments":
+            conditions.append("event_type = ?")
+            params.append(event_type)
+
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        last_key = None
+        while True:
+            page_conditions = list(conditions)
+            page_params = list(params)
+            if last_key is not None:
+                page_conditions.append(f"{key} > ?")
+                page_params.append(last_key)
+            where = f"WHERE {' AND '.join(page_conditions)}" if page_conditions else ""
+            cursor.execute(
+                f"SELECT * FROM {source} {where} ORDER BY {key} LIMIT ?",
+                page_params + [EXPORT_PAGE_SIZE]
+            )
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            key_index = columns.index(key)
+            for row in rows:
+                record = dict(zip(columns, row))
+                if "raw_data" in record:
+                    record["raw_data"] = decompress_raw_data(record["raw_data"]) if include_raw else None
+                yield record
+            last_key = rows[-1][key_index]
+        conn.rollback()
+    finally:
+        conn.close()
+
+def format_export_stream(rows, export_format: str):
+    """
+    Превращает поток записей в куски CSV или JSONL. При закрытии (в том числе досрочном)
+    закрывает rows, и выгрузка освобождает соединение с БД
+    """
+    try:
+        if export_format == "jsonl":
+            for record in rows:
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+            return
+
+        buffer = io.StringIO()
+        writer = None
+        for record in rows:
+            if writer is None:
+                writer = csv.DictWriter(buffer, fieldnames=list(record.keys()))
+                writer.writeheader()
+            writer.writerow(record)
+            # Отдаем данные кусками, чтобы буфер не рос вместе с выгрузкой
+            if buffer.tell() > 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    finally:
+        rows.close()
+
+async def stream_export(chunks):
+    """
+    Отдает куски выгрузки, читая их в пуле потоков. Если клиент отключился посреди выгрузки,
+    Starlette прекращает чтение, но сам генератор не закрывает - закрываем его здесь,
+    иначе соединение с шардом осталось бы открытым до сборки мусора
+    """
+    try:
+        async for chunk in iterate_in_threadpool(chunks):
+            yield chunk
+    finally:
+        await run_in_threadpool(chunks.close)
+
+@app.get("/admin/export/{table}")
+async def export_table(
+    table: str,
+    format: str = "jsonl",
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    event_type: Optional[str] = None,
+    include_archive: bool = False,
+    include_raw: bool = False,
+    username: str = Depends(verify_credentials)
+):
+    require_sqlite_storage("Выгрузка таблиц")
+    if table not in EXPORT_TABLES:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Таблица недоступна для выгрузки"
+        )
+    if format not in ("csv", "jsonl"):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Поддерживаются форматы csv и jsonl"
+        )
+
+    logger.info(f"Выгрузка {table} в формате {format} запрошена пользователем {username}")
+    rows = iter_export_rows(table, date_from, date_to, event_type, include_archive, include_raw)
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        stream_export(format_export_stream(rows, format)),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'}
+    )
+
 @app.post("/shorten")
 async def shorten_url(request: ShortenLinkRequest, username: str = Depends(verify_credentials)):
     try:
         # Убираем запуск очистки при каждом запросе
         # cleanup_old_shortened_links()
         
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
         # Генерируем короткий код
         short_code = generate_short_code(request.original_url)
         
         # Сохраняем в базу данных
-        cursor.execute('''
-        INSERT INTO shortened_links (short_code, original_url, created_at)
-        VALUES (?, ?, ?)
-        ''', (short_code, request.original_url, datetime.now().isoformat()))
-        
-        conn.commit()
-        conn.close()
+        storage.add_link(short_code, request.original_url, datetime.now().isoformat())
         
         # Возвращаем короткий код
         return {"short_code": short_code}
@@ -765,16 +1245,11 @@ async def shorten_url(request: ShortenLinkRequest, username: str = Depends(verif
 @app.get("/payment/{short_code}")
 async def redirect_to_original(short_code: str):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
         # Получаем оригинальный URL
-        cursor.execute('SELECT original_url FROM shortened_links WHERE short_code = ?', (short_code,))
-        result = cursor.fetchone()
-        conn.close()
+        original_url = storage.resolve_link(short_code)
         
-        if result:
-            return RedirectResponse(url=result[0])
+        if original_url:
+            return RedirectResponse(url=original_url)
         else:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
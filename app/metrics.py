@@ -0,0 +1,142 @@
+import threading
+from bisect import bisect_left
+from typing import Dict, Tuple
+
+# Простые метрики в памяти процесса (без внешних зависимостей).
+# Значения доступны администратору командой бота /metrics и в формате Prometheus.
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry_lock = threading.Lock()
+_registry: Dict[str, object] = {}
+
+class Counter:
+    """Монотонный счетчик событий с разбивкой по меткам"""
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.lock = threading.Lock()
+        self.series: Dict[Tuple, float] = {}
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + value
+
+    def snapshot(self) -> Dict[Tuple, float]:
+        with self.lock:
+            return dict(self.series)
+
+class Histogram:
+    """Гистограмма длительностей (в секундах) с разбивкой по меткам"""
+
+    def __init__(self, name: str, description: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        # метки -> [счетчики по корзинам + корзина +Inf, количество, сумма]
+        self.series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += 1
+            series[2] += value
+
+    def quantile(self, q: float, **labels) -> float:
+        """Оценка квантиля по верхней границе корзины"""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if not series or not series[1]:
+                return 0.0
+            rank = q * series[1]
+            seen = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[0]):
+                seen += count
+                if seen >= rank:
+                    return bound
+        return float("inf")
+
+    def snapshot(self) -> Dict[Tuple, dict]:
+        with self.lock:
+            return {
+                key: {"buckets": list(counts), "count": count, "sum": total}
+                for key, (counts, count, total) in self.series.items()
+            }
+
+def histogram(name: str, description: str = "", buckets=DEFAULT_BUCKETS) -> Histogram:
+    """Возвращает гистограмму из реестра, создавая ее при первом обращении"""
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = Histogram(name, description, buckets)
+        return metric
+
+def counter(name: str, description: str = "") -> Counter:
+    """Возвращает счетчик из реестра, создавая его при первом обращении"""
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = Counter(name, description)
+        return metric
+
+def _format_labels(key: Tuple, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def render_prometheus() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    with _registry_lock:
+        metrics = list(_registry.values())
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        if isinstance(metric, Counter):
+            lines.append(f"# TYPE {metric.name} counter")
+            for key, value in metric.snapshot().items():
+                lines.append(f"{metric.name}{_format_labels(key)} {value:g}")
+            continue
+        lines.append(f"# TYPE {metric.name} histogram")
+        for key, series in metric.snapshot().items():
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float("inf"),), series["buckets"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                le_label = 'le="' + le + '"'
+                lines.append(f"{metric.name}_bucket{_format_labels(key, le_label)} {cumulative}")
+            lines.append(f"{metric.name}_count{_format_labels(key)} {series['count']}")
+            lines.append(f"{metric.name}_sum{_format_labels(key)} {series['sum']:.6f}")
+    return "\n".join(lines) + "\n"
+
+def render_summary() -> str:
+    """Краткая сводка для администратора: значения счетчиков, для гистограмм - количество, среднее, p50 и p95"""
+    lines = []
+    with _registry_lock:
+        metrics = list(_registry.values())
+    for metric in metrics:
+        if not metric.snapshot():
+            continue
+        lines.append(f"<b>{metric.name}</b>")
+        if isinstance(metric, Counter):
+            for key, value in sorted(metric.snapshot().items()):
+                labels = ", ".join(str(label) for _, label in key) or "—"
+                lines.append(f"{labels}: {value:g}")
+            continue
+        for key, series in sorted(metric.snapshot().items()):
+            labels = ", ".join(str(value) for _, value in key) or "—"
+            labels_dict = dict(key)
+            average = series["sum"] / series["count"] if series["count"] else 0.0
+            lines.append(
+                f"{labels}: {series['count']} шт., среднее {average:.2f} с, "
+                f"p50 ≤ {metric.quantile(0.5, **labels_dict):g} с, p95 ≤ {metric.quantile(0.95, **labels_dict):g} с"
+            )
+    return "\n".join(lines) if lines else "Метрик пока нет"
@@ -0,0 +1,134 @@
+import os
+import json
+import logging
+import time
+import argparse
+
+from database import (
+    DB_PATH, SHARD_COUNT, acquire_connection, release_connection, connect_with_archive, ensure_schema
+)
+from group_commit import relay_all_staged
+from storage import DATABASE_URL, PostgresStorage
+
+# Перенос данных пользователей из SQLite (основная БД или шарды database.SHARD_COUNT вместе
+# с архивами платежей) в PostgreSQL для STORAGE_BACKEND=postgres. Таблицы копируются через COPY
+# с сохранением номеров платежей; новые номера в PostgreSQL начинаются выше перенесенных.
+# Агрегаты статистики заполняются по скопированным данным, дневные переходы статусов
+# переносятся суммой по шардам. Очередь outbox, сводка и прочие общие таблицы остаются в SQLite.
+#
+# Сервис на время переноса должен быть остановлен, таблица payments в PostgreSQL - пустой.
+# После проверки количества строк нужно запустить сервис с STORAGE_BACKEND=postgres;
+# файлы SQLite с данными пользователей остаются как резервная копия.
+
+# Сколько строк читается из SQLite за один раз
+MIGRATE_BATCH_SIZE = int(os.getenv("MIGRATE_BATCH_SIZE", "5000"))
+
+# Копируемые таблицы шардов: (таблица в PostgreSQL, источник в SQLite)
+SHARD_TABLES = (
+    ("payments", "payments_history"),
+    ("channel_members", "channel_members"),
+    ("subscription_reminders", "subscription_reminders"),
+    ("invoice_cache", "invoice_cache"),
+)
+# Таблицы основной БД
+MAIN_TABLES = ("shortened_links", "reconciliation_state")
+
+logger = logging.getLogger("migrate_postgres")
+
+def _copy(source, target, source_table: str, target_table: str, batch_size: int) -> int:
+    columns = [row[1] for row in source.execute(f"PRAGMA table_info({source_table})")]
+    raw_index = columns.index("raw_data") if "raw_data" in columns else None
+    cursor = source.execute(f"SELECT {', '.join(columns)} FROM {source_table}")
+    copied = 0
+    with target.cursor() as pg_cursor:
+        with pg_cursor.copy(f"COPY {target_table} ({', '.join(columns)}) FROM STDIN") as copy:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    if raw_index is not None and isinstance(row[raw_index], str):
+                        # Тела, сохраненные до перехода на сжатие, - текст; в PostgreSQL raw_data - bytea
+                        row = row[:raw_index] + (row[raw_index].encode("utf-8"),) + row[raw_index + 1:]
+                    copy.write_row(row)
+                copied += len(rows)
+    return copied
+
+def migrate(url: str = DATABASE_URL, batch_size: int = MIGRATE_BATCH_SIZE) -> dict:
+    """Копирует данные пользователей из SQLite в PostgreSQL и сверяет количество строк"""
+    started = time.monotonic()
+    storage = PostgresStorage(url, min_size=1, max_size=1)
+    if SHARD_COUNT > 1:
+        # Сообщения и события, еще не перенесенные из шардов, записываются в основную БД
+        relay_all_staged()
+
+    report = {"shards": SHARD_COUNT, "tables": {}}
+    try:
+        with storage.connection() as target:
+            if target.execute("SELECT EXISTS (SELECT 1 FROM payments)").fetchone()[0]:
+                raise RuntimeError("Таблица payments в PostgreSQL уже содержит данные")
+            transitions = {}
+            for shard in range(SHARD_COUNT):
+                source = connect_with_archive(shard)
+                try:
+                    # Все таблицы шарда читаются из одного снимка
+                    source.execute("BEGIN")
+                    for target_table, source_table in SHARD_TABLES:
+                        counts = report["tables"].setdefault(target_table, {"source": 0})
+                        counts["source"] += _copy(source, target, source_table, target_table, batch_size)
+                    for day, status, count in source.execute('SELECT day, status, transitions FROM member_stats_daily'):
+                        transitions[(day, status)] = transitions.get((day, status), 0) + count
+                    source.rollback()
+                finally:
+                    source.close()
+            source = acquire_connection()
+            try:
+                for table in MAIN_TABLES:
+                    report["tables"][table] = {"source": _copy(source, target, table, table, batch_size)}
+            finally:
+                release_connection(source)
+
+            for table in ("payments", "shortened_links"):
+                target.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM {table}"
+                )
+            for table, counts in report["tables"].items():
+                counts["target"] = target.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            mismatched = [table for table, counts in report["tables"].items() if counts["source"] != counts["target"]]
+            if mismatched:
+                raise RuntimeError(f"Количество строк после переноса не совпадает: {', '.join(mismatched)}")
+        storage.rebuild_stats()
+        # Вставка участников засчитала переходы сегодняшним днем - заменяем их перенесенными
+        with storage.connection() as target:
+            target.execute('DELETE FROM member_stats_daily')
+            with target.cursor() as cursor:
+                cursor.executemany(
+                    'INSERT INTO member_stats_daily (day, status, transitions) VALUES (%s, %s, %s)',
+                    [(day, status, count) for (day, status), count in transitions.items()]
+                )
+    finally:
+        storage.close()
+
+    report["seconds"] = round(time.monotonic() - started, 2)
+    logger.info(f"Данные пользователей перенесены из {DB_PATH} в PostgreSQL за {report['seconds']} с")
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Перенос данных пользователей из SQLite в PostgreSQL (сервис должен быть остановлен)"
+    )
+    parser.add_argument("--url", default=DATABASE_URL, help="Строка подключения (по умолчанию DATABASE_URL)")
+    parser.add_argument("--batch-size", type=int, default=MIGRATE_BATCH_SIZE,
+                        help=f"Строк за одно чтение (по умолчанию {MIGRATE_BATCH_SIZE})")
+    args = parser.parse_args()
+
+    from logging_setup import configure_logging
+    configure_logging()
+    ensure_schema()
+
+    report = migrate(args.url, args.batch_size)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    print("Запустите сервис с STORAGE_BACKEND=postgres")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+import os
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List, Optional
+
+from telebot.apihelper import ApiTelegramException
+
+import metrics
+from database import acquire_connection, release_connection
+from storage import storage
+
+# Исходящие сообщения Telegram (outbox). Бизнес-логика не отправляет уведомления сама,
+# а записывает их в таблицу telegram_outbox в той же транзакции, что и изменение состояния
+# (платеж, продление, удаление из канала), поэтому обработка вебхука не ждет Telegram,
+# а сообщение не теряется, если Telegram недоступен или процесс перезапустился.
+# Отправитель забирает сообщения пачками, отправляет их с общим лимитом (telegram_client)
+# и повторяет неудачные с экспоненциальной задержкой. Сообщения одного чата отправляются
+# по порядку: следующее не берется, пока не отправлено предыдущее. Отправители могут
+# работать в нескольких процессах - каждое сообщение забирает (claim) только один из них.
+
+# Сколько сообщений отправитель забирает за раз и сколько отправляет параллельно
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+OUTBOX_SENDER_THREADS = int(os.getenv("OUTBOX_SENDER_THREADS", "4"))
+# После стольких неудачных попыток сообщение помечается failed
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "15"))
+# Как часто отправитель проверяет новые сообщения, если очередь пуста
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "0.5"))
+
+# Задержка повтора: 2, 4, 8 ... секунд, но не больше 10 минут
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 600.0
+# Сколько секунд сообщение числится за отправителем: если процесс упал во время отправки,
+# после этого срока сообщение заберет другой отправитель
+CLAIM_TTL = 60.0
+
+# Ошибки Telegram, при которых повтор бесполезен: чат не найден, бот заблокирован пользователем
+PERMANENT_ERROR_CODES = {400, 403}
+
+logger = logging.getLogger("outbox")
+
+outbox_sends = metrics.counter("outbox_sends_total", "Попытки отправки из outbox (sent, retry, failed)")
+outbox_delivery = metrics.histogram(
+    "outbox_delivery_seconds", "Время от записи сообщения в outbox до доставки",
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+)
+
+def enqueue(chat_id, kind: str, payload: dict, conn: sqlite3.Connection = None, dedup_key: str = None) -> bool:
+    """
+    Записывает сообщение в outbox. Если передано соединение conn, запись становится частью
+    его текущей транзакции (фиксирует ее вызывающий код). Сообщение с уже записанным
+    dedup_key повторно не добавляется - тогда возвращается False. conn может быть и соединением
+    PostgreSQL (storage.write): тогда сообщение попадет в основную БД после фиксации.
+    """
+    if conn is not None and not isinstance(conn, sqlite3.Connection):
+        now = time.time()
+        return storage.stage(conn, "telegram_outbox", (
+            dedup_key, str(chat_id), kind, json.dumps(payload, ensure_ascii=False), now, now
+        ))
+    own_connection = conn is None
+    if own_connection:
+        conn = acquire_connection()
+    try:
+        now = time.time()
+        cursor = conn.execute('''
+        INSERT OR IGNORE INTO telegram_outbox (dedup_key, chat_id, kind, payload, next_attempt_at, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (dedup_key, str(chat_id), kind, json.dumps(payload, ensure_ascii=False), now, now))
+        added = cursor.rowcount > 0
+        if own_connection:
+            conn.commit()
+    finally:
+        if own_connection:
+            release_connection(conn)
+    if own_connection and added:
+        sender.wake()
+    return added
+
+def enqueue_message(chat_id, text: str, conn: sqlite3.Connection = None, dedup_key: str = None,
+                    parse_mode: str = None, reply_markup=None, disable_web_page_preview: bool = None) -> bool:
+    """Записывает в outbox обычное текстовое сообщение (аргументы как у bot.send_message)"""
+    payload = {"text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    if reply_markup is not None:
+        payload["reply_markup"] = reply_markup.to_json() if hasattr(reply_markup, "to_json") else reply_markup
+    if disable_web_page_preview is not None:
+        payload["disable_web_page_preview"] = disable_web_page_preview
+    return enqueue(chat_id, "message", payload, conn, dedup_key)
+
+def claim_batch(limit: int) -> List[tuple]:
+    """
+    Забирает до limit сообщений, готовых к отправке, не больше одного на чат: сообщение
+    не берется, пока в его чате есть более раннее неотправленное.
+    """
+    now = time.time()
+    conn = acquire_connection()
+    try:
+        rows = conn.execute('''
+        UPDATE telegram_outbox
+        SET status = 'sending', claimed_until = ?, attempts = attempts + 1
+        WHERE id IN (
+            SELECT o.id FROM telegram_outbox o
+            WHERE ((o.status = 'pending' AND o.next_attempt_at <= ?)
+                   OR (o.status = 'sending' AND o.claimed_until < ?))
+              AND NOT EXISTS (
+                  SELECT 1 FROM telegram_outbox earlier
+                  WHERE earlier.chat_id = o.chat_id AND earlier.status IN ('pending', 'sending')
+                    AND earlier.id < o.id
+              )
+            ORDER BY o.id
+            LIMIT ?
+        )
+        RETURNING id, chat_id, kind, payload, attempts, created_at
+        ''', (now + CLAIM_TTL, now, now, limit)).fetchall()
+        conn.commit()
+        return sorted(rows)
+    finally:
+        release_connection(conn)
+
+def _update(outbox_id: int, sql: str, params: tuple):
+    conn = acquire_connection()
+    try:
+        conn.execute(f'UPDATE telegram_outbox SET {sql} WHERE id = ?', params + (outbox_id,))
+        conn.commit()
+    finally:
+        release_connection(conn)
+
+def _render(outbox_id: int, chat_id: str, kind: str, payload: dict) -> dict:
+    """Аргументы bot.send_message для сообщения. Меню и ссылка на канал готовятся при отправке"""
+    if kind == "message":
+        return payload
+    from subscriptions import MENU_TEXT, main_menu_markup, issue_invite_link, channel_access_message
+    if kind == "main_menu":
+        # Кнопки меню зависят от статуса подписки на момент отправки
+        return {"text": MENU_TEXT, "reply_markup": main_menu_markup(chat_id), "parse_mode": "HTML"}
+    if kind == "channel_access":
+        if not payload.get("invite_link"):
+            # Ссылку сохраняем до отправки: при повторе пользователь получит ту же ссылку
+            payload["invite_link"] = issue_invite_link(chat_id)
+            _update(outbox_id, 'payload = ?', (json.dumps(payload, ensure_ascii=False),))
+        text, markup = channel_access_message(payload["invite_link"])
+        return {"text": text, "reply_markup": markup}
+    raise ValueError(f"Неизвестный тип сообщения: {kind}")
+
+def _retry_delay(error: Exception, attempts: int) -> Optional[float]:
+    """Через сколько секунд повторить отправку; None - повторять не нужно"""
+    if isinstance(error, ApiTelegramException):
+        if error.error_code == 429:
+            retry_after = (error.result_json or {}).get("parameters", {}).get("retry_after")
+            if retry_after and attempts < OUTBOX_MAX_ATTEMPTS:
+                return float(retry_after)
+        elif error.error_code in PERMANENT_ERROR_CODES:
+            return None
+    if attempts >= OUTBOX_MAX_ATTEMPTS:
+        return None
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    # Разброс, чтобы после восстановления Telegram повторы не пошли одной волной
+    return delay * random.uniform(0.8, 1.2)
+
+class OutboxSender:
+    """Фоновый отправитель сообщений из outbox"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None or self.stopping.is_set():
+                return
+            self.executor = ThreadPoolExecutor(max_workers=OUTBOX_SENDER_THREADS, thread_name_prefix="outbox")
+            self.thread = threading.Thread(target=self._loop, name="outbox_sender", daemon=True)
+            self.thread.start()
+        logger.info("Отправитель сообщений из outbox запущен")
+
+    def wake(self):
+        self.wakeup.set()
+
+    def stop(self, timeout: float) -> bool:
+        """Прекращает забирать сообщения и ждет начатые отправки не дольше timeout секунд"""
+        with self.lock:
+            self.stopping.set()
+            thread = self.thread
+        self.wakeup.set()
+        if thread is None:
+            return True
+        thread.join(timeout)
+        if thread.is_alive():
+            logger.warning(f"Отправки из outbox не завершились за {timeout} с")
+            return False
+        self.executor.shutdown(wait=False)
+        return True
+
+    def _loop(self):
+        in_flight = set()
+        while not self.stopping.is_set():
+            # Сбрасываем до запроса, чтобы не потерять пробуждение от enqueue
+            self.wakeup.clear()
+            # Новые сообщения забираем, как только освобождается место, не дожидаясь всей пачки
+            batch = []
+            if len(in_flight) < OUTBOX_BATCH_SIZE:
+                try:
+                    batch = claim_batch(OUTBOX_BATCH_SIZE - len(in_flight))
+                except sqlite3.Error as e:
+                    logger.warning(f"Не удалось забрать сообщения из outbox: {str(e)}")
+            in_flight.update(self.executor.submit(self._deliver, row) for row in batch)
+            if in_flight:
+                _, in_flight = wait(in_flight, timeout=OUTBOX_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            else:
+                self.wakeup.wait(OUTBOX_POLL_INTERVAL)
+        # Начатые отправки завершаются, еще не начатые возвращаются в очередь (см. _deliver)
+        wait(in_flight)
+
+    def _deliver(self, row: tuple):
+        outbox_id, chat_id, kind, payload, attempts, created_at = row
+        try:
+            if self.stopping.is_set():
+                # Сервис останавливается: возвращаем сообщение в очередь, его отправит следующий запуск
+                _update(outbox_id, "status = 'pending', claimed_until = NULL, attempts = attempts - 1", ())
+                return
+            # Импорт здесь: отправитель запускается и в воркерах API, и в процессе бота
+            from telegram_client import get_bot
+            message = _render(outbox_id, chat_id, kind, json.loads(payload))
+            sent = get_bot().send_message(chat_id, **message)
+        except Exception as e:
+            self._fail(outbox_id, chat_id, attempts, e)
+            return
+        try:
+            _update(
+                outbox_id, "status = 'sent', sent_at = ?, message_id = ?, claimed_until = NULL, last_error = NULL",
+                (time.time(), sent.message_id)
+            )
+        except sqlite3.Error as e:
+            # Сообщение доставлено; после истечения claim оно может уйти повторно
+            logger.error(f"Не удалось отметить отправку сообщения {outbox_id}: {str(e)}")
+        outbox_sends.inc(result="sent")
+        outbox_delivery.observe(time.time() - created_at)
+
+    def _fail(self, outbox_id: int, chat_id: str, attempts: int, error: Exception):
+        delay = _retry_delay(error, attempts)
+        try:
+            if delay is None:
+                _update(outbox_id, "status = 'failed', claimed_until = NULL, last_error = ?", (str(error),))
+            else:
+                _update(
+                    outbox_id, "status = 'pending', claimed_until = NULL, next_attempt_at = ?, last_error = ?",
+                    (time.time() + delay, str(error))
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось сохранить результат отправки сообщения {outbox_id}: {str(e)}")
+        if delay is None:
+            outbox_sends.inc(result="failed")
+            logger.error(f"Сообщение {outbox_id} для {chat_id} не отправлено (попыток: {attempts}): {str(error)}")
+        else:
+            outbox_sends.inc(result="retry")
+            logger.warning(
+                f"Сообщение {outbox_id} для {chat_id} не отправлено (попытка {attempts}), "
+                f"повтор через {delay:.0f} с: {str(error)}"
+            )
+
+def get_outbox_stats(failed_limit: int = 20) -> dict:
+    """Состояние очереди для администратора: количество по статусам и последние неотправленные"""
+    conn = acquire_connection()
+    try:
+        now = time.time()
+        counts = dict(conn.execute('SELECT status, COUNT(*) FROM telegram_outbox GROUP BY status').fetchall())
+        oldest = conn.execute(
+            "SELECT MIN(created_at) FROM telegram_outbox WHERE status IN ('pending', 'sending')"
+        ).fetchone()[0]
+        failed = [
+            {"id": outbox_id, "chat_id": chat_id, "kind": kind, "attempts": attempts, "error": error}
+            for outbox_id, chat_id, kind, attempts, error in conn.execute(
+                "SELECT id, chat_id, kind, attempts, last_error FROM telegram_outbox "
+                "WHERE status = 'failed' ORDER BY id DESC LIMIT ?", (failed_limit,)
+            ).fetchall()
+        ]
+        return {
+            "counts": counts,
+            "oldest_pending_age": round(now - oldest, 1) if oldest else None,
+            "failed": failed,
+        }
+    finally:
+        release_connection(conn)
+
+def cleanup_outbox(sent_days: int = 7, failed_days: int = 30) -> int:
+    """Удаляет отправленные и окончательно не отправленные сообщения (вместе с ними - ключи дедупликации)"""
+    now = time.time()
+    conn = acquire_connection()
+    try:
+        cursor = conn.execute(
+            "DELETE FROM telegram_outbox WHERE (status = 'sent' AND created_at < ?) OR (status = 'failed' AND created_at < ?)",
+            (now - sent_days * 86400, now - failed_days * 86400)
+        )
+        conn.commit()
+        return cursor.rowcount
+    finally:
+        release_connection(conn)
+
+# Отправитель процесса: запускается ботом и воркерами API (start), останавливается при остановке сервиса
+sender = OutboxSender()
@@ -0,0 +1,138 @@
+import os
+import logging
+import threading
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+
+# Индекс цен для определения периодичности подписки по сумме платежа.
+# Строится из каталога Lava (все валюты и все предложения), цены из переменных
+# окружения PRICE_* используются как запасной вариант для RUB.
+
+# Цены из переменных окружения
+PRICE_MONTHLY = float(os.getenv("PRICE_MONTHLY", "500"))
+PRICE_3_MONTHS = float(os.getenv("PRICE_3_MONTHS", "1200"))
+PRICE_6_MONTHS = float(os.getenv("PRICE_6_MONTHS", "2000"))
+PRICE_YEARLY = float(os.getenv("PRICE_YEARLY", "3850"))
+
+# Словарь соответствия цен и периодичности
+PRICE_PERIODICITY = {
+    PRICE_MONTHLY: "MONTHLY",
+    PRICE_3_MONTHS: "PERIOD_90_DAYS",
+    PRICE_6_MONTHS: "PERIOD_180_DAYS",
+    PRICE_YEARLY: "PERIOD_YEAR"
+}
+
+# Допустимое отклонение суммы от цены тарифа той же валюты (скидки, округление)
+PRICE_TOLERANCE = float(os.getenv("PRICE_TOLERANCE", "0.1"))
+
+DEFAULT_PERIODICITY = "MONTHLY"
+
+logger = logging.getLogger("pricing")
+
+pricing_lookups = metrics.counter(
+    "pricing_lookups_total", "Определения периодичности по сумме платежа (по способу сопоставления)"
+)
+pricing_unmatched = metrics.counter(
+    "pricing_unmatched_total", "Суммы, не сопоставленные ни с одним тарифом (использован MONTHLY)"
+)
+
+def _amount_key(amount) -> float:
+    return round(float(amount), 2)
+
+class PricingIndex:
+    """Неизменяемый индекс цен: точный поиск за O(1), поиск ближайшей цены - бинарный"""
+
+    def __init__(self, subscriptions: List[dict]):
+        # (offer_id или product_id, валюта, сумма) -> периодичность
+        self.by_offer: Dict[Tuple[str, str, float], str] = {}
+        # (валюта, сумма) -> периодичность; None, если у разных тарифов одна цена и разные периоды
+        self.by_amount: Dict[Tuple[str, float], Optional[str]] = {}
+
+        for sub in subscriptions:
+            ids = [sub["offer_id"]] + ([sub["product_id"]] if sub.get("product_id") else [])
+            for price in sub["prices"]:
+                for currency, amount in price["currencies"].items():
+                    if amount is None:
+                        continue
+                    currency = currency.upper()
+                    key = _amount_key(amount)
+                    for item_id in ids:
+                        self.by_offer[(item_id, currency, key)] = price["periodicity"]
+                    known = self.by_amount.get((currency, key), price["periodicity"])
+                    self.by_amount[(currency, key)] = known if known == price["periodicity"] else None
+
+        # Запасные цены из окружения не перекрывают цены каталога
+        for amount, periodicity in PRICE_PERIODICITY.items():
+            self.by_amount.setdefault(("RUB", _amount_key(amount)), periodicity)
+
+        self.sorted_amounts: Dict[str, List[float]] = {}
+        for (currency, amount), periodicity in self.by_amount.items():
+            if periodicity:
+                self.sorted_amounts.setdefault(currency, []).append(amount)
+        for amounts in self.sorted_amounts.values():
+            amounts.sort()
+
+    def lookup(self, amount: float, currency: Optional[str] = None,
+               product_id: Optional[str] = None) -> Tuple[Optional[str], str]:
+        """Возвращает (периодичность или None, способ сопоставления)"""
+        currency = (currency or "RUB").upper()
+        key = _amount_key(amount)
+
+        if product_id:
+            periodicity = self.by_offer.get((product_id, currency, key))
+            if periodicity:
+                return periodicity, "offer"
+
+        periodicity = self.by_amount.get((currency, key))
+        if periodicity:
+            return periodicity, "amount"
+
+        # Ближайшая цена в той же валюте в пределах допустимого отклонения
+        amounts = self.sorted_amounts.get(currency)
+        if amounts:
+            position = bisect_left(amounts, key)
+            neighbours = amounts[max(0, position - 1):position + 1]
+            closest = min(neighbours, key=lambda price: abs(price - key))
+            if abs(closest - key) <= closest * PRICE_TOLERANCE:
+                return self.by_amount[(currency, closest)], "nearest"
+
+        return None, "unmatched"
+
+_index_lock = threading.Lock()
+_index = PricingIndex([])
+_catalog_signature = None
+
+def update_pricing_index(subscriptions: List[dict]) -> bool:
+    """Перестраивает индекс, если цены в каталоге изменились. Возвращает True при перестроении."""
+    global _index, _catalog_signature
+    signature = tuple(sorted(
+        (sub["offer_id"], sub.get("product_id") or "", price["periodicity"], currency, str(amount))
+        for sub in subscriptions
+        for price in sub["prices"]
+        for currency, amount in price["currencies"].items()
+    ))
+    with _index_lock:
+        if signature == _catalog_signature:
+            return False
+        index = PricingIndex(subscriptions)
+        _index = index
+        _catalog_signature = signature
+    logger.info(f"Индекс цен перестроен: {len(index.by_offer)} цен предложений, {len(index.by_amount)} цен по валютам")
+    return True
+
+def resolve_periodicity(amount: float, currency: Optional[str] = None, product_id: Optional[str] = None) -> str:
+    """Определяет периодичность по сумме, валюте и продукту; при отсутствии совпадения - MONTHLY"""
+    if amount is None:
+        pricing_unmatched.inc(currency=(currency or "RUB").upper())
+        return DEFAULT_PERIODICITY
+    periodicity, match = _index.lookup(amount, currency, product_id)
+    pricing_lookups.inc(match=match)
+    if periodicity is None:
+        pricing_unmatched.inc(currency=(currency or "RUB").upper())
+        logger.warning(f"Не удалось определить периодичность для суммы {amount} {currency or ''}, используем {DEFAULT_PERIODICITY}")
+        return DEFAULT_PERIODICITY
+    if match == "nearest":
+        logger.info(f"Сумма {amount} {currency or ''} близка к цене тарифа, используем периодичность {periodicity}")
+    return periodicity
@@ -0,0 +1,167 @@
+import os
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+
+import requests
+
+from storage import storage
+
+# Сверка подписок с LAVA.TOP: ловит потерянные вебхуки о продлении и отмене,
+# чтобы check_subscription_expiration не удалял из канала оплативших пользователей
+
+LAVA_API_KEY = os.getenv("LAVA_API_KEY")
+LAVA_API_URL = os.getenv("LAVA_API_URL", "https://gate.lava.top").rstrip("/")
+# Путь для получения контракта. По документации Lava не проверен - при другом пути
+# у публичного API его задают переменной (заглушка в tests/test_reconciliation.py отвечает на этот)
+LAVA_CONTRACT_PATH = os.getenv("LAVA_CONTRACT_PATH", "/api/v1/invoices/{contract_id}")
+
+# Проверяются подписки, которые истекают в ближайшие RECONCILE_WINDOW_HOURS часов
+# или уже истекли, но еще находятся в льготном периоде
+RECONCILE_WINDOW_HOURS = int(os.getenv("RECONCILE_WINDOW_HOURS", "48"))
+RECONCILE_GRACE_DAYS = int(os.getenv("RECONCILE_GRACE_DAYS", "3"))
+# Один и тот же пользователь перепроверяется не чаще раза в RECONCILE_RECHECK_MINUTES минут
+RECONCILE_RECHECK_MINUTES = int(os.getenv("RECONCILE_RECHECK_MINUTES", "360"))
+RECONCILE_PAGE_SIZE = int(os.getenv("RECONCILE_PAGE_SIZE", "50"))
+RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", "4"))
+RECONCILE_RATE_PER_SECOND = float(os.getenv("RECONCILE_RATE_PER_SECOND", "5"))
+
+logger = logging.getLogger("reconciliation")
+
+class RateLimiter:
+    """Ограничивает частоту запросов к API из нескольких потоков"""
+
+    def __init__(self, rate_per_second: float):
+        self.interval = 1.0 / rate_per_second if rate_per_second > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+def normalize_lava_status(status: Optional[str]) -> str:
+    """Сводит статусы контрактов Lava к active / cancelled / inactive / unknown"""
+    status = (status or "").lower()
+    if status in ("subscription-active", "active"):
+        return "active"
+    if "cancel" in status:
+        return "cancelled"
+    if status:
+        return "inactive"
+    return "unknown"
+
+def fetch_contract(session: requests.Session, limiter: RateLimiter, contract_id: str) -> Optional[dict]:
+    """Получает состояние контракта из Lava с учетом ограничения частоты"""
+    limiter.wait()
+    url = LAVA_API_URL + LAVA_CONTRACT_PATH.format(contract_id=contract_id)
+    try:
+        response = session.get(url, headers={"X-Api-Key": LAVA_API_KEY}, timeout=15)
+        if response.status_code == 404:
+            return {"status": None}
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        logger.warning(f"Не удалось получить контракт {contract_id} из Lava: {e}")
+        return None
+
+def parse_date(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def reconcile_expiring_members(period_days_for_amount: Callable[[float, str, str], int], dry_run: bool = False) -> dict:
+    """
+    Сверяет с Lava пользователей, чья подписка истекает в окне сверки, и исправляет расхождения.
+
+    Пользователи выбираются постранично (по user_id), контракты каждой страницы
+    запрашиваются параллельно с ограничением частоты, исправления страницы
+    записываются одной транзакцией. Пользователи, сверенные недавно, пропускаются.
+
+    - Lava: контракт активен, у нас подписка уже истекла - вебхук о продлении
+      потерян, продлеваем на период последнего платежа.
+    - Lava: подписка отменена, у нас active - переводим в cancelled, дату окончания не трогаем.
+    """
+    now = datetime.now(timezone.utc)
+    window_end = (now + timedelta(hours=RECONCILE_WINDOW_HOURS)).isoformat()
+    grace_start = (now - timedelta(days=RECONCILE_GRACE_DAYS)).isoformat()
+    recheck_before = (now - timedelta(minutes=RECONCILE_RECHECK_MINUTES)).isoformat()
+
+    stats = {"checked": 0, "extended": 0, "cancelled": 0, "errors": 0}
+    limiter = RateLimiter(RECONCILE_RATE_PER_SECOND)
+    session = requests.Session()
+
+    # Части хранилища (шарды SQLite) сверяются по очереди
+    try:
+        with ThreadPoolExecutor(max_workers=RECONCILE_CONCURRENCY) as executor:
+            for partition in storage.partitions():
+                last_user_id = ""
+                while True:
+                    page = storage.reconciliation_page(
+                        partition, window_end, grace_start, recheck_before, last_user_id, RECONCILE_PAGE_SIZE
+                    )
+                    if not page:
+                        break
+                    last_user_id = page[-1][0]
+
+                    contracts = list(executor.map(
+                        lambda member: fetch_contract(session, limiter, member[2]),
+                        page
+                    ))
+
+                    checked_at = datetime.now(timezone.utc).isoformat()
+                    state_rows = []
+                    extensions = []
+                    cancellations = []
+                    for (user_id, end_date_str, contract_id, amount, currency, product_id), contract in zip(page, contracts):
+                        if contract is None:
+                            stats["errors"] += 1
+                            continue
+                        stats["checked"] += 1
+                        lava_status = normalize_lava_status(contract.get("status"))
+                        state_rows.append((user_id, contract_id, lava_status, checked_at))
+
+                        end_date = parse_date(end_date_str)
+                        if lava_status == "active" and end_date and end_date < now:
+                            # Если Lava сообщает дату окончания оплаченного периода - берем ее,
+                            # иначе продлеваем на период последнего платежа
+                            paid_until = parse_date(contract.get("willExpireAt") or contract.get("nextPaymentDate"))
+                            if not paid_until or paid_until <= end_date:
+                                paid_until = end_date + timedelta(days=period_days_for_amount(amount or 0, currency, product_id))
+                            extensions.append((paid_until.isoformat(), user_id))
+                        elif lava_status == "cancelled":
+                            cancellations.append((user_id,))
+
+                    if dry_run:
+                        stats["extended"] += len(extensions)
+                        stats["cancelled"] += len(cancellations)
+                        continue
+
+                    # Исправления страницы записываются одной транзакцией
+                    extended, cancelled = storage.save_reconciliation(partition, state_rows, extensions, cancellations)
+                    stats["extended"] += extended
+                    stats["cancelled"] += cancelled
+
+                    for new_end_date, user_id in extensions:
+                        logger.warning(f"Сверка с Lava: продление пользователя {user_id} без вебхука, новая дата окончания {new_end_date}")
+                    for (user_id,) in cancellations:
+                        logger.warning(f"Сверка с Lava: подписка пользователя {user_id} отменена в Lava, статус обновлен на 'cancelled'")
+    finally:
+        session.close()
+
+    logger.info(
+        f"Сверка с Lava завершена: проверено {stats['checked']}, продлено {stats['extended']}, "
+        f"отменено {stats['cancelled']}, ошибок {stats['errors']}"
+    )
+    return stats
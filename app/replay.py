@@ -0,0 +1,447 @@
+import os
+import heapq
+import json
+import logging
+import sqlite3
+import time
+import argparse
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from database import SHARD_COUNT, acquire_connection, attach_archive, connect_shard, ensure_schema, release_connection
+from reconciliation import parse_date
+from storage import require_sqlite
+
+# Пересчет состояния подписок по журналу платежей. channel_members меняется на месте
+# обработчиками вебхуков, отменой подписки в боте, fallback в add_user_to_channel и проверкой
+# сроков; если таблица разошлась с историей, ее можно восстановить отсюда.
+#
+# build_replay за один проход читает всю историю платежей (payments и архив) в порядке
+# пользователь -> время получения и сворачивает события каждого пользователя по тем же
+# правилам, что и живые обработчики, в отдельную таблицу channel_members_replay. В памяти
+# одновременно находятся только события одного пользователя. Дальше diff_replay сравнивает
+# результат с channel_members, а apply_replay переносит расхождения одной транзакцией.
+#
+# Изменения, которых нет в журнале платежей (отмена автопродления из бота, продление и отмена
+# при сверке с Lava), пересчетом не восстанавливаются: такие расхождения помечаются outside_log
+# и не переносятся. Записи channel_members без платежей в истории (extra) тоже не удаляются,
+# а истекшие подписки (expired) остаются проверке сроков: она удаляет участника из канала.
+#
+# При нескольких шардах (database.SHARD_COUNT) каждый шард пересчитывается отдельно: таблица
+# пересчета своя у каждого шарда, снимки всех шардов хранятся в app_settings основной БД,
+# apply_replay фиксирует шарды по очереди.
+
+# Сколько пользователей записывается в таблицу пересчета одной транзакцией
+REPLAY_BATCH_SIZE = int(os.getenv("REPLAY_BATCH_SIZE", "5000"))
+# Расхождение дат меньше этого числа секунд не считается отличием: живой обработчик считает
+# срок от времени приема вебхука, а в payments.received_at записано время сохранения платежа
+REPLAY_TIME_TOLERANCE = float(os.getenv("REPLAY_TIME_TOLERANCE", "3600"))
+# Сколько расхождений с обоими состояниями возвращается в отчете
+REPLAY_SAMPLE_SIZE = 20
+
+REPLAY_TABLE = "channel_members_replay"
+# Виды расхождений, которые apply_replay переносит в channel_members
+REPLAY_APPLY_KINDS = ("missing", "status", "last_payment", "end_date", "joined_at")
+
+REPLAY_EVENTS = ("payment.success", "subscription.recurring.payment.success", "subscription.cancelled")
+
+logger = logging.getLogger("replay")
+
+class _Fold:
+    """Состояние подписки одного пользователя при пересчете"""
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.status = None
+        self.joined_at = None
+        self.end = None
+        self.end_time = None
+        self.last_payment_id = None
+
+    def expire(self, moment: datetime, grace: timedelta):
+        # Проверка сроков переводит в removed через grace после окончания подписки
+        if self.status in ('active', 'cancelled') and self.end_time is not None and moment - self.end_time >= grace:
+            self.status = 'removed'
+
+    def row(self) -> tuple:
+        return (self.user_id, self.status, self.joined_at, self.end, self.last_payment_id)
+
+def _cancelled_until(raw_data) -> Optional[str]:
+    """Дата окончания доступа (willExpireAt) из тела вебхука отмены, как ее записывает обработчик"""
+    from main import decompress_raw_data, normalize_datetime_string
+
+    try:
+        will_expire_at = json.loads(decompress_raw_data(raw_data)).get("willExpireAt")
+    except (ValueError, AttributeError):
+        will_expire_at = None
+    return normalize_datetime_string(will_expire_at)
+
+def _fold_user(user_id: str, events: list, now: datetime, period_days, grace: timedelta) -> Optional[tuple]:
+    """
+    Сворачивает события пользователя (в порядке получения) в строку channel_members.
+    Правила те же, что в process_webhook: оплата создает подписку заново, автопродление
+    продлевает только существующую, отмена меняет только активную.
+    """
+    state = _Fold(user_id)
+    for payment_id, event_type, received_at, amount, currency, product_id, raw_data in events:
+        moment = parse_date(received_at)
+        if moment is None:
+            continue
+        state.expire(moment, grace)
+        if event_type == "subscription.cancelled":
+            if state.status != 'active':
+                continue
+            state.status = 'cancelled'
+            state.end = _cancelled_until(raw_data)
+            state.end_time = parse_date(state.end)
+            continue
+        if event_type != "payment.success" and state.status is None:
+            # Автопродление без записи в channel_members живой обработчик не применяет
+            continue
+        end_time = moment + timedelta(days=period_days(amount, currency, product_id))
+        if event_type == "payment.success":
+            state.joined_at = received_at
+        state.status = 'active'
+        state.end = end_time.isoformat()
+        state.end_time = end_time
+        state.last_payment_id = payment_id
+    if state.status is None:
+        return None
+    state.expire(now, grace)
+    return state.row()
+
+def _period_days():
+    """Длительность периода по сумме платежа с запоминанием: цены в истории повторяются"""
+    from subscriptions import get_periodicity_by_amount, PERIOD_DAYS
+
+    periods = {}
+
+    def period_days(amount, currency, product_id) -> int:
+        key = (amount, currency, product_id)
+        if key not in periods:
+            periods[key] = PERIOD_DAYS.get(get_periodicity_by_amount(*key), 30)
+        return periods[key]
+    return period_days
+
+def _snapshot_key(shard: int) -> str:
+    """Ключ app_settings со снимком пересчета шарда"""
+    return "members_replay" if SHARD_COUNT == 1 else f"members_replay:{shard}"
+
+def _save_snapshot(shard: int, snapshot: dict):
+    # Снимки всех шардов хранятся в app_settings основной БД
+    conn = acquire_connection()
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO app_settings (key, value) VALUES (?, ?)", (_snapshot_key(shard), json.dumps(snapshot))
+        )
+        conn.commit()
+    finally:
+        release_connection(conn)
+
+def _load_snapshot(shard: int) -> Optional[dict]:
+    conn = acquire_connection()
+    try:
+        row = conn.execute("SELECT value FROM app_settings WHERE key = ?", (_snapshot_key(shard),)).fetchone()
+    finally:
+        release_connection(conn)
+    return json.loads(row[0]) if row else None
+
+def build_replay(batch_size: int = REPLAY_BATCH_SIZE) -> dict:
+    """
+    Пересчитывает состояние всех подписок по истории платежей в таблицу channel_members_replay.
+    Вся история шарда читается из одного снимка БД; номер последнего платежа снимка сохраняется
+    в app_settings, чтобы apply_replay не трогал пользователей с более новыми платежами.
+    """
+    from subscriptions import GRACE_PERIOD_DAYS
+
+    started = time.monotonic()
+    report = {"events": 0, "users": 0, "members": 0, "statuses": {}}
+    now = datetime.now(timezone.utc)
+    grace = timedelta(days=GRACE_PERIOD_DAYS)
+    period_days = _period_days()
+
+    snapshots = [
+        _build_shard(shard, batch_size, now, grace, period_days, report) for shard in range(SHARD_COUNT)
+    ]
+    if SHARD_COUNT == 1:
+        report["snapshot_payment_id"] = snapshots[0]
+    else:
+        report["snapshot_payment_ids"] = snapshots
+
+    report["seconds"] = round(time.monotonic() - started, 2)
+    logger.info(
+        f"Пересчет подписок по истории платежей: событий {report['events']}, пользователей "
+        f"{report['users']}, подписок {report['members']} за {report['seconds']} с"
+    )
+    return report
+
+def _history_rows(conn: sqlite3.Connection, table: str, condition: str = ""):
+    """События таблицы платежей в порядке индекса idx_payments_buyer: покупатель -> время получения"""
+    placeholders = ",".join("?" * len(REPLAY_EVENTS))
+    # Тело вебхука нужно только отменам (willExpireAt), для остальных событий оно не читается
+    cursor = conn.execute(f'''
+    SELECT buyer_email, id, event_type, received_at, amount, currency, product_id,
+           CASE WHEN event_type = 'subscription.cancelled' THEN raw_data END
+    FROM {table}
+    WHERE event_type IN ({placeholders}) {condition}
+    ORDER BY buyer_email, received_at, id
+    ''', REPLAY_EVENTS)
+    cursor.arraysize = 1000
+    while True:
+        page = cursor.fetchmany()
+        if not page:
+            return
+        yield from page
+
+def _history(conn: sqlite3.Connection):
+    """
+    Вся история платежей шарда (основная БД и архив) в порядке покупатель -> время получения.
+    Каждая таблица читается по индексу, без сортировки всей истории во временном B-дереве,
+    а два упорядоченных потока сливаются здесь. События пользователя идут подряд, и в памяти
+    не нужно держать состояние всех пользователей сразу.
+    """
+    # Запись может оказаться в обоих файлах, если перенос в архив прервался (см. payments_history)
+    archived = _history_rows(conn, "archive.payments", "AND id NOT IN (SELECT id FROM main.payments)")
+    return heapq.merge(_history_rows(conn, "main.payments"), archived, key=lambda row: (row[0], row[3], row[1]))
+
+def _build_shard(shard: int, batch_size: int, now: datetime, grace: timedelta, period_days, report: dict) -> int:
+    """Пересчет одного шарда; возвращает номер последнего платежа снимка"""
+    # Только файл шарда: BEGIN IMMEDIATE писателя не блокирует основную БД (см. connect_shard)
+    reader = connect_shard(shard, common=False, isolation_level=None)
+    writer = connect_shard(shard, common=False, timeout=30, isolation_level=None)
+    try:
+        attach_archive(reader, shard)
+        writer.execute(f"DROP TABLE IF EXISTS main.{REPLAY_TABLE}")
+        writer.execute(f'''
+        CREATE TABLE main.{REPLAY_TABLE} (
+            user_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            joined_at TEXT NOT NULL,
+            subscription_end_date TEXT,
+            last_payment_id INTEGER
+        )
+        ''')
+
+        rows = []
+
+        def flush():
+            writer.execute("BEGIN IMMEDIATE")
+            writer.executemany(f'''
+            INSERT INTO {REPLAY_TABLE} (user_id, status, joined_at, subscription_end_date, last_payment_id)
+            VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+            writer.execute("COMMIT")
+            rows.clear()
+
+        def fold(user_id: str, events: list):
+            report["users"] += 1
+            # Платежи пользователя с разными email приходят разными потоками: упорядочиваем
+            # по времени получения (для одного email список уже упорядочен)
+            events.sort(key=lambda event: (event[2], event[0]))
+            row = _fold_user(user_id, events, now, period_days, grace)
+            if row is None:
+                return
+            report["members"] += 1
+            report["statuses"][row[1]] = report["statuses"].get(row[1], 0) + 1
+            rows.append(row)
+            if len(rows) >= batch_size:
+                flush()
+
+        # Снимок: номер последнего платежа и вся история читаются в одной транзакции чтения
+        reader.execute("BEGIN")
+        snapshot_payment_id = reader.execute('SELECT COALESCE(MAX(id), 0) FROM main.payments').fetchone()[0]
+        current_user, events = None, []
+        for row in _history(reader):
+            report["events"] += 1
+            user_id = row[0].split('@')[0]
+            if user_id != current_user:
+                if events:
+                    fold(current_user, events)
+                current_user, events = user_id, []
+            events.append(row[1:])
+        if events:
+            fold(current_user, events)
+        reader.execute("COMMIT")
+        if rows:
+            flush()
+
+    finally:
+        reader.close()
+        writer.close()
+    _save_snapshot(shard, {"snapshot_payment_id": snapshot_payment_id, "built_at": now.isoformat()})
+    return snapshot_payment_id
+
+def _times_differ(live: Optional[str], replay: Optional[str], tolerance: float) -> bool:
+    if live == replay:
+        return False
+    live_time, replay_time = parse_date(live), parse_date(replay)
+    if live_time is None or replay_time is None:
+        return True
+    return abs((live_time - replay_time).total_seconds()) > tolerance
+
+def _classify(live: Optional[tuple], replay: Optional[tuple], tolerance: float, now: datetime) -> Optional[str]:
+    """Вид расхождения записи channel_members (status, joined_at, end, last_payment_id) с пересчетом"""
+    if live is None:
+        return "missing"
+    if replay is None:
+        return "extra"
+    live_status, live_joined, live_end, live_payment = live
+    replay_status, replay_joined, replay_end, replay_payment = replay
+    if live_payment == replay_payment:
+        # После последнего платежа подписку отменили в боте или продлили/отменили при сверке
+        if live_status == 'cancelled' and replay_status == 'active':
+            return "outside_log"
+        live_end_time, replay_end_time = parse_date(live_end), parse_date(replay_end)
+        if (live_status == replay_status and live_end_time is not None and replay_end_time is not None
+                and (live_end_time - replay_end_time).total_seconds() > tolerance):
+            return "outside_log"
+    if replay_status == 'removed' and live_status in ('active', 'cancelled'):
+        # Удаление из канала и уведомления выполнит проверка сроков, а не замена записи
+        return "expired"
+    if live_status == 'removed' and replay_status in ('active', 'cancelled'):
+        # Подписка уже закончилась и участник удален раньше конца отсрочки (например, импортом)
+        replay_end_time = parse_date(replay_end)
+        if replay_end_time is not None and replay_end_time < now:
+            return "expired"
+    if live_status != replay_status:
+        return "status"
+    if live_payment != replay_payment:
+        return "last_payment"
+    if _times_differ(live_end, replay_end, tolerance):
+        return "end_date"
+    if _times_differ(live_joined, replay_joined, tolerance):
+        return "joined_at"
+    return None
+
+def _differences(conn: sqlite3.Connection, shard: int, tolerance: float):
+    """Все расхождения шарда: (user_id, вид, живая запись, пересчитанная запись)"""
+    snapshot = _load_snapshot(shard)
+    if snapshot is None or not conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (REPLAY_TABLE,)
+    ).fetchone():
+        raise RuntimeError("Пересчет подписок еще не выполнялся (build_replay)")
+    snapshot_payment_id = snapshot["snapshot_payment_id"]
+    # Пользователи, у которых после снимка появились платежи: их состояние пересчет не видел
+    changed = {
+        email.split('@')[0] for (email,) in conn.execute(
+            'SELECT DISTINCT buyer_email FROM payments WHERE id > ?', (snapshot_payment_id,)
+        )
+    }
+    cursor = conn.execute(f'''
+    SELECT r.user_id, m.user_id, m.status, m.joined_at, m.subscription_end_date, m.last_payment_id,
+           r.status, r.joined_at, r.subscription_end_date, r.last_payment_id
+    FROM {REPLAY_TABLE} r
+    LEFT JOIN channel_members m ON m.user_id = r.user_id
+    WHERE m.user_id IS NULL
+       OR m.status IS NOT r.status
+       OR m.joined_at IS NOT r.joined_at
+       OR m.subscription_end_date IS NOT r.subscription_end_date
+       OR m.last_payment_id IS NOT r.last_payment_id
+    UNION ALL
+    SELECT m.user_id, m.user_id, m.status, m.joined_at, m.subscription_end_date, m.last_payment_id,
+           NULL, NULL, NULL, NULL
+    FROM channel_members m
+    WHERE NOT EXISTS (SELECT 1 FROM {REPLAY_TABLE} r WHERE r.user_id = m.user_id)
+    ''')
+    now = datetime.now(timezone.utc)
+    for row in cursor:
+        user_id = row[0]
+        live = row[2:6] if row[1] is not None else None
+        replay = row[6:10] if row[6] is not None else None
+        kind = _classify(live, replay, tolerance, now)
+        if kind is None:
+            continue
+        if user_id in changed:
+            kind = "changed_after_snapshot"
+        yield user_id, kind, live, replay
+
+def _state(row: Optional[tuple]) -> Optional[dict]:
+    if row is None:
+        return None
+    return dict(zip(("status", "joined_at", "subscription_end_date", "last_payment_id"), row))
+
+def diff_replay(tolerance: float = REPLAY_TIME_TOLERANCE, sample_size: int = REPLAY_SAMPLE_SIZE) -> dict:
+    """Сравнивает channel_members с результатом build_replay: количество расхождений по видам и примеры"""
+    differences, sample = {}, []
+    for shard in range(SHARD_COUNT):
+        conn = connect_shard(shard, common=False)
+        try:
+            for user_id, kind, live, replay in _differences(conn, shard, tolerance):
+                differences[kind] = differences.get(kind, 0) + 1
+                if len(sample) < sample_size:
+                    sample.append({"user_id": user_id, "kind": kind, "live": _state(live), "replay": _state(replay)})
+        finally:
+            conn.close()
+    return {"differences": differences, "sample": sample}
+
+def apply_replay(tolerance: float = REPLAY_TIME_TOLERANCE) -> dict:
+    """
+    Переносит в channel_members расхождения видов REPLAY_APPLY_KINDS. Сравнение и запись
+    выполняются одной транзакцией записи, поэтому читатели видят либо старое состояние,
+    либо новое целиком, а вебхук не может изменить запись между сравнением и заменой.
+    Изменяются только отличающиеся записи: триггеры статистики учитывают лишь реальные
+    смены статуса. Напоминания об окончании у измененных подписок сбрасываются.
+    При нескольких шардах транзакция своя у каждого шарда.
+    """
+    started = time.monotonic()
+    differences, applied = {}, 0
+    for shard in range(SHARD_COUNT):
+        applied += _apply_shard(shard, tolerance, differences)
+
+    report = {"differences": differences, "applied": applied, "seconds": round(time.monotonic() - started, 2)}
+    logger.warning(f"Состояние подписок заменено пересчитанным по истории платежей: изменено записей {applied}")
+    return report
+
+def _apply_shard(shard: int, tolerance: float, differences: dict) -> int:
+    conn = connect_shard(shard, common=False, timeout=30, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            updates = []
+            for user_id, kind, live, replay in _differences(conn, shard, tolerance):
+                differences[kind] = differences.get(kind, 0) + 1
+                if kind in REPLAY_APPLY_KINDS:
+                    updates.append((user_id,) + tuple(replay))
+            conn.executemany('''
+            INSERT INTO channel_members (user_id, status, joined_at, subscription_end_date, last_payment_id)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                status = excluded.status,
+                joined_at = excluded.joined_at,
+                subscription_end_date = excluded.subscription_end_date,
+                last_payment_id = excluded.last_payment_id
+            ''', updates)
+            conn.executemany('DELETE FROM subscription_reminders WHERE user_id = ?', [(update[0],) for update in updates])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+    return len(updates)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Пересчет channel_members по истории платежей и сравнение с текущим состоянием"
+    )
+    parser.add_argument("--apply", action="store_true",
+                        help="Перенести расхождения в channel_members (без флага - только сравнить)")
+    parser.add_argument("--skip-build", action="store_true",
+                        help="Использовать результат предыдущего пересчета")
+    parser.add_argument("--batch-size", type=int, default=REPLAY_BATCH_SIZE,
+                        help=f"Пользователей в одной транзакции записи (по умолчанию {REPLAY_BATCH_SIZE})")
+    args = parser.parse_args()
+
+    require_sqlite("Пересчет подписок")
+    from logging_setup import configure_logging
+    configure_logging()
+    ensure_schema()
+
+    report = {}
+    if not args.skip_build:
+        report["build"] = build_replay(args.batch_size)
+    report["apply" if args.apply else "diff"] = apply_replay() if args.apply else diff_replay()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
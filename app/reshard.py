@@ -0,0 +1,246 @@
+import os
+import json
+import logging
+import sqlite3
+import time
+import argparse
+
+from database import (
+    DB_PATH, SHARD_COUNT, SHARD_ID_RANGE, archive_path, attach_archive, fill_stats_rollups,
+    init_shard, shard_of, shard_of_email, shard_path, take_staged, put_staged, clear_staged
+)
+from storage import require_sqlite
+
+# Перенос данных пользователей на другое число шардов (database.SHARD_COUNT).
+# Строки payments (вместе с архивом), channel_members, subscription_reminders, payment_summaries
+# и invoice_cache копируются из файлов старой раскладки в файлы новой по шарду пользователя;
+# номера платежей сохраняются, а новые номера в каждом новом шарде начинаются выше всех
+# существующих. Сообщения outbox и события сводки, еще не перенесенные из старых шардов
+# (database.STAGED_TABLES), записываются в основную БД.
+# Агрегаты статистики новых шардов заполняются по скопированным данным, дневные переходы
+# статусов (их нельзя разделить по пользователям) переносятся в первый шард суммой.
+#
+# Сервис на время переноса должен быть остановлен. После проверки количества строк нужно
+# запустить сервис с новым SHARD_COUNT. Старые файлы по умолчанию остаются как резервная копия
+# (--drop-source удаляет их). Пересчет replay.py после переноса нужно выполнить заново.
+
+# Сколько строк читается и записывается за один раз
+RESHARD_BATCH_SIZE = int(os.getenv("RESHARD_BATCH_SIZE", "5000"))
+
+# Копируемые таблицы: (схема, таблица, столбец с пользователем)
+RESHARD_TABLES = (
+    ("main", "payments", "buyer_email"),
+    ("archive", "payments", "buyer_email"),
+    ("main", "channel_members", "user_id"),
+    ("main", "subscription_reminders", "user_id"),
+    ("main", "payment_summaries", "buyer_email"),
+    ("main", "invoice_cache", "user_id"),
+)
+# Таблицы пользователей и агрегатов, которые --drop-source удаляет из основной БД
+SOURCE_TABLES = (
+    "payments", "channel_members", "subscription_reminders", "payment_summaries", "invoice_cache",
+    "payment_stats_daily", "member_status_counts", "member_stats_daily",
+)
+
+logger = logging.getLogger("reshard")
+
+def _connect(shard: int, shard_count: int) -> sqlite3.Connection:
+    conn = sqlite3.connect(shard_path(shard, shard_count), timeout=30, isolation_level=None)
+    attach_archive(conn, shard, shard_count)
+    return conn
+
+def _has_rows(path, tables: tuple) -> bool:
+    if not path.exists():
+        return False
+    conn = sqlite3.connect(path)
+    try:
+        for table in tables:
+            exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+            ).fetchone()
+            if exists and conn.execute(f"SELECT EXISTS (SELECT 1 FROM {table})").fetchone()[0]:
+                return True
+        return False
+    finally:
+        conn.close()
+
+def _has_user_data(shard: int, shard_count: int) -> bool:
+    """Есть ли в файле шарда или в его архиве данные пользователей"""
+    return (_has_rows(shard_path(shard, shard_count), ("payments", "channel_members"))
+            or _has_rows(archive_path(shard, shard_count), ("payments",)))
+
+def _max_payment_id(sources: list) -> int:
+    max_id = 0
+    for conn in sources:
+        for schema in ("main", "archive"):
+            row = conn.execute(f"SELECT MAX(id) FROM {schema}.payments").fetchone()
+            max_id = max(max_id, row[0] or 0)
+        row = conn.execute("SELECT seq FROM main.sqlite_sequence WHERE name = 'payments'").fetchone()
+        max_id = max(max_id, row[0] if row else 0)
+    return max_id
+
+def _count(conns: list, schema: str, table: str) -> int:
+    return sum(conn.execute(f"SELECT COUNT(*) FROM {schema}.{table}").fetchone()[0] for conn in conns)
+
+def _copy_table(source: sqlite3.Connection, targets: list, schema: str, table: str, key_column: str,
+                batch_size: int):
+    columns = [row[1] for row in source.execute(f"PRAGMA {schema}.table_info({table})")]
+    key_index = columns.index(key_column)
+    by_email = key_column == "buyer_email"
+    insert = (
+        f"INSERT INTO {schema}.{table} ({', '.join(columns)}) "
+        f"VALUES ({', '.join('?' * len(columns))})"
+    )
+    cursor = source.execute(f"SELECT {', '.join(columns)} FROM {schema}.{table}")
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        by_target = {}
+        for row in rows:
+            key = row[key_index]
+            target = shard_of_email(key, len(targets)) if by_email else shard_of(key, len(targets))
+            by_target.setdefault(target, []).append(row)
+        for target, target_rows in by_target.items():
+            targets[target].executemany(insert, target_rows)
+
+def _relay_sources(sources: list):
+    """Переносит в основную БД сообщения outbox и события сводки, оставшиеся в старых шардах"""
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        for shard, source in enumerate(sources):
+            staged = take_staged(source, shard)
+            if staged:
+                put_staged(conn, staged)
+                conn.commit()
+                clear_staged(source, staged)
+    finally:
+        conn.close()
+
+def reshard(target_count: int, source_count: int = SHARD_COUNT, batch_size: int = RESHARD_BATCH_SIZE,
+            drop_source: bool = False) -> dict:
+    """
+    Копирует данные пользователей из source_count шардов в target_count шардов и сверяет
+    количество строк. Файлы новой раскладки не должны содержать данных пользователей.
+    """
+    if target_count < 1 or target_count == source_count:
+        raise ValueError("Новое число шардов должно быть положительным и отличаться от текущего")
+    for shard in range(target_count):
+        if _has_user_data(shard, target_count):
+            raise RuntimeError(f"{shard_path(shard, target_count)} уже содержит данные пользователей")
+
+    started = time.monotonic()
+    sources = [_connect(shard, source_count) for shard in range(source_count)]
+    targets = []
+    try:
+        if source_count > 1:
+            _relay_sources(sources)
+        # Новые номера платежей - выше всех существующих, у каждого нового шарда свой диапазон
+        max_id = _max_payment_id(sources)
+        if target_count == 1:
+            first_ids = [max_id + 1]
+        else:
+            base = (max_id // SHARD_ID_RANGE + 1) * SHARD_ID_RANGE
+            first_ids = [base + shard * SHARD_ID_RANGE for shard in range(target_count)]
+        for shard in range(target_count):
+            init_shard(shard, target_count, first_ids[shard])
+        targets = [_connect(shard, target_count) for shard in range(target_count)]
+
+        # Каждый новый шард заполняется одной транзакцией (атомарно для файла шарда и его архива)
+        for conn in targets:
+            conn.execute("BEGIN IMMEDIATE")
+        transitions = {}
+        for source in sources:
+            source.execute("BEGIN")
+            for schema, table, key_column in RESHARD_TABLES:
+                _copy_table(source, targets, schema, table, key_column, batch_size)
+            for day, status, count in source.execute('SELECT day, status, transitions FROM member_stats_daily'):
+                transitions[(day, status)] = transitions.get((day, status), 0) + count
+            source.execute("COMMIT")
+        for shard, conn in enumerate(targets):
+            fill_stats_rollups(conn.cursor())
+            # Вставка участников засчитала переходы сегодняшним днем - заменяем их перенесенными
+            conn.execute('DELETE FROM member_stats_daily')
+            if shard == 0:
+                conn.executemany(
+                    'INSERT INTO member_stats_daily (day, status, transitions) VALUES (?, ?, ?)',
+                    [(day, status, count) for (day, status), count in transitions.items()]
+                )
+        for conn in targets:
+            conn.execute("COMMIT")
+
+        report = {"from": source_count, "to": target_count, "first_payment_ids": first_ids, "tables": {}}
+        mismatched = []
+        for schema, table, _ in RESHARD_TABLES:
+            name = table if schema == "main" else f"{schema}.{table}"
+            counts = {"source": _count(sources, schema, table), "target": _count(targets, schema, table)}
+            report["tables"][name] = counts
+            if counts["source"] != counts["target"]:
+                mismatched.append(name)
+        report["shard_members"] = [
+            conn.execute("SELECT COUNT(*) FROM channel_members").fetchone()[0] for conn in targets
+        ]
+    except Exception:
+        for conn in targets:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+        raise
+    finally:
+        for conn in sources + targets:
+            conn.close()
+
+    if mismatched:
+        raise RuntimeError(f"Количество строк после переноса не совпадает: {', '.join(mismatched)}")
+    if drop_source:
+        _drop_source(source_count)
+        report["source_dropped"] = True
+
+    report["seconds"] = round(time.monotonic() - started, 2)
+    logger.info(
+        f"Данные пользователей перенесены с {source_count} на {target_count} шардов за {report['seconds']} с"
+    )
+    return report
+
+def _drop_source(source_count: int):
+    """Удаляет данные старой раскладки: таблицы в основной БД или файлы шардов с архивами"""
+    if source_count == 1:
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            for table in SOURCE_TABLES:
+                conn.execute(f"DROP TABLE IF EXISTS {table}")
+            conn.commit()
+        finally:
+            conn.close()
+        paths = [archive_path(0, 1)]
+    else:
+        paths = [shard_path(shard, source_count) for shard in range(source_count)]
+        paths += [archive_path(shard, source_count) for shard in range(source_count)]
+    for path in paths:
+        for suffix in ("", "-wal", "-shm"):
+            file = path.with_name(path.name + suffix)
+            if file.exists():
+                file.unlink()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Перенос данных пользователей на другое число шардов (сервис должен быть остановлен)"
+    )
+    parser.add_argument("--to", type=int, required=True, help="Новое число шардов")
+    parser.add_argument("--from", dest="source_count", type=int, default=SHARD_COUNT,
+                        help=f"Текущее число шардов (по умолчанию SHARD_COUNT={SHARD_COUNT})")
+    parser.add_argument("--batch-size", type=int, default=RESHARD_BATCH_SIZE,
+                        help=f"Строк за одну запись (по умолчанию {RESHARD_BATCH_SIZE})")
+    parser.add_argument("--drop-source", action="store_true",
+                        help="После проверки удалить данные старой раскладки")
+    args = parser.parse_args()
+
+    require_sqlite("Перенос на другое число шардов")
+    from logging_setup import configure_logging
+    configure_logging()
+
+    report = reshard(args.to, args.source_count, args.batch_size, args.drop_source)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    print(f"Запустите сервис с SHARD_COUNT={args.to}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import os
+import logging
+import threading
+import uuid
+
+import uvicorn
+from uvicorn.supervisors import Multiprocess
+
+from database import SHARD_COUNT, ensure_schema
+from logging_setup import configure_logging
+
+# Единая точка входа сервиса: API (uvicorn), бот и его периодические задачи под управлением
+# одного процесса. По SIGTERM/SIGINT прием вебхуков и обновлений прекращается, а начатая
+# обработка дожидается не дольше SHUTDOWN_TIMEOUT секунд. Вебхуки, которые не успели
+# обработаться, остаются в webhook_inbox и дообрабатываются при следующем запуске.
+
+API_HOST = os.getenv("API_HOST", "0.0.0.0")
+API_PORT = int(os.getenv("API_PORT", "8000"))
+UVICORN_WORKERS = int(os.getenv("UVICORN_WORKERS", "1"))
+# Сколько секунд дается на завершение начатой работы при остановке. Должно быть меньше
+# времени, которое оркестратор ждет перед SIGKILL (docker stop по умолчанию ждет 10 секунд)
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "8"))
+
+logger = logging.getLogger("service")
+
+class BotComponent:
+    """Бот с периодическими задачами: работает в фоновом потоке, останавливается с ограничением по времени"""
+
+    def __init__(self, bot_service):
+        self.bot_service = bot_service
+        self.stopper = None
+        self.drained = False
+
+    def start(self):
+        threading.Thread(target=self.bot_service.run_bot, name="bot", daemon=True).start()
+
+    def _stop(self):
+        self.drained = self.bot_service.stop_bot(SHUTDOWN_TIMEOUT)
+
+    def request_stop(self):
+        """Начинает остановку, не дожидаясь ее: вызывается из обработчика сигнала"""
+        if self.stopper is None:
+            self.stopper = threading.Thread(target=self._stop, name="bot_shutdown")
+            self.stopper.start()
+
+    def wait_stopped(self) -> bool:
+        self.request_stop()
+        self.stopper.join(SHUTDOWN_TIMEOUT + 1)
+        return self.drained and not self.stopper.is_alive()
+
+def force_exit():
+    # Поток, в котором обрабатывается вебхук, нельзя отменить - он не должен задерживать
+    # выход дольше срока остановки. Незавершенные вебхуки остаются в webhook_inbox
+    logger.warning("Начатая обработка не завершилась за SHUTDOWN_TIMEOUT, процесс прерывается")
+    logging.shutdown()
+    os._exit(1)
+
+class ApiServer(uvicorn.Server):
+    """
+    Сервер API, который останавливается не дольше SHUTDOWN_TIMEOUT. В главном процессе
+    вместе с ним запускается и останавливается бот (в воркерах bot_component не задается).
+    """
+
+    def __init__(self, config: uvicorn.Config, bot_component: BotComponent = None):
+        super().__init__(config)
+        self.bot_component = bot_component
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets=sockets)
+        if self.bot_component and self.started and not self.should_exit:
+            self.bot_component.start()
+
+    def handle_exit(self, sig, frame):
+        if not self.should_exit:
+            logger.info(f"Получен сигнал остановки ({sig}): прекращаем прием вебхуков и обновлений")
+            if self.bot_component:
+                self.bot_component.request_stop()
+            watchdog = threading.Timer(SHUTDOWN_TIMEOUT + 1, force_exit)
+            watchdog.daemon = True
+            watchdog.start()
+        super().handle_exit(sig, frame)
+
+class ApiSupervisor(Multiprocess):
+    """Несколько воркеров API: каждый воркер сам дожидается начатых запросов при остановке"""
+
+    def __init__(self, config: uvicorn.Config, target, sockets, bot_component: BotComponent):
+        super().__init__(config, target=target, sockets=sockets)
+        self.bot_component = bot_component
+
+    def startup(self):
+        super().startup()
+        self.bot_component.start()
+
+    def signal_handler(self, sig, frame):
+        if not self.should_exit.is_set():
+            logger.info(f"Получен сигнал остановки ({sig}): прекращаем прием вебхуков и обновлений")
+            self.bot_component.request_stop()
+        super().signal_handler(sig, frame)
+
+def main():
+    # Идентификатор запуска наследуют все воркеры API (см. main.RUN_ID)
+    os.environ.setdefault("RUN_ID", uuid.uuid4().hex)
+    configure_logging()
+    ensure_schema()
+    if SHARD_COUNT > 1:
+        # На проверенной конфигурации (одно ядро) шарды медленнее одного файла, см. README
+        logger.warning(f"Экспериментальный режим: данные пользователей разделены на {SHARD_COUNT} файлов (SHARD_COUNT)")
+
+    # Модуль бота импортируется только в главном процессе, не в воркерах API
+    import bot as bot_service
+    bot_component = BotComponent(bot_service)
+
+    config = uvicorn.Config(
+        "main:app",
+        host=API_HOST,
+        port=API_PORT,
+        workers=UVICORN_WORKERS,
+        timeout_graceful_shutdown=SHUTDOWN_TIMEOUT,
+    )
+    if config.workers > 1:
+        sock = config.bind_socket()
+        ApiSupervisor(config, target=ApiServer(config).run, sockets=[sock], bot_component=bot_component).run()
+    else:
+        ApiServer(config, bot_component).run()
+
+    # API остановлен (или не смог запуститься) - дожидаемся остановки бота
+    if not bot_component.wait_stopped():
+        force_exit()
+    logger.info("Сервис остановлен")
+
+if __name__ == "__main__":
+    main()
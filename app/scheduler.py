@@ -0,0 +1,403 @@
+import os
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+
+import metrics
+from database import acquire_connection, release_connection
+from leader import LeaderElector, LEADER_HEARTBEAT, HOLDER_ID
+
+# Планировщик фоновых задач процесса: именованные задачи с интервальным или cron-расписанием,
+# случайной задержкой (jitter) и гарантией, что задача не запускается, пока выполняется
+# ее предыдущий запуск. Задачи с арендой (lease) выполняются только в процессе, который
+# держит эту аренду (см. leader.py), остальные - в каждом процессе. Состояние задач каждый
+# процесс записывает в таблицу scheduler_jobs (строка на задачу и процесс), откуда его видит
+# администратор (команда бота /jobs и GET /admin/jobs). Строки остановленного процесса
+# удаляются при остановке, а упавшего - когда они не обновлялись SCHEDULER_STATE_TTL секунд.
+
+# Сколько задач может выполняться одновременно
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", "4"))
+# Как часто процесс подтверждает, что его строки в scheduler_jobs актуальны (в секундах)
+SCHEDULER_STATE_REFRESH = 60.0
+# Строки, не подтвержденные столько секунд, принадлежат завершившемуся процессу и удаляются
+SCHEDULER_STATE_TTL = 5 * SCHEDULER_STATE_REFRESH
+
+logger = logging.getLogger("scheduler")
+
+job_duration = metrics.histogram(
+    "job_duration_seconds", "Длительность выполнения фоновых задач",
+    buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+)
+job_runs = metrics.counter(
+    "job_runs_total", "Запуски фоновых задач (ok, error, skipped - пропущен, пока шел предыдущий запуск)"
+)
+
+class IntervalTrigger:
+    """Запуск каждые seconds секунд"""
+
+    def __init__(self, seconds: float):
+        if seconds <= 0:
+            raise ValueError("Интервал должен быть больше нуля")
+        self.seconds = seconds
+
+    def next_after(self, moment: datetime) -> datetime:
+        return moment + timedelta(seconds=self.seconds)
+
+    def __str__(self):
+        return f"каждые {self.seconds:g} с"
+
+def _parse_cron_field(field: str, low: int, high: int) -> set:
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            step = int(step_text)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start_text, end_text = part.split("-", 1)
+            start, end = int(start_text), int(end_text)
+        else:
+            start = int(part)
+            # "5/15" - с 5 до конца диапазона с шагом 15
+            end = high if step > 1 else start
+        if step < 1 or start < low or end > high or start > end:
+            raise ValueError(f"Недопустимое поле cron: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+class CronTrigger:
+    """
+    Расписание cron из пяти полей: минута, час, день месяца, месяц, день недели (0 или 7 - воскресенье).
+    Поддерживаются *, списки, диапазоны и шаги. Время - UTC.
+    """
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Выражение cron должно состоять из 5 полей: {expression}")
+        self.expression = expression
+        self.minutes = _parse_cron_field(fields[0], 0, 59)
+        self.hours = _parse_cron_field(fields[1], 0, 23)
+        self.days = _parse_cron_field(fields[2], 1, 31)
+        self.months = _parse_cron_field(fields[3], 1, 12)
+        self.weekdays = {day % 7 for day in _parse_cron_field(fields[4], 0, 7)}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day_matches = moment.day in self.days
+        weekday_matches = moment.isoweekday() % 7 in self.weekdays
+        # Как в cron: если ограничены и день месяца, и день недели, достаточно совпадения одного
+        if self.any_day or self.any_weekday:
+            return day_matches and weekday_matches
+        return day_matches or weekday_matches
+
+    def next_after(self, moment: datetime) -> datetime:
+        moment = moment.astimezone(timezone.utc).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # 29 февраля в заданный день недели может наступить только через несколько лет
+        limit = moment + timedelta(days=366 * 8)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Расписание cron никогда не срабатывает: {self.expression}")
+
+    def __str__(self):
+        return f"cron {self.expression}"
+
+def parse_trigger(spec: str):
+    """Число - интервал в секундах, иначе выражение cron"""
+    spec = spec.strip()
+    try:
+        return IntervalTrigger(float(spec))
+    except ValueError:
+        return CronTrigger(spec)
+
+class Job:
+    def __init__(self, name: str, func: Callable, trigger, jitter: float, adaptive: bool, lease: Optional[str]):
+        self.name = name
+        self.lease = lease
+        self.func = func
+        self.trigger = trigger
+        self.jitter = jitter
+        self.adaptive = adaptive
+        self.next_run_at: Optional[datetime] = None
+        self.running = False
+        self.future = None
+        self.last_started_at: Optional[datetime] = None
+        self.last_duration: Optional[float] = None
+        self.last_status: Optional[str] = None
+        self.last_error: Optional[str] = None
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+
+    def schedule_next(self, after: datetime, delay: Optional[float] = None):
+        if delay is not None:
+            self.next_run_at = after + timedelta(seconds=delay)
+        else:
+            self.next_run_at = self.trigger.next_after(after)
+        if self.jitter:
+            self.next_run_at += timedelta(seconds=random.uniform(0, self.jitter))
+
+class Scheduler:
+    """
+    Выполняет задачи в пуле потоков. Функция адаптивной задачи (adaptive=True) возвращает,
+    через сколько секунд после завершения запустить ее снова; после ошибки и для остальных
+    задач следующий запуск - по расписанию. Запуск, наступивший во время выполнения
+    предыдущего, пропускается.
+    """
+
+    def __init__(self, workers: int = SCHEDULER_WORKERS):
+        self.jobs: Dict[str, Job] = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.thread: Optional[threading.Thread] = None
+        # При смене ведущего пересчитываем, какие задачи пора запустить
+        self.elector = LeaderElector(on_change=self.wakeup.set)
+
+    def add_job(self, name: str, func: Callable, trigger, jitter: float = 0,
+                run_at_start: bool = False, adaptive: bool = False, lease: Optional[str] = None):
+        """
+        Регистрирует задачу; trigger - IntervalTrigger, CronTrigger или строка для parse_trigger.
+        Задача с lease в процессе без этой аренды ждет ее получения (после перехвата аренды
+        просроченный запуск выполняется сразу).
+        """
+        if isinstance(trigger, str):
+            trigger = parse_trigger(trigger)
+        job = Job(name, func, trigger, jitter, adaptive, lease)
+        if lease:
+            self.elector.add(lease)
+        now = datetime.now(timezone.utc)
+        if run_at_start:
+            job.next_run_at = now
+        else:
+            job.schedule_next(now)
+        with self.lock:
+            if name in self.jobs:
+                raise ValueError(f"Задача {name} уже зарегистрирована")
+            self.jobs[name] = job
+        self._save_state(job)
+        self.wakeup.set()
+        return job
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._loop, name="scheduler", daemon=True)
+            has_leases = any(job.lease for job in self.jobs.values())
+        if has_leases:
+            self.elector.start()
+        self.thread.start()
+        logger.info(f"Планировщик запущен, задач: {len(self.jobs)}")
+
+    def stop(self, timeout: float) -> bool:
+        """Прекращает запуск задач и ждет завершения выполняющихся не дольше timeout секунд"""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            self.stopping.set()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            # Запуски, которые ждали свободного потока, отменены и уже не начнутся
+            for job in self.jobs.values():
+                if job.future is not None and job.future.cancelled():
+                    job.running = False
+        self.wakeup.set()
+        while True:
+            with self.lock:
+                running = [job.name for job in self.jobs.values() if job.running]
+            if not running:
+                # Задачи завершены - освобождаем аренды, чтобы другой экземпляр сразу их подхватил
+                self.elector.stop()
+                self._delete_state()
+                return True
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(0.1)
+        # Аренды не освобождаем: пока задачи выполняются, другой экземпляр не должен их запускать
+        logger.warning(f"Задачи не завершились за {timeout} с: {', '.join(running)}")
+        return False
+
+    def _loop(self):
+        last_refresh = time.monotonic()
+        while not self.stopping.is_set():
+            if time.monotonic() - last_refresh >= SCHEDULER_STATE_REFRESH:
+                last_refresh = time.monotonic()
+                self._refresh_state()
+            # Сбрасываем до расчета, чтобы не потерять пробуждение от add_job или завершившейся задачи
+            self.wakeup.clear()
+            now = datetime.now(timezone.utc)
+            with self.lock:
+                if self.stopping.is_set():
+                    return
+                runnable = [job for job in self.jobs.values() if self._may_run(job)]
+                due = [job for job in runnable if job.next_run_at <= now]
+                for job in due:
+                    if job.running:
+                        # Предыдущий запуск еще идет: этот пропускаем
+                        job.skipped += 1
+                        job_runs.inc(job=job.name, result="skipped")
+                        logger.warning(f"Задача {job.name} пропущена: предыдущий запуск еще выполняется")
+                        job.schedule_next(now)
+                    else:
+                        job.running = True
+                        job.last_started_at = now
+                        # Время следующего запуска по расписанию (может быть уточнено по завершении)
+                        job.schedule_next(now)
+                        job.future = self.executor.submit(self._run, job)
+                next_run_at = min((job.next_run_at for job in runnable), default=None)
+                # Ведущим процесс может перестать быть без уведомления (истек срок) - перепроверяем чаще
+                max_wait = LEADER_HEARTBEAT if len(runnable) < len(self.jobs) or any(job.lease for job in runnable) else 60.0
+            wait = max_wait if next_run_at is None else (next_run_at - datetime.now(timezone.utc)).total_seconds()
+            self.wakeup.wait(min(max(wait, 0.0), max_wait))
+
+    def _may_run(self, job: Job) -> bool:
+        return job.lease is None or self.elector.is_leader(job.lease)
+
+    def should_continue(self, lease: Optional[str] = None) -> bool:
+        """
+        Для долгих задач: проверка перед очередным действием. False - сервис останавливается
+        или аренда потеряна (проверяется номер аренды в БД), задачу нужно прервать.
+        """
+        if self.stopping.is_set():
+            return False
+        return lease is None or self.elector.verify(lease)
+
+    def _run(self, job: Job):
+        if job.lease and not self.elector.verify(job.lease):
+            # Аренду перехватили между проверкой и запуском
+            logger.warning(f"Задача {job.name} не запущена: аренда {job.lease} у другого процесса")
+            with self.lock:
+                job.running = False
+            return
+        started = time.perf_counter()
+        delay = None
+        try:
+            result = job.func()
+            if job.adaptive and result is not None:
+                delay = float(result)
+            status, error = "ok", None
+        except Exception as e:
+            logger.error(f"Ошибка в задаче {job.name}: {str(e)}", exc_info=True)
+            status, error = "error", str(e)
+        duration = time.perf_counter() - started
+        job_duration.observe(duration, job=job.name)
+        job_runs.inc(job=job.name, result=status)
+        with self.lock:
+            job.running = False
+            job.last_duration = duration
+            job.last_status = status
+            job.last_error = error
+            job.runs += 1
+            job.failures += status == "error"
+            if delay is not None:
+                job.schedule_next(datetime.now(timezone.utc), delay)
+        self._save_state(job)
+        self.wakeup.set()
+
+    def _save_state(self, job: Job):
+        conn = acquire_connection()
+        try:
+            conn.execute('''
+            INSERT INTO scheduler_jobs (
+                name, holder, trigger, next_run_at, last_started_at, last_duration, last_status,
+                last_error, runs, failures, skipped, updated_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(name, holder) DO UPDATE SET
+                trigger = excluded.trigger,
+                next_run_at = excluded.next_run_at,
+                last_started_at = excluded.last_started_at,
+                last_duration = excluded.last_duration,
+                last_status = excluded.last_status,
+                last_error = excluded.last_error,
+                runs = excluded.runs,
+                failures = excluded.failures,
+                skipped = excluded.skipped,
+                updated_at = excluded.updated_at
+            ''', (
+                job.name,
+                HOLDER_ID,
+                str(job.trigger),
+                job.next_run_at.isoformat() if job.next_run_at else None,
+                job.last_started_at.isoformat() if job.last_started_at else None,
+                job.last_duration,
+                job.last_status,
+                job.last_error,
+                job.runs,
+                job.failures,
+                job.skipped,
+                datetime.now(timezone.utc).isoformat(),
+            ))
+            conn.commit()
+        except Exception as e:
+            # Состояние нужно только для просмотра - ошибка записи не должна мешать задачам
+            logger.warning(f"Не удалось сохранить состояние задачи {job.name}: {str(e)}")
+        finally:
+            release_connection(conn)
+
+    def _refresh_state(self):
+        """Подтверждает строки этого процесса и удаляет строки завершившихся процессов"""
+        now = datetime.now(timezone.utc)
+        conn = acquire_connection()
+        try:
+            conn.execute(
+                'UPDATE scheduler_jobs SET updated_at = ? WHERE holder = ?', (now.isoformat(), HOLDER_ID)
+            )
+            conn.execute(
+                'DELETE FROM scheduler_jobs WHERE updated_at < ?',
+                ((now - timedelta(seconds=SCHEDULER_STATE_TTL)).isoformat(),)
+            )
+            conn.commit()
+        except Exception as e:
+            logger.warning(f"Не удалось обновить состояние задач: {str(e)}")
+        finally:
+            release_connection(conn)
+
+    def _delete_state(self):
+        """Удаляет строки остановленного процесса, чтобы они не показывались администратору"""
+        conn = acquire_connection()
+        try:
+            conn.execute('DELETE FROM scheduler_jobs WHERE holder = ?', (HOLDER_ID,))
+            conn.commit()
+        except Exception as e:
+            logger.warning(f"Не удалось удалить состояние задач: {str(e)}")
+        finally:
+            release_connection(conn)
+
+def get_job_states() -> List[dict]:
+    """
+    Состояние задач всех работающих процессов (из таблицы scheduler_jobs): задача, которую
+    регистрируют несколько процессов, - отдельной строкой для каждого (holder). По времени
+    следующего запуска
+    """
+    conn = acquire_connection()
+    try:
+        cursor = conn.execute('''
+        SELECT name, holder, trigger, next_run_at, last_started_at, last_duration, last_status,
+               last_error, runs, failures, skipped, updated_at
+        FROM scheduler_jobs
+        ORDER BY next_run_at
+        ''')
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        release_connection(conn)
+
+# Общий планировщик процесса: задачи регистрируют и API (main.py), и бот (bot.py);
+# при запуске через run.py все задачи выполняются одним планировщиком
+scheduler = Scheduler()
@@ -0,0 +1,1262 @@
+import os
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Iterable, Optional
+
+from database import (
+    PAID_EVENT_TYPES, SHARD_COUNT, STAGED_TABLES, acquire_connection, release_connection, connect_shard,
+    connect_with_archive, get_stats_summary, rebuild_stats_rollups, shard_of, put_staged
+)
+from group_commit import SHARD_RELAY_MIN_DELAY, writer, writer_for, relay_all_staged
+
+# Хранилище данных пользователей: платежи, участники канала, напоминания о продлении
+# и ссылки (короткие ссылки и кэш счетов). Вебхуки, бот и импорт обращаются к этим таблицам
+# только через методы объекта storage, поэтому данные можно хранить в SQLite (SqliteStorage:
+# основная БД или шарды database.SHARD_COUNT, как раньше) или в PostgreSQL (PostgresStorage,
+# STORAGE_BACKEND=postgres).
+#
+# Методы с параметром conn выполняются в текущей транзакции этого соединения. Транзакцию
+# открывает storage.write(user_id, operation): operation(conn) вызывает несколько методов
+# и записывает сообщения outbox (outbox.enqueue), и все это фиксируется вместе. Без conn
+# метод сам берет соединение и фиксирует изменение.
+#
+# Очередь outbox, сводка для администратора, входящие вебхуки, аренды, пул приглашений
+# и настройки в обоих случаях хранятся в основной БД SQLite. Сообщения outbox и события
+# сводки, записанные в транзакции PostgreSQL, попадают в ее промежуточные таблицы и после
+# фиксации переносятся в SQLite (как у шардов, см. database.STAGED_TABLES).
+
+# Хранилище данных пользователей: sqlite или postgres
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").lower()
+# Строка подключения к PostgreSQL (например, postgresql://lava:secret@db:5432/lava)
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://postgres@localhost:5432/lava")
+# Границы размера пула соединений PostgreSQL (в каждом процессе)
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "2"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "16"))
+# Сколько промежуточных строк переносится в SQLite за одну транзакцию
+PG_RELAY_BATCH_SIZE = 500
+
+logger = logging.getLogger("storage")
+
+PAYMENT_COLUMNS = (
+    "event_type", "product_id", "product_title", "buyer_email", "contract_id",
+    "parent_contract_id", "amount", "currency", "timestamp", "status",
+    "error_message", "raw_data", "received_at"
+)
+# Столбцы строки импорта (importer._prepare) в порядке PAYMENT_COLUMNS
+IMPORT_COLUMNS = PAYMENT_COLUMNS
+
+class SqliteStorage:
+    """Данные пользователей в SQLite: в основной БД или в шардах по user_id"""
+
+    name = "sqlite"
+
+    @property
+    def in_main_db(self) -> bool:
+        """Данные пользователей в основной БД: запись можно связать с webhook_inbox в одной транзакции"""
+        return SHARD_COUNT == 1
+
+    @property
+    def stages_rows(self) -> bool:
+        """Нужен ли периодический перенос промежуточных строк outbox и сводки (relay_staged)"""
+        return SHARD_COUNT > 1
+
+    def partitions(self) -> range:
+        """Части хранилища, которые обходят проверка сроков, рассылка и импорт (шарды)"""
+        return range(SHARD_COUNT)
+
+    def partition_of(self, user_id) -> int:
+        return shard_of(user_id)
+
+    @contextmanager
+    def connection(self, partition: Optional[int] = None, conn: Optional[sqlite3.Connection] = None):
+        """
+        Соединение части partition (None - основная БД) из пула. Если передано conn,
+        используется оно; иначе изменения фиксируются при выходе из блока.
+        """
+        if conn is not None:
+            yield conn
+            return
+        conn = acquire_connection(partition)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            release_connection(conn, partition)
+
+    def write(self, user_id, operation: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Выполняет operation(conn) одной транзакцией писателя шарда пользователя (group_commit)"""
+        return writer_for(user_id).run(operation)
+
+    def relay_staged(self) -> int:
+        """Переносит в основную БД сообщения и события, записанные в шарды"""
+        return relay_all_staged() if SHARD_COUNT > 1 else 0
+
+    def close(self):
+        pass
+
+    # Платежи
+
+    def insert_payment(self, conn: sqlite3.Connection, payment: dict) -> int:
+        """Записывает платеж (столбцы payments -> значения), возвращает его id"""
+        columns = list(payment)
+        cursor = conn.execute(
+            f"INSERT INTO payments ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            [payment[column] for column in columns]
+        )
+        return cursor.lastrowid
+
+    def find_payment(self, user_id, contract_id: str, event_type: str, conn=None) -> Optional[int]:
+        """Номер уже сохраненного платежа с тем же типом события и контрактом"""
+        with self.connection(shard_of(user_id), conn) as conn:
+            row = conn.execute(
+                'SELECT id FROM main.payments WHERE contract_id = ? AND event_type = ? ORDER BY id LIMIT 1',
+                (contract_id, event_type)
+            ).fetchone()
+        return row[0] if row else None
+
+    def last_paid_payment(self, user_id, conn=None) -> Optional[tuple]:
+        """
+        Последняя оплата пользователя: (id, status, timestamp, event_type, contract_id,
+        parent_contract_id, amount, currency, product_id, subscription_end_date по этой оплате)
+        """
+        with self.connection(shard_of(user_id), conn) as conn:
+            return conn.execute('''
+            SELECT p.id, p.status, p.timestamp, p.event_type, p.contract_id, p.parent_contract_id,
+                   p.amount, p.currency, p.product_id, cm.subscription_end_date
+            FROM payments p
+            LEFT JOIN channel_members cm ON cm.last_payment_id = p.id
+            WHERE p.buyer_email = ?
+            AND p.event_type IN ('payment.success', 'subscription.recurring.payment.success')
+            ORDER BY p.timestamp DESC
+            LIMIT 1
+            ''', (f"{user_id}@t.me",)).fetchone()
+
+    def count_new_payments(self, hour_since: str, day_since: str) -> tuple:
+        """Число новых подписок (payment.success) с hour_since и с day_since по всем шардам"""
+        last_hour = last_day = 0
+        for shard in self.partitions():
+            with self.connection(shard) as conn:
+                hour, day = conn.execute('''
+                SELECT
+                    SUM(CASE WHEN received_at >= ? THEN 1 ELSE 0 END),
+                    COUNT(*)
+                FROM payments
+                WHERE event_type = 'payment.success' AND received_at >= ?
+                ''', (hour_since, day_since)).fetchone()
+            last_hour += hour or 0
+            last_day += day or 0
+        return last_hour, last_day
+
+    @contextmanager
+    def import_transaction(self, partition: int, dry_run: bool = False):
+        """Транзакция импорта в части partition; с dry_run изменения откатываются"""
+        conn = connect_shard(partition, common=False, timeout=30, isolation_level=None)
+        try:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS import_keys (event_type TEXT, contract_id TEXT, PRIMARY KEY (event_type, contract_id))")
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS import_users (user_id TEXT PRIMARY KEY)")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            if dry_run:
+                conn.rollback()
+            else:
+                conn.commit()
+        finally:
+            conn.close()
+
+    def import_payments(self, conn: sqlite3.Connection, rows: list, dry_run: bool = False) -> list:
+        """
+        Записывает строки импорта (столбцы IMPORT_COLUMNS), которых еще нет в payments
+        (тот же event_type и contract_id). Возвращает (номер строки в rows, id платежа)
+        для новых строк; с dry_run ничего не пишет, id - None.
+        """
+        conn.execute("DELETE FROM temp.import_keys")
+        conn.executemany(
+            "INSERT OR IGNORE INTO temp.import_keys (event_type, contract_id) VALUES (?, ?)",
+            [(row[0], row[4]) for row in rows]
+        )
+        existing = set(conn.execute('''
+        SELECT k.event_type, k.contract_id FROM temp.import_keys k
+        WHERE EXISTS (
+            SELECT 1 FROM payments p WHERE p.contract_id = k.contract_id AND p.event_type = k.event_type
+        )
+        ''').fetchall())
+        new = [index for index, row in enumerate(rows) if (row[0], row[4]) not in existing]
+        if dry_run or not new:
+            return [(index, None) for index in new]
+        conn.executemany(f'''
+        INSERT INTO payments ({', '.join(IMPORT_COLUMNS)})
+        VALUES ({', '.join('?' * len(IMPORT_COLUMNS))})
+        ''', [rows[index] for index in new])
+        # Запись идет под блокировкой записи, поэтому id новых строк идут подряд
+        last_id = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'payments'").fetchone()[0]
+        first_id = last_id - len(new) + 1
+        return [(index, first_id + offset) for offset, index in enumerate(new)]
+
+    def payment_raw_data(self, payment_id: int):
+        """Сжатое тело вебхука платежа или None"""
+        # Номера платежей в шардах не пересекаются: платеж есть не больше чем в одном шарде
+        for shard in self.partitions():
+            with self.connection(shard) as conn:
+                row = conn.execute('SELECT raw_data FROM payments WHERE id = ?', (payment_id,)).fetchone()
+            if row:
+                return row[0]
+        return None
+
+    # Участники канала
+
+    def member_subscription(self, user_id, conn=None) -> Optional[tuple]:
+        """(status, subscription_end_date, last_payment_id, contract_id, parent_contract_id) или None"""
+        with self.connection(shard_of(user_id), conn) as conn:
+            return conn.execute('''
+            SELECT cm.status, cm.subscription_end_date, cm.last_payment_id,
+                   p.contract_id, p.parent_contract_id
+            FROM channel_members cm
+            LEFT JOIN payments p ON p.id = cm.last_payment_id
+            WHERE cm.user_id = ?
+            ''', (user_id,)).fetchone()
+
+    def member_end_date(self, user_id, conn=None) -> Optional[str]:
+        with self.connection(shard_of(user_id), conn) as conn:
+            row = conn.execute("SELECT subscription_end_date FROM channel_members WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def member_status(self, user_id, conn=None) -> Optional[str]:
+        with self.connection(shard_of(user_id), conn) as conn:
+            row = conn.execute('SELECT status FROM channel_members WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def activate_member(self, conn: sqlite3.Connection, user_id, joined_at: str, end_date: str,
+                        payment_id: Optional[int]):
+        """Активная подписка (новая запись или замена существующей)"""
+        conn.execute('''
+        INSERT INTO channel_members
+        (user_id, status, joined_at, subscription_end_date, last_payment_id)
+        VALUES (?, 'active', ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            status = excluded.status,
+            joined_at = excluded.joined_at,
+            subscription_end_date = excluded.subscription_end_date,
+            last_payment_id = excluded.last_payment_id
+        ''', (user_id, joined_at, end_date, payment_id))
+
+    def renew_member(self, conn: sqlite3.Connection, user_id, end_date: str, payment_id: Optional[int]) -> int:
+        cursor = conn.execute('''
+        UPDATE channel_members
+        SET status = 'active',
+            subscription_end_date = ?,
+            last_payment_id = ?
+        WHERE user_id = ?
+        ''', (end_date, payment_id, user_id))
+        return cursor.rowcount
+
+    def cancel_member(self, user_id, conn=None) -> int:
+        """Отмена автопродления: active -> cancelled, дата окончания сохраняется"""
+        with self.connection(shard_of(user_id), conn) as conn:
+            return conn.execute('''
+            UPDATE channel_members
+            SET status = 'cancelled'
+            WHERE user_id = ? AND status = 'active'
+            ''', (user_id,)).rowcount
+
+    def cancel_member_until(self, conn: sqlite3.Connection, user_id, end_date: Optional[str]) -> int:
+        """Отмена автопродления с новой датой окончания (вебхук отмены)"""
+        return conn.execute('''
+        UPDATE channel_members
+        SET status = 'cancelled',
+            subscription_end_date = ?
+        WHERE user_id = ? AND status = 'active'
+        ''', (end_date, user_id)).rowcount
+
+    def remove_member(self, conn: sqlite3.Connection, user_id) -> int:
+        """Статус removed (если еще не установлен) и удаление напоминаний"""
+        rows_updated = conn.execute('''
+        UPDATE channel_members
+        SET status = 'removed'
+        WHERE user_id = ? AND status != 'removed'
+        ''', (user_id,)).rowcount
+        self.clear_reminder(conn, user_id)
+        return rows_updated
+
+    def members_to_check(self) -> list:
+        """
+        Участники active/cancelled с датой окончания по всем шардам:
+        (user_id, subscription_end_date, status, статус платежа, тип события платежа)
+        """
+        members = []
+        for shard in self.partitions():
+            with self.connection(shard) as conn:
+                members += conn.execute('''
+                SELECT
+                    cm.user_id,
+                    cm.subscription_end_date,
+                    cm.status,
+                    p.status as payment_status,
+                    p.event_type
+                FROM channel_members cm
+                LEFT JOIN payments p ON p.id = cm.last_payment_id
+                WHERE cm.status IN ('active', 'cancelled')
+                AND cm.subscription_end_date IS NOT NULL
+                ''').fetchall()
+        return members
+
+    def access_end_dates(self) -> list:
+        """(user_id, subscription_end_date) участников с доступом к каналу по всем шардам"""
+        rows = []
+        for shard in self.partitions():
+            with self.connection(shard) as conn:
+                rows += conn.execute('''
+                SELECT user_id, subscription_end_date FROM channel_members
+                WHERE status IN ('active', 'cancelled') AND subscription_end_date IS NOT NULL
+                ''').fetchall()
+        return rows
+
+    def access_end_date(self, user_id) -> Optional[str]:
+        with self.connection(shard_of(user_id)) as conn:
+            row = conn.execute('''
+            SELECT subscription_end_date FROM channel_members
+            WHERE user_id = ? AND status IN ('active', 'cancelled')
+            ''', (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def known_user_ids(self) -> set:
+        """Все пользователи: участники канала и покупатели (включая архив платежей)"""
+        users = set()
+        for shard in self.partitions():
+            conn = connect_with_archive(shard)
+            try:
+                users.update(row[0] for row in conn.execute('SELECT DISTINCT user_id FROM channel_members'))
+                # Покупатели, которых нет в channel_members
+                users.update(row[0] for row in conn.execute('''
+                SELECT DISTINCT SUBSTR(buyer_email, 1, INSTR(buyer_email, '@') - 1)
+                FROM payments_history
+                WHERE buyer_email NOT IN (
+                    SELECT user_id || '@t.me'
+                    FROM channel_members
+                )
+                '''))
+            finally:
+                conn.close()
+        return users
+
+    def import_members(self, conn: sqlite3.Connection, user_ids: Iterable) -> dict:
+        """
+        Текущие записи пользователей для пересчета импорта: user_id -> (status, joined_at,
+        subscription_end_date, last_payment_id, время последнего учтенного платежа)
+        """
+        conn.execute("DELETE FROM temp.import_users")
+        conn.executemany("INSERT OR IGNORE INTO temp.import_users (user_id) VALUES (?)", [(u,) for u in user_ids])
+        return {
+            row[0]: row[1:] for row in conn.execute('''
+            SELECT cm.user_id, cm.status, cm.joined_at, cm.subscription_end_date, cm.last_payment_id,
+                   COALESCE(p.timestamp, cm.joined_at)
+            FROM channel_members cm
+            JOIN temp.import_users u ON u.user_id = cm.user_id
+            LEFT JOIN payments p ON p.id = cm.last_payment_id
+            ''')
+        }
+
+    def upsert_members(self, conn: sqlite3.Connection, rows: list):
+        """Записывает (user_id, status, joined_at, subscription_end_date, last_payment_id)"""
+        conn.executemany('''
+        INSERT INTO channel_members (user_id, status, joined_at, subscription_end_date, last_payment_id)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            status = excluded.status,
+            joined_at = excluded.joined_at,
+            subscription_end_date = excluded.subscription_end_date,
+            last_payment_id = excluded.last_payment_id
+        ''', rows)
+
+    def reconciliation_page(self, partition: int, window_end: str, grace_start: str, recheck_before: str,
+                            after_user_id: str, limit: int) -> list:
+        """
+        Страница активных подписок для сверки с Lava (reconciliation.py), упорядоченная по user_id:
+        (user_id, subscription_end_date, контракт, amount, currency, product_id)
+        """
+        with self.connection(partition) as conn:
+            return conn.execute('''
+            SELECT cm.user_id, cm.subscription_end_date,
+                   COALESCE(p.parent_contract_id, p.contract_id), p.amount, p.currency, p.product_id
+            FROM channel_members cm
+            JOIN payments p ON p.id = cm.last_payment_id
+            LEFT JOIN reconciliation_state rs ON rs.user_id = cm.user_id
+            WHERE cm.status = 'active'
+              AND cm.subscription_end_date IS NOT NULL
+              AND cm.subscription_end_date < ?
+              AND cm.subscription_end_date > ?
+              AND (rs.checked_at IS NULL OR rs.checked_at < ?)
+              AND cm.user_id > ?
+            ORDER BY cm.user_id
+            LIMIT ?
+            ''', (window_end, grace_start, recheck_before, after_user_id, limit)).fetchall()
+
+    def save_reconciliation(self, partition: int, state_rows: list, extensions: list, cancellations: list) -> tuple:
+        """
+        Одной транзакцией записывает результат сверки страницы: state_rows (user_id, contract_id,
+        lava_status, checked_at), продления (новая дата окончания, user_id) и отмены (user_id,).
+        Возвращает число продленных и отмененных подписок.
+        """
+        with self.connection(partition) as conn:
+            conn.executemany('''
+            INSERT INTO reconciliation_state (user_id, contract_id, lava_status, checked_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                contract_id = excluded.contract_id,
+                lava_status = excluded.lava_status,
+                checked_at = excluded.checked_at
+            ''', state_rows)
+            extended = conn.executemany('''
+            UPDATE channel_members SET subscription_end_date = ?
+            WHERE user_id = ? AND status = 'active'
+            ''', extensions).rowcount if extensions else 0
+            self.clear_reminders(conn, [user_id for _, user_id in extensions])
+            cancelled = conn.executemany('''
+            UPDATE channel_members SET status = 'cancelled'
+            WHERE user_id = ? AND status = 'active'
+            ''', cancellations).rowcount if cancellations else 0
+        return extended, cancelled
+
+    # Напоминания о продлении
+
+    def clear_reminder(self, conn: sqlite3.Connection, user_id):
+        conn.execute('DELETE FROM subscription_reminders WHERE user_id = ?', (user_id,))
+
+    def clear_reminders(self, conn: sqlite3.Connection, user_ids: list):
+        conn.executemany('DELETE FROM subscription_reminders WHERE user_id = ?', [(user_id,) for user_id in user_ids])
+
+    def last_reminder(self, conn: sqlite3.Connection, user_id) -> Optional[str]:
+        row = conn.execute('SELECT last_reminder_at FROM subscription_reminders WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_reminder(self, conn: sqlite3.Connection, user_id, day: str):
+        conn.execute('''
+        INSERT INTO subscription_reminders (user_id, last_reminder_at)
+        VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET last_reminder_at=excluded.last_reminder_at
+        ''', (user_id, day))
+
+    # Ссылки: короткие ссылки на оплату и кэш выставленных счетов
+
+    def add_link(self, short_code: str, original_url: str, created_at: str):
+        with self.connection() as conn:
+            conn.execute('''
+            INSERT INTO shortened_links (short_code, original_url, created_at)
+            VALUES (?, ?, ?)
+            ''', (short_code, original_url, created_at))
+
+    def resolve_link(self, short_code: str) -> Optional[str]:
+        with self.connection() as conn:
+            row = conn.execute('SELECT original_url FROM shortened_links WHERE short_code = ?', (short_code,)).fetchone()
+        return row[0] if row else None
+
+    def count_links(self) -> int:
+        with self.connection() as conn:
+            return conn.execute('SELECT COUNT(*) FROM shortened_links').fetchone()[0]
+
+    def delete_links_before(self, cutoff: str) -> int:
+        with self.connection() as conn:
+            return conn.execute('DELETE FROM shortened_links WHERE created_at < ?', (cutoff,)).rowcount
+
+    def cached_invoice(self, user_id, offer_id, periodicity, currency, since: str) -> Optional[str]:
+        with self.connection(shard_of(user_id)) as conn:
+            row = conn.execute('''
+            SELECT short_url FROM invoice_cache
+            WHERE user_id = ? AND offer_id = ? AND periodicity = ? AND currency = ? AND created_at >= ?
+            ''', (str(user_id), offer_id, periodicity, currency, since)).fetchone()
+        return row[0] if row else None
+
+    def cache_invoice(self, user_id, offer_id, periodicity, currency, payment_url: str, short_url: str,
+                      created_at: str):
+        with self.connection(shard_of(user_id)) as conn:
+            conn.execute('''
+            INSERT INTO invoice_cache (user_id, offer_id, periodicity, currency, payment_url, short_url, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, offer_id, periodicity, currency) DO UPDATE SET
+                payment_url = excluded.payment_url,
+                short_url = excluded.short_url,
+                created_at = excluded.created_at
+            ''', (str(user_id), offer_id, periodicity, currency, payment_url, short_url, created_at))
+
+    def invalidate_invoices(self, conn: sqlite3.Connection, user_id):
+        conn.execute('DELETE FROM invoice_cache WHERE user_id = ?', (user_id,))
+
+    def delete_invoices_before(self, cutoff: str) -> int:
+        deleted = 0
+        for shard in self.partitions():
+            with self.connection(shard) as conn:
+                deleted += conn.execute('DELETE FROM invoice_cache WHERE created_at < ?', (cutoff,)).rowcount
+        return deleted
+
+    # Статистика
+
+    def stats_summary(self, days: int = 30) -> dict:
+        return get_stats_summary(days)
+
+    def rebuild_stats(self) -> dict:
+        return rebuild_stats_rollups()
+
+# Схема PostgreSQL. Таблицы и агрегаты статистики повторяют схему SQLite (database.py);
+# даты хранятся строками ISO 8601, как в SQLite, поэтому код сравнивает и разбирает их
+# одинаково для обоих хранилищ. Агрегаты обновляют триггеры уровня оператора: пакетная
+# запись (COPY при импорте) обновляет каждую строку агрегата один раз.
+# Счетчики статусов меняются в порядке статусов, чтобы встречные переходы
+# (active -> cancelled и cancelled -> active) не блокировали друг друга.
+POSTGRES_SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS payments (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        event_type TEXT NOT NULL,
+        product_id TEXT NOT NULL,
+        product_title TEXT NOT NULL,
+        buyer_email TEXT NOT NULL,
+        contract_id TEXT NOT NULL,
+        parent_contract_id TEXT,
+        amount DOUBLE PRECISION NOT NULL,
+        currency TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        status TEXT NOT NULL,
+        error_message TEXT,
+        raw_data BYTEA NOT NULL,
+        received_at TEXT NOT NULL,
+        processed INTEGER DEFAULT 0
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_payments_contract ON payments(contract_id, event_type)',
+    'CREATE INDEX IF NOT EXISTS idx_payments_buyer ON payments(buyer_email, timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_payments_received ON payments(received_at) WHERE event_type = \'payment.success\'',
+    '''
+    CREATE TABLE IF NOT EXISTS channel_members (
+        user_id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        joined_at TEXT NOT NULL,
+        expires_at TEXT,
+        subscription_end_date TEXT,
+        last_payment_id BIGINT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_channel_members_payment ON channel_members(last_payment_id)',
+    '''
+    CREATE TABLE IF NOT EXISTS subscription_reminders (
+        user_id TEXT PRIMARY KEY,
+        last_reminder_at TEXT NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS shortened_links (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        short_code TEXT UNIQUE NOT NULL,
+        original_url TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS invoice_cache (
+        user_id TEXT NOT NULL,
+        offer_id TEXT NOT NULL,
+        periodicity TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        payment_url TEXT NOT NULL,
+        short_url TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (user_id, offer_id, periodicity, currency)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS reconciliation_state (
+        user_id TEXT PRIMARY KEY,
+        contract_id TEXT,
+        lava_status TEXT,
+        checked_at TEXT NOT NULL
+    )
+    ''',
+    # Промежуточные таблицы outbox и сводки (database.STAGED_TABLES)
+    '''
+    CREATE TABLE IF NOT EXISTS telegram_outbox (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        dedup_key TEXT UNIQUE,
+        chat_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        next_attempt_at DOUBLE PRECISION NOT NULL,
+        created_at DOUBLE PRECISION NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS admin_events (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        dedup_key TEXT UNIQUE,
+        category TEXT NOT NULL,
+        summary TEXT NOT NULL,
+        created_at DOUBLE PRECISION NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS payment_stats_daily (
+        day TEXT NOT NULL,
+        product_id TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        event_type TEXT NOT NULL,
+        events BIGINT NOT NULL DEFAULT 0,
+        amount DOUBLE PRECISION NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, product_id, currency, event_type)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS member_status_counts (
+        status TEXT PRIMARY KEY,
+        members BIGINT NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS member_stats_daily (
+        day TEXT NOT NULL,
+        status TEXT NOT NULL,
+        transitions BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, status)
+    )
+    ''',
+    '''
+    CREATE OR REPLACE FUNCTION payments_stats_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO payment_stats_daily AS s (day, product_id, currency, event_type, events, amount)
+        SELECT substr(received_at, 1, 10), product_id, currency, event_type, COUNT(*), SUM(amount)
+        FROM new_rows
+        GROUP BY 1, 2, 3, 4
+        ORDER BY 1, 2, 3, 4
+        ON CONFLICT (day, product_id, currency, event_type) DO UPDATE SET
+            events = s.events + excluded.events,
+            amount = s.amount + excluded.amount;
+        RETURN NULL;
+    END
+    $$
+    ''',
+    '''
+    CREATE OR REPLACE FUNCTION channel_members_stats_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        WITH counts AS (
+            INSERT INTO member_status_counts AS c (status, members)
+            SELECT status, COUNT(*) FROM new_rows GROUP BY status ORDER BY status
+            ON CONFLICT (status) DO UPDATE SET members = c.members + excluded.members
+        )
+        INSERT INTO member_stats_daily AS s (day, status, transitions)
+        SELECT to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD'), status, COUNT(*)
+        FROM new_rows GROUP BY status ORDER BY status
+        ON CONFLICT (day, status) DO UPDATE SET transitions = s.transitions + excluded.transitions;
+        RETURN NULL;
+    END
+    $$
+    ''',
+    '''
+    CREATE OR REPLACE FUNCTION channel_members_stats_update() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        WITH changes AS (
+            SELECT o.status AS old_status, n.status AS new_status
+            FROM old_rows o JOIN new_rows n USING (user_id)
+            WHERE o.status IS DISTINCT FROM n.status
+        ), counts AS (
+            INSERT INTO member_status_counts AS c (status, members)
+            SELECT status, SUM(delta) FROM (
+                SELECT old_status AS status, -1 AS delta FROM changes
+                UNION ALL
+                SELECT new_status, 1 FROM changes
+            ) d
+            GROUP BY status
+            ORDER BY status
+            ON CONFLICT (status) DO UPDATE SET members = c.members + excluded.members
+        )
+        INSERT INTO member_stats_daily AS s (day, status, transitions)
+        SELECT to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD'), new_status, COUNT(*)
+        FROM changes GROUP BY new_status ORDER BY new_status
+        ON CONFLICT (day, status) DO UPDATE SET transitions = s.transitions + excluded.transitions;
+        RETURN NULL;
+    END
+    $$
+    ''',
+    '''
+    CREATE OR REPLACE FUNCTION channel_members_stats_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO member_status_counts AS c (status, members)
+        SELECT status, -COUNT(*) FROM old_rows GROUP BY status ORDER BY status
+        ON CONFLICT (status) DO UPDATE SET members = c.members + excluded.members;
+        RETURN NULL;
+    END
+    $$
+    ''',
+    '''
+    CREATE OR REPLACE TRIGGER payments_stats_insert AFTER INSERT ON payments
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION payments_stats_insert()
+    ''',
+    '''
+    CREATE OR REPLACE TRIGGER channel_members_stats_insert AFTER INSERT ON channel_members
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION channel_members_stats_insert()
+    ''',
+    '''
+    CREATE OR REPLACE TRIGGER channel_members_stats_update AFTER UPDATE ON channel_members
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION channel_members_stats_update()
+    ''',
+    '''
+    CREATE OR REPLACE TRIGGER channel_members_stats_delete AFTER DELETE ON channel_members
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION channel_members_stats_delete()
+    ''',
+)
+
+class PostgresStorage:
+    """
+    Данные пользователей в PostgreSQL (нужны пакеты psycopg и psycopg-pool). Соединения
+    берутся из пула; запросы с параметрами подготавливаются на сервере при первом
+    выполнении (prepare_threshold=0) и повторно не разбираются; импорт пишет платежи через COPY.
+    """
+
+    name = "postgres"
+    in_main_db = False
+    stages_rows = True
+
+    def __init__(self, url: str = DATABASE_URL, min_size: int = PG_POOL_MIN, max_size: int = PG_POOL_MAX):
+        self.url = url
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.pool = None
+        self.lock = threading.Lock()
+        # Записал ли текущий поток промежуточные строки в своей транзакции
+        self.local = threading.local()
+        self.relay_wanted = threading.Event()
+        self.relay_thread: Optional[threading.Thread] = None
+
+    def _pool(self):
+        with self.lock:
+            if self.pool is None:
+                try:
+                    from psycopg_pool import ConnectionPool
+                except ImportError as e:
+                    raise RuntimeError(
+                        "Для STORAGE_BACKEND=postgres нужны пакеты psycopg и psycopg-pool "
+                        "(pip install -r requirements-postgres.txt)"
+                    ) from e
+                pool = ConnectionPool(
+                    self.url, min_size=self.min_size, max_size=self.max_size,
+                    kwargs={"prepare_threshold": 0}, name="storage", open=True
+                )
+                with pool.connection() as conn:
+                    # Схему создает один процесс, остальные ждут блокировку
+                    conn.execute("SELECT pg_advisory_xact_lock(hashtext('lava_storage_schema'))")
+                    for statement in POSTGRES_SCHEMA:
+                        conn.execute(statement)
+                self.pool = pool
+                logger.info(f"Пул соединений PostgreSQL открыт ({self.min_size}-{self.max_size})")
+            return self.pool
+
+    def partitions(self) -> range:
+        return range(1)
+
+    def partition_of(self, user_id) -> int:
+        return 0
+
+    @contextmanager
+    def connection(self, partition: Optional[int] = None, conn=None):
+        """
+        Соединение из пула; если передано conn, используется оно. Изменения фиксируются
+        при выходе (при ошибке откатываются), затем записанные в транзакции сообщения
+        outbox и события сводки переносятся в SQLite
+        """
+        if conn is not None:
+            yield conn
+            return
+        outer_staged = getattr(self.local, "staged", False)
+        self.local.staged = False
+        try:
+            with self._pool().connection() as conn:
+                yield conn
+            if self.local.staged:
+                self._wake_relay()
+        finally:
+            self.local.staged = outer_staged
+
+    def write(self, user_id, operation: Callable[[Any], Any]) -> Any:
+        """Выполняет operation(conn) одной транзакцией (см. connection)"""
+        with self.connection() as conn:
+            return operation(conn)
+
+    def stage(self, conn, table: str, row: tuple) -> bool:
+        """Строка outbox или сводки (столбцы STAGED_TABLES[table]) в транзакции conn"""
+        columns = STAGED_TABLES[table]
+        cursor = conn.execute(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) "
+            f"ON CONFLICT (dedup_key) DO NOTHING",
+            row
+        )
+        self.local.staged = True
+        return cursor.rowcount > 0
+
+    def _wake_relay(self):
+        with self.lock:
+            if self.relay_thread is None:
+                self.relay_thread = threading.Thread(target=self._relay_loop, name="storage-relay", daemon=True)
+                self.relay_thread.start()
+        self.relay_wanted.set()
+
+    def _relay_loop(self):
+        # Строки, записанные за время переноса, забирает следующий проход. Под нагрузкой
+        # перенос выполняется не чаще раза в SHARD_RELAY_MIN_DELAY: строки многих транзакций
+        # переносятся одной транзакцией основной БД
+        while True:
+            self.relay_wanted.wait()
+            time.sleep(SHARD_RELAY_MIN_DELAY)
+            self.relay_wanted.clear()
+            try:
+                self.relay_staged()
+            except Exception as e:
+                # Строки останутся в PostgreSQL до следующего переноса
+                logger.error(f"Не удалось перенести сообщения и события из PostgreSQL: {str(e)}")
+
+    def relay_staged(self) -> int:
+        """
+        Переносит сообщения outbox и события сводки в основную БД SQLite. Строки, которые
+        переносит другой процесс, пропускаются (SKIP LOCKED); повторная запись той же строки
+        в SQLite не дублирует ее (dedup_key).
+        """
+        relayed = 0
+        while True:
+            staged, taken = {}, {}
+            with self.connection() as conn:
+                for table, columns in STAGED_TABLES.items():
+                    rows = conn.execute(
+                        f"SELECT id, {', '.join(columns)} FROM {table} ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED",
+                        (PG_RELAY_BATCH_SIZE,)
+                    ).fetchall()
+                    if rows:
+                        taken[table] = [row[0] for row in rows]
+                        staged[table] = (rows[-1][0], [
+                            (row[1] or f"postgres:{row[0]}:{row[-1]!r}",) + tuple(row[2:]) for row in rows
+                        ])
+                if not staged:
+                    break
+                writer.run(lambda main_conn: put_staged(main_conn, staged))
+                # Удаляются только перенесенные строки: строка с меньшим id могла быть
+                # зафиксирована позже и в эту пачку не попасть
+                for table, ids in taken.items():
+                    conn.execute(f"DELETE FROM {table} WHERE id = ANY(%s)", (ids,))
+            relayed += sum(len(ids) for ids in taken.values())
+            if all(len(ids) < PG_RELAY_BATCH_SIZE for ids in taken.values()):
+                break
+        if relayed:
+            from outbox import sender
+            sender.wake()
+        return relayed
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool = None
+
+    # Платежи
+
+    def insert_payment(self, conn, payment: dict) -> int:
+        columns = list(payment)
+        return conn.execute(
+            f"INSERT INTO payments ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) RETURNING id",
+            [payment[column] for column in columns]
+        ).fetchone()[0]
+
+    def find_payment(self, user_id, contract_id: str, event_type: str, conn=None) -> Optional[int]:
+        with self.connection(conn=conn) as conn:
+            row = conn.execute(
+                'SELECT id FROM payments WHERE contract_id = %s AND event_type = %s ORDER BY id LIMIT 1',
+                (contract_id, event_type)
+            ).fetchone()
+        return row[0] if row else None
+
+    def last_paid_payment(self, user_id, conn=None) -> Optional[tuple]:
+        with self.connection(conn=conn) as conn:
+            return conn.execute('''
+            SELECT p.id, p.status, p.timestamp, p.event_type, p.contract_id, p.parent_contract_id,
+                   p.amount, p.currency, p.product_id, cm.subscription_end_date
+            FROM payments p
+            LEFT JOIN channel_members cm ON cm.last_payment_id = p.id
+            WHERE p.buyer_email = %s
+            AND p.event_type IN ('payment.success', 'subscription.recurring.payment.success')
+            ORDER BY p.timestamp DESC
+            LIMIT 1
+            ''', (f"{user_id}@t.me",)).fetchone()
+
+    def count_new_payments(self, hour_since: str, day_since: str) -> tuple:
+        with self.connection() as conn:
+            hour, day = conn.execute('''
+            SELECT COUNT(*) FILTER (WHERE received_at >= %s), COUNT(*)
+            FROM payments
+            WHERE event_type = 'payment.success' AND received_at >= %s
+            ''', (hour_since, day_since)).fetchone()
+        return hour or 0, day or 0
+
+    @contextmanager
+    def import_transaction(self, partition: int, dry_run: bool = False):
+        import psycopg
+        with self.connection() as conn:
+            with conn.transaction():
+                yield conn
+                if dry_run:
+                    raise psycopg.Rollback()
+
+    def import_payments(self, conn, rows: list, dry_run: bool = False) -> list:
+        """См. SqliteStorage.import_payments. Строки загружаются во временную таблицу через COPY"""
+        # Как и в SQLite, пачка пишется под блокировкой записи платежей: событие не запишется
+        # дважды, если тот же вебхук придет во время импорта
+        conn.execute("LOCK TABLE payments IN SHARE ROW EXCLUSIVE MODE")
+        conn.execute(
+            "CREATE TEMP TABLE import_payments ON COMMIT DROP AS "
+            f"SELECT 0 AS n, {', '.join(IMPORT_COLUMNS)} FROM payments WITH NO DATA"
+        )
+        with conn.cursor() as cursor:
+            with cursor.copy(f"COPY import_payments (n, {', '.join(IMPORT_COLUMNS)}) FROM STDIN") as copy:
+                for index, row in enumerate(rows):
+                    copy.write_row((index,) + tuple(row))
+        new = '''
+        FROM import_payments i
+        WHERE NOT EXISTS (
+            SELECT 1 FROM payments p WHERE p.contract_id = i.contract_id AND p.event_type = i.event_type
+        )
+        '''
+        if dry_run:
+            return [(row[0], None) for row in conn.execute(f"SELECT i.n {new} ORDER BY i.n").fetchall()]
+        inserted = conn.execute(f'''
+        INSERT INTO payments ({', '.join(IMPORT_COLUMNS)})
+        SELECT {', '.join('i.' + column for column in IMPORT_COLUMNS)} {new}
+        ORDER BY i.n
+        RETURNING id, event_type, contract_id
+        ''').fetchall()
+        # Пара (event_type, contract_id) в пачке уникальна (повторы отбрасывает importer)
+        index_of = {(row[0], row[4]): index for index, row in enumerate(rows)}
+        return sorted((index_of[(event_type, contract_id)], payment_id) for payment_id, event_type, contract_id in inserted)
+
+    def payment_raw_data(self, payment_id: int):
+        with self.connection() as conn:
+            row = conn.execute('SELECT raw_data FROM payments WHERE id = %s', (payment_id,)).fetchone()
+        return row[0] if row else None
+
+    # Участники канала
+
+    def member_subscription(self, user_id, conn=None) -> Optional[tuple]:
+        with self.connection(conn=conn) as conn:
+            return conn.execute('''
+            SELECT cm.status, cm.subscription_end_date, cm.last_payment_id,
+                   p.contract_id, p.parent_contract_id
+            FROM channel_members cm
+            LEFT JOIN payments p ON p.id = cm.last_payment_id
+            WHERE cm.user_id = %s
+            ''', (str(user_id),)).fetchone()
+
+    def member_end_date(self, user_id, conn=None) -> Optional[str]:
+        with self.connection(conn=conn) as conn:
+            row = conn.execute(
+                "SELECT subscription_end_date FROM channel_members WHERE user_id = %s", (str(user_id),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def member_status(self, user_id, conn=None) -> Optional[str]:
+        with self.connection(conn=conn) as conn:
+            row = conn.execute('SELECT status FROM channel_members WHERE user_id = %s', (str(user_id),)).fetchone()
+        return row[0] if row else None
+
+    def activate_member(self, conn, user_id, joined_at: str, end_date: str, payment_id: Optional[int]):
+        conn.execute('''
+        INSERT INTO channel_members
+        (user_id, status, joined_at, subscription_end_date, last_payment_id)
+        VALUES (%s, 'active', %s, %s, %s)
+        ON CONFLICT (user_id) DO UPDATE SET
+            status = excluded.status,
+            joined_at = excluded.joined_at,
+            subscription_end_date = excluded.subscription_end_date,
+            last_payment_id = excluded.last_payment_id
+        ''', (str(user_id), joined_at, end_date, payment_id))
+
+    def renew_member(self, conn, user_id, end_date: str, payment_id: Optional[int]) -> int:
+        return conn.execute('''
+        UPDATE channel_members
+        SET status = 'active',
+            subscription_end_date = %s,
+            last_payment_id = %s
+        WHERE user_id = %s
+        ''', (end_date, payment_id, str(user_id))).rowcount
+
+    def cancel_member(self, user_id, conn=None) -> int:
+        with self.connection(conn=conn) as conn:
+            return conn.execute('''
+            UPDATE channel_members
+            SET status = 'cancelled'
+            WHERE user_id = %s AND status = 'active'
+            ''', (str(user_id),)).rowcount
+
+    def cancel_member_until(self, conn, user_id, end_date: Optional[str]) -> int:
+        return conn.execute('''
+        UPDATE channel_members
+        SET status = 'cancelled',
+            subscription_end_date = %s
+        WHERE user_id = %s AND status = 'active'
+        ''', (end_date, str(user_id))).rowcount
+
+    def remove_member(self, conn, user_id) -> int:
+        rows_updated = conn.execute('''
+        UPDATE channel_members
+        SET status = 'removed'
+        WHERE user_id = %s AND status != 'removed'
+        ''', (str(user_id),)).rowcount
+        self.clear_reminder(conn, user_id)
+        return rows_updated
+
+    def members_to_check(self) -> list:
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT
+                cm.user_id,
+                cm.subscription_end_date,
+                cm.status,
+                p.status as payment_status,
+                p.event_type
+            FROM channel_members cm
+            LEFT JOIN payments p ON p.id = cm.last_payment_id
+            WHERE cm.status IN ('active', 'cancelled')
+            AND cm.subscription_end_date IS NOT NULL
+            ''').fetchall()
+
+    def access_end_dates(self) -> list:
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT user_id, subscription_end_date FROM channel_members
+            WHERE status IN ('active', 'cancelled') AND subscription_end_date IS NOT NULL
+            ''').fetchall()
+
+    def access_end_date(self, user_id) -> Optional[str]:
+        with self.connection() as conn:
+            row = conn.execute('''
+            SELECT subscription_end_date FROM channel_members
+            WHERE user_id = %s AND status IN ('active', 'cancelled')
+            ''', (str(user_id),)).fetchone()
+        return row[0] if row else None
+
+    def known_user_ids(self) -> set:
+        with self.connection() as conn:
+            return {row[0] for row in conn.execute('''
+            SELECT user_id FROM channel_members
+            UNION
+            SELECT split_part(buyer_email, '@', 1) FROM payments
+            ''')}
+
+    def import_members(self, conn, user_ids: Iterable) -> dict:
+        return {
+            row[0]: row[1:] for row in conn.execute('''
+            SELECT cm.user_id, cm.status, cm.joined_at, cm.subscription_end_date, cm.last_payment_id,
+                   COALESCE(p.timestamp, cm.joined_at)
+            FROM channel_members cm
+            LEFT JOIN payments p ON p.id = cm.last_payment_id
+            WHERE cm.user_id = ANY(%s)
+            ''', (list(user_ids),))
+        }
+
+    def upsert_members(self, conn, rows: list):
+        with conn.cursor() as cursor:
+            cursor.executemany('''
+            INSERT INTO channel_members (user_id, status, joined_at, subscription_end_date, last_payment_id)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (user_id) DO UPDATE SET
+                status = excluded.status,
+                joined_at = excluded.joined_at,
+                subscription_end_date = excluded.subscription_end_date,
+                last_payment_id = excluded.last_payment_id
+            ''', rows)
+
+    def reconciliation_page(self, partition: int, window_end: str, grace_start: str, recheck_before: str,
+                            after_user_id: str, limit: int) -> list:
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT cm.user_id, cm.subscription_end_date,
+                   COALESCE(p.parent_contract_id, p.contract_id), p.amount, p.currency, p.product_id
+            FROM channel_members cm
+            JOIN payments p ON p.id = cm.last_payment_id
+            LEFT JOIN reconciliation_state rs ON rs.user_id = cm.user_id
+            WHERE cm.status = 'active'
+              AND cm.subscription_end_date IS NOT NULL
+              AND cm.subscription_end_date < %s
+              AND cm.subscription_end_date > %s
+              AND (rs.checked_at IS NULL OR rs.checked_at < %s)
+              AND cm.user_id > %s
+            ORDER BY cm.user_id
+            LIMIT %s
+            ''', (window_end, grace_start, recheck_before, after_user_id, limit)).fetchall()
+
+    def save_reconciliation(self, partition: int, state_rows: list, extensions: list, cancellations: list) -> tuple:
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.executemany('''
+                INSERT INTO reconciliation_state (user_id, contract_id, lava_status, checked_at)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    contract_id = excluded.contract_id,
+                    lava_status = excluded.lava_status,
+                    checked_at = excluded.checked_at
+                ''', state_rows)
+            extended = conn.execute('''
+            UPDATE channel_members cm SET subscription_end_date = e.end_date
+            FROM unnest(%s::text[], %s::text[]) AS e(end_date, user_id)
+            WHERE cm.user_id = e.user_id AND cm.status = 'active'
+            ''', ([end_date for end_date, _ in extensions], [user_id for _, user_id in extensions])).rowcount
+            self.clear_reminders(conn, [user_id for _, user_id in extensions])
+            cancelled = conn.execute('''
+            UPDATE channel_members SET status = 'cancelled'
+            WHERE user_id = ANY(%s) AND status = 'active'
+            ''', ([user_id for (user_id,) in cancellations],)).rowcount
+        return extended, cancelled
+
+    # Напоминания о продлении
+
+    def clear_reminder(self, conn, user_id):
+        conn.execute('DELETE FROM subscription_reminders WHERE user_id = %s', (str(user_id),))
+
+    def clear_reminders(self, conn, user_ids: list):
+        conn.execute('DELETE FROM subscription_reminders WHERE user_id = ANY(%s)', ([str(u) for u in user_ids],))
+
+    def last_reminder(self, conn, user_id) -> Optional[str]:
+        row = conn.execute(
+            'SELECT last_reminder_at FROM subscription_reminders WHERE user_id = %s', (str(user_id),)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_reminder(self, conn, user_id, day: str):
+        conn.execute('''
+        INSERT INTO subscription_reminders (user_id, last_reminder_at)
+        VALUES (%s, %s)
+        ON CONFLICT (user_id) DO UPDATE SET last_reminder_at = excluded.last_reminder_at
+        ''', (str(user_id), day))
+
+    # Ссылки
+
+    def add_link(self, short_code: str, original_url: str, created_at: str):
+        with self.connection() as conn:
+            conn.execute('''
+            INSERT INTO shortened_links (short_code, original_url, created_at)
+            VALUES (%s, %s, %s)
+            ''', (short_code, original_url, created_at))
+
+    def resolve_link(self, short_code: str) -> Optional[str]:
+        with self.connection() as conn:
+            row = conn.execute(
+                'SELECT original_url FROM shortened_links WHERE short_code = %s', (short_code,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def count_links(self) -> int:
+        with self.connection() as conn:
+            return conn.execute('SELECT COUNT(*) FROM shortened_links').fetchone()[0]
+
+    def delete_links_before(self, cutoff: str) -> int:
+        with self.connection() as conn:
+            return conn.execute('DELETE FROM shortened_links WHERE created_at < %s', (cutoff,)).rowcount
+
+    def cached_invoice(self, user_id, offer_id, periodicity, currency, since: str) -> Optional[str]:
+        with self.connection() as conn:
+            row = conn.execute('''
+            SELECT short_url FROM invoice_cache
+            WHERE user_id = %s AND offer_id = %s AND periodicity = %s AND currency = %s AND created_at >= %s
+            ''', (str(user_id), offer_id, periodicity, currency, since)).fetchone()
+        return row[0] if row else None
+
+    def cache_invoice(self, user_id, offer_id, periodicity, currency, payment_url: str, short_url: str,
+                      created_at: str):
+        with self.connection() as conn:
+            conn.execute('''
+            INSERT INTO invoice_cache (user_id, offer_id, periodicity, currency, payment_url, short_url, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (user_id, offer_id, periodicity, currency) DO UPDATE SET
+                payment_url = excluded.payment_url,
+                short_url = excluded.short_url,
+                created_at = excluded.created_at
+            ''', (str(user_id), offer_id, periodicity, currency, payment_url, short_url, created_at))
+
+    def invalidate_invoices(self, conn, user_id):
+        conn.execute('DELETE FROM invoice_cache WHERE user_id = %s', (str(user_id),))
+
+    def delete_invoices_before(self, cutoff: str) -> int:
+        with self.connection() as conn:
+            return conn.execute('DELETE FROM invoice_cache WHERE created_at < %s', (cutoff,)).rowcount
+
+    # Статистика (те же агрегаты, что в SQLite, см. database.get_stats_summary)
+
+    def stats_summary(self, days: int = 30) -> dict:
+        since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).date().isoformat()
+        today = datetime.now(timezone.utc).date().isoformat()
+        with self.connection() as conn:
+            members = dict(conn.execute('SELECT status, members FROM member_status_counts').fetchall())
+            revenue = {
+                currency: {"today": today_amount, "period": period_amount, "total": total_amount}
+                for currency, today_amount, period_amount, total_amount in conn.execute('''
+                SELECT currency,
+                       COALESCE(SUM(amount) FILTER (WHERE day = %s), 0),
+                       COALESCE(SUM(amount) FILTER (WHERE day >= %s), 0),
+                       SUM(amount)
+                FROM payment_stats_daily
+                WHERE event_type = ANY(%s)
+                GROUP BY currency
+                ''', (today, since, list(PAID_EVENT_TYPES)))
+            }
+            events = dict(conn.execute('''
+            SELECT event_type, SUM(events)::bigint FROM payment_stats_daily
+            WHERE day >= %s
+            GROUP BY event_type
+            ''', (since,)).fetchall())
+            transitions = dict(conn.execute('''
+            SELECT status, SUM(transitions)::bigint FROM member_stats_daily
+            WHERE day >= %s
+            GROUP BY status
+            ''', (since,)).fetchall())
+        return {
+            "days": days,
+            "members": members,
+            "revenue": revenue,
+            "events": events,
+            "transitions": transitions,
+        }
+
+    def rebuild_stats(self) -> dict:
+        """Пересчитывает агрегаты по payments и channel_members (дневные переходы не пересчитываются)"""
+        with self.connection() as conn:
+            conn.execute('DELETE FROM payment_stats_daily')
+            payment_rows = conn.execute('''
+            INSERT INTO payment_stats_daily (day, product_id, currency, event_type, events, amount)
+            SELECT substr(received_at, 1, 10), product_id, currency, event_type, COUNT(*), COALESCE(SUM(amount), 0)
+            FROM payments
+            GROUP BY 1, 2, 3, 4
+            ''').rowcount
+            conn.execute('DELETE FROM member_status_counts')
+            conn.execute('''
+            INSERT INTO member_status_counts (status, members)
+            SELECT status, COUNT(*) FROM channel_members GROUP BY status
+            ''')
+        logger.info(f"Агрегаты статистики пересчитаны: {payment_rows} строк по платежам")
+        return {"payment_rows": payment_rows}
+
+def require_sqlite(feature: str):
+    """Останавливает функции, которые работают напрямую с файлами SQLite (архив, шарды, пересчет)"""
+    if storage.name != "sqlite":
+        raise RuntimeError(f"{feature}: недоступно при STORAGE_BACKEND={storage.name}, функция работает с файлами SQLite")
+
+if STORAGE_BACKEND not in ("sqlite", "postgres"):
+    raise ValueError(f"Неизвестное хранилище STORAGE_BACKEND={STORAGE_BACKEND} (sqlite или postgres)")
+
+storage = PostgresStorage() if STORAGE_BACKEND == "postgres" else SqliteStorage()
+
+# Ошибки БД текущего хранилища (для обработчиков, которые отличают их от прочих ошибок)
+DATABASE_ERRORS = (sqlite3.Error,)
+if STORAGE_BACKEND == "postgres":
+    try:
+        import psycopg
+        DATABASE_ERRORS += (psycopg.Error,)
+    except ImportError:
+        pass
@@ -0,0 +1,586 @@
+import os
+import logging
+import sqlite3
+import threading
+import time
+import json
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import requests
+from telebot import types
+
+from database import DB_PATH
+from storage import storage, DATABASE_ERRORS
+from telegram_client import bot
+from pricing import resolve_periodicity, update_pricing_index
+from invite_pool import INVITE_LINK_TTL, record_issued_link, take_invite_link
+from outbox import enqueue, enqueue_message
+import admin_digest
+
+# Общая логика подписок, которая нужна и боту, и вебхук-серверу: каталог и счета Lava,
+# статус подписки, выдача доступа к каналу и уведомления. Модуль не регистрирует
+# обработчики бота и не имеет побочных эффектов при импорте, поэтому его безопасно
+# импортировать в каждом воркере uvicorn.
+
+logger = logging.getLogger("payment_bot")
+
+# Получение настроек из переменных окружения
+LAVA_API_KEY = os.getenv("LAVA_API_KEY")
+LAVA_API_URL = os.getenv("LAVA_API_URL", "https://gate.lava.top").rstrip("/")
+CHANNEL_ID = os.getenv("CHANNEL_ID")
+ADMIN_ID = os.getenv("ADMIN_ID")
+SUPPORT_USERNAME = os.getenv("SUPPORT_USERNAME", "support")  # Имя пользователя техподдержки в Telegram
+CHANNEL_LINK = os.getenv("CHANNEL_LINK", "")  # Постоянная ссылка на канал
+# Режим заявок на вступление: вместо одноразовой ссылки на каждый платеж пользователи получают
+# одну общую ссылку с заявкой, а бот одобряет заявки по статусу подписки
+JOIN_REQUEST_MODE = os.getenv("JOIN_REQUEST_MODE", "false").lower() in ("1", "true", "yes")
+JOIN_REQUEST_LINK = os.getenv("JOIN_REQUEST_LINK", "")  # Готовая ссылка с заявкой (иначе создается ботом)
+
+# Сколько секунд каталог подписок Lava берется из кэша, без повторного запроса
+CATALOG_CACHE_TTL = int(os.getenv("CATALOG_CACHE_TTL", "300"))
+
+# Словарь дней для каждого периода
+PERIOD_DAYS = {
+    "MONTHLY": 30,
+    "PERIOD_90_DAYS": 90,
+    "PERIOD_180_DAYS": 180,
+    "PERIOD_YEAR": 365
+}
+
+# Дней отсрочки после окончания подписки, после которых участник удаляется из канала
+GRACE_PERIOD_DAYS = 3
+
+# Функция для определения периодичности по стоимости
+
+def get_periodicity_by_amount(amount: float, currency: str = None, product_id: str = None) -> str:
+    """
+    Определяет периодичность подписки по стоимости (с учетом валюты и продукта, если они известны)
+    """
+    refresh_catalog_if_stale()
+    return resolve_periodicity(amount, currency, product_id)
+
+
+# Кэш каталога подписок: при каждом обновлении перестраивается индекс цен
+catalog_lock = threading.Lock()
+catalog_cache = {"subscriptions": None, "fetched_at": 0.0, "failed_at": 0.0, "refreshing": False}
+
+def get_available_subscriptions():
+    """Каталог подписок из кэша; при устаревании кэша запрашивается заново"""
+    with catalog_lock:
+        if catalog_cache["subscriptions"] is not None and time.monotonic() - catalog_cache["fetched_at"] < CATALOG_CACHE_TTL:
+            return catalog_cache["subscriptions"]
+    
+    subscriptions = fetch_available_subscriptions()
+    with catalog_lock:
+        if subscriptions is None:
+            catalog_cache["failed_at"] = time.monotonic()
+            # Lava недоступна - лучше показать устаревший каталог, чем ошибку
+            return catalog_cache["subscriptions"]
+        catalog_cache["subscriptions"] = subscriptions
+        catalog_cache["fetched_at"] = time.monotonic()
+    update_pricing_index(subscriptions)
+    return subscriptions
+
+def refresh_catalog_if_stale():
+    """
+    Подгружает каталог для индекса цен. Первая загрузка выполняется сразу,
+    устаревший каталог обновляется в фоне, чтобы не задерживать обработку вебхука.
+    """
+    with catalog_lock:
+        now = time.monotonic()
+        if catalog_cache["refreshing"] or now - catalog_cache["failed_at"] < 60:
+            return
+        if catalog_cache["subscriptions"] is not None and now - catalog_cache["fetched_at"] < CATALOG_CACHE_TTL:
+            return
+        loaded = catalog_cache["subscriptions"] is not None
+        catalog_cache["refreshing"] = True
+    
+    def refresh():
+        try:
+            get_available_subscriptions()
+        finally:
+            with catalog_lock:
+                catalog_cache["refreshing"] = False
+    
+    if loaded:
+        threading.Thread(target=refresh, daemon=True).start()
+    else:
+        refresh()
+
+# Функция для получения списка доступных подписок из Lava
+def fetch_available_subscriptions():
+    url = f"{LAVA_API_URL}/api/v2/products"
+    params = {
+        "contentCategories": "PRODUCT",
+        "feedVisibility": "ONLY_VISIBLE",
+        "showAllSubscriptionPeriods": "true"
+    }
+    headers = {
+        "X-Api-Key": LAVA_API_KEY
+    }
+    
+    try:
+        response = requests.get(url, params=params, headers=headers)
+        response.raise_for_status()
+        data = response.json()
+        
+        subscriptions = []
+        for item in data.get("items", []):
+            if item.get("type") == "SUBSCRIPTION":
+                for offer in item.get("offers", []):
+                    # Группируем цены по периодичности
+                    prices_by_period = {}
+                    for price in offer["prices"]:
+                        if price["periodicity"] not in prices_by_period:
+                            prices_by_period[price["periodicity"]] = {}
+                        prices_by_period[price["periodicity"]][price["currency"]] = price["amount"]
+                    
+                    # Преобразуем в список для удобства
+                    prices = []
+                    for periodicity, currencies in prices_by_period.items():
+                        prices.append({
+                            "periodicity": periodicity,
+                            "currencies": currencies
+                        })
+                    
+                    if prices:
+                        subscriptions.append({
+                            "offer_id": offer["id"],
+                            "product_id": item.get("id"),
+                            "name": offer["name"],
+                            "description": offer["description"],
+                            "prices": prices
+                        })
+        
+        return subscriptions
+    except Exception as e:
+        logger.error(f"Ошибка при получении списка подписок: {str(e)}")
+        return None
+
+# Функция для создания ссылки на оплату
+def create_payment_link(user_id, offer_id, periodicity, currency="RUB"):
+    url = f"{LAVA_API_URL}/api/v2/invoice"
+    headers = {
+        "Content-Type": "application/json",
+        "X-Api-Key": LAVA_API_KEY
+    }
+    
+    payload = {
+        "email": f"{user_id}@t.me",
+        "offerId": offer_id,
+        "periodicity": periodicity,
+        "currency": currency,
+        "buyerLanguage": "RU",
+        "clientUtm": {}
+    }
+    
+    try:
+        logger.info(f"Создание ссылки на оплату для пользователя {user_id}")
+        logger.debug(f"URL запроса: {url}")
+        logger.debug(f"Заголовки: {headers}")
+        logger.debug(f"Тело запроса: {payload}")
+        
+        response = requests.post(url, headers=headers, json=payload)
+        logger.debug(f"Код ответа: {response.status_code}")
+        logger.debug(f"Тело ответа: {response.text}")
+        
+        response.raise_for_status()
+        response_data = response.json()
+        
+        logger.info(f"Успешно получен ответ от API: {response_data}")
+        return response_data
+        
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Ошибка при отправке запроса: {str(e)}")
+        if hasattr(e, 'response') and e.response is not None:
+            logger.error(f"Код ответа: {e.response.status_code}")
+            logger.error(f"Тело ответа: {e.response.text}")
+        return None
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка при создании ссылки: {str(e)}", exc_info=True)
+        return None
+
+# Функция для отмены подписки
+def cancel_subscription(user_id, contract_id):
+    try:
+        url = f"{LAVA_API_URL}/api/v1/subscriptions"
+        headers = {
+            "Content-Type": "application/json",
+            "X-Api-Key": LAVA_API_KEY
+        }
+        
+        # Добавляем параметры в URL для DELETE запроса
+        params = {
+            "contractId": contract_id,
+            "email": f"{user_id}@t.me"
+        }
+        
+        logger.info(f"Отправка запроса на отмену подписки:")
+        logger.info(f"URL: {url}")
+        logger.info(f"Headers: {headers}")
+        logger.info(f"Params: {params}")
+        
+        response = requests.delete(url, headers=headers, params=params)
+        
+        logger.info(f"Ответ от LAVA.TOP:")
+        logger.info(f"Статус: {response.status_code}")
+        logger.info(f"Тело ответа: {response.text}")
+        logger.info(f"Заголовки: {response.headers}")
+        
+        # Проверяем оба кода успешного ответа: 200 и 204
+        if response.status_code in [200, 204]:
+            logger.info(f"Подписка успешно отменена для пользователя {user_id}")
+            
+            # Обновляем статус в БД, но сохраняем дату окончания
+            storage.cancel_member(user_id)
+            
+            return True, "✅ Автопродление подписки отключено."
+        else:
+            # Парсим тело ответа, чтобы проверить конкретную ошибку
+            try:
+                error_response = response.json()
+                error_message = error_response.get("error", "")
+                if "Subscription cancelling error (have been already cancelled or not a subscription)" in error_message:
+                    logger.info(f"Подписка для пользователя {user_id} уже была отменена или не является подпиской. Обновляем статус в БД на 'cancelled'.")
+                    
+                    storage.cancel_member(user_id)
+                    return True, "⚠️ Ваша подписка уже была отменена ранее." 
+            except json.JSONDecodeError:
+                pass # Не удалось распарсить JSON, обрабатываем как обычную ошибку
+
+            logger.error(f"Ошибка при отмене подписки: код {response.status_code}, ответ: {response.text}")
+            return False, f"❌ Произошла ошибка при отмене подписки: {response.text}. Попробуйте позже или обратитесь в поддержку."
+            
+    except Exception as e:
+        logger.error(f"Ошибка при отмене подписки: {str(e)}")
+        return False, f"❌ Произошла ошибка при отмене подписки: {str(e)}. Попробуйте позже или обратитесь в поддержку."
+
+# Функция для проверки статуса подписки пользователя
+def check_subscription_status(user_id):
+    try:
+        # Сначала проверяем статус в channel_members
+        member = storage.member_subscription(user_id)
+        
+        if member:
+            status, end_date_str, last_payment_id, contract_id, parent_contract_id = member
+            
+            if status == 'removed':
+                return {"status": "removed", "end_date": end_date_str, "contract_id": parent_contract_id or contract_id}
+            
+            if status == 'cancelled':
+                return {"status": "cancelled", "end_date": end_date_str, "contract_id": parent_contract_id or contract_id}
+
+            # Проверяем, не истекла ли подписка, обрабатывая возможные ошибки даты
+            if end_date_str:
+                try:
+                    end_date = datetime.fromisoformat(end_date_str.replace('Z', '+00:00'))
+                    if end_date > datetime.now(timezone.utc):
+                        return {
+                            "status": status,  # Возвращаем фактический статус (active или cancelled)
+                            "end_date": end_date_str,
+                            "contract_id": parent_contract_id or contract_id
+                        }
+                except ValueError as ve:
+                    logger.error(f"Ошибка формата даты в check_subscription_status (member): {end_date_str} - {ve}")
+                except Exception as e:
+                    logger.error(f"Неожиданная ошибка при парсинге даты в check_subscription_status (member): {end_date_str} - {e}")
+        
+        # Если нет активной записи в channel_members или она истекла, проверяем последний платеж
+        payment = storage.last_paid_payment(user_id)
+        
+        if payment:
+            _, status, timestamp_str, event_type, contract_id, parent_contract_id, amount, currency, product_id, end_date_str_from_payment = payment
+            
+            # Если end_date_str_from_payment пуст, рассчитываем его на основе amount
+            if not end_date_str_from_payment and timestamp_str and amount is not None:
+                try:
+                    periodicity = get_periodicity_by_amount(amount, currency, product_id)
+                    days = PERIOD_DAYS.get(periodicity, 30)
+                    start_date = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
+                    end_date_calculated = (start_date + timedelta(days=days)).isoformat()
+                    end_date_str_from_payment = end_date_calculated
+                    logger.info(f"Рассчитана дата окончания подписки для {user_id} по последнему платежу: {end_date_calculated}")
+                except Exception as e:
+                    logger.error(f"Ошибка при расчете даты окончания по amount для {user_id}: {e}")
+                    end_date_str_from_payment = None # Очищаем, чтобы не использовать некорректную дату
+
+            is_active = False
+            if end_date_str_from_payment:
+                try:
+                    end_date = datetime.fromisoformat(end_date_str_from_payment.replace('Z', '+00:00'))
+                    if end_date > datetime.now(timezone.utc):
+                        is_active = True
+                except ValueError as ve:
+                    logger.error(f"Ошибка формата даты в check_subscription_status (payment): {end_date_str_from_payment} - {ve}")
+                except Exception as e:
+                    logger.error(f"Неожиданная ошибка при парсинге даты в check_subscription_status (payment): {end_date_str_from_payment} - {e}")
+            
+            return {
+                "status": "active" if is_active else "inactive",
+                "end_date": end_date_str_from_payment,
+                "contract_id": parent_contract_id or contract_id
+            }
+        
+        return {"status": "no_subscription"}
+        
+    except DATABASE_ERRORS as sqle:
+        logger.error(f"Ошибка БД при проверке статуса подписки для {user_id}: {sqle}")
+        return {"status": "error", "error": f"Ошибка базы данных: {sqle}"}
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка при проверке статуса подписки для {user_id}: {str(e)}", exc_info=True)
+        return {"status": "error", "error": f"Неизвестная ошибка: {e}"}
+
+# Функция для выдачи пользователю ссылки на вступление в канал
+def issue_invite_link(user_id) -> str:
+    if JOIN_REQUEST_MODE:
+        # Общая ссылка с заявкой: заявку одобрит обработчик chat_join_request
+        invite_link = get_join_request_link()
+    else:
+        # Берем готовую ссылку-приглашение из пула, чтобы не ждать Telegram
+        invite_link = take_invite_link(user_id)
+    if not invite_link:
+        # Пул пуст - создаем ссылку напрямую, как раньше
+        logger.warning(f"Пул ссылок-приглашений пуст, создаем ссылку для пользователя {user_id} напрямую")
+        expire_date = int(time.time()) + INVITE_LINK_TTL
+        invite_link = bot.create_chat_invite_link(
+            chat_id=CHANNEL_ID,
+            member_limit=1,
+            expire_date=expire_date
+        ).invite_link
+        record_issued_link(user_id, invite_link, expire_date)
+    return invite_link
+
+# Функция для построения сообщения со ссылкой на вход в канал
+def channel_access_message(invite_link: str):
+    channel_markup = types.InlineKeyboardMarkup(row_width=1)
+    channel_button = types.InlineKeyboardButton('📺 Войти в канал', url=invite_link)
+    channel_markup.add(channel_button)
+    access_text = f"Поздравляем! Вы успешно оформили подписку. Вот ваша ссылка для доступа к закрытому каналу: {invite_link}"
+    if JOIN_REQUEST_MODE:
+        access_text += "\n\nПодайте заявку на вступление по ссылке - она будет одобрена автоматически."
+    return access_text, channel_markup
+
+def notification_key(event_type: str, user_id, contract_id: Optional[str], payment_id) -> str:
+    """
+    Ключ дедупликации уведомлений о событии Lava. Повторная доставка того же события
+    приходит с тем же контрактом, поэтому ключ строится по пользователю и контракту:
+    одинаковый контракт у разных пользователей не глушит их уведомления. Без контракта
+    повторы не отличить от новых событий, и ключ берется по сохраненному платежу.
+    """
+    if contract_id:
+        return f"{event_type}:{user_id}:{contract_id}"
+    return f"{event_type}:{user_id}:payment-{payment_id}"
+
+# Функция для добавления пользователя в закрытый канал.
+# Сообщения со ссылкой и меню записываются в outbox в транзакции conn (если передано),
+# а ссылка-приглашение выдается при отправке - обработка платежа не ждет Telegram
+def add_user_to_channel(user_id, conn=None, dedup_key: str = None):
+    try:
+        # Без conn - своя транзакция, которая фиксируется при выходе из блока
+        with storage.connection(storage.partition_of(user_id), conn) as conn:
+            # Проверяем, есть ли уже запись в channel_members
+            # Дата окончания подписки должна быть установлена в main.py перед вызовом этой функции
+            existing_member = storage.member_subscription(user_id, conn)
+            
+            if existing_member:
+                logger.info(f"Пользователь {user_id} уже имеет запись в channel_members с датой окончания: {existing_member[1]}")
+            else:
+                # Fallback: если записи нет (не должно происходить при нормальной работе),
+                # получаем информацию о последнем платеже и рассчитываем дату
+                logger.warning(f"Запись channel_members для пользователя {user_id} не найдена, создаем fallback запись")
+                payment = storage.last_paid_payment(user_id, conn)
+                if payment:
+                    payment_id, _, timestamp, _, _, _, amount, currency, product_id, _ = payment
+                    # Определяем периодичность по стоимости
+                    periodicity = get_periodicity_by_amount(amount, currency, product_id)
+                    days = PERIOD_DAYS.get(periodicity, 30)
+                    try:
+                        # Используем timestamp из платежа (не идеально, но лучше чем ничего)
+                        end_date = (datetime.fromisoformat(timestamp.replace('Z', '+00:00')) + 
+                                   timedelta(days=days)).isoformat()
+                        logger.warning(f"Fallback расчет даты для {user_id}: стоимость {amount}, периодичность {periodicity}, дней {days}, окончание {end_date}")
+                    except Exception as e:
+                        logger.error(f"Ошибка при расчете даты окончания подписки: {str(e)}")
+                        end_date = (datetime.fromisoformat(timestamp.replace('Z', '+00:00')) + timedelta(days=30)).isoformat()
+                    # Добавляем запись в channel_members
+                    current_time = datetime.now(timezone.utc).isoformat()
+                    storage.activate_member(conn, user_id, current_time, end_date, payment_id)
+            # Сообщение с кнопкой для входа в канал, затем меню подписчика
+            enqueue(user_id, "channel_access", {}, conn, dedup_key and f"{dedup_key}:access")
+            enqueue_message(user_id, MENU_TEXT, conn, dedup_key and f"{dedup_key}:welcome", disable_web_page_preview=False)
+            enqueue(user_id, "main_menu", {}, conn, dedup_key and f"{dedup_key}:menu")
+        logger.info(f"Пользователь {user_id} добавлен в закрытый канал, ссылка поставлена в очередь отправки")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при добавлении пользователя {user_id} в канал: {str(e)}")
+        return False
+
+# Функция получения общей ссылки с заявкой на вступление в канал
+def get_join_request_link():
+    if JOIN_REQUEST_LINK:
+        return JOIN_REQUEST_LINK
+    
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT value FROM app_settings WHERE key = 'join_request_link'")
+        row = cursor.fetchone()
+        if row:
+            return row[0]
+        
+        # Ссылка создается один раз и дальше используется для всех подписчиков
+        invite_link = bot.create_chat_invite_link(
+            chat_id=CHANNEL_ID,
+            name="Подписчики",
+            creates_join_request=True
+        ).invite_link
+        # Если ссылку одновременно создал другой процесс, используем сохраненную им
+        cursor.execute('''
+        INSERT OR IGNORE INTO app_settings (key, value) VALUES ('join_request_link', ?)
+        ''', (invite_link,))
+        conn.commit()
+        cursor.execute("SELECT value FROM app_settings WHERE key = 'join_request_link'")
+        logger.info("Создана общая ссылка с заявкой на вступление в канал")
+        return cursor.fetchone()[0]
+    finally:
+        conn.close()
+
+
+# Обновляем функцию remove_user_from_channel
+def remove_user_from_channel(user_id):
+    try:
+        logger.info(f"Попытка удаления пользователя {user_id} из канала {CHANNEL_ID}")
+        
+        # Проверяем права бота в канале
+        try:
+            bot_member = bot.get_chat_member(CHANNEL_ID, bot.get_me().id)
+            logger.debug(f"Права бота в канале: {bot_member.status}")
+            if bot_member.status != 'administrator':
+                logger.error(f"Бот не является администратором канала {CHANNEL_ID}")
+                return False
+        except Exception as e:
+            logger.error(f"Ошибка при проверке прав бота в канале {CHANNEL_ID}: {e}")
+            return False
+        
+        # Проверяем текущий статус пользователя
+        try:
+            current_status = bot.get_chat_member(CHANNEL_ID, user_id)
+            logger.debug(f"Текущий статус пользователя {user_id} в канале: {current_status.status}")
+            
+            # Если пользователь уже не в канале, считаем операцию успешной
+            if current_status.status in ['left', 'kicked']:
+                logger.info(f"Пользователь {user_id} уже не в канале (статус: {current_status.status})")
+                return True
+        except Exception as e:
+            # Если не удалось получить статус, возможно пользователь уже удален
+            logger.warning(f"Не удалось получить статус пользователя {user_id} в канале: {e}")
+            # Продолжаем попытку удаления
+        
+        # Пытаемся удалить пользователя
+        try:
+            result = bot.ban_chat_member(CHANNEL_ID, user_id)
+            logger.info(f"Результат бана пользователя {user_id}: {result}")
+        except Exception as e:
+            logger.error(f"Ошибка при бане пользователя {user_id}: {e}")
+            return False
+        
+        # Сразу разбаниваем, чтобы пользователь мог вернуться после оплаты
+        try:
+            bot.unban_chat_member(CHANNEL_ID, user_id)
+            logger.info(f"Пользователь {user_id} разбанен для возможности повторного входа")
+        except Exception as e:
+            logger.warning(f"Не удалось разбанить пользователя {user_id}: {e}")
+            # Это не критично, продолжаем
+        
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при удалении пользователя {user_id} из канала: {str(e)}", exc_info=True)
+        return False
+
+
+# Функция для отправки уведомления администратору. Событие с видом category попадает
+# в сводку (admin_digest) одной строкой summary, срочное (critical) отправляется сразу
+def notify_admin(message, conn=None, dedup_key: str = None,
+                 category: str = None, summary: str = None, critical: bool = False):
+    if not ADMIN_ID:
+        logger.warning("ID администратора не указан. Уведомление не отправлено.")
+        return False
+
+    try:
+        if admin_digest.is_buffered(category, critical):
+            admin_digest.add_event(category, summary or message, conn, dedup_key)
+            logger.info(f"Событие для администратора добавлено в сводку: {category}")
+            return True
+        # Уведомление отправит outbox; с conn - в одной транзакции с изменением состояния
+        enqueue_message(ADMIN_ID, message, conn, dedup_key, parse_mode="HTML")
+        admin_digest.admin_notifications.inc(category=category or "other", delivery="immediate")
+        logger.info(f"Уведомление администратору поставлено в очередь: {message[:50]}...")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при отправке уведомления администратору: {str(e)}")
+        return False
+
+# Задача отправки накопленной сводки событий администратору
+def flush_admin_digest():
+    if ADMIN_ID:
+        admin_digest.flush_digest(ADMIN_ID)
+
+
+# Текст сообщения с главным меню
+MENU_TEXT = "⠀⠀⠀⠀⠀Меню подписчика⠀⠀⠀⠀⠀"
+
+# Функция для построения кнопок главного меню по статусу подписки
+def main_menu_markup(user_id) -> types.InlineKeyboardMarkup:
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    
+    # Проверяем статус подписки для определения доступных кнопок
+    subscription = check_subscription_status(user_id)
+    
+    # Общие кнопки
+    btn_about = types.InlineKeyboardButton('🔍 Подробнее о канале', callback_data='show_about')
+    
+    # Создаем кнопку поддержки только если SUPPORT_USERNAME задан
+    btn_support = None
+    if SUPPORT_USERNAME:
+        btn_support = types.InlineKeyboardButton('📞 Поддержка', url=f"https://t.me/{SUPPORT_USERNAME}")
+
+    if subscription["status"] in ["active", "cancelled"]:
+        # Кнопки для активной или отмененной подписки
+        btn_status = types.InlineKeyboardButton('ℹ️ Статус подписки', callback_data='show_status')
+        markup.add(btn_status)
+        
+        # Создаем кнопку перехода в канал только если CHANNEL_LINK задан
+        if CHANNEL_LINK:
+            btn_channel = types.InlineKeyboardButton('📺 Перейти в канал', url=CHANNEL_LINK)
+            markup.add(btn_channel)
+            
+        markup.add(btn_about)
+        if btn_support: # Добавляем кнопку поддержки, если она была создана
+            markup.add(btn_support)
+        
+    else:
+        # Кнопки для неактивной подписки
+        btn_subscribe = types.InlineKeyboardButton('💳 Оформить подписку', callback_data='show_subscribe')
+        btn_status = types.InlineKeyboardButton('ℹ️ Статус подписки', callback_data='show_status')
+        markup.add(btn_subscribe)
+        markup.add(btn_status)
+        markup.add(btn_about)
+        if btn_support: # Добавляем кнопку поддержки, если она была создана
+            markup.add(btn_support)
+    return markup
+
+# Функция для показа главного меню
+def show_main_menu(message):
+    markup = main_menu_markup(message.chat.id)
+        
+    # Отправляем меню отдельным сообщением
+    try:
+        bot.send_message( # Используем send_message для надежности
+            message.chat.id,
+            MENU_TEXT,
+            reply_markup=markup,
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при отправке главного меню пользователю {message.chat.id}: {str(e)}")
@@ -0,0 +1,185 @@
+import os
+import logging
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+import telebot
+from telebot import apihelper
+
+import metrics
+from database import DB_PATH
+
+# Общий клиент Telegram для процесса бота и воркеров API.
+# Экземпляр TeleBot создается при первом обращении, а не при импорте; в процессе API
+# на нем не регистрируются обработчики - он используется только для отправки сообщений.
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Адрес Bot API (для локальной заглушки Telegram при тестах)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
+# Общий для всех процессов лимит запросов к Telegram в секунду (0 - без ограничения)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+# Лимиты отправки в один чат: в личный чат - сообщений в секунду, в группу или канал - в минуту
+# (Telegram допускает около 1 сообщения в секунду в чат и 20 в минуту в группу; 0 - без ограничения)
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_RATE_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MINUTE", "20"))
+# Сколько сообщений подряд можно отправить в один чат без ожидания
+TELEGRAM_CHAT_BURST = max(1, int(os.getenv("TELEGRAM_CHAT_BURST", "3")))
+
+# Методы, которые не расходуют лимит на отправку сообщений
+UNLIMITED_METHODS = {"getUpdates", "getMe", "answerCallbackQuery", "getChatMember"}
+# Методы, которые кроме общего лимита расходуют лимит чата-получателя (помимо send*)
+CHAT_LIMITED_METHODS = {"copyMessage", "copyMessages", "forwardMessage", "forwardMessages"}
+
+logger = logging.getLogger("telegram_client")
+
+rate_limit_wait = metrics.histogram(
+    "telegram_rate_limit_wait_seconds", "Ожидание слота отправки в Telegram (по лимиту: chat или global)",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+too_many_requests = metrics.counter("telegram_429_total", "Ответы Telegram 429 Too Many Requests (по лимиту)")
+
+_bot = None
+_bot_lock = threading.Lock()
+_local = threading.local()
+
+def _get_connection() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = sqlite3.connect(DB_PATH, timeout=10, isolation_level=None)
+        # Состояние лимита не страшно потерять при сбое питания: коммит без fsync
+        conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+def chat_limit(chat_id) -> Optional[Tuple[str, float, int]]:
+    """Лимит чата: (имя строки состояния, запросов в секунду, сообщений без ожидания) или None"""
+    if chat_id is None:
+        return None
+    chat = str(chat_id)
+    # Отрицательный id или @username - группа или канал, положительный - личный чат
+    if chat.startswith("-") or chat.startswith("@"):
+        rate = TELEGRAM_GROUP_RATE_PER_MINUTE / 60
+    else:
+        rate = TELEGRAM_CHAT_RATE
+    if rate <= 0:
+        return None
+    return f"chat:{chat}", rate, TELEGRAM_CHAT_BURST
+
+def reserve_send_slot(name: str = "global", rate_per_second: float = None, burst: int = 1) -> float:
+    """
+    Резервирует слот отправки в общем для всех процессов лимите name и возвращает,
+    сколько секунд нужно подождать до него. Для лимита в SQLite хранится теоретическое
+    время следующего запроса (GCRA): первые burst запросов проходят без ожидания,
+    дальше - не чаще rate_per_second. Резервирование - одна атомарная команда UPSERT.
+    """
+    rate = TELEGRAM_GLOBAL_RATE if rate_per_second is None else rate_per_second
+    if rate <= 0:
+        return 0.0
+    interval = 1.0 / rate
+    now = time.time()
+    try:
+        row = _get_connection().execute('''
+        INSERT INTO telegram_rate_limit (name, next_at) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET next_at = MAX(next_at, ?) + ?
+        RETURNING next_at
+        ''', (name, now + interval, now, interval)).fetchone()
+    except sqlite3.Error as e:
+        # Лимит не должен мешать отправке: при ошибке БД отправляем без ожидания
+        logger.warning(f"Не удалось зарезервировать слот отправки в Telegram: {e}")
+        return 0.0
+    return max(0.0, row[0] - interval * burst - now)
+
+def wait_send_slot(chat_id=None) -> float:
+    """
+    Дожидается слота отправки: сначала в лимите чата chat_id, затем в общем лимите.
+    Общий слот берется только после ожидания чата, поэтому сообщение, ждущее свой чат,
+    не задерживает отправку в другие чаты. Возвращает общее время ожидания.
+    """
+    waited = 0.0
+    chat = chat_limit(chat_id)
+    if chat:
+        delay = reserve_send_slot(*chat)
+        rate_limit_wait.observe(delay, limit="chat")
+        if delay > 0:
+            time.sleep(delay)
+        waited += delay
+    delay = reserve_send_slot()
+    rate_limit_wait.observe(delay, limit="global")
+    if delay > 0:
+        time.sleep(delay)
+    return waited + delay
+
+def defer_sends(name: str, seconds: float, rate_per_second: float = None, burst: int = 1):
+    """Сдвигает лимит name во всех процессах: следующий запрос не раньше чем через seconds секунд"""
+    rate = TELEGRAM_GLOBAL_RATE if rate_per_second is None else rate_per_second
+    # Запас на burst: иначе сразу после паузы прошли бы несколько запросов подряд
+    next_at = time.time() + seconds + ((burst - 1) / rate if rate > 0 else 0)
+    try:
+        _get_connection().execute('''
+        INSERT INTO telegram_rate_limit (name, next_at) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET next_at = MAX(next_at, excluded.next_at)
+        ''', (name, next_at))
+    except sqlite3.Error as e:
+        logger.warning(f"Не удалось сдвинуть лимит отправки в Telegram: {e}")
+
+def cleanup_rate_limit_state() -> int:
+    """Удаляет состояние лимитов чатов, в которые давно ничего не отправлялось"""
+    cursor = _get_connection().execute(
+        "DELETE FROM telegram_rate_limit WHERE name != 'global' AND next_at < ?", (time.time() - 3600,)
+    )
+    return cursor.rowcount
+
+def _on_too_many_requests(response, chat_id):
+    # Telegram сообщает, сколько ждать: этот срок не отправляют и остальные процессы
+    try:
+        retry_after = float(response.json().get("parameters", {}).get("retry_after", 1))
+    except (ValueError, AttributeError):
+        retry_after = 1.0
+    chat = chat_limit(chat_id)
+    if chat:
+        name, rate, burst = chat
+    else:
+        name, rate, burst = "global", None, 1
+    too_many_requests.inc(limit=name.split(":", 1)[0])
+    logger.warning(f"Telegram ответил 429 ({name}), отправка приостановлена на {retry_after:g} с")
+    defer_sends(name, retry_after, rate, burst)
+
+def _make_rate_limited_sender(next_sender):
+    def sender(method, url, params=None, files=None, timeout=None, proxies=None):
+        method_name = url.rsplit("/", 1)[-1]
+        chat_id = None
+        if method_name not in UNLIMITED_METHODS:
+            if params and (method_name.startswith("send") or method_name in CHAT_LIMITED_METHODS):
+                chat_id = params.get("chat_id")
+            wait_send_slot(chat_id)
+        if next_sender:
+            response = next_sender(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+        else:
+            response = apihelper._get_req_session().request(
+                method, url, params=params, files=files, timeout=timeout, proxies=proxies
+            )
+        if getattr(response, "status_code", None) == 429:
+            _on_too_many_requests(response, chat_id)
+        return response
+    return sender
+
+def get_bot() -> telebot.TeleBot:
+    """Возвращает общий для процесса экземпляр TeleBot, создавая его при первом вызове"""
+    global _bot
+    if _bot is None:
+        with _bot_lock:
+            if _bot is None:
+                if TELEGRAM_API_URL:
+                    apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+                apihelper.CUSTOM_REQUEST_SENDER = _make_rate_limited_sender(apihelper.CUSTOM_REQUEST_SENDER)
+                _bot = telebot.TeleBot(BOT_TOKEN)
+    return _bot
+
+class _LazyBot:
+    """Заменяет экземпляр TeleBot в импортах: `from telegram_client import bot`"""
+
+    def __getattr__(self, name):
+        return getattr(get_bot(), name)
+
+bot = _LazyBot()
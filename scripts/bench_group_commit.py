@@ -0,0 +1,115 @@
+"""
+Сравнение пропускной способности записи вебхуков с групповой фиксацией и без нее.
+
+Для каждого режима (GROUP_COMMIT=true и false) запускает отдельный процесс, который
+обрабатывает --requests вебхуков payment.success так же, как обработчик /lava/payment:
+запись во входящие (webhook_inbox) в цикле событий, затем process_webhook в пуле потоков,
+не больше --concurrency одновременно. HTTP и Telegram не участвуют: измеряются только
+записи в БД (платеж, подписка, outbox, отметка об обработке).
+
+Запуск (использует БД из database.DB_PATH и шарды при SHARD_COUNT > 1, созданные записи
+удаляются после проверки):
+    python scripts/bench_group_commit.py --requests 2000 --concurrency 32
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(SCRIPTS_DIR, "..", "app")
+# Пользователи теста, по ним записи удаляются после проверки
+USER_ID_BASE = 970000000
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+def run_worker(requests_count: int, concurrency: int):
+    sys.path.insert(0, APP_DIR)
+    from database import ensure_schema
+    from bench_webhook import make_payload
+    import main
+    import group_commit
+
+    ensure_schema()
+    bodies = [json.dumps(make_payload(USER_ID_BASE + number)).encode() for number in range(requests_count)]
+    latencies = []
+
+    async def handle(body: bytes, limit: asyncio.Semaphore):
+        async with limit:
+            started = time.perf_counter()
+            received_at = datetime.now(timezone.utc)
+            inbox_id = await main.record_webhook(body, received_at)
+            result = await asyncio.to_thread(main.process_webhook, body, received_at, inbox_id)
+            if result["status"] != "success":
+                raise RuntimeError(result["message"])
+            latencies.append(time.perf_counter() - started)
+
+    async def run_all():
+        limit = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*(handle(body, limit) for body in bodies))
+
+    started = time.perf_counter()
+    asyncio.run(run_all())
+    elapsed = time.perf_counter() - started
+    group_commit.stop_writers(10)
+    batches = group_commit.batch_size.snapshot().get((), {"count": 0, "sum": 0})
+    print(json.dumps({
+        "elapsed": elapsed, "p50": percentile(latencies, 0.5), "p95": percentile(latencies, 0.95),
+        "transactions": batches["count"], "operations": batches["sum"],
+    }))
+
+def cleanup():
+    sys.path.insert(0, APP_DIR)
+    from database import DB_PATH, SHARD_COUNT, connect_shard
+    import sqlite3
+
+    emails = (f"{USER_ID_BASE}@t.me", f"{USER_ID_BASE + 10 ** 6}@t.me")
+    users = (str(USER_ID_BASE), str(USER_ID_BASE + 10 ** 6))
+    for shard in range(SHARD_COUNT):
+        conn = connect_shard(shard)
+        conn.execute("DELETE FROM main.payments WHERE buyer_email >= ? AND buyer_email < ?", emails)
+        conn.execute("DELETE FROM main.channel_members WHERE user_id >= ? AND user_id < ?", users)
+        conn.commit()
+        conn.close()
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute("DELETE FROM telegram_outbox WHERE chat_id >= ? AND chat_id < ?", users)
+    conn.execute("DELETE FROM admin_events WHERE summary >= ? AND summary < ?", users)
+    conn.commit()
+    conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.requests, args.concurrency)
+        return
+
+    command = [sys.executable, os.path.abspath(__file__), "--worker",
+               "--requests", str(args.requests), "--concurrency", str(args.concurrency)]
+    try:
+        for mode in ("false", "true"):
+            # Уведомления не отправляются: отправитель outbox в процессе теста не запускается
+            env = dict(os.environ, GROUP_COMMIT=mode, ADMIN_ID=os.getenv("ADMIN_ID", "1"))
+            output = subprocess.run(command, env=env, stdout=subprocess.PIPE, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            line = (f"GROUP_COMMIT={mode}: {args.requests / result['elapsed']:.1f} вебхуков/с, "
+                    f"p50 {result['p50'] * 1000:.0f} мс, p95 {result['p95'] * 1000:.0f} мс")
+            if result["transactions"]:
+                line += (f", транзакций записи: {result['transactions']} "
+                         f"(в среднем {result['operations'] / result['transactions']:.1f} операций)")
+            print(line)
+    finally:
+        cleanup()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Скорость разбора тела вебхука Lava для каждого типа события.
+
+Сравниваются прежний parse_raw (через str), model_validate_json из байтов и orjson.loads +
+model_validate (путь main.parse_webhook_payload; orjson входит в app/requirements.txt):
+    python scripts/bench_parse.py --iterations 50000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import warnings
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BASE_PAYLOAD = {
+    "product": {"id": "bench-product", "title": "Подписка"},
+    "buyer": {"email": "123456789@t.me"},
+    "contractId": "7a3c1f0e-5b2d-4c8e-9f6a-1d2e3f4a5b6c",
+    "amount": 500.0,
+    "currency": "RUB",
+    "timestamp": "2025-01-01T00:00:00.000000Z",
+}
+EVENT_PAYLOADS = {
+    "payment.success": {"status": "completed"},
+    "subscription.recurring.payment.success": {
+        "status": "subscription-active", "parentContractId": "2b4d6f8a-0c1e-4a3b-8d5f-7e9a1c3b5d7f",
+    },
+    "subscription.cancelled": {
+        "status": "subscription-cancelled", "cancelledAt": "2025-01-02T00:00:00Z",
+        "willExpireAt": "2025-02-01T00:00:00Z",
+    },
+    "payment.failed": {"status": "failed", "errorMessage": "Insufficient funds"},
+}
+
+def measure(parse, body: bytes, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        parse(body)
+    return iterations / (time.perf_counter() - started)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=50000)
+    args = parser.parse_args()
+
+    sys.path.insert(0, APP_DIR)
+    from main import WebhookPayload
+
+    methods = [
+        ("parse_raw", lambda body: WebhookPayload.parse_raw(body.decode("utf-8"))),
+        ("model_validate_json", WebhookPayload.model_validate_json),
+    ]
+    if orjson is not None:
+        methods.append(("orjson", lambda body: WebhookPayload.model_validate(orjson.loads(body))))
+    else:
+        print("orjson не установлен, путь orjson пропущен")
+    # parse_raw в pydantic v2 устарел и на каждый вызов выдает предупреждение
+    warnings.simplefilter("ignore", DeprecationWarning)
+
+    for event_type, fields in EVENT_PAYLOADS.items():
+        body = json.dumps(dict(BASE_PAYLOAD, eventType=event_type, **fields)).encode()
+        results = [f"{name} {measure(parse, body, args.iterations):,.0f}/с" for name, parse in methods]
+        print(f"{event_type}: {', '.join(results)}")
+
+if __name__ == "__main__":
+    main()
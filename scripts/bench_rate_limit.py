@@ -0,0 +1,119 @@
+"""
+Проверка общего лимита отправки в Telegram на нескольких процессах.
+
+Запускает --processes процессов по --threads потоков, которые --duration секунд «отправляют»
+сообщения в --chats чатов через telegram_client.reserve_send_slot (без обращения к Telegram).
+Проверяет, что ни в одном окне в 1 секунду общий лимит не превышен, а в каждый чат
+отправлено не больше, чем разрешает его лимит, и показывает время резервирования слота.
+
+Запуск (использует БД из database.DB_PATH, состояние лимитов удаляется после проверки):
+    python scripts/bench_rate_limit.py --processes 4 --threads 8 --chats 50 --duration 10
+"""
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+from bisect import bisect_right
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+def run_worker(threads: int, chats: int, duration: float):
+    sys.path.insert(0, APP_DIR)
+    from database import ensure_schema
+    import telegram_client
+
+    ensure_schema()
+    output_lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def send(offset: int):
+        number = offset
+        while time.time() < deadline:
+            # Личные чаты с положительным id, каждый пятидесятый запрос - в группу
+            chat = -1000 - number % 3 if number % 50 == 0 else 100000 + number % chats
+            # То же, что telegram_client.wait_send_slot, но с замером времени резервирования
+            reserve_seconds = delay = 0.0
+            for limit in (telegram_client.chat_limit(chat), ("global",)):
+                started = time.perf_counter()
+                limit_delay = telegram_client.reserve_send_slot(*limit)
+                reserve_seconds += time.perf_counter() - started
+                if limit_delay > 0:
+                    time.sleep(limit_delay)
+                delay += limit_delay
+            with output_lock:
+                print(f"{chat} {time.time():.4f} {reserve_seconds:.6f} {delay:.4f}", flush=True)
+            number += threads
+
+    workers = [threading.Thread(target=send, args=(offset,)) for offset in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+def max_in_window(moments, window: float) -> int:
+    moments = sorted(moments)
+    return max((bisect_right(moments, moment + window - 1e-9) - index for index, moment in enumerate(moments)), default=0)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.threads, args.chats, args.duration)
+        return
+
+    sys.path.insert(0, APP_DIR)
+    import telegram_client
+    from database import DB_PATH
+    import sqlite3
+
+    command = [sys.executable, os.path.abspath(__file__), "--worker", "--threads", str(args.threads),
+               "--chats", str(args.chats), "--duration", str(args.duration)]
+    processes = [subprocess.Popen(command, stdout=subprocess.PIPE, text=True) for _ in range(args.processes)]
+    sends = []
+    for process in processes:
+        for line in process.stdout:
+            chat, moment, reserve_seconds, delay = line.split()
+            sends.append((chat, float(moment), float(reserve_seconds), float(delay)))
+        process.wait()
+
+    global_rate = telegram_client.TELEGRAM_GLOBAL_RATE
+    print(f"отправок: {len(sends)}, общий лимит {global_rate:g}/с, "
+          f"максимум за 1 с: {max_in_window([moment for _, moment, _, _ in sends], 1.0)}")
+
+    # В чат за окно можно отправить burst сообщений сразу и еще rate * окно
+    violations = 0
+    by_chat = {}
+    for chat, moment, _, _ in sends:
+        by_chat.setdefault(chat, []).append(moment)
+    for chat, moments in by_chat.items():
+        _, rate, burst = telegram_client.chat_limit(chat)
+        window = max(1.0, 1 / rate)
+        if max_in_window(moments, window) > burst + rate * window + 1e-6:
+            violations += 1
+    print(f"чатов: {len(by_chat)}, чатов с превышением лимита: {violations}")
+
+    reserve = [reserve_seconds * 1000 for _, _, reserve_seconds, _ in sends]
+    delays = [delay for _, _, _, delay in sends]
+    print(f"резервирование слота: p50 {percentile(reserve, 0.5):.2f} мс, p95 {percentile(reserve, 0.95):.2f} мс, "
+          f"p99 {percentile(reserve, 0.99):.2f} мс")
+    print(f"ожидание слота: p50 {percentile(delays, 0.5):.2f} с, p95 {percentile(delays, 0.95):.2f} с")
+
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute("DELETE FROM telegram_rate_limit WHERE name LIKE 'chat:%'")
+    conn.commit()
+    conn.close()
+
+if __name__ == "__main__":
+    main()
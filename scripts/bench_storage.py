@@ -0,0 +1,173 @@
+"""
+Сравнение хранилищ данных пользователей (STORAGE_BACKEND=sqlite и postgres) на двух нагрузках.
+
+Вебхуки: --requests вебхуков payment.success, как в обработчике /lava/payment (запись во
+входящие в цикле событий, затем process_webhook в пуле потоков, не больше --concurrency
+одновременно). Проверка сроков: --members участников с истекшей подпиской, затем
+check_subscription_expiration бота. Половина участников вышла из канала, половина в нем;
+у половины закончился льготный период (перевод в removed и уведомления), у остальных -
+нет (напоминание). Telegram не вызывается: статус в канале и удаление подменяются.
+
+Для каждого хранилища запускается отдельный процесс. Проверка сроков обходит только
+участников теста. Используются БД из database.DB_PATH и PostgreSQL из DATABASE_URL
+(таблицы создаются при первом подключении), созданные записи удаляются после проверки:
+    DATABASE_URL=postgresql://postgres@localhost:5432/lava python scripts/bench_storage.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(SCRIPTS_DIR, "..", "app")
+# Пользователи теста вебхуков и проверки сроков, по ним записи удаляются после проверки
+WEBHOOK_USER_BASE = 960000000
+EXPIRY_USER_BASE = 961000000
+USER_RANGE = (str(WEBHOOK_USER_BASE), str(EXPIRY_USER_BASE + 10 ** 6))
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+def run_webhooks(requests_count: int, concurrency: int) -> dict:
+    from bench_webhook import make_payload
+    import main
+
+    bodies = [json.dumps(make_payload(WEBHOOK_USER_BASE + number)).encode() for number in range(requests_count)]
+    latencies = []
+
+    async def handle(body: bytes, limit: asyncio.Semaphore):
+        async with limit:
+            started = time.perf_counter()
+            received_at = datetime.now(timezone.utc)
+            inbox_id = await main.record_webhook(body, received_at)
+            result = await asyncio.to_thread(main.process_webhook, body, received_at, inbox_id)
+            if result["status"] != "success":
+                raise RuntimeError(result["message"])
+            latencies.append(time.perf_counter() - started)
+
+    async def run_all():
+        limit = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*(handle(body, limit) for body in bodies))
+
+    started = time.perf_counter()
+    asyncio.run(run_all())
+    return {"elapsed": time.perf_counter() - started, "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95)}
+
+def run_expiry(members_count: int) -> dict:
+    from types import SimpleNamespace
+    import bot
+    from storage import storage
+
+    now = datetime.now(timezone.utc)
+    users = [str(EXPIRY_USER_BASE + number) for number in range(members_count)]
+    for user_id in users:
+        # Каждый второй - после льготного периода, остальные - в нем
+        days = bot.GRACE_PERIOD_DAYS + 1 if int(user_id) % 4 < 2 else 1
+        storage.write(user_id, lambda conn, user_id=user_id, days=days: storage.activate_member(
+            conn, user_id, (now - timedelta(days=40)).isoformat(), (now - timedelta(days=days)).isoformat(), None
+        ))
+
+    members_to_check = storage.members_to_check
+    test_users = set(users)
+    storage.members_to_check = lambda: [member for member in members_to_check() if member[0] in test_users]
+    bot.bot.get_chat_member = lambda chat_id, user_id: SimpleNamespace(
+        status="left" if int(user_id) % 2 == 0 else "member"
+    )
+    bot.remove_user_from_channel = lambda user_id: True
+    bot.scheduler.should_continue = lambda lease=None: True
+
+    started = time.perf_counter()
+    bot.check_subscription_expiration()
+    elapsed = time.perf_counter() - started
+    statuses = {}
+    for user_id in users:
+        status = storage.member_status(user_id)
+        statuses[status] = statuses.get(status, 0) + 1
+    return {"elapsed": elapsed, "statuses": statuses}
+
+def run_worker(requests_count: int, concurrency: int, members_count: int):
+    sys.path.insert(0, APP_DIR)
+    from database import ensure_schema
+    import group_commit
+    from storage import storage
+
+    ensure_schema()
+    result = {"webhooks": run_webhooks(requests_count, concurrency), "expiry": run_expiry(members_count)}
+    result["relayed"] = storage.relay_staged()
+    group_commit.stop_writers(10)
+    print(json.dumps(result))
+
+def cleanup(backend: str):
+    env = dict(os.environ, STORAGE_BACKEND=backend)
+    subprocess.run([sys.executable, os.path.abspath(__file__), "--cleanup"], env=env, check=True)
+
+def run_cleanup():
+    sys.path.insert(0, APP_DIR)
+    from database import DB_PATH, SHARD_COUNT, connect_shard
+    from storage import storage
+    import sqlite3
+
+    emails = tuple(f"{user_id}@t.me" for user_id in USER_RANGE)
+    if storage.name == "postgres":
+        with storage.connection() as conn:
+            conn.execute("DELETE FROM payments WHERE buyer_email >= %s AND buyer_email < %s", emails)
+            for table in ("channel_members", "subscription_reminders", "invoice_cache"):
+                conn.execute(f"DELETE FROM {table} WHERE user_id >= %s AND user_id < %s", USER_RANGE)
+            conn.execute("DELETE FROM telegram_outbox WHERE chat_id >= %s AND chat_id < %s", USER_RANGE)
+            conn.execute("DELETE FROM admin_events WHERE summary >= %s AND summary < %s", USER_RANGE)
+        storage.rebuild_stats()
+    else:
+        for shard in range(SHARD_COUNT):
+            conn = connect_shard(shard)
+            conn.execute("DELETE FROM main.payments WHERE buyer_email >= ? AND buyer_email < ?", emails)
+            for table in ("channel_members", "subscription_reminders", "invoice_cache"):
+                conn.execute(f"DELETE FROM main.{table} WHERE user_id >= ? AND user_id < ?", USER_RANGE)
+            conn.commit()
+            conn.close()
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute("DELETE FROM telegram_outbox WHERE chat_id >= ? AND chat_id < ?", USER_RANGE)
+    conn.execute("DELETE FROM admin_events WHERE summary >= ? AND summary < ?", USER_RANGE)
+    conn.commit()
+    conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--backends", default="sqlite,postgres")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--cleanup", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.requests, args.concurrency, args.members)
+        return
+    if args.cleanup:
+        run_cleanup()
+        return
+
+    command = [sys.executable, os.path.abspath(__file__), "--worker", "--requests", str(args.requests),
+               "--concurrency", str(args.concurrency), "--members", str(args.members)]
+    for backend in args.backends.split(","):
+        # Уведомления не отправляются: отправитель outbox в процессе теста не запускается
+        env = dict(os.environ, STORAGE_BACKEND=backend, ADMIN_ID=os.getenv("ADMIN_ID", "1"))
+        try:
+            output = subprocess.run(command, env=env, stdout=subprocess.PIPE, text=True, check=True).stdout
+        finally:
+            cleanup(backend)
+        result = json.loads(output.strip().splitlines()[-1])
+        webhooks, expiry = result["webhooks"], result["expiry"]
+        print(f"{backend}: вебхуки {args.requests / webhooks['elapsed']:.1f}/с, "
+              f"p50 {webhooks['p50'] * 1000:.0f} мс, p95 {webhooks['p95'] * 1000:.0f} мс; "
+              f"проверка сроков {args.members / expiry['elapsed']:.1f} участников/с "
+              f"({expiry['elapsed']:.2f} с, статусы {expiry['statuses']})")
+
+if __name__ == "__main__":
+    main()
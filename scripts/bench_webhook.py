@@ -0,0 +1,116 @@
+"""
+Нагрузочный тест вебхука /lava/payment.
+
+Запуск сервера (например, с 4 воркерами и заглушкой Telegram из этого скрипта):
+    TELEGRAM_API_URL=http://127.0.0.1:8081 TELEGRAM_GLOBAL_RATE=0 TELEGRAM_CHAT_RATE=0 BOT_TOKEN=1:test \
+        uvicorn main:app --port 8000 --workers 4
+Запуск теста:
+    python scripts/bench_webhook.py --requests 2000 --concurrency 32 --fake-telegram-port 8081
+"""
+import argparse
+import itertools
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    """Отвечает на любой метод Bot API успешным результатом с задержкой, как настоящий Telegram"""
+    delay = 0.03
+    message_ids = itertools.count(1)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        time.sleep(self.delay)
+        method = self.path.split("?", 1)[0].rsplit("/", 1)[-1]
+        if method == "createChatInviteLink":
+            result = {"invite_link": f"https://t.me/+{uuid.uuid4().hex[:12]}",
+                      "creator": {"id": 1, "is_bot": True, "first_name": "bot"},
+                      "creates_join_request": False, "is_primary": False, "is_revoked": False}
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bot", "username": "bot"}
+        elif method == "getChatMember":
+            result = {"user": {"id": 1, "is_bot": True, "first_name": "bot"}, "status": "administrator"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = {"message_id": next(self.message_ids), "date": 0, "chat": {"id": 1, "type": "private"}}
+        else:
+            result = True
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+def make_payload(user_id: int) -> dict:
+    return {
+        "eventType": "payment.success",
+        "product": {"id": "bench-product", "title": "Подписка"},
+        "buyer": {"email": f"{user_id}@t.me"},
+        "contractId": str(uuid.uuid4()),
+        "amount": 500,
+        "currency": "RUB",
+        "timestamp": "2024-01-01T00:00:00Z",
+        "status": "completed",
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000/lava/payment")
+    parser.add_argument("--user", default="admin")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--first-user-id", type=int, default=10_000_000)
+    parser.add_argument("--fake-telegram-port", type=int, default=0,
+                        help="запустить заглушку Telegram Bot API на этом порту")
+    parser.add_argument("--fake-telegram-delay", type=float, default=0.03)
+    args = parser.parse_args()
+
+    if args.fake_telegram_port:
+        FakeTelegramHandler.delay = args.fake_telegram_delay
+        server = ThreadingHTTPServer(("127.0.0.1", args.fake_telegram_port), FakeTelegramHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    local = threading.local()
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def send(i):
+        nonlocal errors
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+            session.auth = (args.user, args.password)
+        started = time.perf_counter()
+        try:
+            ok = session.post(args.url, json=make_payload(args.first_user_id + i), timeout=60).status_code == 200
+        except requests.RequestException:
+            ok = False
+        with lock:
+            latencies.append(time.perf_counter() - started)
+            errors += 0 if ok else 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(send, range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"запросов: {args.requests}, ошибок: {errors}, время: {elapsed:.1f} с")
+    print(f"пропускная способность: {args.requests / elapsed:.1f} запросов/с")
+    print(f"задержка: p50 {latencies[len(latencies) // 2] * 1000:.0f} мс, "
+          f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.0f} мс")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+# Файлы SQLite тестов - во временном каталоге; переменные задаются до импорта модулей app
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="lava-tests-")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ["STORAGE_BACKEND"] = "sqlite"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import database  # noqa: E402
+
+database.init_db()
+
+@pytest.fixture(scope="session")
+def postgres_schema():
+    """
+    Возвращает функцию, которая создает отдельную схему PostgreSQL и строку подключения
+    к ней (схемы удаляются в конце сессии). Без DATABASE_URL тесты PostgreSQL пропускаются.
+    """
+    url = os.getenv("DATABASE_URL")
+    if not url:
+        pytest.skip("DATABASE_URL не задан: тесты PostgreSQL пропущены")
+    psycopg = pytest.importorskip("psycopg")
+    from psycopg.conninfo import make_conninfo
+
+    schemas = []
+
+    def create() -> str:
+        schema = f"lava_test_{uuid.uuid4().hex[:12]}"
+        with psycopg.connect(url, autocommit=True) as conn:
+            conn.execute(f"CREATE SCHEMA {schema}")
+        schemas.append(schema)
+        return make_conninfo(url, options=f"-c search_path={schema}")
+
+    yield create
+    with psycopg.connect(url, autocommit=True) as conn:
+        for schema in schemas:
+            conn.execute(f"DROP SCHEMA {schema} CASCADE")
+
+@pytest.fixture(scope="session")
+def sqlite_storage():
+    from storage import SqliteStorage
+    return SqliteStorage()
+
+@pytest.fixture(scope="session")
+def postgres_storage(postgres_schema):
+    from storage import PostgresStorage
+    storage = PostgresStorage(postgres_schema(), min_size=1, max_size=4)
+    yield storage
+    storage.close()
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def backend(request, monkeypatch):
+    """Хранилище; outbox и сводка пишут промежуточные строки в него же"""
+    storage = request.getfixturevalue(f"{request.param}_storage")
+    import admin_digest
+    import outbox
+    monkeypatch.setattr(outbox, "storage", storage)
+    monkeypatch.setattr(admin_digest, "storage", storage)
+    return storage
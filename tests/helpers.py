@@ -0,0 +1,43 @@
+"""Общие данные тестов: номера пользователей, платежи и подписки"""
+import itertools
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta, timezone
+
+# Номера пользователей тестов не пересекаются между тестами и запусками
+_user_ids = itertools.count(int(time.time()) * 100)
+
+def new_user() -> str:
+    return str(next(_user_ids))
+
+def iso(days: float = 0) -> str:
+    return (datetime.now(timezone.utc) + timedelta(days=days)).isoformat()
+
+def payment(user_id, event_type: str = "payment.success", amount: float = 500.0,
+            contract_id: str = None, parent_contract_id: str = None) -> dict:
+    now = iso()
+    return {
+        "event_type": event_type,
+        "product_id": "test-product",
+        "product_title": "Подписка",
+        "buyer_email": f"{user_id}@t.me",
+        "contract_id": contract_id or str(uuid.uuid4()),
+        "parent_contract_id": parent_contract_id,
+        "amount": amount,
+        "currency": "RUB",
+        "timestamp": now,
+        "status": "completed",
+        "error_message": None,
+        "raw_data": zlib.compress(f'{{"eventType": "{event_type}"}}'.encode()),
+        "received_at": now,
+    }
+
+def subscribe(storage, user_id, end_date: str = None) -> int:
+    """Первый платеж: запись платежа и активная подписка (как обработчик payment.success)"""
+    def operation(conn):
+        payment_id = storage.insert_payment(conn, payment(user_id))
+        storage.activate_member(conn, user_id, iso(), end_date or iso(30), payment_id)
+        storage.clear_reminder(conn, user_id)
+        return payment_id
+    return storage.write(user_id, operation)
@@ -0,0 +1,17 @@
+"""Инициализация схемы: ошибка не скрывается, и run.py не запускает сервис без схемы"""
+import sqlite3
+
+import pytest
+
+import database
+
+def test_init_db_raises_on_error(monkeypatch):
+    def broken(cursor):
+        raise sqlite3.OperationalError("disk I/O error")
+    monkeypatch.setattr(database, "create_user_tables", broken)
+    with pytest.raises(sqlite3.OperationalError):
+        database.init_db()
+
+def test_init_db_is_idempotent():
+    database.init_db()
+    assert database.get_schema_version() == database.SCHEMA_VERSION
@@ -0,0 +1,62 @@
+"""Выгрузка /admin/export: соединение с шардом закрывается и при отключении клиента"""
+import asyncio
+import sqlite3
+
+import database
+import main
+from helpers import new_user, payment
+from storage import SqliteStorage
+
+class TrackedConnection(sqlite3.Connection):
+    opened = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.closed = False
+        TrackedConnection.opened.append(self)
+
+    def close(self):
+        self.closed = True
+        super().close()
+
+def add_payments(count: int):
+    storage = SqliteStorage()
+    user_id = new_user()
+    storage.write(user_id, lambda conn: [storage.insert_payment(conn, payment(user_id)) for _ in range(count)])
+
+def test_export_closes_connection_on_disconnect(monkeypatch):
+    add_payments(5)
+    TrackedConnection.opened.clear()
+    monkeypatch.setattr(main, "EXPORT_PAGE_SIZE", 2)
+    monkeypatch.setattr(
+        main, "connect_shard",
+        lambda shard, **kwargs: database.connect_shard(shard, factory=TrackedConnection, **kwargs)
+    )
+
+    # Ответ (StreamingResponse) держит генератор до конца запроса, поэтому и здесь
+    # ссылка на него сохраняется: соединение должно закрыться без сборки мусора
+    rows = main.iter_export_rows("payments", None, None, None, False, False)
+    formatted = main.format_export_stream(rows, "jsonl")
+
+    async def read_first_chunk():
+        chunks = main.stream_export(formatted)
+        first = await chunks.__anext__()
+        # Отключение клиента: Starlette закрывает поток ответа, не дочитав его
+        await chunks.aclose()
+        return first
+
+    assert asyncio.run(read_first_chunk())
+    assert len(TrackedConnection.opened) == 1
+    assert TrackedConnection.opened[0].closed
+
+def test_export_reads_all_pages(monkeypatch):
+    add_payments(5)
+    monkeypatch.setattr(main, "EXPORT_PAGE_SIZE", 2)
+
+    async def read_all():
+        rows = main.iter_export_rows("payments", None, None, "payment.success", False, False)
+        return [chunk async for chunk in main.stream_export(main.format_export_stream(rows, "csv"))]
+
+    lines = "".join(asyncio.run(read_all())).splitlines()
+    assert lines[0].startswith("id,")
+    assert len(lines) - 1 >= 5
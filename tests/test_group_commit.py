@@ -0,0 +1,95 @@
+"""Групповая фиксация (group_commit.py): ошибка операции откатывает только ее точку сохранения"""
+import sqlite3
+import uuid
+from concurrent.futures import Future
+
+import pytest
+
+import database
+from group_commit import GroupCommitWriter
+
+@pytest.fixture
+def table():
+    """Отдельная таблица теста в основной БД"""
+    name = f"group_commit_{uuid.uuid4().hex[:8]}"
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.execute(f"CREATE TABLE {name} (value TEXT UNIQUE NOT NULL)")
+    conn.commit()
+    conn.close()
+    return name
+
+def values(table: str) -> set:
+    conn = sqlite3.connect(database.DB_PATH)
+    try:
+        return {row[0] for row in conn.execute(f"SELECT value FROM {table}")}
+    finally:
+        conn.close()
+
+def insert(table: str, value: str, fail: bool = False):
+    def operation(conn):
+        conn.execute(f"INSERT INTO {table} (value) VALUES (?)", (value,))
+        if fail:
+            raise ValueError(f"ошибка операции {value}")
+        return value
+    return operation
+
+def commit_batch(operations: list, timeout: float = 30, cancelled: tuple = ()) -> list:
+    """Одна пачка писателя основной БД; cancelled - номера операций, отмененных до фиксации"""
+    batch = [(operation, Future()) for operation in operations]
+    for index in cancelled:
+        batch[index][1].cancel()
+    conn = sqlite3.connect(database.DB_PATH, timeout=timeout, isolation_level=None)
+    try:
+        GroupCommitWriter()._commit(conn, batch)
+    finally:
+        conn.close()
+    return [future for _, future in batch]
+
+def test_failed_operation_rolls_back_only_itself(table):
+    futures = commit_batch([
+        insert(table, "first"),
+        insert(table, "broken", fail=True),
+        insert(table, "first"),  # нарушение UNIQUE
+        insert(table, "last"),
+    ])
+
+    assert futures[0].result() == "first"
+    with pytest.raises(ValueError):
+        futures[1].result()
+    with pytest.raises(sqlite3.IntegrityError):
+        futures[2].result()
+    assert futures[3].result() == "last"
+    assert values(table) == {"first", "last"}
+
+def test_cancelled_operation_is_not_executed(table):
+    futures = commit_batch([insert(table, "cancelled"), insert(table, "kept")], cancelled=(0,))
+    assert futures[0].cancelled()
+    assert futures[1].result() == "kept"
+    assert values(table) == {"kept"}
+
+def test_locked_database_fails_whole_batch(table):
+    # Другое соединение держит блокировку записи: BEGIN IMMEDIATE пачки не проходит
+    holder = sqlite3.connect(database.DB_PATH, isolation_level=None)
+    holder.execute("BEGIN IMMEDIATE")
+    try:
+        futures = commit_batch([insert(table, "a"), insert(table, "b")], timeout=0.1)
+    finally:
+        holder.execute("ROLLBACK")
+        holder.close()
+    for future in futures:
+        with pytest.raises(sqlite3.OperationalError):
+            future.result()
+    assert values(table) == set()
+
+def test_writer_thread_commits_and_stops(table):
+    writer = GroupCommitWriter(max_delay_ms=20)
+    futures = [writer.submit(insert(table, str(index))) for index in range(10)]
+    futures.append(writer.submit(insert(table, "0")))
+    assert [future.result(5) for future in futures[:10]] == [str(index) for index in range(10)]
+    with pytest.raises(sqlite3.IntegrityError):
+        futures[10].result(5)
+
+    assert writer.stop(5)
+    # Остановленный писатель выполняет операции сразу, в вызывающем потоке
+    assert writer.run(insert(table, "after_stop")) == "after_stop"
+    assert values(table) == {str(index) for index in range(10)} | {"after_stop"}
@@ -0,0 +1,68 @@
+"""Пул ссылок-приглашений: выдача, пополнение и отзыв устаревших ссылок"""
+import itertools
+from types import SimpleNamespace
+
+import invite_pool
+from database import acquire_connection, release_connection
+from helpers import iso, new_user, subscribe
+from storage import SqliteStorage
+
+class FakeBot:
+    def __init__(self):
+        self.numbers = itertools.count()
+        self.created = []
+        self.revoked = []
+
+    def create_chat_invite_link(self, chat_id, member_limit, expire_date):
+        assert member_limit == 1
+        link = SimpleNamespace(invite_link=f"https://t.me/+test{next(self.numbers)}-{new_user()}")
+        self.created.append((link.invite_link, expire_date))
+        return link
+
+    def revoke_chat_invite_link(self, chat_id, invite_link):
+        self.revoked.append(invite_link)
+
+def link_state(invite_link: str):
+    conn = acquire_connection()
+    try:
+        return conn.execute(
+            'SELECT issued_to, revoked_at FROM invite_links WHERE invite_link = ?', (invite_link,)
+        ).fetchone()
+    finally:
+        release_connection(conn)
+
+def test_issued_links_are_revoked(monkeypatch):
+    bot = FakeBot()
+    monkeypatch.setattr(invite_pool, "target_pool_size", lambda: len(bot.created) + 3)
+    assert invite_pool.refill_invite_pool(bot, "-100") == 3
+
+    paid_user, expired_user = new_user(), new_user()
+    subscribe(SqliteStorage(), paid_user)
+    subscribe(SqliteStorage(), expired_user, iso(-1))
+    paid_link = invite_pool.take_invite_link(paid_user)
+    expired_link = invite_pool.take_invite_link(expired_user)
+    assert paid_link != expired_link
+    assert link_state(paid_link)[0] == paid_user
+
+    # У получателя нет доступа - ссылка отзывается сразу
+    invite_pool.revoke_stale_invite_links(bot, "-100")
+    assert expired_link in bot.revoked
+    assert paid_link not in bot.revoked
+    assert link_state(expired_link)[1] is not None
+    assert link_state(paid_link)[1] is None
+
+    # Ссылка, которой не воспользовались за INVITE_LINK_ISSUED_TTL_HOURS, отзывается и при доступе
+    monkeypatch.setattr(invite_pool, "INVITE_LINK_ISSUED_TTL_HOURS", 1e-9)
+    invite_pool.revoke_stale_invite_links(bot, "-100")
+    assert paid_link in bot.revoked
+    assert bot.revoked.count(expired_link) == 1
+
+def test_directly_created_link_is_tracked(monkeypatch):
+    bot = FakeBot()
+    user_id = new_user()
+    invite_link = bot.create_chat_invite_link("-100", 1, 0).invite_link
+    invite_pool.record_issued_link(user_id, invite_link, bot.created[-1][1] + 10 ** 10)
+    assert link_state(invite_link) == (user_id, None)
+
+    invite_pool.revoke_stale_invite_links(bot, "-100")
+    assert invite_link in bot.revoked
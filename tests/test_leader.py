@@ -0,0 +1,123 @@
+"""
+Аренда ведущего (leader.py): номер аренды растет при смене владельца, и бывший ведущий
+с устаревшим номером не проходит проверку. Последний тест запускает два процесса-претендента
+на общей временной БД: ведущего приостанавливают (SIGSTOP) и затем останавливают штатно (SIGTERM).
+"""
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import leader
+
+APP_DIR = os.path.dirname(os.path.abspath(leader.__file__))
+
+# Претендент: держит аренду и каждые 0.05 с печатает номер аренды и результат проверки по БД
+WORKER = '''
+import signal, sys, threading, time
+sys.path.insert(0, sys.argv[1])
+import leader
+elector = leader.LeaderElector()
+elector.add(sys.argv[2])
+stop = threading.Event()
+signal.signal(signal.SIGTERM, lambda *_: stop.set())
+elector.start()
+while not stop.wait(0.05):
+    print(leader.HOLDER_ID, elector.token(sys.argv[2]), elector.verify(sys.argv[2]), flush=True)
+elector.stop()
+'''
+
+def lease_name() -> str:
+    return f"test_{uuid.uuid4().hex[:8]}"
+
+def test_takeover_increments_token_and_rejects_stale_holder():
+    name = lease_name()
+    first = leader.try_acquire(name, "holder-a", ttl=0.3)
+    assert first is not None
+    # Пока аренда действует, другой претендент ее не получает, а владелец продлевает с тем же номером
+    assert leader.try_acquire(name, "holder-b", ttl=0.3) is None
+    assert leader.try_acquire(name, "holder-a", ttl=0.3) == first
+
+    time.sleep(0.4)
+    second = leader.try_acquire(name, "holder-b", ttl=5)
+    assert second == first + 1
+    assert not leader.holds_lease(name, first, "holder-a")
+    assert leader.holds_lease(name, second, "holder-b")
+    # Бывший владелец не может продлить аренду, пока ее держит другой
+    assert leader.try_acquire(name, "holder-a", ttl=5) is None
+
+def test_release_hands_lease_over_immediately():
+    name = lease_name()
+    token = leader.try_acquire(name, "holder-a", ttl=60)
+    leader.release(name, "holder-a")
+    assert not leader.holds_lease(name, token, "holder-a")
+    assert leader.try_acquire(name, "holder-b", ttl=60) == token + 1
+
+class Holder:
+    """Процесс-претендент и последнее состояние, которое он напечатал"""
+
+    def __init__(self, name: str):
+        env = dict(os.environ, LEADER_LEASE_TTL="3", LEADER_HEARTBEAT="0.1")
+        self.process = subprocess.Popen(
+            [sys.executable, "-c", WORKER, APP_DIR, name],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, env=env
+        )
+        self.holder_id = None
+        self.states = []
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        for line in self.process.stdout:
+            holder_id, token, verified = line.split()
+            self.holder_id = holder_id
+            self.states.append((None if token == "None" else int(token), verified == "True"))
+
+    def wait_for(self, condition, timeout: float = 15):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.states and condition(*self.states[-1]):
+                return self.states[-1]
+            time.sleep(0.05)
+        raise AssertionError(f"состояние не достигнуто, последнее: {self.states[-1:]}")
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGCONT)
+            self.process.terminate()
+        self.process.wait(10)
+
+def test_failover_between_processes():
+    name = lease_name()
+    first = Holder(name)
+    second = None
+    try:
+        first_token, _ = first.wait_for(lambda token, verified: token is not None and verified)
+
+        second = Holder(name)
+        second.wait_for(lambda token, verified: token is None)
+
+        # Ведущий «засыпает»: аренда истекает, и ее забирает второй процесс с большим номером
+        first.process.send_signal(signal.SIGSTOP)
+        second_token, _ = second.wait_for(lambda token, verified: token is not None and verified)
+        assert second_token > first_token
+        assert not leader.holds_lease(name, first_token, first.holder_id)
+
+        # Проснувшийся бывший ведущий с устаревшим номером проверку не проходит и уступает
+        first.states.clear()
+        first.process.send_signal(signal.SIGCONT)
+        first.wait_for(lambda token, verified: token is None)
+        assert all(not verified for token, verified in first.states)
+
+        # Штатная остановка освобождает аренду сразу, не дожидаясь истечения
+        stopped_at = time.monotonic()
+        second.stop()
+        third_token, _ = first.wait_for(lambda token, verified: token is not None and verified)
+        assert third_token > second_token
+        assert time.monotonic() - stopped_at < 2
+    finally:
+        first.stop()
+        if second is not None:
+            second.stop()
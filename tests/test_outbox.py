@@ -0,0 +1,122 @@
+"""Outbox (outbox.py): дедупликация, выдача по одному сообщению на чат и задержка повторов"""
+import sqlite3
+import time
+
+import pytest
+from telebot.apihelper import ApiTelegramException
+
+import database
+import outbox
+from helpers import new_user
+
+@pytest.fixture(autouse=True)
+def idle_outbox():
+    """Сообщения других тестов не должны попасть в выдачу: отмечаем их отправленными"""
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.execute("UPDATE telegram_outbox SET status = 'sent' WHERE status IN ('pending', 'sending')")
+    conn.commit()
+    conn.close()
+
+def row(outbox_id: int) -> tuple:
+    conn = sqlite3.connect(database.DB_PATH)
+    try:
+        return conn.execute(
+            "SELECT status, attempts, next_attempt_at, last_error FROM telegram_outbox WHERE id = ?", (outbox_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+
+def set_columns(outbox_id: int, **columns):
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.execute(
+        f"UPDATE telegram_outbox SET {', '.join(f'{name} = ?' for name in columns)} WHERE id = ?",
+        tuple(columns.values()) + (outbox_id,)
+    )
+    conn.commit()
+    conn.close()
+
+def telegram_error(code: int, **parameters) -> ApiTelegramException:
+    result = {"ok": False, "error_code": code, "description": "test"}
+    if parameters:
+        result["parameters"] = parameters
+    return ApiTelegramException("sendMessage", None, result)
+
+def test_enqueue_deduplicates_by_key():
+    chat = new_user()
+    assert outbox.enqueue_message(chat, "первое", dedup_key=f"test:{chat}")
+    assert not outbox.enqueue_message(chat, "повтор", dedup_key=f"test:{chat}")
+    # Без ключа дедупликации сообщения не склеиваются
+    assert outbox.enqueue_message(chat, "без ключа")
+    assert outbox.enqueue_message(chat, "без ключа")
+    conn = sqlite3.connect(database.DB_PATH)
+    try:
+        payloads = [payload for (payload,) in conn.execute(
+            "SELECT payload FROM telegram_outbox WHERE chat_id = ? ORDER BY id", (chat,)
+        )]
+    finally:
+        conn.close()
+    assert len(payloads) == 3 and "первое" in payloads[0]
+
+def test_claim_takes_one_message_per_chat_in_order():
+    first_chat, second_chat = new_user(), new_user()
+    outbox.enqueue_message(first_chat, "1")
+    outbox.enqueue_message(first_chat, "2")
+    outbox.enqueue_message(second_chat, "3")
+
+    claimed = outbox.claim_batch(10)
+    assert [(chat_id, payload) for _, chat_id, _, payload, _, _ in claimed] == [
+        (first_chat, '{"text": "1"}'), (second_chat, '{"text": "3"}')
+    ]
+    assert all(attempts == 1 for *_, attempts, _ in claimed)
+    assert row(claimed[0][0])[0] == "sending"
+    # Пока первое сообщение чата не отправлено, второе не выдается
+    assert outbox.claim_batch(10) == []
+
+    outbox._update(claimed[0][0], "status = 'sent'", ())
+    [(_, chat_id, _, payload, _, _)] = outbox.claim_batch(10)
+    assert (chat_id, payload) == (first_chat, '{"text": "2"}')
+
+def test_expired_claim_is_taken_again():
+    chat = new_user()
+    outbox.enqueue_message(chat, "текст")
+    [(outbox_id, *_)] = outbox.claim_batch(10)
+    assert outbox.claim_batch(10) == []
+
+    # Отправитель упал, не отметив результат: после CLAIM_TTL сообщение забирает другой
+    set_columns(outbox_id, claimed_until=time.time() - 1)
+    [(claimed_id, _, _, _, attempts, _)] = outbox.claim_batch(10)
+    assert (claimed_id, attempts) == (outbox_id, 2)
+
+def test_failed_send_is_retried_later_or_failed():
+    chat = new_user()
+    outbox.enqueue_message(chat, "повтор")
+    outbox.enqueue_message(chat, "окончательная ошибка", dedup_key=f"failed:{chat}")
+    [(outbox_id, _, _, _, attempts, _)] = outbox.claim_batch(10)
+
+    outbox.sender._fail(outbox_id, chat, attempts, telegram_error(429, retry_after=30))
+    status, _, next_attempt_at, last_error = row(outbox_id)
+    assert status == "pending" and 29 < next_attempt_at - time.time() <= 30
+    assert "429" in last_error
+    # Повтор еще не наступил: следующее сообщение чата тоже ждет
+    assert outbox.claim_batch(10) == []
+
+    set_columns(outbox_id, status="sent")
+    [(failed_id, _, _, _, attempts, _)] = outbox.claim_batch(10)
+    outbox.sender._fail(failed_id, chat, attempts, telegram_error(403))
+    assert row(failed_id)[0] == "failed"
+
+def test_retry_delay_backoff():
+    error = RuntimeError("сеть недоступна")
+    for attempts, base in ((1, 2), (2, 4), (5, 32), (10, outbox.RETRY_MAX_DELAY)):
+        delay = outbox._retry_delay(error, attempts)
+        assert base * 0.8 <= delay <= base * 1.2
+    assert outbox._retry_delay(error, outbox.OUTBOX_MAX_ATTEMPTS) is None
+
+    # 429: ждем столько, сколько просит Telegram, без разброса
+    assert outbox._retry_delay(telegram_error(429, retry_after=17), 3) == 17.0
+    assert outbox._retry_delay(telegram_error(429, retry_after=17), outbox.OUTBOX_MAX_ATTEMPTS) is None
+    # Чат не найден или бот заблокирован - повторять бесполезно
+    assert outbox._retry_delay(telegram_error(403), 1) is None
+    assert outbox._retry_delay(telegram_error(400), 1) is None
+    # Прочие ошибки Telegram повторяются с обычной задержкой
+    assert 1.6 <= outbox._retry_delay(telegram_error(502), 1) <= 2.4
@@ -0,0 +1,111 @@
+"""
+Сверка с Lava (reconciliation.py) против локальной заглушки API Lava. Путь запроса контракта
+(LAVA_CONTRACT_PATH) по документации Lava не проверен: заглушка отвечает на путь по умолчанию.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import reconciliation
+from helpers import iso, new_user, subscribe
+
+class LavaStub(ThreadingHTTPServer):
+    """Отвечает на запросы контрактов: contract_id -> (код ответа, тело)"""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), LavaStubHandler)
+        self.contracts = {}
+        self.requests = []
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+class LavaStubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        prefix, _, contract_id = self.path.rpartition("/")
+        self.server.requests.append((self.path, self.headers.get("X-Api-Key")))
+        code, body = self.server.contracts.get(contract_id, (404, {}))
+        if prefix != "/api/v1/invoices":
+            code, body = 404, {}
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def lava(monkeypatch, backend):
+    stub = LavaStub()
+    thread = threading.Thread(target=stub.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(reconciliation, "LAVA_API_URL", stub.url)
+    monkeypatch.setattr(reconciliation, "LAVA_API_KEY", "test-key")
+    monkeypatch.setattr(reconciliation, "RECONCILE_RATE_PER_SECOND", 0)
+    monkeypatch.setattr(reconciliation, "storage", backend)
+    yield stub
+    stub.shutdown()
+    stub.server_close()
+
+def member(backend, end_days: float, response) -> tuple:
+    """Активный участник с датой окончания через end_days дней; Lava отвечает response на его контракт"""
+    user_id = new_user()
+    subscribe(backend, user_id, iso(end_days))
+    contract_id = backend.member_subscription(user_id)[3]
+    return user_id, contract_id, response
+
+def test_reconcile_against_stub(lava, backend):
+    paid_until = iso(29)
+    members = {
+        "extended_by_lava": member(backend, -1, (200, {"status": "subscription-active", "willExpireAt": paid_until})),
+        "extended_by_period": member(backend, -1, (200, {"status": "subscription-active"})),
+        "cancelled": member(backend, 1, (200, {"status": "subscription-cancelled"})),
+        "unchanged": member(backend, 1, (200, {"status": "subscription-active"})),
+        "lava_error": member(backend, -1, (500, {})),
+    }
+    ends = {name: backend.member_end_date(user_id) for name, (user_id, _, _) in members.items()}
+    for user_id, contract_id, response in members.values():
+        lava.contracts[contract_id] = response
+
+    stats = reconciliation.reconcile_expiring_members(lambda amount, currency, product_id: 30)
+
+    assert stats["extended"] == 2
+    assert stats["cancelled"] == 1
+    assert stats["errors"] >= 1
+    requested = {path.rpartition("/")[2] for path, _ in lava.requests}
+    assert {contract_id for _, contract_id, _ in members.values()} <= requested
+    assert {api_key for _, api_key in lava.requests} == {"test-key"}
+
+    def state(name):
+        user_id = members[name][0]
+        return backend.member_status(user_id), backend.member_end_date(user_id)
+
+    assert state("extended_by_lava") == ("active", paid_until)
+    status, end_date = state("extended_by_period")
+    assert status == "active" and end_date > iso(28)
+    assert state("cancelled") == ("cancelled", ends["cancelled"])
+    assert state("unchanged") == ("active", ends["unchanged"])
+    assert state("lava_error") == ("active", ends["lava_error"])
+
+    # Сверенные недавно пропускаются; ошибка Lava не записывается, и участник проверяется снова
+    lava.requests.clear()
+    reconciliation.reconcile_expiring_members(lambda amount, currency, product_id: 30)
+    requested = {path.rpartition("/")[2] for path, _ in lava.requests}
+    assert members["lava_error"][1] in requested
+    assert members["unchanged"][1] not in requested
+
+def test_dry_run_changes_nothing(lava, backend):
+    user_id, contract_id, response = member(backend, -1, (200, {"status": "subscription-active"}))
+    lava.contracts[contract_id] = response
+    end_date = backend.member_end_date(user_id)
+
+    stats = reconciliation.reconcile_expiring_members(lambda amount, currency, product_id: 30, dry_run=True)
+
+    assert stats["extended"] >= 1
+    assert backend.member_end_date(user_id) == end_date
@@ -0,0 +1,79 @@
+"""Пересчет подписок (replay.py): история из основной БД и архива сливается в порядке получения"""
+import json
+import sqlite3
+import time
+from datetime import timedelta
+
+import pytest
+
+import database
+import replay
+import subscriptions
+from helpers import iso, new_user, payment
+from reconciliation import parse_date
+from storage import SqliteStorage
+
+@pytest.fixture(autouse=True)
+def no_catalog(monkeypatch):
+    # Каталог Lava не запрашивается: период оплаты - MONTHLY (30 дней)
+    monkeypatch.setitem(subscriptions.catalog_cache, "failed_at", time.monotonic())
+
+def add_payment(user_id, event_type: str, received_days: float, archived: bool = False) -> dict:
+    row = payment(user_id, event_type)
+    row["received_at"] = iso(received_days)
+    storage = SqliteStorage()
+    row["id"] = storage.write(user_id, lambda conn: storage.insert_payment(conn, dict(row)))
+    if archived:
+        conn = database.connect_with_archive(database.shard_of(user_id))
+        try:
+            conn.execute("INSERT INTO archive.payments SELECT * FROM main.payments WHERE id = ?", (row["id"],))
+            conn.execute("DELETE FROM main.payments WHERE id = ?", (row["id"],))
+            conn.commit()
+        finally:
+            conn.close()
+    return row
+
+def replayed(user_id) -> tuple:
+    conn = database.connect_shard(database.shard_of(user_id), common=False)
+    try:
+        return conn.execute(
+            f"SELECT status, joined_at, subscription_end_date, last_payment_id FROM {replay.REPLAY_TABLE} WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+
+def test_build_folds_archive_and_main_in_received_order():
+    user_id = new_user()
+    # Первая оплата уже в архиве; без нее автопродление из основной БД не создало бы подписку
+    first = add_payment(user_id, "payment.success", -40, archived=True)
+    renewal = add_payment(user_id, "subscription.recurring.payment.success", -10)
+    other = new_user()
+    add_payment(other, "subscription.recurring.payment.success", -5)
+
+    replay.build_replay(batch_size=2)
+
+    status, joined_at, end_date, last_payment_id = replayed(user_id)
+    assert (status, joined_at, last_payment_id) == ("active", first["received_at"], renewal["id"])
+    assert parse_date(end_date) == parse_date(renewal["received_at"]) + timedelta(days=30)
+    assert replayed(other) is None
+
+    # Снимок пересчета хранится в app_settings основной БД
+    conn = sqlite3.connect(database.DB_PATH)
+    try:
+        snapshot = conn.execute(
+            "SELECT value FROM app_settings WHERE key = ?", (replay._snapshot_key(database.shard_of(user_id)),)
+        ).fetchone()
+    finally:
+        conn.close()
+    assert json.loads(snapshot[0])["snapshot_payment_id"] >= renewal["id"]
+
+def test_diff_reports_member_missing_from_live_table():
+    user_id = new_user()
+    add_payment(user_id, "payment.success", -1)
+    replay.build_replay()
+
+    report = replay.diff_replay(sample_size=10 ** 6)
+
+    kinds = {item["user_id"]: item["kind"] for item in report["sample"]}
+    assert kinds[user_id] == "missing"
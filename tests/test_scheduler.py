@@ -0,0 +1,132 @@
+"""Планировщик (scheduler.py): разбор cron, расчет следующего запуска и выполнение задач"""
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+
+import scheduler
+from scheduler import CronTrigger, IntervalTrigger, Scheduler, _parse_cron_field, parse_trigger
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+@pytest.mark.parametrize("field, expected", [
+    ("*", set(range(0, 60))),
+    ("*/15", {0, 15, 30, 45}),
+    ("5/15", {5, 20, 35, 50}),
+    ("10-12", {10, 11, 12}),
+    ("10-20/5", {10, 15, 20}),
+    ("1,3,58-59", {1, 3, 58, 59}),
+])
+def test_parse_cron_field(field, expected):
+    assert _parse_cron_field(field, 0, 59) == expected
+
+@pytest.mark.parametrize("field", ["60", "5-1", "*/0", "-1", "x"])
+def test_parse_cron_field_rejects_invalid(field):
+    with pytest.raises(ValueError):
+        _parse_cron_field(field, 0, 59)
+
+@pytest.mark.parametrize("expression, after, expected", [
+    # Следующий запуск строго позже заданного момента
+    ("30 2 * * *", utc(2026, 1, 1, 2, 30), utc(2026, 1, 2, 2, 30)),
+    ("30 2 * * *", utc(2026, 1, 1, 2, 29, 59), utc(2026, 1, 1, 2, 30)),
+    ("*/10 * * * *", utc(2026, 1, 1, 23, 55), utc(2026, 1, 2, 0, 0)),
+    # Переход через месяц и год
+    ("0 0 1 * *", utc(2026, 12, 15), utc(2027, 1, 1)),
+    # 7 и 0 - воскресенье (19.10.2026 - понедельник)
+    ("0 9 * * 7", utc(2026, 10, 19), utc(2026, 10, 25, 9, 0)),
+    ("0 9 * * 0", utc(2026, 10, 19), utc(2026, 10, 25, 9, 0)),
+    # День месяца и день недели ограничены оба: достаточно совпадения одного (пятница 23.10)
+    ("0 0 13 * 5", utc(2026, 10, 19), utc(2026, 10, 23)),
+    # 29 февраля - через два года
+    ("0 0 29 2 *", utc(2026, 3, 1), utc(2028, 2, 29)),
+])
+def test_cron_next_after(expression, after, expected):
+    assert CronTrigger(expression).next_after(after) == expected
+
+def test_cron_rejects_invalid_expressions():
+    with pytest.raises(ValueError):
+        CronTrigger("* * * *")
+    with pytest.raises(ValueError):
+        CronTrigger("0 0 31 2 *").next_after(utc(2026, 1, 1))
+
+def test_parse_trigger():
+    interval = parse_trigger(" 30 ")
+    assert isinstance(interval, IntervalTrigger) and interval.seconds == 30
+    assert interval.next_after(utc(2026, 1, 1)) == utc(2026, 1, 1, 0, 0, 30)
+    assert isinstance(parse_trigger("*/5 * * * *"), CronTrigger)
+    with pytest.raises(ValueError):
+        IntervalTrigger(0)
+
+def wait_until(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "условие не выполнено"
+        time.sleep(0.01)
+
+@pytest.fixture
+def jobs():
+    instance = Scheduler(workers=2)
+    yield instance
+    assert instance.stop(5)
+
+def job_name() -> str:
+    return f"test_{uuid.uuid4().hex[:8]}"
+
+def test_adaptive_job_reschedules_itself(jobs):
+    runs = []
+    # По расписанию - раз в час, но задача сама просит запустить ее снова через 10 мс
+    job = jobs.add_job(job_name(), lambda: runs.append(time.monotonic()) or 0.01, IntervalTrigger(3600),
+                       run_at_start=True, adaptive=True)
+    jobs.start()
+    wait_until(lambda: len(runs) >= 3)
+    assert job.last_status == "ok"
+
+def test_overlapping_run_is_skipped(jobs):
+    release = threading.Event()
+    active, overlaps = [], []
+
+    def slow():
+        overlaps.append(len(active))
+        active.append(1)
+        release.wait(5)
+        active.pop()
+
+    job = jobs.add_job(job_name(), slow, IntervalTrigger(0.02), run_at_start=True)
+    jobs.start()
+    wait_until(lambda: job.skipped >= 2)
+    release.set()
+    wait_until(lambda: job.runs >= 1)
+    assert overlaps[0] == 0 and max(overlaps) == 0
+
+def test_failed_job_is_recorded(jobs):
+    def broken():
+        raise RuntimeError("сбой задачи")
+
+    name = job_name()
+    job = jobs.add_job(name, broken, "3600", run_at_start=True)
+    jobs.start()
+    wait_until(lambda: job.runs >= 1 and not job.running)
+    assert (job.last_status, job.last_error, job.failures) == ("error", "сбой задачи", 1)
+    # Следующий запуск - по расписанию, через час
+    assert (job.next_run_at - datetime.now(timezone.utc)).total_seconds() > 3500
+    # Состояние для администратора записывается в scheduler_jobs после завершения запуска
+    def saved() -> list:
+        return [state for state in scheduler.get_job_states() if state["name"] == name and state["runs"]]
+    wait_until(saved)
+    state = saved()[0]
+    assert (state["last_status"], state["failures"], state["trigger"]) == ("error", 1, "каждые 3600 с")
+
+def test_lease_job_runs_in_lease_holder(jobs):
+    runs = []
+    jobs.add_job(job_name(), lambda: runs.append(1), IntervalTrigger(3600), run_at_start=True, lease=job_name())
+    jobs.start()
+    wait_until(lambda: runs)
+
+def test_duplicate_job_name_is_rejected(jobs):
+    name = job_name()
+    jobs.add_job(name, lambda: None, "0 * * * *")
+    with pytest.raises(ValueError):
+        jobs.add_job(name, lambda: None, "0 * * * *")
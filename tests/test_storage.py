@@ -0,0 +1,290 @@
+"""
+Одни и те же сценарии хранилища для SQLite и PostgreSQL: платеж, продление, отмена,
+истечение подписки, импорт, перенос сообщений outbox и агрегаты статистики.
+Тесты PostgreSQL выполняются, если задан DATABASE_URL:
+    DATABASE_URL=postgresql://postgres@localhost:5432/lava python -m pytest -q tests
+"""
+import time
+import zlib
+
+import pytest
+
+import admin_digest
+import outbox
+from database import acquire_connection, release_connection
+from helpers import iso, new_user, payment, subscribe
+from storage import IMPORT_COLUMNS
+
+def totals(storage) -> dict:
+    """Счетчики stats_summary без нулевых значений"""
+    summary = storage.stats_summary(30)
+    return {
+        "members": {status: count for status, count in summary["members"].items() if count},
+        "events": {event_type: count for event_type, count in summary["events"].items() if count},
+        "revenue": {currency: float(amounts["total"]) for currency, amounts in summary["revenue"].items()},
+        "transitions": {status: count for status, count in summary["transitions"].items() if count},
+    }
+
+def delta(before: dict, after: dict, key: str) -> dict:
+    names = set(before[key]) | set(after[key])
+    changes = {name: after[key].get(name, 0) - before[key].get(name, 0) for name in names}
+    return {name: change for name, change in changes.items() if change}
+
+def test_payment_success(backend):
+    user_id = new_user()
+    end_date = iso(30)
+    before = totals(backend)
+
+    body = payment(user_id)
+    def operation(conn):
+        payment_id = backend.insert_payment(conn, body)
+        backend.activate_member(conn, user_id, iso(), end_date, payment_id)
+        backend.clear_reminder(conn, user_id)
+        return payment_id
+    payment_id = backend.write(user_id, operation)
+
+    assert backend.find_payment(user_id, body["contract_id"], "payment.success") == payment_id
+    assert backend.find_payment(user_id, body["contract_id"], "payment.failed") is None
+    assert backend.member_status(user_id) == "active"
+    assert backend.member_end_date(user_id) == end_date
+    assert backend.member_subscription(user_id) == ("active", end_date, payment_id, body["contract_id"], None)
+    last = backend.last_paid_payment(user_id)
+    assert (last[0], last[3], last[4], last[9]) == (payment_id, "payment.success", body["contract_id"], end_date)
+    assert zlib.decompress(bytes(backend.payment_raw_data(payment_id))) == b'{"eventType": "payment.success"}'
+    assert backend.access_end_date(user_id) == end_date
+
+    after = totals(backend)
+    assert delta(before, after, "members") == {"active": 1}
+    assert delta(before, after, "events") == {"payment.success": 1}
+    assert delta(before, after, "revenue") == {"RUB": 500.0}
+    assert delta(before, after, "transitions") == {"active": 1}
+
+def test_renewal(backend):
+    user_id = new_user()
+    first_id = subscribe(backend, user_id)
+    contract_id = backend.member_subscription(user_id)[3]
+    backend.write(user_id, lambda conn: backend.set_reminder(conn, user_id, "3"))
+    before = totals(backend)
+
+    end_date = iso(60)
+    body = payment(user_id, "subscription.recurring.payment.success", 450.0, parent_contract_id=contract_id)
+    def operation(conn):
+        payment_id = backend.insert_payment(conn, body)
+        assert backend.renew_member(conn, user_id, end_date, payment_id) == 1
+        backend.clear_reminder(conn, user_id)
+        return payment_id
+    payment_id = backend.write(user_id, operation)
+
+    assert payment_id != first_id
+    assert backend.member_subscription(user_id) == ("active", end_date, payment_id, body["contract_id"], contract_id)
+    assert backend.last_paid_payment(user_id)[0] == payment_id
+    assert backend.write(user_id, lambda conn: backend.last_reminder(conn, user_id)) is None
+    assert backend.write(user_id, lambda conn: backend.renew_member(conn, new_user(), end_date, None)) == 0
+
+    after = totals(backend)
+    assert delta(before, after, "members") == {}
+    assert delta(before, after, "events") == {"subscription.recurring.payment.success": 1}
+    assert delta(before, after, "revenue") == {"RUB": 450.0}
+    assert delta(before, after, "transitions") == {}
+
+def test_cancel(backend):
+    user_id = new_user()
+    subscribe(backend, user_id)
+    before = totals(backend)
+
+    until = iso(10)
+    assert backend.write(user_id, lambda conn: backend.cancel_member_until(conn, user_id, until)) == 1
+    assert backend.write(user_id, lambda conn: backend.cancel_member_until(conn, user_id, iso(20))) == 0
+    assert backend.cancel_member(user_id) == 0
+    assert backend.member_status(user_id) == "cancelled"
+    assert backend.member_end_date(user_id) == until
+    # Отмененная подписка дает доступ до даты окончания
+    assert backend.access_end_date(user_id) == until
+
+    after = totals(backend)
+    assert delta(before, after, "members") == {"active": -1, "cancelled": 1}
+    assert delta(before, after, "transitions") == {"cancelled": 1}
+
+    other_id = new_user()
+    subscribe(backend, other_id)
+    assert backend.cancel_member(other_id) == 1
+    assert backend.cancel_member(other_id) == 0
+    assert backend.member_status(other_id) == "cancelled"
+
+def test_expiry(backend):
+    user_id = new_user()
+    end_date = iso(-1)
+    subscribe(backend, user_id, end_date)
+    assert (user_id, end_date, "active") in {row[:3] for row in backend.members_to_check()}
+
+    backend.write(user_id, lambda conn: backend.set_reminder(conn, user_id, "1"))
+    assert backend.write(user_id, lambda conn: backend.last_reminder(conn, user_id)) == "1"
+    before = totals(backend)
+
+    assert backend.write(user_id, lambda conn: backend.remove_member(conn, user_id)) == 1
+    assert backend.write(user_id, lambda conn: backend.remove_member(conn, user_id)) == 0
+    assert backend.member_status(user_id) == "removed"
+    assert backend.write(user_id, lambda conn: backend.last_reminder(conn, user_id)) is None
+    assert backend.access_end_date(user_id) is None
+    assert user_id not in {row[0] for row in backend.members_to_check()}
+    assert user_id not in {row[0] for row in backend.access_end_dates()}
+    assert delta(before, totals(backend), "members") == {"active": -1, "removed": 1}
+
+    # Новая оплата возвращает removed в active (вставка с ON CONFLICT DO UPDATE)
+    before = totals(backend)
+    subscribe(backend, user_id)
+    assert backend.member_status(user_id) == "active"
+    assert delta(before, totals(backend), "members") == {"active": 1, "removed": -1}
+
+def test_import(backend):
+    users = [new_user() for _ in range(3)]
+    rows = [tuple(payment(user_id)[column] for column in IMPORT_COLUMNS) for user_id in users]
+    partition = backend.partition_of(users[0])
+    before = totals(backend)
+
+    with backend.import_transaction(partition, dry_run=True) as conn:
+        assert backend.import_payments(conn, rows, dry_run=True) == [(0, None), (1, None), (2, None)]
+    assert backend.find_payment(users[0], rows[0][4], rows[0][0]) is None
+    assert totals(backend) == before
+
+    with backend.import_transaction(partition) as conn:
+        written = backend.import_payments(conn, rows)
+    assert [index for index, _ in written] == [0, 1, 2]
+    for index, payment_id in written:
+        assert backend.find_payment(users[index], rows[index][4], rows[index][0]) == payment_id
+
+    # Повторный импорт пропускает уже записанные платежи
+    extra_user = new_user()
+    extra = tuple(payment(extra_user, amount=300.0)[column] for column in IMPORT_COLUMNS)
+    with backend.import_transaction(partition) as conn:
+        again = backend.import_payments(conn, rows + [extra])
+    assert [index for index, _ in again] == [3]
+    assert backend.find_payment(extra_user, extra[4], extra[0]) == again[0][1]
+
+    after = totals(backend)
+    assert delta(before, after, "events") == {"payment.success": 4}
+    assert delta(before, after, "revenue") == {"RUB": 1800.0}
+
+    # Пересчет участников по импортированным платежам
+    payment_ids = dict(written)
+    member_rows = [
+        (user_id, "active", rows[index][8], iso(30), payment_ids[index]) for index, user_id in enumerate(users)
+    ]
+    with backend.import_transaction(partition) as conn:
+        assert backend.import_members(conn, users) == {}
+        backend.upsert_members(conn, member_rows)
+    with backend.import_transaction(partition) as conn:
+        current = backend.import_members(conn, users + [extra_user])
+    assert set(current) == set(users)
+    for user_id, status, joined_at, end_date, payment_id in member_rows:
+        assert current[user_id] == (status, joined_at, end_date, payment_id, joined_at)
+
+    # Повторная запись тех же участников обновляет строки и не меняет счетчики статусов
+    middle = totals(backend)
+    with backend.import_transaction(partition) as conn:
+        backend.upsert_members(conn, [(user_id, "cancelled") + row[2:] for row, user_id in zip(member_rows, users)])
+    assert delta(middle, totals(backend), "members") == {"active": -3, "cancelled": 3}
+    assert backend.known_user_ids() >= set(users) | {extra_user}
+
+def _main_db_rows(table: str, dedup_key: str) -> int:
+    conn = acquire_connection()
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM {table} WHERE dedup_key = ?", (dedup_key,)).fetchone()[0]
+    finally:
+        release_connection(conn)
+
+def test_relay(backend):
+    user_id = new_user()
+    message_key, event_key = f"test:{user_id}:message", f"test:{user_id}:event"
+
+    def operation(conn):
+        added = [
+            outbox.enqueue(user_id, "message", {"text": "Оплата получена"}, conn, message_key),
+            admin_digest.add_event("renewal", f"Продление {user_id}", conn, event_key),
+        ]
+        # Повтор с тем же dedup_key в той же транзакции не добавляет строк
+        added += [
+            outbox.enqueue(user_id, "message", {"text": "Оплата получена"}, conn, message_key),
+            admin_digest.add_event("renewal", f"Продление {user_id}", conn, event_key),
+        ]
+        return added
+    assert backend.write(user_id, operation) == [True, True, False, False]
+
+    deadline = time.monotonic() + 5
+    while _main_db_rows("telegram_outbox", message_key) == 0 and time.monotonic() < deadline:
+        backend.relay_staged()
+        time.sleep(0.05)
+    assert _main_db_rows("telegram_outbox", message_key) == 1
+    assert _main_db_rows("admin_events", event_key) == 1
+
+    # Повтор после переноса: строка снова попадает в промежуточную таблицу, но в основной БД
+    # остается одна (dedup_key)
+    backend.write(user_id, lambda conn: outbox.enqueue(user_id, "message", {"text": "Повтор"}, conn, message_key))
+    backend.relay_staged()
+    assert _main_db_rows("telegram_outbox", message_key) == 1
+
+    if backend.name == "postgres":
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            with backend.connection() as conn:
+                staged = conn.execute(
+                    "SELECT (SELECT COUNT(*) FROM telegram_outbox) + (SELECT COUNT(*) FROM admin_events)"
+                ).fetchone()[0]
+            if staged == 0:
+                break
+            backend.relay_staged()
+            time.sleep(0.05)
+        assert staged == 0
+
+def test_stats_match_rebuild(backend):
+    for action in ("active", "cancelled", "removed"):
+        user_id = new_user()
+        subscribe(backend, user_id)
+        if action == "cancelled":
+            backend.cancel_member(user_id)
+        elif action == "removed":
+            backend.write(user_id, lambda conn: backend.remove_member(conn, user_id))
+
+    before = totals(backend)
+    backend.rebuild_stats()
+    after = totals(backend)
+    assert after["members"] == before["members"]
+    assert after["events"] == before["events"]
+    assert after["revenue"] == pytest.approx(before["revenue"])
+
+def test_migrate_postgres(sqlite_storage, postgres_schema):
+    import migrate_postgres
+    from storage import PostgresStorage
+
+    user_id = new_user()
+    payment_id = subscribe(sqlite_storage, user_id)
+    sqlite_storage.write(user_id, lambda conn: sqlite_storage.set_reminder(conn, user_id, "3"))
+    sqlite_storage.add_link(f"t{user_id}", "https://example.com/pay", iso())
+
+    url = postgres_schema()
+    report = migrate_postgres.migrate(url)
+    for table, counts in report["tables"].items():
+        assert counts["source"] == counts["target"], table
+    assert report["tables"]["payments"]["target"] > 0
+    assert report["tables"]["channel_members"]["target"] > 0
+
+    postgres = PostgresStorage(url, min_size=1, max_size=1)
+    try:
+        expected, migrated = totals(sqlite_storage), totals(postgres)
+        assert migrated["members"] == expected["members"]
+        assert migrated["events"] == expected["events"]
+        assert migrated["transitions"] == expected["transitions"]
+        assert migrated["revenue"] == pytest.approx(expected["revenue"])
+
+        contract_id = sqlite_storage.member_subscription(user_id)[3]
+        assert postgres.find_payment(user_id, contract_id, "payment.success") == payment_id
+        assert postgres.member_subscription(user_id) == sqlite_storage.member_subscription(user_id)
+        assert bytes(postgres.payment_raw_data(payment_id)) == sqlite_storage.payment_raw_data(payment_id)
+        assert postgres.write(user_id, lambda conn: postgres.last_reminder(conn, user_id)) == "3"
+        assert postgres.resolve_link(f"t{user_id}") == "https://example.com/pay"
+        assert postgres.known_user_ids() == sqlite_storage.known_user_ids()
+
+        # Новые платежи получают номера выше перенесенных
+        assert subscribe(postgres, new_user()) > payment_id
+    finally:
+        postgres.close()
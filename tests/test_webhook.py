@@ -0,0 +1,66 @@
+"""Обработка вебхука Lava: уведомления дедуплицируются по пользователю, а не только по контракту"""
+import json
+import sqlite3
+import time
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+
+import database
+import main
+import subscriptions
+from helpers import new_user
+
+@pytest.fixture(autouse=True)
+def no_catalog(monkeypatch):
+    # Каталог Lava не запрашивается: периодичность определяется по умолчанию
+    monkeypatch.setitem(subscriptions.catalog_cache, "failed_at", time.monotonic())
+
+def webhook(user_id, contract_id: str) -> bytes:
+    return json.dumps({
+        "eventType": "payment.success",
+        "product": {"id": "test-product", "title": "Подписка"},
+        "buyer": {"email": f"{user_id}@t.me"},
+        "contractId": contract_id,
+        "amount": 500.0,
+        "currency": "RUB",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "status": "subscription-active",
+    }).encode()
+
+def outbox_keys(user_id) -> list:
+    conn = sqlite3.connect(database.DB_PATH)
+    try:
+        rows = conn.execute(
+            "SELECT dedup_key FROM telegram_outbox WHERE chat_id = ? ORDER BY id", (str(user_id),)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows]
+
+def process(body: bytes) -> dict:
+    return main.process_webhook(body, datetime.now(timezone.utc))
+
+def test_same_contract_for_two_users_notifies_both():
+    contract_id = str(uuid.uuid4())
+    first, second = new_user(), new_user()
+    process(webhook(first, contract_id))
+    process(webhook(second, contract_id))
+    assert outbox_keys(first)
+    assert len(outbox_keys(second)) == len(outbox_keys(first))
+
+def test_redelivered_webhook_is_not_notified_twice():
+    user_id = new_user()
+    body = webhook(user_id, str(uuid.uuid4()))
+    process(body)
+    sent = outbox_keys(user_id)
+    process(body)
+    assert outbox_keys(user_id) == sent
+
+def test_empty_contract_notifies_every_payment():
+    user_id = new_user()
+    process(webhook(user_id, ""))
+    sent = outbox_keys(user_id)
+    process(webhook(user_id, ""))
+    assert len(outbox_keys(user_id)) == 2 * len(sent)